@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+At-rest compression benchmark.
+
+Streams each payload kind through compress.Encoder into a file on --dir, for
+every codec, then decodes it back with send_decoded. Reports the stored
+ratio, encode/decode MB/s (of original bytes) and CPU seconds, next to the
+bytes saved on disk, so the CPU cost can be weighed against the I/O saved.
+"log" is repetitive text, "random" is incompressible (skipped by the probe).
+
+    python bench/bench_compress.py --size-mb 256 --dir /data
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "server"))
+
+from app import compress  # noqa: E402
+
+CHUNK = 1024 * 1024
+
+
+def _log_block(seed: int) -> bytes:
+    lines = [
+        f"2024-01-01T00:00:{i % 60:02d}Z INFO request id={(i + seed) * 7919 % 1000003} "
+        f"path=/api/v1/items/{(i * seed) % 977} status={200 if i % 13 else 500} ms={i % 250}\n"
+        for i in range(seed * 20000, (seed + 1) * 20000)
+    ]
+    return "".join(lines).encode()[:CHUNK]
+
+
+# Distinct blocks, more than any codec's window, so repeats cannot help.
+BLOCKS = 8
+PAYLOADS = {"log": _log_block, "random": lambda _seed: os.urandom(CHUNK)}
+
+
+class _Null:
+    def write(self, data) -> None:
+        pass
+
+
+def _timed(fn) -> tuple[float, float]:
+    wall, cpu = time.perf_counter(), time.process_time()
+    fn()
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+
+def run(codec: str, pool: list[bytes], blocks: int, out: Path) -> dict[str, float | str]:
+    result: dict[str, float | str] = {}
+
+    def encode() -> None:
+        with open(out, "wb") as f:
+            encoder = compress.Encoder(f, codec)
+            for i in range(blocks):
+                encoder.write(pool[i % BLOCKS])
+            encoder.finish()
+            os.fsync(f.fileno())
+        result["stored"] = encoder.codec
+
+    result["enc_wall"], result["enc_cpu"] = _timed(encode)
+    result["bytes"] = out.stat().st_size
+
+    def decode() -> None:
+        with open(out, "rb") as f:
+            if result["stored"] == compress.NONE:
+                while f.read(CHUNK):
+                    pass
+            else:
+                compress.send_decoded(f, _Null(), blocks * CHUNK, str(result["stored"]))
+
+    result["dec_wall"], result["dec_cpu"] = _timed(decode)
+    out.unlink()
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size-mb", type=int, default=128)
+    parser.add_argument("--dir", default=None, help="where to write (use the DATA_DIR filesystem)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        out = Path(tmp) / "out.bin"
+        for kind, make in PAYLOADS.items():
+            pool = [make(seed) for seed in range(BLOCKS)]
+            print(f"{kind}, {args.size_mb} MB")
+            for codec in compress.CODECS:
+                r = run(codec, pool, args.size_mb, out)
+                ratio = float(r["bytes"]) / (args.size_mb * CHUNK)
+                saved = args.size_mb - float(r["bytes"]) / CHUNK
+                print(
+                    f"  {codec:4s} -> {r['stored']:4s} ratio {ratio:5.3f}  "
+                    f"enc {args.size_mb / float(r['enc_wall']):7.0f} MB/s cpu {r['enc_cpu']:6.2f}s  "
+                    f"dec {args.size_mb / float(r['dec_wall']):7.0f} MB/s cpu {r['dec_cpu']:6.2f}s  "
+                    f"saved {saved:8.1f} MB"
+                )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Metadata backend latency benchmark.
+
+Times single-row insert_files, get_file_by_token and delete_expired calls,
+the way one scp session issues them, against each backend: SQLite in a temp
+directory on --dir (put it on the DATA_DIR filesystem), and Postgres when
+DB_HOST/DB_NAME/DB_USER/DB_PASSWORD point at a scratch database (its rows
+are truncated first). Reports p50/p99/max per operation in microseconds.
+
+    python bench/bench_db.py --ops 2000 --dir /data
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+from types import ModuleType
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "server"))
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+
+from app import db, db_postgres, db_sqlite  # noqa: E402
+
+
+def _percentiles(samples: list[float]) -> str:
+    samples.sort()
+    p50 = samples[len(samples) // 2] * 1e6
+    p99 = samples[min(len(samples) - 1, len(samples) * 99 // 100)] * 1e6
+    return f"p50 {p50:8.0f} us  p99 {p99:8.0f} us  max {samples[-1] * 1e6:8.0f} us"
+
+
+def _timed(fn, *args) -> float:
+    started = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - started
+
+
+def run(backend: ModuleType, ops: int) -> dict[str, list[float]]:
+    now = db.utcnow()
+    # Row i expires i microseconds after `now`, so each pass below takes one batch.
+    records = [
+        db.FileRecord(
+            token=f"tok{i:08d}",
+            sha512="0" * 128,
+            original_name="f.bin",
+            size_bytes=1024,
+            stored_path=f"/data/tok{i:08d}",
+            created_at=now,
+            expires_at=now + timedelta(microseconds=i),
+        )
+        for i in range(ops)
+    ]
+    results: dict[str, list[float]] = {"insert_files": [], "get_file_by_token": []}
+    backend.hold_connection()
+    for r in records:
+        results["insert_files"].append(_timed(backend.insert_files, [r]))
+    for r in records:
+        results["get_file_by_token"].append(_timed(backend.get_file_by_token, r.token))
+    # One small expiry pass at a time, as the cleaner does when woken per deadline.
+    expire = []
+    batch = 10
+    for i in range(batch, ops + 1, batch):
+        cutoff = now + timedelta(microseconds=i - 1)
+        expire.append(_timed(lambda: list(backend.delete_expired(cutoff, batch + 1))))
+    results[f"delete_expired ({batch})"] = expire
+    backend.release_connection()
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--dir", default=None, help="where the SQLite file goes")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        os.environ["DB_PATH"] = str(Path(tmp) / "files.db")
+        backends: list[tuple[str, ModuleType]] = [(db.SQLITE, db_sqlite)]
+        if os.environ.get("DB_HOST"):
+            backends.append((db.POSTGRES, db_postgres))
+        for name, backend in backends:
+            backend.init_db()
+            if backend is db_postgres:
+                with db_postgres.conn() as c:
+                    c.execute("TRUNCATE files, blobs, segments")
+            print(f"{name}, {args.ops} rows")
+            for op, samples in run(backend, args.ops).items():
+                print(f"  {op:24s} {_percentiles(samples)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
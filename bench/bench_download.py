@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Download copy-path benchmark.
+
+Streams one large file through each scp_send_one copy mode into a `cat`
+child that discards it, the way sshd drains the gateway's stdout, and
+reports throughput plus the gateway process's CPU time. "legacy" is the old
+read(1 MiB) + write loop.
+
+    python bench/bench_download.py --size-gb 4 --sink pipe
+    python bench/bench_download.py --size-gb 4 --sink socket --runs 3
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "server"))
+
+from app import zerocopy  # noqa: E402
+
+CHUNK = 1024 * 1024
+
+
+def _make_file(path: str, size: int) -> None:
+    block = os.urandom(CHUNK)
+    with open(path, "wb") as f:
+        for _ in range(size // CHUNK):
+            f.write(block)
+
+
+def _sink(kind: str) -> tuple[subprocess.Popen, int]:
+    # Returns the draining child and the fd the sender writes to.
+    if kind == "pipe":
+        r, w = os.pipe()
+    else:
+        r, w = socket.socketpair()
+        r, w = r.detach(), w.detach()
+    child = subprocess.Popen(["cat"], stdin=r, stdout=subprocess.DEVNULL)
+    os.close(r)
+    return child, w
+
+
+def _legacy(src, out) -> int:
+    sent = 0
+    while True:
+        chunk = src.read(CHUNK)
+        if not chunk:
+            break
+        out.write(chunk)
+        sent += len(chunk)
+    return sent
+
+
+def run(path: str, size: int, mode: str, sink: str) -> tuple[float, float]:
+    child, w = _sink(sink)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    with open(path, "rb") as src, os.fdopen(w, "wb") as out:
+        if mode == "legacy":
+            sent = _legacy(src, out)
+        else:
+            sent, used = zerocopy.send_file(src, out, size, mode)
+            if used != mode:
+                raise RuntimeError(f"{mode} unavailable for a {sink} (fell back to {used})")
+    child.wait()
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    if sent != size:
+        raise RuntimeError(f"sent {sent} of {size} bytes")
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    return elapsed, cpu
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size-gb", type=float, default=2.0)
+    parser.add_argument("--sink", choices=("pipe", "socket"), default="pipe")
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--dir", default=None, help="where to create the test file")
+    args = parser.parse_args()
+
+    size = int(args.size_gb * 1024**3) // CHUNK * CHUNK
+    modes = ["legacy", zerocopy.COPY, zerocopy.SENDFILE]
+    if args.sink == "pipe":
+        modes.append(zerocopy.SPLICE)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        path = os.path.join(tmp, "payload.bin")
+        _make_file(path, size)
+        print(f"{size / 1024**3:.2f} GiB into a {args.sink}, best of {args.runs}")
+        for mode in modes:
+            best = min(run(path, size, mode, args.sink) for _ in range(args.runs))
+            elapsed, cpu = best
+            print(
+                f"  {mode:8s} {size / elapsed / 1024**2:8.0f} MiB/s  "
+                f"wall={elapsed:6.2f}s  gateway cpu={cpu:6.2f}s"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+DATA_DIR layout benchmark.
+
+Creates --files small files the way the gateway does (write a .tmp, rename
+into place), then unlinks them the way the cleaner does, once per layout
+depth, and reports create+rename and unlink rates. Depth 0 is the old flat
+directory; 2 is the default sharded layout.
+
+    python bench/bench_layout.py --files 1000000 --depths 0 2 --dir /data/bench
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import secrets
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "server"))
+
+from app import storage  # noqa: E402
+
+
+def run(base: Path, tokens: list[str], depth: int) -> tuple[float, float]:
+    data_dir = base / f"depth{depth}"
+    data_dir.mkdir()
+    storage._MADE_DIRS.clear()
+    payload = b"x" * 64
+
+    start = time.perf_counter()
+    for token in tokens:
+        final = storage.token_path(data_dir, token, depth)
+        storage.ensure_parent(final)
+        tmp = final.parent / f".{token}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, final)
+    created = time.perf_counter() - start
+
+    # Same shape as the cleaner: unlinkat relative to an open DATA_DIR fd.
+    dir_fd = os.open(data_dir, os.O_RDONLY | os.O_DIRECTORY)
+    prefix = f"{data_dir}{os.sep}"
+    start = time.perf_counter()
+    try:
+        for token in tokens:
+            path = str(storage.token_path(data_dir, token, depth))
+            os.unlink(path[len(prefix) :], dir_fd=dir_fd)
+    finally:
+        os.close(dir_fd)
+    removed = time.perf_counter() - start
+
+    shutil.rmtree(data_dir)
+    return created, removed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--files", type=int, default=1_000_000)
+    parser.add_argument("--depths", type=int, nargs="+", default=[0, 2])
+    parser.add_argument("--dir", default=None, help="scratch parent dir (use the DATA_DIR filesystem)")
+    args = parser.parse_args()
+
+    tokens = [secrets.token_urlsafe(32) for _ in range(args.files)]
+    with tempfile.TemporaryDirectory(dir=args.dir) as base:
+        print(f"{args.files} files under {base}")
+        for depth in args.depths:
+            created, removed = run(Path(base), tokens, depth)
+            print(
+                f"  depth={depth}: create+rename {args.files / created:9.0f}/s "
+                f"({created:.1f}s)  unlink {args.files / removed:9.0f}/s ({removed:.1f}s)"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Logging overhead benchmark.
+
+Times one logutil call in the shapes the hot paths use: a DEBUG line with
+the level at INFO (disabled), and enabled lines written to a file sink. The
+f-string rows show what a call cost before arguments were deferred: the
+message is built even when the line is dropped.
+
+    python bench/bench_logutil.py --calls 200000
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "server"))
+
+from app import logutil  # noqa: E402
+
+
+def _reset(level: str, sink: str) -> None:
+    os.environ["LOG_LEVEL"] = level
+    os.environ["LOG_SINK"] = sink
+    logutil._CURRENT_LEVEL = None
+
+
+def per_call_ns(fn, calls: int) -> float:
+    token, size = "a" * 43, 123456
+    start = time.perf_counter_ns()
+    for _ in range(calls):
+        fn(token, size)
+    elapsed = time.perf_counter_ns() - start
+    logutil.flush()
+    return elapsed / calls
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=200_000)
+    args = parser.parse_args()
+
+    cases = {
+        "debug %-args": lambda t, n: logutil.debug("lookup token=%r size=%d", t, n),
+        "debug f-string": lambda t, n: logutil.debug(f"lookup token={t!r} size={n}"),
+        "enabled() guard": lambda t, n: logutil.enabled("DEBUG"),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        sink = str(Path(tmp) / "bench.log")
+        rows = []
+        _reset("INFO", sink)
+        for name, fn in cases.items():
+            rows.append((f"{name} (disabled)", per_call_ns(fn, args.calls)))
+        _reset("DEBUG", sink)
+        for name in ("debug %-args", "debug f-string"):
+            rows.append((f"{name} (to file)", per_call_ns(cases[name], args.calls)))
+        size = os.path.getsize(sink)
+
+    print(f"per call ({args.calls} calls):")
+    for name, ns in rows:
+        print(f"  {name:28} {ns:8.1f}ns")
+    print(f"  wrote {size / 1e6:.1f}MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+scp (legacy protocol) vs SFTP transfer benchmark.
+
+Runs the real OpenSSH `scp` client in both modes (-O legacy, -s SFTP) for an
+upload and a download of one file and reports MB/s per round-trip time.
+
+By default scp is pointed (-S) at this script acting as ssh: it starts the
+gateway locally, with a JSON file standing in for the files table, and
+relays stdin/stdout with --rtt-ms of added latency, split evenly between the
+two directions. With --ssh-port the transfers go through a real sshd
+instead (e.g. the compose stack on localhost:2222, keys in ssh-agent).
+
+    python bench/bench_sftp.py --size-mb 64 --rtt-ms 0 20 50
+    python bench/bench_sftp.py --size-mb 256 --ssh-port 2222
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+SERVER = ROOT / "server"
+HOSTS = ("put", "get")
+
+
+def serve(mode: str) -> None:
+    # Gateway session with the DB replaced by DATA_DIR/index.json.
+    sys.path.insert(0, str(SERVER))
+    from app import db, gateway, sftp, store
+
+    index = Path(os.environ["DATA_DIR"]) / "index.json"
+
+    def insert_files(records):
+        rows = json.loads(index.read_text()) if index.exists() else {}
+        for r in records:
+            row = r._asdict()
+            del row["created_at"], row["expires_at"]
+            rows[r.token] = row
+        index.write_text(json.dumps(rows))
+        return []
+
+    def get_file_by_token(token):
+        row = json.loads(index.read_text()).get(token)
+        if row is None:
+            return None
+        now = db.utcnow()
+        return db.FileRecord(created_at=now, expires_at=now.replace(year=now.year + 1), **row)
+
+    store.insert_files = insert_files
+    gateway.get_file_by_token = sftp.get_file_by_token = get_file_by_token
+    sys.argv = ["gateway.py", mode]
+    gateway.main()
+
+
+def _relay(src: int, dst: int, delay: float) -> None:
+    # Forwards src to dst, delivering each chunk `delay` seconds after it was read.
+    pending: queue.SimpleQueue = queue.SimpleQueue()
+
+    def reader() -> None:
+        while True:
+            data = os.read(src, 256 * 1024)
+            pending.put((time.monotonic() + delay, data))
+            if not data:
+                return
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        due, data = pending.get()
+        wait = due - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        if not data:
+            os.close(dst)
+            return
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst, view) :]
+
+
+def ssh_shim(argv: list[str]) -> int:
+    # Invoked by scp as: <shim> [ssh options] [-s] [--] host command...
+    host_index = next(i for i, a in enumerate(argv) if a in HOSTS)
+    host, command = argv[host_index], " ".join(argv[host_index + 1 :])
+    env = dict(os.environ)
+    env["SSH_ORIGINAL_COMMAND"] = "internal-sftp" if "-s" in argv[:host_index] else command
+    child = subprocess.Popen(
+        [sys.executable, __file__, "--serve", host],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        env=env,
+    )
+    delay = float(os.environ.get("BENCH_RTT_MS", "0")) / 2000
+    up = threading.Thread(target=_relay, args=(0, child.stdin.fileno(), delay), daemon=True)
+    up.start()
+    _relay(child.stdout.fileno(), 1, delay)
+    return child.wait()
+
+
+def _scp(args: list[str], env: dict[str, str], ssh: list[str]) -> tuple[float, str]:
+    start = time.perf_counter()
+    proc = subprocess.run(
+        ["scp", "-q", *ssh, *args], env=env, capture_output=True, text=True, check=True
+    )
+    return time.perf_counter() - start, proc.stderr
+
+
+def _token(stderr: str) -> str:
+    return next(line[6:] for line in stderr.splitlines() if line.startswith("token="))
+
+
+def main() -> int:
+    if len(sys.argv) > 2 and sys.argv[1] == "--serve":
+        serve(sys.argv[2])
+        return 0
+    if os.environ.get("BENCH_SSH_SHIM") == "1":
+        return ssh_shim(sys.argv[1:])
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--rtt-ms", type=float, nargs="+", default=[0.0, 20.0, 50.0])
+    parser.add_argument("--ssh-port", type=int, default=None, help="use a real sshd on localhost")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        payload = Path(tmp) / "payload.bin"
+        payload.write_bytes(os.urandom(args.size_mb * 1024 * 1024))
+        data_dir = Path(tmp) / "data"
+        data_dir.mkdir()
+        env = dict(os.environ, DATA_DIR=str(data_dir), TTL_DAYS="1", LOG_LEVEL="ERROR")
+        env["LOG_SINK"] = os.devnull
+        if args.ssh_port is None:
+            shim = Path(tmp) / "ssh"
+            shim.write_text(f"#!/bin/sh\nBENCH_SSH_SHIM=1 exec {sys.executable} {__file__} \"$@\"\n")
+            shim.chmod(0o755)
+            ssh = ["-S", str(shim)]
+            rtts = args.rtt_ms
+            user = "{}"
+        else:
+            ssh = ["-P", str(args.ssh_port), "-o", "StrictHostKeyChecking=no"]
+            rtts = [None]
+            user = "{}@localhost"
+
+        print(f"{args.size_mb} MB, OpenSSH scp, MB/s")
+        for rtt in rtts:
+            if rtt is not None:
+                env["BENCH_RTT_MS"] = str(rtt)
+            label = "sshd" if rtt is None else f"rtt={rtt:g}ms"
+            for name, flag in (("scp", "-O"), ("sftp", "-s")):
+                put_s, stderr = _scp([flag, str(payload), user.format("put") + ":"], env, ssh)
+                out = Path(tmp) / "out.bin"
+                get_s, _ = _scp([flag, user.format("get") + ":" + _token(stderr), str(out)], env, ssh)
+                assert out.stat().st_size == payload.stat().st_size
+                out.unlink()
+                print(
+                    f"  {label:10s} {name:4s}  put {args.size_mb / put_s:7.1f}  "
+                    f"get {args.size_mb / get_s:7.1f}"
+                )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Gateway startup benchmark.
+
+Measures wall time from exec of `python -m app.gateway put` until the first
+scp ACK byte (the initial _send_ok()) arrives on stdout, and prints an
+`-X importtime` breakdown of the gateway's direct imports. No database is
+needed: the session sends no C records, so the DB is never touched.
+
+Wall-clock budgets are too noisy for shared CI runners, so the test suite
+gates what this measures instead: test_gateway_import_defers_heavy_modules
+fails when a module kept off the path to the first ACK (socket, hashlib,
+psycopg, app.upload...) is imported by app.gateway again. Run this with
+--budget-ms on a quiet machine when changing the gateway's imports.
+
+    python bench/bench_startup.py --runs 50 --budget-ms 60
+    python bench/bench_startup.py --cold   # no usable __pycache__
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+SERVER = ROOT / "server"
+
+
+def _env(data_dir: str, pycache: str | None) -> dict[str, str]:
+    env = dict(os.environ)
+    env.update(
+        {
+            "PYTHONPATH": str(SERVER),
+            "DATA_DIR": data_dir,
+            "TTL_DAYS": "1",
+            "LOG_LEVEL": "ERROR",
+            "LOG_SINK": os.devnull,
+            "SSH_ORIGINAL_COMMAND": "scp -t /",
+        }
+    )
+    if pycache is not None:
+        # Emulate put/get users that cannot write __pycache__ under /srv/app.
+        env["PYTHONPYCACHEPREFIX"] = pycache
+        env["PYTHONDONTWRITEBYTECODE"] = "1"
+    return env
+
+
+def time_to_first_ack(env: dict[str, str]) -> float:
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "app.gateway", "put"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env=env,
+    )
+    ack = proc.stdout.read(1)
+    elapsed = time.perf_counter() - start
+    proc.stdin.close()
+    proc.stdout.close()
+    proc.wait()
+    if ack != b"\x00":
+        raise RuntimeError(f"gateway did not ACK: {ack!r} (exit {proc.returncode})")
+    return elapsed
+
+
+def import_breakdown(env: dict[str, str], top: int) -> list[tuple[int, int, str]]:
+    # Direct imports of app.gateway, sorted by cumulative microseconds.
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.gateway"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth <= 1:
+            rows.append((int(cumulative_us), int(self_us), name.strip()))
+    rows.sort(reverse=True)
+    return rows[:top]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=30)
+    parser.add_argument("--budget-ms", type=float, default=None)
+    parser.add_argument("--cold", action="store_true", help="ignore cached bytecode")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir, tempfile.TemporaryDirectory() as pycache:
+        samples = []
+        for _ in range(args.runs):
+            # A fresh, unwritable-in-effect cache dir per run forces recompilation.
+            prefix = tempfile.mkdtemp(dir=pycache) if args.cold else None
+            samples.append(time_to_first_ack(_env(data_dir, prefix)) * 1000)
+        breakdown = import_breakdown(_env(data_dir, None), args.top)
+
+    samples.sort()
+    median = statistics.median(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"exec -> first ACK ({args.runs} runs{', cold' if args.cold else ''}):")
+    print(f"  min={samples[0]:.1f}ms median={median:.1f}ms p95={p95:.1f}ms")
+    print("import time (direct imports of app.gateway, cumulative):")
+    for cumulative_us, self_us, name in breakdown:
+        print(f"  {cumulative_us / 1000:7.2f}ms  (self {self_us / 1000:5.2f}ms)  {name}")
+
+    if args.budget_ms is not None and median > args.budget_ms:
+        print(f"FAIL: median {median:.1f}ms exceeds budget {args.budget_ms:.1f}ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
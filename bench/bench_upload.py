@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Upload engine benchmark.
+
+Feeds a payload through a pipe from a `cat` child, the way sshd feeds the
+gateway's stdin, into a file on --dir, once with the old serial loop
+(read 1 MiB, write, hash) and once with upload.receive, and reports MB/s.
+
+    python bench/bench_upload.py --size-mb 2048 --runs 3 --dir /data
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "server"))
+
+from app import upload  # noqa: E402
+
+CHUNK = 1024 * 1024
+
+
+def legacy(src, dst, size: int) -> str:
+    # The loop scp_receive_one used before the upload engine.
+    h = hashlib.sha512()
+    remaining = size
+    while remaining > 0:
+        chunk = src.read(min(CHUNK, remaining))
+        if not chunk:
+            raise EOFError("unexpected EOF while reading file data")
+        remaining -= len(chunk)
+        dst.write(chunk)
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def run(engine, payload: Path, out: Path, size: int) -> tuple[float, str]:
+    child = subprocess.Popen(["cat", str(payload)], stdout=subprocess.PIPE)
+    start = time.perf_counter()
+    with open(out, "wb") as dst:
+        digest = engine(child.stdout, dst, size)
+    elapsed = time.perf_counter() - start
+    child.stdout.close()
+    child.wait()
+    out.unlink()
+    return elapsed, digest
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--dir", default=None, help="where to write (use the DATA_DIR filesystem)")
+    args = parser.parse_args()
+
+    size = args.size_mb * CHUNK
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        payload = Path(tmp) / "payload.bin"
+        block = os.urandom(CHUNK)
+        with open(payload, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        results = {}
+        for name, engine in (("serial", legacy), ("pipelined", upload.receive)):
+            samples = [run(engine, payload, Path(tmp) / "out.bin", size) for _ in range(args.runs)]
+            best = min(elapsed for elapsed, _ in samples)
+            results[name] = args.size_mb / best
+            digests = {digest for _, digest in samples}
+            assert len(digests) == 1, digests
+            print(f"  {name:9s} {results[name]:8.0f} MB/s  (best of {args.runs}, {best:.2f}s)")
+
+    gain = results["pipelined"] / results["serial"] - 1
+    print(f"pipelined vs serial: {gain * 100:+.1f}%")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
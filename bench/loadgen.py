@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Hermetic scp load generator.
+
+Runs gateway.scp_receive_one / scp_send_one in-process, the way a daemon
+worker does, with a client thread speaking scp on the other end of two OS
+pipes in place of sshd and the scp client. --concurrency worker processes
+share --sessions between them: each is a put session of --files files with
+sizes drawn from --sizes, followed (with --get) by one get session per
+uploaded token. The files table is SQLite in the run's temp directory
+(--db sqlite), a dict in each worker (--db fake), or the Postgres that
+DB_HOST/DB_NAME/DB_USER/DB_PASSWORD point at (--db postgres). Everything
+else (DATA_CODEC, DATA_SEGMENT_MAX_KB, SHAPE_*, GATEWAY_MAX_*...) comes from
+the environment, as for a real session. Reports, for puts and gets apart,
+MB/s and sessions/s from the first such session starting to the last one
+ending, and p50/p99 session latency.
+
+--sizes is SIZE[:WEIGHT],... drawn by weight, or lognormal:MEDIAN:SIGMA.
+
+    python bench/loadgen.py --sessions 200 --concurrency 8 --files 4 --sizes 4K:70,1M:25,32M:5
+    python bench/loadgen.py --sizes lognormal:256K:1.5 --get --db fake --dir /data
+"""
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "server"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+CHUNK = 1024 * 1024
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+# Payload bytes; each file starts with 16 random ones so dedup sees distinct files.
+BLOCK = memoryview(os.urandom(CHUNK))
+
+Sampler = Callable[[random.Random], int]
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().removesuffix("B")
+    unit = UNITS.get(text[-1:], 1)
+    return int(float(text.rstrip("KMG")) * unit)
+
+
+def size_sampler(spec: str) -> Sampler:
+    if spec.startswith("lognormal:"):
+        _, median, sigma = spec.split(":")
+        mu, s = math.log(parse_size(median)), float(sigma)
+        return lambda rng: max(1, int(rng.lognormvariate(mu, s)))
+    sizes, weights = [], []
+    for part in spec.split(","):
+        size, _, weight = part.partition(":")
+        sizes.append(parse_size(size))
+        weights.append(float(weight or 1))
+    return lambda rng: rng.choices(sizes, weights)[0]
+
+
+def _write_all(fd: int, data: bytes | memoryview) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def _expect_ok(rf) -> None:
+    ack = rf.read(1)
+    if ack != b"\0":
+        raise RuntimeError(f"gateway refused: {(ack + rf.readline()).decode(errors='replace')!r}")
+
+
+def put_client(w: int, rf, sizes: list[int]) -> None:
+    # scp -t's peer: the local scp sending files.
+    _expect_ok(rf)
+    for i, size in enumerate(sizes):
+        _write_all(w, f"C0644 {size} f{i}.bin\n".encode())
+        _expect_ok(rf)
+        head = os.urandom(min(16, size))
+        _write_all(w, head)
+        left = size - len(head)
+        while left:
+            n = min(left, CHUNK)
+            _write_all(w, BLOCK[:n])
+            left -= n
+        _write_all(w, b"\0")
+        _expect_ok(rf)
+
+
+def get_client(w: int, rf, size: int) -> None:
+    # scp -f's peer: the local scp receiving one file, discarded.
+    _write_all(w, b"\0")
+    header = rf.readline()
+    if not header.startswith(b"C"):
+        raise RuntimeError(f"unexpected record: {header!r}")
+    _write_all(w, b"\0")
+    buf = memoryview(bytearray(CHUNK))
+    left = size
+    while left:
+        n = rf.readinto(buf[: min(left, CHUNK)])
+        if not n:
+            raise EOFError(f"short download, {left} bytes missing")
+        left -= n
+    _expect_ok(rf)
+    _write_all(w, b"\0")
+
+
+def session(serve: Callable[[], object], client: Callable, arg) -> object:
+    """
+    Runs serve() as the gateway with its stdio on pipes to client(w, rf, arg)
+    in a thread; returns what serve() returned.
+    """
+    to_gw_r, to_gw_w = os.pipe()
+    from_gw_r, from_gw_w = os.pipe()
+    saved = (sys.stdin, sys.stdout, sys.stderr)
+    sys.stdin, sys.stdout = open(to_gw_r, "r"), open(from_gw_w, "w")
+    sys.stderr = io.StringIO()
+    failed: list[BaseException] = []
+
+    def run() -> None:
+        try:
+            with open(from_gw_r, "rb") as rf:
+                client(to_gw_w, rf, arg)
+        except BaseException as exc:
+            failed.append(exc)
+        finally:
+            # EOF on the gateway's stdin ends a put session.
+            os.close(to_gw_w)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    try:
+        result = serve()
+    except SystemExit:
+        raise RuntimeError(f"gateway exited: {sys.stderr.getvalue().strip()!r}") from None
+    finally:
+        # Unblocks a client still waiting on the gateway.
+        sys.stdin.close()
+        sys.stdout.close()
+        thread.join()
+        sys.stdin, sys.stdout, sys.stderr = saved
+    if failed:
+        raise failed[0]
+    return result
+
+
+def _use_fake_db() -> None:
+    from app import gateway, store
+
+    rows = {}
+
+    def insert_files(records):
+        rows.update((r.token, r) for r in records)
+        return []
+
+    store.insert_files = insert_files
+    gateway.get_file_by_token = rows.get
+
+
+def worker(args: argparse.Namespace, index: int, out: int) -> None:
+    # Sessions index, index + concurrency, ...; samples go to `out` as JSON.
+    from app import admission, gateway
+
+    if args.db == "fake":
+        _use_fake_db()
+    conf = gateway.Config.from_env()
+    sampler = size_sampler(args.sizes)
+    rng = random.Random(f"{args.seed}:{index}")
+    samples = []
+
+    def timed(kind: str, mode: str, serve, client, arg, size: int):
+        started = time.monotonic()
+        sample = {"kind": kind, "start": started, "bytes": size, "error": None}
+        result = None
+        try:
+            with admission.admit(conf.admission, conf.data_dir, mode):
+                result = session(serve, client, arg)
+        except Exception as exc:
+            sample["error"] = repr(exc)
+        sample["seconds"] = time.monotonic() - sample["start"]
+        samples.append(sample)
+        return result
+
+    for _ in range(index, args.sessions, args.concurrency):
+        sizes = [sampler(rng) for _ in range(args.files)]
+        receipts = timed(
+            "put", "put", lambda: gateway.scp_receive_one(conf), put_client, sizes, sum(sizes)
+        )
+        if args.get:
+            for r in receipts or ():
+                token, size = r["token"], r["size_bytes"]
+                serve = lambda: gateway.scp_send_one(conf, token)  # noqa: E731
+                timed("get", "get", serve, get_client, size, size)
+    with os.fdopen(out, "w") as f:
+        json.dump(samples, f)
+
+
+def _percentile(values: list[float], q: int) -> float:
+    return values[min(len(values) - 1, len(values) * q // 100)]
+
+
+def _wall(samples: list[dict]) -> float:
+    # From the first of these sessions starting to the last one ending.
+    start = min(s["start"] for s in samples)
+    return max(s["start"] + s["seconds"] for s in samples) - start
+
+
+def report(samples: list[dict]) -> None:
+    for kind in ("put", "get"):
+        rows = [s for s in samples if s["kind"] == kind]
+        if not rows:
+            continue
+        # Rates over this kind's own window, not the whole run's.
+        wall = _wall(rows)
+        ok = [s for s in rows if s["error"] is None]
+        latency = sorted(s["seconds"] for s in ok) or [0.0]
+        size = sum(s["bytes"] for s in ok)
+        print(
+            f"  {kind}  {len(ok):6d} sessions {len(rows) - len(ok):4d} failed  "
+            f"{size / wall / 1e6:8.1f} MB/s  {len(ok) / wall:8.1f} sessions/s  "
+            f"p50 {_percentile(latency, 50) * 1e3:8.1f}ms  "
+            f"p99 {_percentile(latency, 99) * 1e3:8.1f}ms"
+        )
+        errors = [s["error"] for s in rows if s["error"]]
+        if errors:
+            print(f"       first error: {errors[0]}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sessions", type=int, default=100, help="put sessions in all")
+    parser.add_argument("--concurrency", type=int, default=4, help="worker processes")
+    parser.add_argument("--files", type=int, default=1, help="files per put session")
+    parser.add_argument("--sizes", default="64K:60,1M:30,16M:10")
+    parser.add_argument("--get", action="store_true", help="download every uploaded file")
+    parser.add_argument("--db", choices=("sqlite", "fake", "postgres"), default="sqlite")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dir", default=None, help="where DATA_DIR goes (use the real filesystem)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        os.environ["DATA_DIR"] = str(Path(tmp) / "data")
+        if args.db == "sqlite":
+            os.environ["DB_BACKEND"] = "sqlite"
+            os.environ["DB_PATH"] = str(Path(tmp) / "files.db")
+        elif args.db == "postgres":
+            os.environ["DB_BACKEND"] = "postgres"
+        # app.db picks the backend from DB_BACKEND on each call.
+        from app import db
+
+        if args.db != "fake":
+            db.init_db()
+            db.release_connection()
+
+        pipes, pids = [], []
+        for index in range(args.concurrency):
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(r)
+                status = 0
+                try:
+                    worker(args, index, w)
+                except BaseException:
+                    import traceback
+
+                    traceback.print_exc()
+                    status = 1
+                os._exit(status)
+            os.close(w)
+            pipes.append(r)
+            pids.append(pid)
+
+        samples: list[dict] = []
+        for r in pipes:
+            with os.fdopen(r) as f:
+                samples.extend(json.loads(f.read() or "[]"))
+        crashed = sum(os.waitpid(pid, 0)[1] != 0 for pid in pids)
+
+    if not samples:
+        print("no sessions ran", file=sys.stderr)
+        return 1
+    wall = _wall(samples)
+    print(
+        f"{args.sessions} put sessions x {args.files} files ({args.sizes}), "
+        f"concurrency {args.concurrency}, db {args.db}, {wall:.2f}s"
+    )
+    report(samples)
+    if crashed:
+        print(f"  {crashed} workers crashed", file=sys.stderr)
+    return 1 if crashed or any(s["error"] for s in samples) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Gateway hot-path microbenchmarks with a regression check.
+
+Times the per-record and per-byte paths of a session: gateway._read_exact
+and _read_line on stdin fed through a pipe by a `cat` child (as sshd feeds
+it), _parse_c_record, upload.receive into a file and the download copy
+(zerocopy.send_file) into a pipe drained by `cat`, for payloads from
+--sizes, and logutil.log with the line dropped and written to a file.
+Small payloads are sent back to back, --volume-mb in all, as in a
+many-file session. Each case reports the median of --runs as a rate
+(higher is better), and the spread of the runs around it.
+
+--save writes the results to --baseline (a JSON file). Without it the results
+are compared with the baseline and the run fails if any case is slower by more
+than its tolerance: TOLERANCES for cases that move bulk data through pipes and
+the page cache, --tolerance for the rest, or --tolerance-for NAME=FRACTION.
+
+Rates are specific to the machine, so no baseline is committed. In CI, record
+one from the target branch and check the change against it on the same
+runner, in the same job:
+
+    git worktree add /tmp/base origin/main
+    python /tmp/base/bench/microbench.py --save --baseline /tmp/microbench.json
+    python bench/microbench.py --baseline /tmp/microbench.json
+
+    python bench/microbench.py --sizes 1K 1M 64M 1G --tolerance 0.25
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "server"))
+os.environ["LOG_LEVEL"] = "WARNING"
+
+from app import gateway, logutil, upload, zerocopy  # noqa: E402
+
+CHUNK = 1024 * 1024
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+RECORD = b"C0644 1048576 file-000123.bin\n"
+# Allowed slowdown for cases whose time is mostly pipes, cat and the page
+# cache, which vary more from run to run than the pure-Python ones.
+TOLERANCES = {"read_exact 64K": 0.25, "receive": 0.25, "send": 0.25, "log to file": 0.25}
+
+# Returns (units of work done, seconds taken).
+Case = Callable[[Path], tuple[float, float]]
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().removesuffix("B")
+    return int(float(text.rstrip("KMG")) * UNITS.get(text[-1:], 1))
+
+
+def _label(size: int) -> str:
+    for suffix, unit in (("G", UNITS["G"]), ("M", UNITS["M"]), ("K", UNITS["K"])):
+        if size >= unit and size % unit == 0:
+            return f"{size // unit}{suffix}"
+    return f"{size}B"
+
+
+def _payload(tmp: Path, size: int, content: bytes | None = None) -> Path:
+    # Written once per run; `content` repeated, or random 1 MiB blocks.
+    path = tmp / f"payload-{size}-{len(content or b'')}"
+    if not path.exists():
+        block = (content or b"") * (CHUNK // len(content)) if content else os.urandom(CHUNK)
+        with open(path, "wb") as f:
+            left = size
+            while left:
+                left -= f.write(block[: min(left, len(block))])
+    return path
+
+
+@contextmanager
+def _cat(path: Path) -> Iterator[int]:
+    # Read end of a pipe a `cat` child fills with `path`.
+    child = subprocess.Popen(["cat", str(path)], stdout=subprocess.PIPE)
+    try:
+        yield child.stdout.fileno()
+    finally:
+        child.stdout.close()
+        child.wait()
+
+
+@contextmanager
+def _stdin(path: Path) -> Iterator[None]:
+    saved = sys.stdin
+    with _cat(path) as fd:
+        sys.stdin = open(fd, "r", closefd=False)
+        try:
+            yield
+        finally:
+            sys.stdin.close()
+            sys.stdin = saved
+
+
+def read_exact(size: int, count: int) -> Case:
+    def case(tmp: Path) -> tuple[float, float]:
+        with _stdin(_payload(tmp, size * count)):
+            start = time.perf_counter()
+            for _ in range(count):
+                gateway._read_exact(size)
+            return count, time.perf_counter() - start
+
+    return case
+
+
+def read_line(count: int) -> Case:
+    def case(tmp: Path) -> tuple[float, float]:
+        with _stdin(_payload(tmp, len(RECORD) * count, RECORD)):
+            start = time.perf_counter()
+            for _ in range(count):
+                gateway._read_line()
+            return count, time.perf_counter() - start
+
+    return case
+
+
+def parse_c_record(count: int) -> Case:
+    lines = [b"C0644 %d file-%06d.bin\n" % (i * 4099, i) for i in range(1000)]
+
+    def case(tmp: Path) -> tuple[float, float]:
+        start = time.perf_counter()
+        for i in range(count):
+            gateway._parse_c_record(lines[i % 1000])
+        return count, time.perf_counter() - start
+
+    return case
+
+
+def receive(size: int, volume: int) -> Case:
+    count = max(1, volume // size)
+
+    def case(tmp: Path) -> tuple[float, float]:
+        with _cat(_payload(tmp, size * count)) as fd, open(fd, "rb", closefd=False) as src:
+            with open(tmp / "received", "wb") as dst:
+                start = time.perf_counter()
+                for _ in range(count):
+                    dst.seek(0)
+                    upload.receive(src, dst, size)
+                elapsed = time.perf_counter() - start
+        return size * count / 1e6, elapsed
+
+    return case
+
+
+def send(size: int, volume: int) -> Case:
+    count = max(1, volume // size)
+
+    def case(tmp: Path) -> tuple[float, float]:
+        path = _payload(tmp, size * count)
+        r, w = os.pipe()
+        child = subprocess.Popen(["cat"], stdin=r, stdout=subprocess.DEVNULL)
+        os.close(r)
+        with open(path, "rb") as src, os.fdopen(w, "wb") as out:
+            start = time.perf_counter()
+            for i in range(count):
+                src.seek(i * size)
+                sent, _ = zerocopy.send_file(src, out, size, zerocopy.AUTO)
+                if sent != size:
+                    raise RuntimeError(f"sent {sent} of {size} bytes")
+            out.flush()
+        child.wait()
+        return size * count / 1e6, time.perf_counter() - start
+
+    return case
+
+
+def log(level: str, count: int) -> Case:
+    # A DEBUG line with the level at `level`: dropped at INFO, written at DEBUG.
+    def case(tmp: Path) -> tuple[float, float]:
+        os.environ.update(LOG_LEVEL=level, LOG_SINK=str(tmp / "bench.log"))
+        logutil._CURRENT_LEVEL = None
+        token = "a" * 43
+        try:
+            start = time.perf_counter()
+            for i in range(count):
+                logutil.log("DEBUG", "scp_send_one: lookup token=%r size=%d", token, i)
+            logutil.flush()
+            return count, time.perf_counter() - start
+        finally:
+            os.environ.update(LOG_LEVEL="WARNING", LOG_SINK="")
+            logutil._CURRENT_LEVEL = None
+
+    return case
+
+
+def cases(args: argparse.Namespace) -> dict[str, tuple[str, Case]]:
+    n, volume = args.records, args.volume_mb * CHUNK
+    found: dict[str, tuple[str, Case]] = {
+        "read_exact 1B": ("ops/s", read_exact(1, n)),
+        "read_exact 64K": ("ops/s", read_exact(64 * 1024, max(1, volume // (64 * 1024)))),
+        "read_line": ("ops/s", read_line(n)),
+        "parse_c_record": ("ops/s", parse_c_record(n)),
+    }
+    for size in map(parse_size, args.sizes):
+        found[f"receive {_label(size)}"] = ("MB/s", receive(size, volume))
+        found[f"send {_label(size)}"] = ("MB/s", send(size, volume))
+    found["log dropped"] = ("ops/s", log("INFO", n))
+    found["log to file"] = ("ops/s", log("DEBUG", n))
+    return {k: v for k, v in found.items() if not args.only or any(s in k for s in args.only)}
+
+
+def tolerance(name: str, args: argparse.Namespace) -> float:
+    for case, allowed in args.tolerance_for:
+        if case == name:
+            return allowed
+    return next((t for case, t in TOLERANCES.items() if name.startswith(case)), args.tolerance)
+
+
+def _case_tolerance(text: str) -> tuple[str, float]:
+    name, _, allowed = text.rpartition("=")
+    return name, float(allowed)
+
+
+def _machine() -> dict[str, str | int]:
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count() or 0,
+        "node": platform.node(),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", nargs="+", default=["1K", "64K", "1M", "64M"])
+    parser.add_argument("--volume-mb", type=int, default=64, help="bytes moved per size case")
+    parser.add_argument("--records", type=int, default=100_000, help="calls per record case")
+    parser.add_argument("--runs", type=int, default=9, help="runs per case; the median counts")
+    parser.add_argument("--only", nargs="*", help="run cases whose name contains one of these")
+    parser.add_argument("--baseline", type=Path, default=ROOT / "bench" / "microbench.json")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown")
+    parser.add_argument(
+        "--tolerance-for",
+        type=_case_tolerance,
+        action="append",
+        default=[],
+        metavar="NAME=FRACTION",
+        help="allowed slowdown for one case",
+    )
+    parser.add_argument("--save", action="store_true", help="write the results as the baseline")
+    parser.add_argument("--dir", default=None, help="where payloads go (the DATA_DIR filesystem)")
+    args = parser.parse_args()
+
+    baseline: dict = {}
+    if not args.save and args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+        if baseline.get("machine") != _machine():
+            print(f"warning: baseline is from {baseline.get('machine')}, not {_machine()}")
+    base = baseline.get("results", {})
+
+    results: dict[str, dict[str, float | str]] = {}
+    regressed = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for name, (unit, case) in cases(args).items():
+            samples = [case(Path(tmp)) for _ in range(args.runs)]
+            rates = [units / seconds for units, seconds in samples]
+            rate = statistics.median(rates)
+            spread = (max(rates) - min(rates)) / rate
+            results[name] = {"rate": rate, "unit": unit}
+            line = f"  {name:18s} {rate:14,.1f} {unit:5s} ±{spread * 50:4.1f}%"
+            if name in base:
+                change = rate / base[name]["rate"] - 1
+                line += f"  {change * 100:+6.1f}% vs baseline"
+                if change < -tolerance(name, args):
+                    regressed.append(name)
+                    line += "  REGRESSED"
+            print(line, flush=True)
+
+    if args.save:
+        args.baseline.write_text(
+            json.dumps({"machine": _machine(), "results": results}, indent=2) + "\n"
+        )
+        print(f"baseline written to {args.baseline}")
+        return 0
+    if not base:
+        print(f"no baseline at {args.baseline}; run with --save to record one")
+    if regressed:
+        print(f"{len(regressed)} case(s) slower than allowed: {', '.join(regressed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
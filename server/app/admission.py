@@ -0,0 +1,228 @@
+"""
+Admission control: how many put and get sessions run at once.
+
+Each mode has GATEWAY_MAX_PUT / GATEWAY_MAX_GET slots, files under
+DATA_DIR/admission held with flock for the length of a session, so every
+gateway process (daemon workers and one-off sessions alike) counts, and a
+crashed session frees its slot with its last fd. A session that finds no
+free slot takes one of GATEWAY_QUEUE queue slots and polls for a run slot
+for up to GATEWAY_QUEUE_SECONDS; with the queue full too it is turned away
+at once. 0 slots = no limit.
+
+The queue is first come, first served. Each waiter draws a ticket from a
+counter file and writes it into its queue slot, and only the waiter holding
+the lowest ticket among the held queue slots may take a run slot that frees
+up. Waiters also hold a shared lock on <mode>.queued, so a newcomer that
+cannot lock that file exclusively joins the queue rather than take a free
+run slot ahead of them.
+"""
+from __future__ import annotations
+
+import fcntl
+import os
+import struct
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+from app import logutil, metrics
+
+DIR_NAME = "admission"
+DEFAULT_QUEUE = 64
+DEFAULT_QUEUE_SECONDS = 30.0
+# Poll interval while queued. The head of the queue polls at the short one
+# throughout, so a freed slot is handed over within milliseconds; the rest
+# back off to the long one until they reach the head.
+POLL_MIN_SECONDS = 0.002
+POLL_MAX_SECONDS = 0.05
+
+_TICKET = struct.Struct(">Q")
+
+
+class Busy(Exception):
+    pass
+
+
+class Limits(NamedTuple):
+    put: int = 0
+    get: int = 0
+    queue: int = DEFAULT_QUEUE
+    queue_seconds: float = DEFAULT_QUEUE_SECONDS
+
+    def slots(self, mode: str) -> int:
+        return self.put if mode == "put" else self.get
+
+
+def limits_from_env() -> Limits:
+    return Limits(
+        put=int(os.environ.get("GATEWAY_MAX_PUT", "0")),
+        get=int(os.environ.get("GATEWAY_MAX_GET", "0")),
+        queue=int(os.environ.get("GATEWAY_QUEUE", str(DEFAULT_QUEUE))),
+        queue_seconds=float(os.environ.get("GATEWAY_QUEUE_SECONDS", str(DEFAULT_QUEUE_SECONDS))),
+    )
+
+
+def _open_slot(path: Path) -> int:
+    # Read-write: queue slots and the counter hold a ticket number.
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o660)
+        # Put and get sessions run as different users in DATA_DIR's group;
+        # umask would drop the group write bit.
+        os.fchmod(fd, 0o660)
+    except FileExistsError:
+        fd = os.open(path, os.O_RDWR)
+    return fd
+
+
+def _read_ticket(fd: int) -> int:
+    data = os.pread(fd, _TICKET.size, 0)
+    return _TICKET.unpack(data)[0] if len(data) == _TICKET.size else 0
+
+
+def _queue_waiting(directory: Path, mode: str) -> bool:
+    # True while any session of `mode` is queued (holds <mode>.queued shared).
+    fd = _open_slot(directory / f"{mode}.queued")
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+
+def _queued_tickets(directory: Path, mode: str, limits: Limits) -> list[int]:
+    # Tickets of the held queue slots, this session's own included. The shared
+    # lock on the counter keeps out _enqueue, so no slot is read between being
+    # taken and being given its ticket (it would still hold its last owner's).
+    counter_fd = _open_slot(directory / f"{mode}.ticket")
+    try:
+        fcntl.flock(counter_fd, fcntl.LOCK_SH)
+        tickets = []
+        for i in range(limits.queue):
+            try:
+                fd = os.open(directory / f"{mode}.queue.{i}", os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                tickets.append(_read_ticket(fd))
+            finally:
+                os.close(fd)
+        return tickets
+    finally:
+        os.close(counter_fd)
+
+
+def _take(directory: Path, prefix: str, count: int) -> tuple[int, int] | None:
+    # Returns (index, fd) of the first slot nobody holds, or None.
+    for i in range(count):
+        fd = _open_slot(directory / f"{prefix}.{i}")
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        return i, fd
+    return None
+
+
+def _enqueue(directory: Path, mode: str, limits: Limits) -> tuple[int, int] | None:
+    # Returns (queue slot fd, ticket), or None with the queue full. Slot and
+    # ticket are taken under the counter's lock; see _queued_tickets.
+    counter_fd = _open_slot(directory / f"{mode}.ticket")
+    try:
+        fcntl.flock(counter_fd, fcntl.LOCK_EX)
+        queued = _take(directory, f"{mode}.queue", limits.queue)
+        if queued is None:
+            return None
+        ticket = _read_ticket(counter_fd)
+        os.pwrite(counter_fd, _TICKET.pack(ticket + 1), 0)
+        os.pwrite(queued[1], _TICKET.pack(ticket), 0)
+        return queued[1], ticket
+    finally:
+        os.close(counter_fd)
+
+
+def _wait(directory: Path, mode: str, limits: Limits) -> int:
+    # Queued: returns the run slot's fd once one frees up.
+    marker_fd = _open_slot(directory / f"{mode}.queued")
+    try:
+        fcntl.flock(marker_fd, fcntl.LOCK_SH)
+        queued = _enqueue(directory, mode, limits)
+        if queued is None:
+            metrics.inc("gateway_admission_total", mode=mode, result="rejected")
+            logutil.warning(f"admission: {mode} queue full queue={limits.queue}")
+            raise Busy(f"server busy: {mode} queue is full, try again later")
+        queue_fd, ticket = queued
+        try:
+            tickets = _queued_tickets(directory, mode, limits)
+            ahead = sum(t < ticket for t in tickets)
+            logutil.info(
+                f"admission: {mode} queued position={ahead + 1} depth={len(tickets)} "
+                f"slots={limits.slots(mode)}"
+            )
+            return _poll(directory, mode, limits, ticket)
+        finally:
+            os.close(queue_fd)
+    finally:
+        os.close(marker_fd)
+
+
+def _poll(directory: Path, mode: str, limits: Limits, ticket: int) -> int:
+    started = time.monotonic()
+    deadline = started + limits.queue_seconds
+    delay = POLL_MIN_SECONDS
+    while True:
+        taken = None
+        # Only the longest-waiting session may take a slot.
+        head = min(_queued_tickets(directory, mode, limits), default=ticket) >= ticket
+        if head:
+            taken = _take(directory, mode, limits.slots(mode))
+            delay = POLL_MIN_SECONDS
+        waited = time.monotonic() - started
+        if taken is not None:
+            metrics.observe("gateway_admission_wait_seconds", waited, mode=mode)
+            metrics.inc("gateway_admission_total", mode=mode, result="queued")
+            logutil.info(f"admission: {mode} admitted after wait={waited:.3f}s")
+            return taken[1]
+        if time.monotonic() + delay > deadline:
+            metrics.inc("gateway_admission_total", mode=mode, result="timeout")
+            logutil.warning(f"admission: {mode} gave up after wait={waited:.3f}s")
+            raise Busy(f"server busy: no {mode} slot free in {limits.queue_seconds:g}s")
+        time.sleep(delay)
+        if not head:
+            delay = min(delay * 2, POLL_MAX_SECONDS)
+
+
+@contextmanager
+def admit(limits: Limits, data_dir: Path, mode: str) -> Iterator[None]:
+    """
+    Holds one of `mode`'s run slots for the block, queueing for it if need
+    be. Raises Busy when the queue is full or the wait runs out.
+    """
+    slots = limits.slots(mode)
+    if slots <= 0:
+        yield
+        return
+    directory = data_dir / DIR_NAME
+    try:
+        directory.mkdir()
+        # Put and get sessions both add slot files, through the group the dir
+        # inherits from DATA_DIR (the entrypoint does this too).
+        directory.chmod(0o2770)
+    except FileExistsError:
+        pass
+    # Sessions already queued go first.
+    taken = None if _queue_waiting(directory, mode) else _take(directory, mode, slots)
+    if taken is not None:
+        fd = taken[1]
+        metrics.inc("gateway_admission_total", mode=mode, result="admitted")
+    else:
+        fd = _wait(directory, mode, limits)
+    try:
+        yield
+    finally:
+        os.close(fd)
@@ -0,0 +1,161 @@
+"""
+Disk allocation for uploads whose size is known up front (scp C records).
+Free space is checked with statvfs and the whole file is reserved with
+posix_fallocate before the client is told to send anything. Data goes to an
+O_TMPFILE, which only gets a name once the upload is complete, so a crashed
+or interrupted session leaves nothing on disk.
+"""
+from __future__ import annotations
+
+import errno
+import os
+from pathlib import Path
+from typing import BinaryIO
+
+from app import logutil
+
+# Space kept free on DATA_DIR for the database, logs and concurrent sessions.
+DEFAULT_RESERVE_MB = 1024
+_NO_SPACE = {errno.ENOSPC, errno.EDQUOT}
+# fallocate not supported by this filesystem.
+_UNSUPPORTED = {errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS}
+_PROC_FD = Path("/proc/self/fd")
+
+
+class NoSpace(Exception):
+    pass
+
+
+def reserve_from_env() -> int:
+    return int(os.environ.get("DATA_RESERVE_MB", str(DEFAULT_RESERVE_MB))) * 1024 * 1024
+
+
+def preallocate_from_env() -> bool:
+    return os.environ.get("DATA_PREALLOCATE", "1") == "1"
+
+
+def check_space(data_dir: Path, size: int, reserve: int) -> None:
+    st = os.statvfs(data_dir)
+    free = st.f_bavail * st.f_frsize
+    if free - size < reserve:
+        raise NoSpace(f"not enough space for {size} bytes ({free} free, {reserve} reserved)")
+
+
+# Whether O_TMPFILE files can be linked into place here; probed on first use.
+_TMPFILE_OK: bool | None = None
+
+
+def _link_tmpfile(fd: int, dest: Path) -> None:
+    # linkat(AT_SYMLINK_FOLLOW) through /proc: AT_EMPTY_PATH would need
+    # CAP_DAC_READ_SEARCH.
+    os.link(_PROC_FD / str(fd), dest)
+
+
+def _probe(directory: Path) -> bool:
+    if not hasattr(os, "O_TMPFILE") or not _PROC_FD.is_dir():
+        return False
+    probe = directory / f".tmpfile-probe.{os.getpid()}"
+    try:
+        fd = os.open(directory, os.O_TMPFILE | os.O_WRONLY, 0o644)
+    except OSError:
+        return False
+    try:
+        _link_tmpfile(fd, probe)
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+    os.unlink(probe)
+    return True
+
+
+def _open_tmpfile(directory: Path) -> int | None:
+    global _TMPFILE_OK
+    if _TMPFILE_OK is None:
+        _TMPFILE_OK = _probe(directory)
+        if not _TMPFILE_OK:
+            logutil.info("allocate: O_TMPFILE unavailable, using named temporary files")
+    if not _TMPFILE_OK:
+        return None
+    return os.open(directory, os.O_TMPFILE | os.O_WRONLY, 0o644)
+
+
+class Allocation:
+    """
+    A file being received. Anonymous (O_TMPFILE) where the filesystem allows
+    it, otherwise the named tmp_path. Write through `file`, then commit().
+    """
+
+    def __init__(self, fd: int, tmp_path: Path | None) -> None:
+        self.fd = fd
+        # None while the data has no name on disk.
+        self.tmp_path = tmp_path
+        self.file: BinaryIO = open(fd, "wb", closefd=False)
+
+    def reserve(self, size: int) -> None:
+        """
+        Preallocates `size` more bytes from the current write position, for
+        files that grow member by member (directory bundles).
+        """
+        if size > 0:
+            _fallocate(self.fd, self.file.tell(), size)
+
+    def commit(self, dest: Path, *, durable: bool = False) -> None:
+        # Preallocation sized the file for the raw payload; compressed data
+        # ends earlier.
+        self.file.flush()
+        os.ftruncate(self.fd, self.file.tell())
+        self.file.close()
+        if durable:
+            os.fsync(self.fd)
+        try:
+            if self.tmp_path is None:
+                _link_tmpfile(self.fd, dest)
+            else:
+                os.replace(self.tmp_path, dest)
+        finally:
+            self._close()
+
+    def _close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def abort(self) -> None:
+        self.file.close()
+        self._close()
+        if self.tmp_path is not None:
+            try:
+                os.unlink(self.tmp_path)
+            except FileNotFoundError:
+                pass
+
+
+def allocate(tmp_path: Path, size: int, *, preallocate: bool = True) -> Allocation:
+    """
+    Opens the file for an upload of `size` bytes in tmp_path's directory.
+    Raises NoSpace if the filesystem cannot hold it.
+    """
+    fd = _open_tmpfile(tmp_path.parent)
+    alloc = Allocation(
+        os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644) if fd is None else fd,
+        tmp_path if fd is None else None,
+    )
+    if preallocate and size > 0:
+        try:
+            _fallocate(alloc.fd, 0, size)
+        except BaseException:
+            alloc.abort()
+            raise
+    return alloc
+
+
+def _fallocate(fd: int, offset: int, size: int) -> None:
+    try:
+        os.posix_fallocate(fd, offset, size)
+    except OSError as exc:
+        if exc.errno in _UNSUPPORTED:
+            return
+        if exc.errno in _NO_SPACE:
+            raise NoSpace(f"cannot reserve {size} bytes") from None
+        raise
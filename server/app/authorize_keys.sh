@@ -4,6 +4,7 @@ set -eu
 user="${1:-}"
 key_type="${2:-}"
 key_b64="${3:-}"
+key_fp="${4:-}"
 
 if [ -f /etc/ssh/sshd_env ]; then
   # shellcheck disable=SC1091
@@ -45,7 +46,7 @@ log_verbose() { log VERBOSE "$*"; }
 
 clean_token() {
   # If sshd didn't expand a token, it will be passed literally like "%k".
-  if [ "$1" = "%k" ] || [ "$1" = "%t" ]; then
+  if [ "$1" = "%k" ] || [ "$1" = "%t" ] || [ "$1" = "%f" ]; then
     echo ""
   else
     echo "$1"
@@ -54,13 +55,15 @@ clean_token() {
 
 key_type="$(clean_token "$key_type")"
 key_b64="$(clean_token "$key_b64")"
+key_fp="$(clean_token "$key_fp")"
 
 log_info "invoked user=${user} key_type=${key_type:-<empty>} key_b64_len=${#key_b64}"
 
 # Always accept the presented key for put/get (no signup required).
 if [ "$user" = "put" ] || [ "$user" = "get" ]; then
   if [ -n "$key_type" ] && [ -n "$key_b64" ]; then
-    log_debug "accepting presented key for user=${user}"
+    # Same fingerprint the gateway keeps quotas against (KEY_QUOTA_*).
+    log_info "accepting presented key for user=${user} fingerprint=${key_fp:-<unknown>}"
     printf "%s %s\n" "$key_type" "$key_b64"
     exit 0
   fi
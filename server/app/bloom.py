@@ -0,0 +1,202 @@
+"""
+Bloom filter of live tokens, so downloads of tokens that never existed are
+refused without a database lookup.
+
+The filter is DATA_DIR/tokens.bloom, read through mmap: a header, then the
+bit array. Gateways add tokens right after their rows commit and before the
+client sees a receipt. The cleaner rebuilds the filter from `files` to drop
+expired tokens: it creates tokens.bloom.next, fills it from the DB, and
+renames it over the live filter. While .next exists gateways add to both,
+so a token committed during the scan is never lost. Writers serialize on
+flock(tokens.bloom.lock), which also keeps concurrent bit updates to one
+byte from overwriting each other. Readers take no lock.
+"""
+from __future__ import annotations
+
+import fcntl
+import math
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple
+
+FILTER_NAME = "tokens.bloom"
+NEXT_SUFFIX = ".next"
+LOCK_SUFFIX = ".lock"
+FP_RATE = 0.01
+MAX_HASHES = 16
+
+MAGIC = b"TOKBLM01"
+# magic, bit count, hash count
+_HEADER = struct.Struct(">8sQI")
+
+# ((inode, ctime), filter) of the filter this process last read; see might_contain.
+_reader: tuple[tuple[int, int], "Filter"] | None = None
+
+
+class Stats(NamedTuple):
+    tokens: int
+    bits: int
+    hashes: int
+    # Fraction of bits set, and the false-positive rate that implies.
+    fill: float
+    fp_rate: float
+
+
+def capacity_from_env() -> int:
+    # Expected live tokens the filter is sized for; 0 disables it.
+    return int(os.environ.get("DATA_BLOOM_CAPACITY", "0"))
+
+
+def filter_path(data_dir: Path) -> Path:
+    return data_dir / FILTER_NAME
+
+
+def sizing(capacity: int, fp_rate: float = FP_RATE) -> tuple[int, int]:
+    """
+    Returns (bits, hashes) for `capacity` tokens at `fp_rate`.
+    """
+    bits = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)
+    bits = max(64, (bits + 63) // 64 * 64)
+    # A tiny capacity rounds up to 64 bits; more hashes than that buys nothing.
+    hashes = min(MAX_HASHES, max(1, round(bits / max(capacity, 1) * math.log(2))))
+    return bits, hashes
+
+
+def _positions(token: str, bits: int, hashes: int) -> Iterator[int]:
+    # Double hashing over one BLAKE2b digest (Kirsch-Mitzenmacher).
+    import hashlib
+
+    digest = hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    for i in range(hashes):
+        yield (h1 + i * h2) % bits
+
+
+class Filter:
+    def __init__(self, path: Path, *, writable: bool = False) -> None:
+        fd = os.open(path, os.O_RDWR if writable else os.O_RDONLY)
+        try:
+            access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            self._map = mmap.mmap(fd, 0, access=access)
+        finally:
+            # The mapping keeps the file open.
+            os.close(fd)
+        magic, self.bits, self.hashes = _HEADER.unpack_from(self._map)
+        if magic != MAGIC or len(self._map) != _HEADER.size + self.bits // 8:
+            self._map.close()
+            raise ValueError(f"not a token filter: {path}")
+
+    @classmethod
+    def create(cls, path: Path, capacity: int, fp_rate: float = FP_RATE) -> "Filter":
+        bits, hashes = sizing(capacity, fp_rate)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o660)
+        try:
+            # Gateways run as other users in DATA_DIR's group and add to it;
+            # umask would drop the group write bit.
+            os.fchmod(fd, 0o660)
+            os.write(fd, _HEADER.pack(MAGIC, bits, hashes))
+            os.ftruncate(fd, _HEADER.size + bits // 8)
+        finally:
+            os.close(fd)
+        return cls(path, writable=True)
+
+    def add(self, tokens: Iterable[str]) -> None:
+        m = self._map
+        for token in tokens:
+            for pos in _positions(token, self.bits, self.hashes):
+                i = _HEADER.size + (pos >> 3)
+                m[i] |= 1 << (pos & 7)
+
+    def __contains__(self, token: str) -> bool:
+        m = self._map
+        return all(
+            m[_HEADER.size + (pos >> 3)] & (1 << (pos & 7))
+            for pos in _positions(token, self.bits, self.hashes)
+        )
+
+    def stats(self, tokens: int) -> Stats:
+        ones = int.from_bytes(self._map[_HEADER.size :], "little").bit_count()
+        fill = ones / self.bits
+        return Stats(tokens, self.bits, self.hashes, fill, fill**self.hashes)
+
+    def close(self) -> None:
+        self._map.close()
+
+
+@contextmanager
+def _locked(data_dir: Path) -> Iterator[None]:
+    path = data_dir / (FILTER_NAME + LOCK_SUFFIX)
+    # flock needs no write access, so whichever user creates it is fine.
+    fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing drops the flock.
+        os.close(fd)
+
+
+def might_contain(data_dir: Path, token: str) -> bool:
+    """
+    False only if `token` was never added. True without a filter on disk.
+    """
+    global _reader
+    path = filter_path(data_dir)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return True
+    # ctime as well, as a freed inode number can come back for a later rebuild.
+    key = (st.st_ino, st.st_ctime_ns)
+    if _reader is None or _reader[0] != key:
+        # First use, or the cleaner swapped in a rebuilt filter.
+        if _reader is not None:
+            _reader[1].close()
+        _reader = (key, Filter(path))
+    return token in _reader[1]
+
+
+def add(data_dir: Path, tokens: list[str]) -> None:
+    """
+    Adds tokens to the live filter, and to the one being rebuilt if any.
+    """
+    live = filter_path(data_dir)
+    with _locked(data_dir):
+        for path in (live, live.with_name(FILTER_NAME + NEXT_SUFFIX)):
+            try:
+                f = Filter(path, writable=True)
+            except FileNotFoundError:
+                continue
+            try:
+                f.add(tokens)
+            finally:
+                f.close()
+
+
+def rebuild(data_dir: Path, capacity: int, batches: Iterable[list[str]]) -> Stats:
+    """
+    Builds a filter from `batches` of live tokens and swaps it in.
+    """
+    live = filter_path(data_dir)
+    pending = live.with_name(FILTER_NAME + NEXT_SUFFIX)
+    with _locked(data_dir):
+        f = Filter.create(pending, capacity)
+    count = 0
+    try:
+        for batch in batches:
+            with _locked(data_dir):
+                f.add(batch)
+            count += len(batch)
+        with _locked(data_dir):
+            os.replace(pending, live)
+        return f.stats(count)
+    except BaseException:
+        with _locked(data_dir):
+            pending.unlink(missing_ok=True)
+        raise
+    finally:
+        f.close()
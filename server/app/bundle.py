@@ -0,0 +1,109 @@
+"""
+Directory bundles: a whole scp -r upload stored as one file under one token.
+
+Layout: member payloads back to back, then an index with one entry per scp
+record (D = enter directory, C = file, E = leave directory) in upload order,
+then a fixed-size trailer pointing at the index. Replaying the index
+re-creates the record stream for scp -f.
+
+A bundle's sha512 is the digest of its index. Each C entry carries the
+SHA-512 of its payload, which upload.receive computes anyway, so the index
+digest identifies the tree without hashing the data a second time.
+"""
+from __future__ import annotations
+
+import hashlib
+import struct
+from typing import BinaryIO, NamedTuple
+
+MAGIC = b"SCPBNDL1"
+DIR = "D"
+FILE = "C"
+END = "E"
+
+# kind, mode, size, offset, sha512 (zeros for D/E), name length; name follows.
+_ENTRY = struct.Struct(">cIQQ64sH")
+# magic, index offset, entry count
+_TRAILER = struct.Struct(">8sQI")
+
+
+class Entry(NamedTuple):
+    kind: str
+    mode: int = 0
+    name: str = ""
+    size: int = 0
+    offset: int = 0
+    sha512: str = ""
+
+
+def _check_name(name: str) -> str:
+    # Names become paths on the downloading side.
+    if not name or "/" in name or name in (".", ".."):
+        raise ValueError(f"bad name in directory upload: {name!r}")
+    return name
+
+
+class Writer:
+    """
+    Builds a bundle in `dst`. Member data goes through write(), so a Writer
+    can be handed to upload.receive directly.
+    """
+
+    def __init__(self, dst: BinaryIO) -> None:
+        self._dst = dst
+        self.entries: list[Entry] = []
+        self.depth = 0
+        # Payload bytes written so far; the next member starts here.
+        self.size = 0
+
+    def write(self, data: bytes | memoryview) -> None:
+        self._dst.write(data)
+        self.size += len(data)
+
+    def enter(self, mode: int, name: str) -> None:
+        self.entries.append(Entry(DIR, mode, _check_name(name)))
+        self.depth += 1
+
+    def leave(self) -> None:
+        self.entries.append(Entry(END))
+        self.depth -= 1
+
+    def add(self, mode: int, name: str, size: int, sha512: str) -> None:
+        # The member's data is the last `size` bytes written.
+        self.entries.append(Entry(FILE, mode, _check_name(name), size, self.size - size, sha512))
+
+    @property
+    def name(self) -> str:
+        return self.entries[0].name
+
+    def finish(self) -> str:
+        """
+        Appends the index and trailer; returns the bundle's sha512.
+        """
+        parts = []
+        for e in self.entries:
+            name = e.name.encode("utf-8")
+            digest = bytes.fromhex(e.sha512) if e.sha512 else bytes(64)
+            parts.append(
+                _ENTRY.pack(e.kind.encode("ascii"), e.mode, e.size, e.offset, digest, len(name))
+            )
+            parts.append(name)
+        index = b"".join(parts)
+        self._dst.write(index)
+        self._dst.write(_TRAILER.pack(MAGIC, self.size, len(self.entries)))
+        return hashlib.sha512(index).hexdigest()
+
+
+def read_index(f: BinaryIO) -> list[Entry]:
+    f.seek(-_TRAILER.size, 2)
+    magic, index_offset, count = _TRAILER.unpack(f.read(_TRAILER.size))
+    if magic != MAGIC:
+        raise ValueError("not a directory bundle")
+    f.seek(index_offset)
+    entries = []
+    for _ in range(count):
+        kind, mode, size, offset, digest, name_len = _ENTRY.unpack(f.read(_ENTRY.size))
+        name = f.read(name_len).decode("utf-8")
+        sha512 = digest.hex() if kind == FILE.encode("ascii") else ""
+        entries.append(Entry(kind.decode("ascii"), mode, name, size, offset, sha512))
+    return entries
@@ -1,3 +1,4 @@
+from app import metrics
 from app.db import init_db
 from app.cleanup_worker import CleanupConfig, run_cleanup_loop
 
@@ -5,6 +6,7 @@ from app.cleanup_worker import CleanupConfig, run_cleanup_loop
 def main() -> None:
     init_db()
     config = CleanupConfig.from_env()
+    metrics.serve_from_env()
     run_cleanup_loop(config)
 
 
@@ -1,58 +1,378 @@
 from __future__ import annotations
 
+import heapq
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Iterable, Callable
+from typing import TYPE_CHECKING, Iterable, Callable
 
-from app import logutil
-from app.db import delete_expired, utcnow
+from app import bloom, logutil, metrics, segments
+from app.db import (
+    delete_expired,
+    expiry_listener,
+    forget_segments,
+    list_tokens,
+    move_segment_entries,
+    segment_entries,
+    segment_usage,
+    upcoming_expirations,
+    utcnow,
+)
+
+if TYPE_CHECKING:
+    from app.db import ExpiryListener
+
+REMOVED = "removed"
+MISSING = "missing"
+FAILED = "failed"
+# Back-off after a DB or listener failure before reconnecting.
+RETRY_SECONDS = 5.0
 
 
 @dataclass(frozen=True)
 class CleanupConfig:
     data_dir: Path
+    # Longest sleep between full resyncs with the DB; expiry itself is event-driven.
     interval_seconds: int
+    # Segment reclaim, filter rebuild and a schedule re-seed (which is how SQLite,
+    # without NOTIFY, learns of new deadlines) run this often between resyncs.
+    reclaim_interval_seconds: int = 60
+    workers: int = 8
+    # Upper bound on unlinks per second across all workers; 0 = unlimited.
+    ops_per_second: float = 0.0
+    # Upcoming deadlines read per schedule seed.
+    window: int = 1000
+    # Wait this long past a deadline so neighbouring expiries share one pass.
+    slack_seconds: float = 1.0
+    # Closed segments with less live data than this fraction get compacted.
+    segment_min_live: float = segments.DEFAULT_MIN_LIVE
+    # Tokens the rebuilt filter (see app.bloom) is sized for; 0 = no filter.
+    bloom_capacity: int = 0
+    # Tokens read per query while rebuilding the filter.
+    scan_batch: int = 10000
 
     @classmethod
     def from_env(cls) -> "CleanupConfig":
         # Resolve configuration once at startup for stable logging.
         data_dir = Path(os.environ.get("DATA_DIR", "/data")).resolve()
-        interval = int(os.environ.get("CLEAN_INTERVAL_SECONDS", "60"))
-        return cls(data_dir=data_dir, interval_seconds=interval)
+        interval = int(os.environ.get("CLEAN_INTERVAL_SECONDS", "3600"))
+        reclaim_interval = int(os.environ.get("RECLAIM_INTERVAL_SECONDS", "60"))
+        workers = int(os.environ.get("CLEAN_WORKERS", "8"))
+        ops_per_second = float(os.environ.get("CLEAN_OPS_PER_SECOND", "0"))
+        window = int(os.environ.get("CLEAN_WINDOW", "1000"))
+        slack = float(os.environ.get("CLEAN_SLACK_SECONDS", "1"))
+        min_live = float(os.environ.get("CLEAN_SEGMENT_MIN_LIVE", str(segments.DEFAULT_MIN_LIVE)))
+        return cls(
+            data_dir=data_dir,
+            interval_seconds=interval,
+            reclaim_interval_seconds=reclaim_interval,
+            workers=workers,
+            ops_per_second=ops_per_second,
+            window=window,
+            slack_seconds=slack,
+            segment_min_live=min_live,
+            bloom_capacity=bloom.capacity_from_env(),
+        )
 
 
-def remove_expired_files(expired: Iterable[tuple[str, str]]) -> None:
-    # Remove files already deleted from DB.
-    for token, stored_path in expired:
+class ExpirySchedule:
+    """
+    Min-heap of upcoming expires_at values, seeded from an ORDER BY ... LIMIT
+    window and extended with deadlines announced over NOTIFY.
+    """
+
+    def __init__(self, window: int) -> None:
+        self.window = window
+        self._heap: list[datetime] = []
+        # Last seeded deadline when the window was full: rows past it are unknown.
+        self._window_end: datetime | None = None
+
+    def seed(self, deadlines: list[datetime]) -> None:
+        self._heap = list(deadlines)
+        heapq.heapify(self._heap)
+        full = len(deadlines) >= self.window
+        self._window_end = deadlines[-1] if full and deadlines else None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, deadline: datetime) -> None:
+        heapq.heappush(self._heap, deadline)
+
+    def next_deadline(self) -> datetime | None:
+        return self._heap[0] if self._heap else None
+
+    def expire_through(self, now: datetime) -> None:
+        while self._heap and self._heap[0] <= now:
+            heapq.heappop(self._heap)
+
+    def needs_seed(self) -> bool:
+        if self._window_end is None:
+            return False
+        return not self._heap or self._heap[0] > self._window_end
+
+
+class Pacer:
+    """
+    Spaces operations evenly so all threads together stay under `rate` per second.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        *,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+        self._clock = clock
+        self._sleep = sleep
+
+    def wait(self) -> None:
+        if not self._interval:
+            return
+        with self._lock:
+            now = self._clock()
+            slot = max(now, self._next)
+            self._next = slot + self._interval
+        if slot > now:
+            self._sleep(slot - now)
+
+
+class FileRemover:
+    """
+    Unlinks expired files on a bounded thread pool, relative to an open
+    DATA_DIR fd so each removal is a single unlinkat() with no stat.
+    """
+
+    def __init__(self, config: CleanupConfig) -> None:
+        self._prefix = f"{config.data_dir}{os.sep}"
+        self._dir_fd = os.open(config.data_dir, os.O_RDONLY | os.O_DIRECTORY)
+        self._pool = ThreadPoolExecutor(
+            max_workers=max(1, config.workers), thread_name_prefix="cleanup"
+        )
+        self._pacer = Pacer(config.ops_per_second)
+
+    def __enter__(self) -> "FileRemover":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+        os.close(self._dir_fd)
+
+    def _remove_one(self, row: tuple[str, str]) -> str:
+        token, stored_path = row
+        # Paths outside DATA_DIR stay absolute; unlinkat ignores dir_fd for them.
+        name = stored_path
+        if stored_path.startswith(self._prefix):
+            name = stored_path[len(self._prefix) :]
+        self._pacer.wait()
         try:
-            path = Path(stored_path)
-            if path.is_file():
-                path.unlink()
-                logutil.verbose(
-                    f"cleanup: removed token={token} path={stored_path}"
-                )
-            else:
-                logutil.warning(
-                    f"cleanup: missing file token={token} path={stored_path}"
-                )
+            os.unlink(name, dir_fd=self._dir_fd)
+        except FileNotFoundError:
+            logutil.warning(f"cleanup: missing file token={token} path={stored_path}")
+            return MISSING
         except Exception as exc:
             logutil.error(
                 f"cleanup: failed to remove token={token} path={stored_path} err={exc!r}"
             )
+            return FAILED
+        logutil.verbose("cleanup: removed token=%s path=%s", token, stored_path)
+        return REMOVED
+
+    def remove(self, expired: Iterable[tuple[str, str]]) -> dict[str, int]:
+        started = time.monotonic()
+        counts = {REMOVED: 0, MISSING: 0, FAILED: 0}
+        for outcome in self._pool.map(self._remove_one, expired):
+            counts[outcome] += 1
+        elapsed = time.monotonic() - started
+        total = sum(counts.values())
+        for outcome, count in counts.items():
+            if count:
+                metrics.inc("cleanup_files_total", count, result=outcome)
+        if total:
+            metrics.observe("cleanup_batch_seconds", elapsed)
+            rate = total / elapsed if elapsed > 0 else float(total)
+            logutil.info(
+                f"cleanup: batch removed={counts[REMOVED]} missing={counts[MISSING]} "
+                f"failed={counts[FAILED]} seconds={elapsed:.3f} ops_per_sec={rate:.0f}"
+            )
+        return counts
+
+
+def remove_expired_files(
+    expired: Iterable[tuple[str, str]], config: CleanupConfig
+) -> dict[str, int]:
+    # Remove files already deleted from DB.
+    with FileRemover(config) as remover:
+        return remover.remove(expired)
+
+
+def _expire(remover: FileRemover) -> int:
+    deleted = 0
+    for batch in delete_expired(utcnow()):
+        remover.remove(batch)
+        deleted += len(batch)
+    if not deleted:
+        logutil.debug("cleanup: no expired files")
+    metrics.inc("cleanup_expired_rows_total", deleted)
+    return deleted
+
+
+def reclaim_segments(remover: FileRemover, config: CleanupConfig) -> int:
+    """
+    Unlinks closed segments without live entries and compacts sparse ones;
+    returns how many segments were unlinked. A segment without rows is only
+    unlinked once no session holds its lease (see segments.lock_idle).
+    """
+    closed = segments.closed_segments(config.data_dir, utcnow().timestamp())
+    if not closed:
+        return 0
+    usage = segment_usage([str(p) for p in closed])
+    idle = []
+    for path in closed:
+        live, live_bytes = usage.get(str(path), (0, 0))
+        if live > 0 and live_bytes < config.segment_min_live * path.stat().st_size:
+            moves = segment_entries(str(path))
+            moved = move_segment_entries(
+                str(path), segments.compact(config.data_dir, path, moves)
+            )
+            segments.release()
+            logutil.info(f"cleanup: compacted segment path={path} moved={len(moved)}")
+        else:
+            # Compacted segments wait a pass, for downloads that looked them up.
+            idle.append(str(path))
+    held = {}
+    for p in idle:
+        fd = segments.lock_idle(Path(p))
+        if fd is None:
+            logutil.info(f"cleanup: segment still leased path={p}")
+        else:
+            held[p] = fd
+    try:
+        dead = forget_segments(list(held))
+        remover.remove(
+            [("segment", p) for p in dead]
+            + [("segment", str(segments.lease_path(Path(p)))) for p in dead]
+        )
+    finally:
+        for fd in held.values():
+            os.close(fd)
+    metrics.inc("cleanup_segments_total", len(dead))
+    return len(dead)
+
+
+def _token_batches(limit: int) -> Iterable[list[str]]:
+    after = ""
+    while True:
+        tokens = list_tokens(after, limit)
+        if not tokens:
+            return
+        yield tokens
+        after = tokens[-1]
+
+
+def rebuild_filter(config: CleanupConfig) -> bloom.Stats | None:
+    """
+    Rebuilds the token filter from `files`, dropping tokens that expired.
+    """
+    if config.bloom_capacity <= 0:
+        return None
+    stats = bloom.rebuild(
+        config.data_dir, config.bloom_capacity, _token_batches(config.scan_batch)
+    )
+    logutil.info(
+        f"cleanup: rebuilt token filter tokens={stats.tokens} bits={stats.bits} "
+        f"hashes={stats.hashes} fill={stats.fill:.4f} fp_rate={stats.fp_rate:.6f}"
+    )
+    metrics.set_gauge("bloom_tokens", stats.tokens)
+    metrics.set_gauge("bloom_fill_ratio", stats.fill)
+    metrics.set_gauge("bloom_fp_rate", stats.fp_rate)
+    if stats.tokens > config.bloom_capacity:
+        logutil.warning(
+            f"cleanup: token filter over capacity tokens={stats.tokens} "
+            f"capacity={config.bloom_capacity}; raise DATA_BLOOM_CAPACITY"
+        )
+    return stats
 
 
 def run_cleanup_loop(
-    config: CleanupConfig, *, sleep: Callable[[float], None] = time.sleep
+    config: CleanupConfig,
+    *,
+    sleep: Callable[[float], None] = time.sleep,
+    clock: Callable[[], float] = time.monotonic,
+    listener: ExpiryListener | None = None,
 ) -> None:
+    """
+    Sleeps until the next known deadline or a NOTIFY from the gateway, so files
+    go close to their expires_at; an idle system only queries once per reclaim
+    interval, and resyncs fully once per interval.
+    """
     logutil.info(
-        f"cleanup: starting data_dir={config.data_dir} interval_seconds={config.interval_seconds}"
+        f"cleanup: starting data_dir={config.data_dir} interval_seconds={config.interval_seconds} "
+        f"reclaim_interval_seconds={config.reclaim_interval_seconds} "
+        f"workers={config.workers} ops_per_second={config.ops_per_second or 'unlimited'} "
+        f"window={config.window} slack_seconds={config.slack_seconds}"
     )
-    while True:
-        expired = delete_expired(utcnow())
-        if not expired:
-            logutil.debug("cleanup: no expired files")
-        remove_expired_files(expired)
-        logutil.debug("cleanup: sleeping")
-        sleep(config.interval_seconds)
+    listener = listener if listener is not None else expiry_listener()
+    schedule = ExpirySchedule(config.window)
+    slack = timedelta(seconds=config.slack_seconds)
+    reconnect = True
+    synced_at = 0.0
+    reclaimed_at = 0.0
+    with FileRemover(config) as remover, listener:
+        while True:
+            try:
+                if reconnect:
+                    listener.connect()
+                    reconnect = False
+                    synced_at = clock() - config.interval_seconds
+                if clock() - synced_at >= config.interval_seconds:
+                    # Full resync; also covers anything missed while not listening.
+                    _expire(remover)
+                    reclaim_segments(remover, config)
+                    rebuild_filter(config)
+                    schedule.seed(upcoming_expirations(config.window))
+                    synced_at = reclaimed_at = clock()
+                elif clock() - reclaimed_at >= config.reclaim_interval_seconds:
+                    reclaim_segments(remover, config)
+                    rebuild_filter(config)
+                    schedule.seed(upcoming_expirations(config.window))
+                    reclaimed_at = clock()
+
+                now = utcnow()
+                deadline = schedule.next_deadline()
+                if deadline is not None and deadline + slack <= now:
+                    _expire(remover)
+                    # The earliest deadline in the pass waited longest.
+                    lag = (utcnow() - deadline).total_seconds()
+                    metrics.observe("cleanup_lag_seconds", lag)
+                    schedule.expire_through(now)
+                    if schedule.needs_seed():
+                        schedule.seed(upcoming_expirations(config.window))
+                    continue
+
+                timeout = min(
+                    config.interval_seconds - (clock() - synced_at),
+                    config.reclaim_interval_seconds - (clock() - reclaimed_at),
+                )
+                metrics.set_gauge("cleanup_scheduled_deadlines", len(schedule))
+                if deadline is not None:
+                    timeout = min(timeout, (deadline + slack - now).total_seconds())
+                logutil.debug("cleanup: sleeping seconds=%.3f", max(timeout, 0.0))
+                logutil.flush()
+                for announced in listener.wait(max(timeout, 0.0)):
+                    schedule.push(announced)
+            except Exception as exc:
+                logutil.error(f"cleanup: pass failed err={exc!r}")
+                reconnect = True
+                sleep(RETRY_SECONDS)
@@ -0,0 +1,228 @@
+"""
+At-rest compression for stored payloads. Uploads go through an Encoder that
+compresses while streaming unless the first chunk shows the payload is
+already compressed; downloads decode on the fly. The codec actually used is
+recorded per file (files.codec), so DATA_CODEC can change at any time.
+"""
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator, Protocol
+
+NONE = "none"
+ZLIB = "zlib"
+LZMA = "lzma"
+CODECS = (NONE, ZLIB, LZMA)
+
+# How much of the first chunk is test-compressed, and the ratio it must beat.
+SAMPLE_BYTES = 64 * 1024
+MIN_RATIO = 0.9
+READ_CHUNK = 1024 * 1024
+ZLIB_LEVEL = 6
+LZMA_PRESET = 1
+
+
+class _Compressor(Protocol):
+    def compress(self, data: bytes | memoryview, /) -> bytes: ...
+    def flush(self) -> bytes: ...
+
+
+class _Decompressor(Protocol):
+    # Set once the end of the stream was decoded; later input is not ours.
+    eof: bool
+
+    def decompress(self, data: bytes, /, max_length: int = ...) -> bytes: ...
+
+
+def codec_from_env() -> str:
+    codec = os.environ.get("DATA_CODEC", NONE)
+    if codec not in CODECS:
+        raise ValueError(f"unknown DATA_CODEC {codec!r}; expected one of {CODECS}")
+    return codec
+
+
+def _compressor(codec: str) -> _Compressor:
+    # Codec modules load on first use; most sessions never need them.
+    if codec == ZLIB:
+        import zlib
+
+        return zlib.compressobj(ZLIB_LEVEL)
+    import lzma
+
+    return lzma.LZMACompressor(preset=LZMA_PRESET)
+
+
+def _decompressor(codec: str) -> _Decompressor:
+    if codec == ZLIB:
+        import zlib
+
+        return zlib.decompressobj()
+    if codec == LZMA:
+        import lzma
+
+        return lzma.LZMADecompressor()
+    raise ValueError(f"unknown codec {codec!r}")
+
+
+def compressible(sample: bytes | memoryview) -> bool:
+    """
+    Quick zlib level-1 probe: False for payloads (archives, images, media)
+    that would not shrink by at least 1 - MIN_RATIO.
+    """
+    import zlib
+
+    sample = sample[:SAMPLE_BYTES]
+    return len(zlib.compress(sample, 1)) < len(sample) * MIN_RATIO
+
+
+class Encoder:
+    """
+    Write-through wrapper around a binary file. After finish(), `codec` is
+    what the bytes on disk are encoded with.
+    """
+
+    def __init__(self, dst: BinaryIO, codec: str) -> None:
+        self.codec = codec
+        self._dst = dst
+        self._comp: _Compressor | None = None
+        self._decided = codec == NONE
+
+    def write(self, data: bytes | memoryview) -> None:
+        if not self._decided:
+            self._decided = True
+            if compressible(data):
+                self._comp = _compressor(self.codec)
+            else:
+                self.codec = NONE
+        if self._comp is None:
+            self._dst.write(data)
+            return
+        out = self._comp.compress(data)
+        if out:
+            self._dst.write(out)
+
+    def finish(self) -> None:
+        if self._comp is not None:
+            self._dst.write(self._comp.flush())
+        elif not self._decided:
+            # Empty payload: nothing to compress.
+            self.codec = NONE
+
+
+def encode_path(path: Path, codec: str) -> str:
+    """
+    Compresses a finished file in place, for uploads whose writes did not
+    arrive in order (SFTP). Returns the codec the file ends up with.
+    """
+    if codec == NONE:
+        return NONE
+    tmp = path.with_name(path.name + ".z")
+    with open(path, "rb") as src:
+        if not compressible(src.read(SAMPLE_BYTES)):
+            return NONE
+        src.seek(0)
+        try:
+            with open(tmp, "wb") as dst:
+                comp = _compressor(codec)
+                while chunk := src.read(READ_CHUNK):
+                    dst.write(comp.compress(chunk))
+                dst.write(comp.flush())
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+    os.replace(tmp, path)
+    return codec
+
+
+def _pieces(src: BinaryIO, codec: str) -> Iterator[bytes]:
+    """
+    Decodes src in pieces of at most READ_CHUNK bytes, reading more of it
+    only once the input so far is used up: however well the payload
+    compressed, a piece never holds more than that.
+    """
+    dec = _decompressor(codec)
+    tail = b""
+    drained = False
+    while not dec.eof:
+        # zlib hands back the input it did not get to; lzma keeps it itself.
+        if not tail and getattr(dec, "needs_input", True) and not drained:
+            tail = src.read(READ_CHUNK)
+            drained = not tail
+        data = dec.decompress(tail, READ_CHUNK)
+        tail = getattr(dec, "unconsumed_tail", b"")
+        if data:
+            yield data
+        elif drained and not tail:
+            return
+
+
+def send_decoded(
+    src: BinaryIO,
+    out: BinaryIO,
+    count: int,
+    codec: str,
+    pace: Callable[[int], None] | None = None,
+) -> int:
+    """
+    Writes up to `count` decoded bytes of src to out; returns how many.
+    `pace` is called with each decoded chunk (see app.shaping).
+    """
+    sent = 0
+    for data in _pieces(src, codec):
+        data = data[: count - sent]
+        out.write(data)
+        sent += len(data)
+        if pace is not None:
+            pace(len(data))
+        if sent >= count:
+            break
+    return sent
+
+
+class DecodedReader:
+    """
+    pread() over a compressed file for SFTP. Decoding only goes forward, so
+    reads are cheap while offsets increase, as with pipelined downloads; a
+    read behind the window restarts from the beginning. The stream starts at
+    byte `start` of the file (a segment entry) and ends where it decodes to.
+    """
+
+    def __init__(self, path: str, codec: str, start: int = 0) -> None:
+        self._path = path
+        self._codec = codec
+        self._start = start
+        self._src: BinaryIO | None = None
+        self._restart()
+
+    def _restart(self) -> None:
+        self.close()
+        self._src = open(self._path, "rb")
+        self._src.seek(self._start)
+        self._pieces = _pieces(self._src, self._codec)
+        self._buf = bytearray()
+        self._buf_offset = 0
+        self._eof = False
+
+    def pread(self, length: int, offset: int) -> bytes:
+        if offset < self._buf_offset:
+            self._restart()
+        end = offset + length
+        while True:
+            # Drop what lies before this read; later reads only move forward.
+            skip = min(offset - self._buf_offset, len(self._buf))
+            del self._buf[:skip]
+            self._buf_offset += skip
+            if self._buf_offset + len(self._buf) >= end or self._eof:
+                break
+            piece = next(self._pieces, None)
+            if piece is None:
+                self._eof = True
+            else:
+                self._buf += piece
+        return bytes(self._buf[: end - self._buf_offset])
+
+    def close(self) -> None:
+        if self._src is not None:
+            self._src.close()
+            self._src = None
@@ -1,57 +1,59 @@
 from __future__ import annotations
 
 import os
-from contextlib import contextmanager
 from datetime import datetime, timezone
-from typing import Iterator
-
-import psycopg
+from types import ModuleType
+from typing import TYPE_CHECKING, ContextManager, Iterator, NamedTuple, Sequence
 
 from app import logutil
 
-ExpiredRow = tuple[str, str]
-
-
-def _dsn() -> str:
-    # Read DB connection info from environment for container flexibility.
-    host = os.environ["DB_HOST"]
-    port = os.environ.get("DB_PORT", "5432")
-    name = os.environ["DB_NAME"]
-    user = os.environ["DB_USER"]
-    pw = os.environ["DB_PASSWORD"]
-    logutil.debug(f"db dsn host={host} port={port} dbname={name} user={user}")
-    return f"host={host} port={port} dbname={name} user={user} password={pw}"
+if TYPE_CHECKING:
+    from app import db_postgres, db_sqlite
 
+    ExpiryListener = db_postgres.ExpiryListener | db_sqlite.ExpiryListener
 
-@contextmanager
-def conn() -> Iterator[psycopg.Connection]:
-    logutil.verbose("db connecting")
-    with psycopg.connect(_dsn()) as c:
-        yield c
-    logutil.verbose("db connection closed")
-
+ExpiredRow = tuple[str, str]
 
-def init_db() -> None:
-    # Idempotent schema initialization.
-    logutil.info("db init schema")
-    with conn() as c:
-        c.execute(
-            """
-            CREATE TABLE IF NOT EXISTS files (
-              token TEXT PRIMARY KEY,
-              sha512 TEXT NOT NULL,
-              original_name TEXT NOT NULL,
-              size_bytes BIGINT NOT NULL,
-              stored_path TEXT NOT NULL,
-              created_at TIMESTAMPTZ NOT NULL,
-              expires_at TIMESTAMPTZ NOT NULL
-            );
-            """
-        )
-        c.execute(
-            "CREATE INDEX IF NOT EXISTS idx_files_expires_at ON files(expires_at);"
-        )
-    logutil.debug("db init complete")
+# Receipts written per executemany() round; bounds memory and transaction size.
+INSERT_BATCH_SIZE = 500
+# Rows deleted per delete_expired() transaction.
+EXPIRE_BATCH_SIZE = 1000
+# insert_files() announces the earliest new expires_at here; the cleaner LISTENs.
+EXPIRY_CHANNEL = "files_expiry"
+
+# Default; see app.db_postgres.
+POSTGRES = "postgres"
+# Embedded, for single-node deployments (see app.db_sqlite).
+SQLITE = "sqlite"
+BACKENDS = (POSTGRES, SQLITE)
+
+
+class FileRecord(NamedTuple):
+    # Field order matches the INSERT column list so records bind directly.
+    token: str
+    sha512: str
+    original_name: str
+    size_bytes: int
+    stored_path: str
+    created_at: datetime
+    expires_at: datetime
+    # stored_path is a shared blob (see insert_files) rather than this token's own file.
+    blob: bool = False
+    # How stored_path is encoded on disk, one of compress.CODECS.
+    codec: str = "none"
+    # stored_path is a directory bundle (see app.bundle) from scp -r.
+    bundle: bool = False
+    # Set when stored_path is a shared segment (see app.segments): where this
+    # payload starts in it and how many bytes it takes there.
+    seg_offset: int | None = None
+    seg_length: int | None = None
+
+
+def backend_from_env() -> str:
+    backend = os.environ.get("DB_BACKEND", POSTGRES)
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown DB_BACKEND {backend!r}; expected one of {BACKENDS}")
+    return backend
 
 
 def insert_file(
@@ -64,56 +66,167 @@ def insert_file(
     created_at: datetime,
     expires_at: datetime,
 ) -> None:
-    logutil.debug(
-        f"db insert token={token} size_bytes={size_bytes} name={original_name!r}"
+    logutil.debug("db insert token=%s size_bytes=%s name=%r", token, size_bytes, original_name)
+    insert_files(
+        [
+            FileRecord(
+                token=token,
+                sha512=sha512,
+                original_name=original_name,
+                size_bytes=size_bytes,
+                stored_path=stored_path,
+                created_at=created_at,
+                expires_at=expires_at,
+            )
+        ]
     )
-    with conn() as c:
-        c.execute(
-            """
-            INSERT INTO files(token, sha512, original_name, size_bytes, stored_path, created_at, expires_at)
-            VALUES (%s,%s,%s,%s,%s,%s,%s)
-            """,
-            (
-                token,
-                sha512,
-                original_name,
-                size_bytes,
-                stored_path,
-                created_at,
-                expires_at,
-            ),
-        )
-    logutil.verbose("db insert complete")
-
-
-def get_file_by_token(
-    token: str,
-) -> tuple[str, str, str, int, str, datetime, datetime] | None:
-    logutil.debug(f"db lookup token={token}")
-    with conn() as c:
-        row = c.execute(
-            "SELECT token, sha512, original_name, size_bytes, stored_path, created_at, expires_at FROM files WHERE token=%s",
-            (token,),
-        ).fetchone()
-        logutil.verbose(f"db lookup token={token} found={row is not None}")
-        return row
-
-
-def delete_expired(now: datetime) -> list[ExpiredRow]:
-    """
-    Returns list of (token, stored_path) deleted from DB.
-    """
-    logutil.debug(f"db delete_expired now={now.isoformat()}")
-    with conn() as c:
-        rows = c.execute(
-            "SELECT token, stored_path FROM files WHERE expires_at <= %s",
-            (now,),
-        ).fetchall()
-        c.execute("DELETE FROM files WHERE expires_at <= %s", (now,))
-        logutil.info(f"db delete_expired deleted={len(rows)}")
-        return [(r[0], r[1]) for r in rows]
+
+
+def _blob_refs(
+    records: Sequence[FileRecord],
+) -> tuple[list[str], list[int], dict[str, FileRecord]]:
+    # (digests, references per digest, first record per digest). Sorted so
+    # concurrent sessions lock blobs rows in one order.
+    counts: dict[str, int] = {}
+    candidates: dict[str, FileRecord] = {}
+    for r in records:
+        counts[r.sha512] = counts.get(r.sha512, 0) + 1
+        candidates.setdefault(r.sha512, r)
+    digests = sorted(counts)
+    return digests, [counts[d] for d in digests], candidates
+
+
+def _segment_deltas(
+    entries: Sequence[tuple[str, int]], sign: int
+) -> tuple[list[str], list[int], list[int]]:
+    # (paths, live deltas, byte deltas), in path order so sessions lock
+    # segments rows alike.
+    live: dict[str, int] = {}
+    size: dict[str, int] = {}
+    for path, length in entries:
+        live[path] = live.get(path, 0) + sign
+        size[path] = size.get(path, 0) + sign * length
+    paths = sorted(live)
+    return paths, [live[p] for p in paths], [size[p] for p in paths]
+
+
+def _release_counts(digests: list[str]) -> tuple[list[str], list[int]]:
+    # Sorted digests and how many references each loses.
+    counts: dict[str, int] = {}
+    for d in digests:
+        counts[d] = counts.get(d, 0) + 1
+    keys = sorted(counts)
+    return keys, [counts[k] for k in keys]
 
 
 def utcnow() -> datetime:
     # Centralized time source for easier testing/mocking.
     return datetime.now(timezone.utc)
+
+
+def backend() -> ModuleType:
+    """
+    The module that implements the functions below for DB_BACKEND, read at
+    each call: app.db_postgres or app.db_sqlite.
+    """
+    if backend_from_env() == SQLITE:
+        from app import db_sqlite
+
+        return db_sqlite
+    from app import db_postgres
+
+    return db_postgres
+
+
+# What callers use, whatever the backend; each one goes to backend().
+
+
+def hold_connection() -> None:
+    backend().hold_connection()
+
+
+def release_connection() -> None:
+    backend().release_connection()
+
+
+def session() -> ContextManager[None]:
+    return backend().session()
+
+
+def init_db() -> None:
+    backend().init_db()
+
+
+def insert_files(records: Sequence[FileRecord]) -> list[str]:
+    return backend().insert_files(records)
+
+
+def get_file_by_token(token: str) -> FileRecord | None:
+    return backend().get_file_by_token(token)
+
+
+def delete_expired(
+    now: datetime, batch_size: int = EXPIRE_BATCH_SIZE
+) -> Iterator[list[ExpiredRow]]:
+    return backend().delete_expired(now, batch_size)
+
+
+def list_stored_paths(after_token: str, limit: int) -> list[tuple[str, str]]:
+    return backend().list_stored_paths(after_token, limit)
+
+
+def list_tokens(after_token: str, limit: int) -> list[str]:
+    return backend().list_tokens(after_token, limit)
+
+
+def update_stored_paths(moves: Sequence[tuple[str, str, str]]) -> set[str]:
+    return backend().update_stored_paths(moves)
+
+
+def segment_usage(paths: Sequence[str]) -> dict[str, tuple[int, int]]:
+    return backend().segment_usage(paths)
+
+
+def forget_segments(paths: Sequence[str]) -> list[str]:
+    return backend().forget_segments(paths)
+
+
+def segment_entries(path: str) -> list[tuple[str, int, int]]:
+    return backend().segment_entries(path)
+
+
+def move_segment_entries(old_path: str, moves: Sequence[tuple[str, str, int]]) -> set[str]:
+    return backend().move_segment_entries(old_path, moves)
+
+
+def upcoming_expirations(limit: int) -> list[datetime]:
+    return backend().upcoming_expirations(limit)
+
+
+def charge_key(
+    key: str,
+    sessions: int,
+    size_bytes: int,
+    *,
+    max_sessions: int,
+    max_bytes: int,
+    now: datetime,
+    window_seconds: float,
+) -> bool:
+    return backend().charge_key(
+        key,
+        sessions,
+        size_bytes,
+        max_sessions=max_sessions,
+        max_bytes=max_bytes,
+        now=now,
+        window_seconds=window_seconds,
+    )
+
+
+def refund_key(key: str, sessions: int, size_bytes: int) -> None:
+    backend().refund_key(key, sessions, size_bytes)
+
+
+def expiry_listener() -> ExpiryListener:
+    return backend().ExpiryListener()
@@ -0,0 +1,596 @@
+"""
+Postgres metadata backend, the default (DB_BACKEND=postgres).
+
+Sessions reuse one connection per process (hold_connection, session), and
+insert_files() announces new deadlines with NOTIFY, which ExpiryListener
+waits on in the cleaner. psycopg is imported on first connect.
+"""
+from __future__ import annotations
+
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from types import ModuleType
+from typing import TYPE_CHECKING, Iterator, Sequence
+
+from app import logutil, metrics, phases
+from app.db import (
+    EXPIRE_BATCH_SIZE,
+    EXPIRY_CHANNEL,
+    POSTGRES,
+    ExpiredRow,
+    FileRecord,
+    _blob_refs,
+    _release_counts,
+    _segment_deltas,
+)
+
+if TYPE_CHECKING:
+    import psycopg
+
+# Connection kept open by long-lived processes (see hold_connection).
+_HELD: psycopg.Connection | None = None
+# Set inside session(): conn() opens _HELD on first use and keeps it.
+_KEEP = False
+
+_FILE_COLUMNS = ", ".join(FileRecord._fields)
+_FILE_VALUES = ", ".join(["%s"] * len(FileRecord._fields))
+
+# Drains a key's buckets by the time since they were last charged, at their
+# maximum per window, and adds the charge only if both stay within their
+# maxima; no row comes back otherwise.
+_DRAINED = """
+    GREATEST(0, b.{column} - GREATEST(0, EXTRACT(EPOCH FROM EXCLUDED.charged_at - b.charged_at))
+      * %(max_{column})s / %(window)s)
+"""
+_CHARGE_KEY = f"""
+    INSERT INTO key_buckets AS b (fingerprint, charged_at, sessions, bytes)
+    VALUES (%(key)s, %(now)s, %(sessions)s, %(bytes)s)
+    ON CONFLICT (fingerprint) DO UPDATE SET
+      charged_at = GREATEST(b.charged_at, EXCLUDED.charged_at),
+      sessions = {_DRAINED.format(column="sessions")} + EXCLUDED.sessions,
+      bytes = {_DRAINED.format(column="bytes")} + EXCLUDED.bytes
+    WHERE {_DRAINED.format(column="sessions")} + EXCLUDED.sessions <= %(max_sessions)s
+      AND {_DRAINED.format(column="bytes")} + EXCLUDED.bytes <= %(max_bytes)s
+    RETURNING sessions
+"""
+_REFUND_KEY = """
+    UPDATE key_buckets SET
+      sessions = GREATEST(0, sessions - %(sessions)s), bytes = GREATEST(0, bytes - %(bytes)s)
+    WHERE fingerprint = %(key)s
+"""
+
+
+def _dsn() -> str:
+    # Read DB connection info from environment for container flexibility.
+    host = os.environ["DB_HOST"]
+    port = os.environ.get("DB_PORT", "5432")
+    name = os.environ["DB_NAME"]
+    user = os.environ["DB_USER"]
+    pw = os.environ["DB_PASSWORD"]
+    logutil.debug("db dsn host=%s port=%s dbname=%s user=%s", host, port, name, user)
+    return f"host={host} port={port} dbname={name} user={user} password={pw}"
+
+
+def _psycopg() -> ModuleType:
+    # Imported on first use so sessions that fail before touching the DB
+    # (bad flags, missing token) never pay for loading psycopg.
+    import psycopg
+
+    return psycopg
+
+
+def hold_connection() -> None:
+    """
+    Open one connection for this process and reuse it for every conn() block.
+    Used by pre-forked gateway workers so sessions skip the connect handshake.
+    """
+    global _HELD
+    release_connection()
+    logutil.debug("db holding connection")
+    with phases.span("db_connect"):
+        _HELD = _psycopg().connect(_dsn(), autocommit=True)
+
+
+def release_connection() -> None:
+    global _HELD
+    held, _HELD = _HELD, None
+    if held is not None:
+        held.close()
+        logutil.debug("db released held connection")
+
+
+@contextmanager
+
+def session() -> Iterator[None]:
+    """
+    Reuse one connection for every conn() block inside, opened on first use.
+    Nested sessions and processes that already hold a connection share it.
+    """
+    global _KEEP
+    if _KEEP or _HELD is not None:
+        yield
+        return
+    _KEEP = True
+    try:
+        yield
+    finally:
+        _KEEP = False
+        release_connection()
+
+
+@contextmanager
+
+def conn() -> Iterator[psycopg.Connection]:
+    started = time.perf_counter()
+    try:
+        if _HELD is None and _KEEP:
+            hold_connection()
+        if _HELD is not None:
+            if _HELD.closed or _HELD.broken:
+                logutil.warning("db held connection lost, reconnecting")
+                hold_connection()
+            # Held connections are autocommit; each block is one transaction.
+            with _HELD.transaction():
+                yield _HELD
+            return
+        logutil.verbose("db connecting")
+        with _psycopg().connect(_dsn()) as c:
+            yield c
+        logutil.verbose("db connection closed")
+    finally:
+        # Connect through commit: what a caller waits for.
+        metrics.observe("db_transaction_seconds", time.perf_counter() - started, backend=POSTGRES)
+
+
+def init_db() -> None:
+    # Idempotent schema initialization.
+    logutil.info("db init schema")
+    with conn() as c:
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+              token TEXT PRIMARY KEY,
+              sha512 TEXT NOT NULL,
+              original_name TEXT NOT NULL,
+              size_bytes BIGINT NOT NULL,
+              stored_path TEXT NOT NULL,
+              created_at TIMESTAMPTZ NOT NULL,
+              expires_at TIMESTAMPTZ NOT NULL
+            );
+            """
+        )
+        c.execute(
+            "CREATE INDEX IF NOT EXISTS idx_files_expires_at ON files(expires_at);"
+        )
+        c.execute(
+            "ALTER TABLE files ADD COLUMN IF NOT EXISTS blob BOOLEAN NOT NULL DEFAULT false;"
+        )
+        # One row per deduplicated payload; refcount = files rows with blob=true.
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+              sha512 TEXT PRIMARY KEY,
+              stored_path TEXT NOT NULL,
+              refcount BIGINT NOT NULL
+            );
+            """
+        )
+        c.execute(
+            "ALTER TABLE files ADD COLUMN IF NOT EXISTS codec TEXT NOT NULL DEFAULT 'none';"
+        )
+        c.execute(
+            "ALTER TABLE blobs ADD COLUMN IF NOT EXISTS codec TEXT NOT NULL DEFAULT 'none';"
+        )
+        c.execute(
+            "ALTER TABLE files ADD COLUMN IF NOT EXISTS bundle BOOLEAN NOT NULL DEFAULT false;"
+        )
+        c.execute(
+            "ALTER TABLE files ADD COLUMN IF NOT EXISTS seg_offset BIGINT, "
+            "ADD COLUMN IF NOT EXISTS seg_length BIGINT;"
+        )
+        # Live entries per segment file; the cleaner reclaims those left at 0.
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS segments (
+              path TEXT PRIMARY KEY,
+              live BIGINT NOT NULL,
+              live_bytes BIGINT NOT NULL
+            );
+            """
+        )
+        c.execute(
+            "CREATE INDEX IF NOT EXISTS idx_files_segment ON files(stored_path) "
+            "WHERE seg_offset IS NOT NULL;"
+        )
+        # Per-key token buckets for app.quota; they replace the fixed-window
+        # key_usage counters, which only ever held the current window.
+        c.execute("DROP TABLE IF EXISTS key_usage;")
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS key_buckets (
+              fingerprint TEXT PRIMARY KEY,
+              charged_at TIMESTAMPTZ NOT NULL,
+              sessions DOUBLE PRECISION NOT NULL,
+              bytes DOUBLE PRECISION NOT NULL
+            );
+            """
+        )
+    logutil.debug("db init complete")
+
+
+def _adopt_blobs(
+    c: psycopg.Connection, records: Sequence[FileRecord]
+) -> dict[str, tuple[str, str]]:
+    # Take a reference on each digest, registering the candidate file if the
+    # blob is new.
+    digests, counts, candidates = _blob_refs(records)
+    rows = c.execute(
+        """
+        INSERT INTO blobs (sha512, stored_path, refcount, codec)
+        SELECT * FROM unnest(%s::text[], %s::text[], %s::bigint[], %s::text[])
+        ON CONFLICT (sha512) DO UPDATE SET refcount = blobs.refcount + EXCLUDED.refcount
+        RETURNING sha512, stored_path, codec
+        """,
+        (
+            digests,
+            [candidates[d].stored_path for d in digests],
+            counts,
+            [candidates[d].codec for d in digests],
+        ),
+    ).fetchall()
+    return {r[0]: (r[1], r[2]) for r in rows}
+
+
+def insert_files(records: Sequence[FileRecord]) -> list[str]:
+    """
+    Insert a group of receipts in one transaction.
+    executemany() runs in pipeline mode, so the group costs one round trip.
+
+    Records with blob=True carry a candidate blob file in stored_path; each
+    row is pointed at the blob already registered for its sha512, if any,
+    and takes that blob's codec.
+    Returns the candidate files that were not adopted, for the caller to
+    remove once this has committed.
+    """
+    if not records:
+        return []
+    logutil.debug("db insert_files count=%s", len(records))
+    candidates = [r.stored_path for r in records if r.blob]
+    blobs: dict[str, tuple[str, str]] = {}
+    with conn() as c:
+        if candidates:
+            blobs = _adopt_blobs(c, [r for r in records if r.blob])
+            records = [
+                r._replace(stored_path=blobs[r.sha512][0], codec=blobs[r.sha512][1])
+                if r.blob
+                else r
+                for r in records
+            ]
+        with c.cursor() as cur:
+            cur.executemany(
+                f"INSERT INTO files({_FILE_COLUMNS}) VALUES ({_FILE_VALUES})",
+                records,
+            )
+        _count_segments(
+            c, [(r.stored_path, r.seg_length) for r in records if r.seg_length is not None], 1
+        )
+        # Delivered on commit, so the cleaner never sees a row it cannot read.
+        c.execute(
+            "SELECT pg_notify(%s, %s)",
+            (EXPIRY_CHANNEL, min(r.expires_at for r in records).isoformat()),
+        )
+    logutil.verbose("db insert_files complete")
+    adopted = {path for path, _ in blobs.values()}
+    return [path for path in candidates if path not in adopted]
+
+
+def _count_segments(
+    c: psycopg.Connection, entries: Sequence[tuple[str, int]], sign: int
+) -> None:
+    # Adds (sign=1) or removes (sign=-1) (path, length) entries from the
+    # per-segment counts.
+    if not entries:
+        return
+    c.execute(
+        """
+        INSERT INTO segments (path, live, live_bytes)
+        SELECT * FROM unnest(%s::text[], %s::bigint[], %s::bigint[])
+        ON CONFLICT (path) DO UPDATE SET live = segments.live + EXCLUDED.live,
+          live_bytes = segments.live_bytes + EXCLUDED.live_bytes
+        """,
+        _segment_deltas(entries, sign),
+    )
+
+
+def get_file_by_token(token: str) -> FileRecord | None:
+    logutil.debug("db lookup token=%s", token)
+    with conn() as c:
+        row = c.execute(
+            f"SELECT {_FILE_COLUMNS} FROM files WHERE token=%s",
+            (token,),
+        ).fetchone()
+        logutil.verbose("db lookup token=%s found=%s", token, row is not None)
+        return None if row is None else FileRecord(*row)
+
+
+def delete_expired(
+    now: datetime, batch_size: int = EXPIRE_BATCH_SIZE
+) -> Iterator[list[ExpiredRow]]:
+    """
+    Yields batches of (token, stored_path) deleted from DB.
+    Each batch is one short DELETE ... RETURNING transaction, committed before
+    it is yielded, so memory and lock time stay bounded however large the
+    backlog is. Rows locked by a concurrent cleaner are skipped.
+    Rows sharing a blob release their reference instead; a blob is yielded
+    as (sha512, stored_path) once its last reference is gone. Rows stored in
+    a segment only update its counts; whole segments are reclaimed separately.
+    """
+    logutil.debug("db delete_expired now=%s batch_size=%s", now.isoformat(), batch_size)
+    deleted = 0
+    with session():
+        while True:
+            with conn() as c:
+                # ctid = ANY(ARRAY(...)) lets the planner use a TID scan.
+                rows = c.execute(
+                    """
+                    DELETE FROM files
+                    WHERE ctid = ANY(ARRAY(
+                      SELECT ctid FROM files
+                      WHERE expires_at <= %s
+                      LIMIT %s
+                      FOR UPDATE SKIP LOCKED
+                    ))
+                    RETURNING token, stored_path, sha512, blob, seg_length
+                    """,
+                    (now, batch_size),
+                ).fetchall()
+                expired = [(r[0], r[1]) for r in rows if not r[3] and r[4] is None]
+                expired += _release_blobs(c, [r[2] for r in rows if r[3]])
+                _count_segments(c, [(r[1], r[4]) for r in rows if r[4] is not None], -1)
+            deleted += len(rows)
+            if expired:
+                logutil.debug("db delete_expired batch=%s files=%s", len(rows), len(expired))
+                yield expired
+            if len(rows) < batch_size:
+                break
+    logutil.info(f"db delete_expired deleted={deleted}")
+
+
+def _release_blobs(c: psycopg.Connection, digests: list[str]) -> list[ExpiredRow]:
+    # Drop one reference per expired row; blobs left unreferenced are removed.
+    if not digests:
+        return []
+    keys, counts = _release_counts(digests)
+    # Same lock order as insert_files, so the two never deadlock.
+    c.execute(
+        "SELECT 1 FROM blobs WHERE sha512 = ANY(%s) ORDER BY sha512 FOR UPDATE", (keys,)
+    )
+    c.execute(
+        """
+        UPDATE blobs AS b SET refcount = b.refcount - d.n
+        FROM (SELECT unnest(%s::text[]) AS sha512, unnest(%s::bigint[]) AS n) AS d
+        WHERE b.sha512 = d.sha512
+        """,
+        (keys, counts),
+    )
+    rows = c.execute(
+        "DELETE FROM blobs WHERE sha512 = ANY(%s) AND refcount <= 0 RETURNING sha512, stored_path",
+        (keys,),
+    ).fetchall()
+    return [(r[0], r[1]) for r in rows]
+
+
+def list_stored_paths(after_token: str, limit: int) -> list[tuple[str, str]]:
+    """
+    Returns up to `limit` (token, stored_path) rows with token > after_token,
+    in token order, for keyset-paginated scans of the whole table. Rows that
+    share a blob or a segment are left out: their paths do not depend on the
+    token.
+    """
+    with conn() as c:
+        rows = c.execute(
+            "SELECT token, stored_path FROM files WHERE token > %s AND NOT blob "
+            "AND seg_offset IS NULL ORDER BY token LIMIT %s",
+            (after_token, limit),
+        ).fetchall()
+    return [(r[0], r[1]) for r in rows]
+
+
+def list_tokens(after_token: str, limit: int) -> list[str]:
+    """
+    Returns up to `limit` tokens > after_token in token order, for keyset
+    scans of every row (see bloom.rebuild).
+    """
+    with conn() as c:
+        rows = c.execute(
+            "SELECT token FROM files WHERE token > %s ORDER BY token LIMIT %s",
+            (after_token, limit),
+        ).fetchall()
+    return [r[0] for r in rows]
+
+
+def update_stored_paths(moves: Sequence[tuple[str, str, str]]) -> set[str]:
+    """
+    Applies (token, old_path, new_path) moves in one statement. A row is only
+    updated if it still points at old_path; returns the tokens that were.
+    """
+    if not moves:
+        return set()
+    tokens, old_paths, new_paths = (list(col) for col in zip(*moves))
+    logutil.debug("db update_stored_paths count=%s", len(moves))
+    with conn() as c:
+        rows = c.execute(
+            """
+            UPDATE files AS f SET stored_path = m.new_path
+            FROM (
+              SELECT unnest(%s::text[]) AS token,
+                     unnest(%s::text[]) AS old_path,
+                     unnest(%s::text[]) AS new_path
+            ) AS m
+            WHERE f.token = m.token AND f.stored_path = m.old_path
+            RETURNING f.token
+            """,
+            (tokens, old_paths, new_paths),
+        ).fetchall()
+    return {r[0] for r in rows}
+
+
+def segment_usage(paths: Sequence[str]) -> dict[str, tuple[int, int]]:
+    """
+    Returns {path: (live entries, live bytes)} for the segments that have a row.
+    """
+    with conn() as c:
+        rows = c.execute(
+            "SELECT path, live, live_bytes FROM segments WHERE path = ANY(%s)",
+            (list(paths),),
+        ).fetchall()
+    return {r[0]: (r[1], r[2]) for r in rows}
+
+
+def forget_segments(paths: Sequence[str]) -> list[str]:
+    """
+    Drops the rows of segments without live entries; returns the paths that
+    are now safe to unlink. A segment with no row at all is returned as well:
+    callers pass only segments whose lease they hold (segments.lock_idle),
+    so no session still has entries in it waiting for their rows.
+    """
+    with conn() as c:
+        counted = {
+            r[0]: r[1]
+            for r in c.execute(
+                "SELECT path, live FROM segments WHERE path = ANY(%s) FOR UPDATE",
+                (list(paths),),
+            ).fetchall()
+        }
+        c.execute("DELETE FROM segments WHERE path = ANY(%s) AND live <= 0", (list(paths),))
+    return [p for p in paths if counted.get(p, 0) <= 0]
+
+
+def segment_entries(path: str) -> list[tuple[str, int, int]]:
+    """
+    Returns (token, seg_offset, seg_length) for the rows stored in a segment.
+    """
+    with conn() as c:
+        rows = c.execute(
+            "SELECT token, seg_offset, seg_length FROM files "
+            "WHERE stored_path = %s AND seg_offset IS NOT NULL ORDER BY seg_offset",
+            (path,),
+        ).fetchall()
+    return [(r[0], r[1], r[2]) for r in rows]
+
+
+def move_segment_entries(old_path: str, moves: Sequence[tuple[str, str, int]]) -> set[str]:
+    """
+    Repoints (token, new_path, new_offset) rows that still live in old_path
+    and moves their counts along; returns the tokens that were updated.
+    """
+    if not moves:
+        return set()
+    tokens, new_paths, offsets = (list(col) for col in zip(*moves))
+    logutil.debug("db move_segment_entries path=%s count=%s", old_path, len(moves))
+    with conn() as c:
+        rows = c.execute(
+            """
+            UPDATE files AS f SET stored_path = m.new_path, seg_offset = m.new_offset
+            FROM (
+              SELECT unnest(%s::text[]) AS token,
+                     unnest(%s::text[]) AS new_path,
+                     unnest(%s::bigint[]) AS new_offset
+            ) AS m
+            WHERE f.token = m.token AND f.stored_path = %s AND f.seg_offset IS NOT NULL
+            RETURNING f.token, f.stored_path, f.seg_length
+            """,
+            (tokens, new_paths, offsets, old_path),
+        ).fetchall()
+        _count_segments(c, [(old_path, r[2]) for r in rows], -1)
+        _count_segments(c, [(r[1], r[2]) for r in rows], 1)
+    return {r[0] for r in rows}
+
+
+def upcoming_expirations(limit: int) -> list[datetime]:
+    """
+    Returns the earliest `limit` expires_at values, oldest first.
+    """
+    logutil.debug("db upcoming_expirations limit=%s", limit)
+    with conn() as c:
+        rows = c.execute(
+            "SELECT expires_at FROM files ORDER BY expires_at LIMIT %s",
+            (limit,),
+        ).fetchall()
+    return [r[0] for r in rows]
+
+
+def charge_key(
+    key: str,
+    sessions: int,
+    size_bytes: int,
+    *,
+    max_sessions: int,
+    max_bytes: int,
+    now: datetime,
+    window_seconds: float,
+) -> bool:
+    """
+    Adds sessions and bytes to `key`'s buckets if that keeps both within
+    their maxima, after draining each by its maximum per `window_seconds`
+    since the last charge. Returns False, charging nothing, when it would not.
+    """
+    params = dict(
+        key=key,
+        sessions=sessions,
+        bytes=size_bytes,
+        max_sessions=max_sessions,
+        max_bytes=max_bytes,
+        now=now,
+        window=window_seconds,
+    )
+    with conn() as c:
+        row = c.execute(_CHARGE_KEY, params).fetchone()
+    return row is not None
+
+
+def refund_key(key: str, sessions: int, size_bytes: int) -> None:
+    """
+    Takes back a charge_key() charge for work that did not happen.
+    """
+    with conn() as c:
+        c.execute(_REFUND_KEY, dict(key=key, sessions=sessions, bytes=size_bytes))
+
+
+class ExpiryListener:
+    """
+    Dedicated LISTEN connection for deadlines announced by insert_files().
+    """
+
+    def __init__(self) -> None:
+        self._conn: psycopg.Connection | None = None
+
+    def __enter__(self) -> "ExpiryListener":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        listener, self._conn = self._conn, None
+        if listener is not None:
+            listener.close()
+
+    def connect(self) -> None:
+        self.close()
+        logutil.debug("db listening channel=%s", EXPIRY_CHANNEL)
+        self._conn = _psycopg().connect(_dsn(), autocommit=True)
+        self._conn.execute(f"LISTEN {EXPIRY_CHANNEL}")
+
+    def wait(self, timeout: float) -> list[datetime]:
+        """
+        Blocks up to `timeout` seconds; returns announced deadlines (possibly none).
+        """
+        if self._conn is None:
+            raise RuntimeError("expiry listener is not connected")
+        return [
+            datetime.fromisoformat(n.payload)
+            for n in self._conn.notifies(timeout=timeout, stop_after=1)
+        ]
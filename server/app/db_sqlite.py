@@ -0,0 +1,511 @@
+"""
+SQLite metadata backend for single-node deployments (DB_BACKEND=sqlite).
+
+Same functions and schema as app.db_postgres, over a WAL-mode database
+file on local disk, so lookups and inserts cost a page read or an fsync
+instead of a network round trip. Readers never block the writer;
+writers (gateway workers and the cleaner) take turns through BEGIN
+IMMEDIATE, waiting up to BUSY_SECONDS for each other.
+
+Timestamps are stored as fixed-width UTC ISO strings, so they sort as text.
+There is no LISTEN/NOTIFY: ExpiryListener polls for new rows instead.
+"""
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterator, Sequence
+
+from app import logutil, metrics, phases
+from app.db import (
+    EXPIRE_BATCH_SIZE,
+    ExpiredRow,
+    SQLITE,
+    FileRecord,
+    _blob_refs,
+    _release_counts,
+    _segment_deltas,
+)
+
+# How long a writer waits for another one before giving up.
+BUSY_SECONDS = 30.0
+# ExpiryListener.wait() checks for new rows this often.
+POLL_SECONDS = 5.0
+
+_FILE_COLUMNS = ", ".join(FileRecord._fields)
+_FILE_VALUES = ", ".join(["?"] * len(FileRecord._fields))
+# id never repeats (AUTOINCREMENT), so ExpiryListener can poll for rows
+# above the last id it saw even after the newest rows were deleted.
+_FILES_TABLE = """
+    CREATE TABLE IF NOT EXISTS files (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      token TEXT NOT NULL UNIQUE,
+      sha512 TEXT NOT NULL,
+      original_name TEXT NOT NULL,
+      size_bytes INTEGER NOT NULL,
+      stored_path TEXT NOT NULL,
+      created_at TEXT NOT NULL,
+      expires_at TEXT NOT NULL,
+      blob INTEGER NOT NULL DEFAULT 0,
+      codec TEXT NOT NULL DEFAULT 'none',
+      bundle INTEGER NOT NULL DEFAULT 0,
+      seg_offset INTEGER,
+      seg_length INTEGER
+    )
+"""
+# See app.db_postgres._CHARGE_KEY; julianday() differences are in days.
+_DRAINED = """
+    max(0, b.{column} - max(0, julianday(excluded.charged_at) - julianday(b.charged_at))
+      * 86400 * :max_{column} / :window)
+"""
+_CHARGE_KEY = f"""
+    INSERT INTO key_buckets AS b (fingerprint, charged_at, sessions, bytes)
+    VALUES (:key, :now, :sessions, :bytes)
+    ON CONFLICT (fingerprint) DO UPDATE SET
+      charged_at = max(b.charged_at, excluded.charged_at),
+      sessions = {_DRAINED.format(column="sessions")} + excluded.sessions,
+      bytes = {_DRAINED.format(column="bytes")} + excluded.bytes
+    WHERE {_DRAINED.format(column="sessions")} + excluded.sessions <= :max_sessions
+      AND {_DRAINED.format(column="bytes")} + excluded.bytes <= :max_bytes
+    RETURNING sessions
+"""
+_REFUND_KEY = """
+    UPDATE key_buckets SET
+      sessions = max(0, sessions - :sessions), bytes = max(0, bytes - :bytes)
+    WHERE fingerprint = :key
+"""
+
+# Opened on first use in each process; a forked child opens its own.
+_CONN: sqlite3.Connection | None = None
+_PID = 0
+
+
+def _path() -> str:
+    default = os.path.join(os.environ.get("DATA_DIR", "/data"), "meta", "files.db")
+    return os.environ.get("DB_PATH", default)
+
+
+def _ts(value: datetime) -> str:
+    return value.astimezone(timezone.utc).isoformat(timespec="microseconds")
+
+
+def _dt(value: str) -> datetime:
+    return datetime.fromisoformat(value)
+
+
+def _json(values: Sequence[str]) -> str:
+    # Lists are bound as one JSON array and expanded with json_each().
+    return json.dumps(list(values))
+
+
+def _connection() -> sqlite3.Connection:
+    global _CONN, _PID
+    if _CONN is None or _PID != os.getpid():
+        path = _path()
+        logutil.debug("db sqlite open path=%s", path)
+        with phases.span("db_connect"):
+            # isolation_level=None: transactions are only what conn() begins.
+            _CONN = sqlite3.connect(path, timeout=BUSY_SECONDS, isolation_level=None)
+            _CONN.execute("PRAGMA journal_mode=WAL")
+            # With WAL, NORMAL only syncs at checkpoints; a crash of the process
+            # loses nothing, a power cut at most the last transactions.
+            _CONN.execute("PRAGMA synchronous=NORMAL")
+        _PID = os.getpid()
+    return _CONN
+
+
+def hold_connection() -> None:
+    """
+    Open this process's connection now rather than on first use.
+    """
+    release_connection()
+    _connection()
+
+
+def release_connection() -> None:
+    global _CONN
+    held, _CONN = _CONN, None
+    if held is not None and _PID == os.getpid():
+        held.close()
+        logutil.debug("db released held connection")
+
+
+@contextmanager
+def session() -> Iterator[None]:
+    # Every process already reuses one connection.
+    yield
+
+
+@contextmanager
+def conn() -> Iterator[sqlite3.Connection]:
+    # One write transaction; IMMEDIATE takes the write lock up front, so two
+    # writers never deadlock upgrading a read lock.
+    started = time.perf_counter()
+    c = _connection()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            yield c
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
+    finally:
+        metrics.observe("db_transaction_seconds", time.perf_counter() - started, backend=SQLITE)
+
+
+def init_db() -> None:
+    # Idempotent schema initialization.
+    path = _path()
+    logutil.info(f"db init schema path={path}")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with conn() as c:
+        row = c.execute("SELECT sql FROM sqlite_master WHERE name = 'files'").fetchone()
+        # Tables from before the AUTOINCREMENT id are rebuilt around it.
+        rebuild = row is not None and "AUTOINCREMENT" not in row[0]
+        if rebuild:
+            logutil.info("db rebuilding files with an AUTOINCREMENT id")
+            c.execute("ALTER TABLE files RENAME TO files_old")
+        c.execute(_FILES_TABLE)
+        if rebuild:
+            c.execute(
+                f"INSERT INTO files({_FILE_COLUMNS}) "
+                f"SELECT {_FILE_COLUMNS} FROM files_old ORDER BY rowid"
+            )
+            c.execute("DROP TABLE files_old")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_files_expires_at ON files(expires_at)")
+        c.execute(
+            "CREATE INDEX IF NOT EXISTS idx_files_segment ON files(stored_path) "
+            "WHERE seg_offset IS NOT NULL"
+        )
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+              sha512 TEXT PRIMARY KEY,
+              stored_path TEXT NOT NULL,
+              refcount INTEGER NOT NULL,
+              codec TEXT NOT NULL DEFAULT 'none'
+            )
+            """
+        )
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS segments (
+              path TEXT PRIMARY KEY,
+              live INTEGER NOT NULL,
+              live_bytes INTEGER NOT NULL
+            )
+            """
+        )
+        c.execute("DROP TABLE IF EXISTS key_usage")
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS key_buckets (
+              fingerprint TEXT PRIMARY KEY,
+              charged_at TEXT NOT NULL,
+              sessions REAL NOT NULL,
+              bytes REAL NOT NULL
+            )
+            """
+        )
+    logutil.debug("db init complete")
+
+
+def _adopt_blobs(
+    c: sqlite3.Connection, records: Sequence[FileRecord]
+) -> dict[str, tuple[str, str]]:
+    digests, counts, candidates = _blob_refs(records)
+    blobs = {}
+    for digest, count in zip(digests, counts):
+        row = c.execute(
+            """
+            INSERT INTO blobs (sha512, stored_path, refcount, codec) VALUES (?, ?, ?, ?)
+            ON CONFLICT (sha512) DO UPDATE SET refcount = refcount + excluded.refcount
+            RETURNING stored_path, codec
+            """,
+            (digest, candidates[digest].stored_path, count, candidates[digest].codec),
+        ).fetchone()
+        blobs[digest] = (row[0], row[1])
+    return blobs
+
+
+def _count_segments(
+    c: sqlite3.Connection, entries: Sequence[tuple[str, int]], sign: int
+) -> None:
+    c.executemany(
+        """
+        INSERT INTO segments (path, live, live_bytes) VALUES (?, ?, ?)
+        ON CONFLICT (path) DO UPDATE SET live = live + excluded.live,
+          live_bytes = live_bytes + excluded.live_bytes
+        """,
+        zip(*_segment_deltas(entries, sign)),
+    )
+
+
+def insert_files(records: Sequence[FileRecord]) -> list[str]:
+    """
+    Insert a group of receipts in one transaction; see app.db.insert_files.
+    """
+    if not records:
+        return []
+    logutil.debug("db insert_files count=%s", len(records))
+    candidates = [r.stored_path for r in records if r.blob]
+    blobs: dict[str, tuple[str, str]] = {}
+    with conn() as c:
+        if candidates:
+            blobs = _adopt_blobs(c, [r for r in records if r.blob])
+            records = [
+                r._replace(stored_path=blobs[r.sha512][0], codec=blobs[r.sha512][1])
+                if r.blob
+                else r
+                for r in records
+            ]
+        c.executemany(
+            f"INSERT INTO files({_FILE_COLUMNS}) VALUES ({_FILE_VALUES})",
+            [
+                r._replace(created_at=_ts(r.created_at), expires_at=_ts(r.expires_at))
+                for r in records
+            ],
+        )
+        _count_segments(
+            c, [(r.stored_path, r.seg_length) for r in records if r.seg_length is not None], 1
+        )
+    logutil.verbose("db insert_files complete")
+    adopted = {path for path, _ in blobs.values()}
+    return [path for path in candidates if path not in adopted]
+
+
+def _record(row: tuple) -> FileRecord:
+    record = FileRecord(*row)
+    return record._replace(
+        created_at=_dt(record.created_at),
+        expires_at=_dt(record.expires_at),
+        blob=bool(record.blob),
+        bundle=bool(record.bundle),
+    )
+
+
+def get_file_by_token(token: str) -> FileRecord | None:
+    logutil.debug("db lookup token=%s", token)
+    started = time.perf_counter()
+    # A plain read outside conn(); timed the same way for comparable numbers.
+    row = _connection().execute(
+        f"SELECT {_FILE_COLUMNS} FROM files WHERE token=?", (token,)
+    ).fetchone()
+    metrics.observe("db_transaction_seconds", time.perf_counter() - started, backend=SQLITE)
+    logutil.verbose("db lookup token=%s found=%s", token, row is not None)
+    return None if row is None else _record(row)
+
+
+def delete_expired(
+    now: datetime, batch_size: int = EXPIRE_BATCH_SIZE
+) -> Iterator[list[ExpiredRow]]:
+    """
+    Yields batches of (token, stored_path) deleted from DB, with the same
+    blob and segment handling as app.db.delete_expired.
+    """
+    logutil.debug("db delete_expired now=%s batch_size=%s", now.isoformat(), batch_size)
+    deleted = 0
+    while True:
+        with conn() as c:
+            rows = c.execute(
+                """
+                DELETE FROM files
+                WHERE token IN (SELECT token FROM files WHERE expires_at <= ? LIMIT ?)
+                RETURNING token, stored_path, sha512, blob, seg_length
+                """,
+                (_ts(now), batch_size),
+            ).fetchall()
+            expired = [(r[0], r[1]) for r in rows if not r[3] and r[4] is None]
+            expired += _release_blobs(c, [r[2] for r in rows if r[3]])
+            _count_segments(c, [(r[1], r[4]) for r in rows if r[4] is not None], -1)
+        deleted += len(rows)
+        if expired:
+            logutil.debug("db delete_expired batch=%s files=%s", len(rows), len(expired))
+            yield expired
+        if len(rows) < batch_size:
+            break
+    logutil.info(f"db delete_expired deleted={deleted}")
+
+
+def _release_blobs(c: sqlite3.Connection, digests: list[str]) -> list[ExpiredRow]:
+    keys, counts = _release_counts(digests)
+    c.executemany(
+        "UPDATE blobs SET refcount = refcount - ? WHERE sha512 = ?", zip(counts, keys)
+    )
+    rows = c.execute(
+        "DELETE FROM blobs WHERE sha512 IN (SELECT value FROM json_each(?)) AND refcount <= 0 "
+        "RETURNING sha512, stored_path",
+        (_json(keys),),
+    ).fetchall()
+    return [(r[0], r[1]) for r in rows]
+
+
+def list_stored_paths(after_token: str, limit: int) -> list[tuple[str, str]]:
+    rows = _connection().execute(
+        "SELECT token, stored_path FROM files WHERE token > ? AND NOT blob "
+        "AND seg_offset IS NULL ORDER BY token LIMIT ?",
+        (after_token, limit),
+    ).fetchall()
+    return [(r[0], r[1]) for r in rows]
+
+
+def list_tokens(after_token: str, limit: int) -> list[str]:
+    rows = _connection().execute(
+        "SELECT token FROM files WHERE token > ? ORDER BY token LIMIT ?", (after_token, limit)
+    ).fetchall()
+    return [r[0] for r in rows]
+
+
+def update_stored_paths(moves: Sequence[tuple[str, str, str]]) -> set[str]:
+    if not moves:
+        return set()
+    logutil.debug("db update_stored_paths count=%s", len(moves))
+    updated = set()
+    with conn() as c:
+        for token, old_path, new_path in moves:
+            row = c.execute(
+                "UPDATE files SET stored_path = ? WHERE token = ? AND stored_path = ? "
+                "RETURNING token",
+                (new_path, token, old_path),
+            ).fetchone()
+            if row is not None:
+                updated.add(row[0])
+    return updated
+
+
+def segment_usage(paths: Sequence[str]) -> dict[str, tuple[int, int]]:
+    rows = _connection().execute(
+        "SELECT path, live, live_bytes FROM segments "
+        "WHERE path IN (SELECT value FROM json_each(?))",
+        (_json(paths),),
+    ).fetchall()
+    return {r[0]: (r[1], r[2]) for r in rows}
+
+
+def forget_segments(paths: Sequence[str]) -> list[str]:
+    with conn() as c:
+        counted = dict(
+            c.execute(
+                "SELECT path, live FROM segments WHERE path IN (SELECT value FROM json_each(?))",
+                (_json(paths),),
+            ).fetchall()
+        )
+        c.execute(
+            "DELETE FROM segments WHERE path IN (SELECT value FROM json_each(?)) AND live <= 0",
+            (_json(paths),),
+        )
+    return [p for p in paths if counted.get(p, 0) <= 0]
+
+
+def segment_entries(path: str) -> list[tuple[str, int, int]]:
+    rows = _connection().execute(
+        "SELECT token, seg_offset, seg_length FROM files "
+        "WHERE stored_path = ? AND seg_offset IS NOT NULL ORDER BY seg_offset",
+        (path,),
+    ).fetchall()
+    return [(r[0], r[1], r[2]) for r in rows]
+
+
+def move_segment_entries(old_path: str, moves: Sequence[tuple[str, str, int]]) -> set[str]:
+    if not moves:
+        return set()
+    logutil.debug("db move_segment_entries path=%s count=%s", old_path, len(moves))
+    rows = []
+    with conn() as c:
+        for token, new_path, new_offset in moves:
+            row = c.execute(
+                "UPDATE files SET stored_path = ?, seg_offset = ? "
+                "WHERE token = ? AND stored_path = ? AND seg_offset IS NOT NULL "
+                "RETURNING token, stored_path, seg_length",
+                (new_path, new_offset, token, old_path),
+            ).fetchone()
+            if row is not None:
+                rows.append(row)
+        _count_segments(c, [(old_path, r[2]) for r in rows], -1)
+        _count_segments(c, [(r[1], r[2]) for r in rows], 1)
+    return {r[0] for r in rows}
+
+
+def upcoming_expirations(limit: int) -> list[datetime]:
+    logutil.debug("db upcoming_expirations limit=%s", limit)
+    rows = _connection().execute(
+        "SELECT expires_at FROM files ORDER BY expires_at LIMIT ?", (limit,)
+    ).fetchall()
+    return [_dt(r[0]) for r in rows]
+
+
+def charge_key(
+    key: str,
+    sessions: int,
+    size_bytes: int,
+    *,
+    max_sessions: int,
+    max_bytes: int,
+    now: datetime,
+    window_seconds: float,
+) -> bool:
+    params = dict(
+        key=key,
+        sessions=sessions,
+        bytes=size_bytes,
+        max_sessions=max_sessions,
+        max_bytes=max_bytes,
+        now=_ts(now),
+        window=window_seconds,
+    )
+    with conn() as c:
+        row = c.execute(_CHARGE_KEY, params).fetchone()
+    return row is not None
+
+
+def refund_key(key: str, sessions: int, size_bytes: int) -> None:
+    with conn() as c:
+        c.execute(_REFUND_KEY, dict(key=key, sessions=sessions, bytes=size_bytes))
+
+
+class ExpiryListener:
+    """
+    Polls for rows inserted since the last wait(), in place of LISTEN, and
+    reports the earliest of their deadlines.
+    """
+
+    def __init__(self) -> None:
+        # Highest files id already reported; None until connect().
+        self._seen: int | None = None
+
+    def __enter__(self) -> "ExpiryListener":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._seen = None
+
+    def connect(self) -> None:
+        row = _connection().execute("SELECT coalesce(max(id), 0) FROM files").fetchone()
+        self._seen = row[0]
+
+    def wait(self, timeout: float) -> list[datetime]:
+        """
+        Blocks up to `timeout` seconds; returns announced deadlines (possibly none).
+        """
+        if self._seen is None:
+            raise RuntimeError("expiry listener is not connected")
+        end = time.monotonic() + timeout
+        while True:
+            newest, earliest = _connection().execute(
+                "SELECT max(id), min(expires_at) FROM files WHERE id > ?", (self._seen,)
+            ).fetchone()
+            if newest is not None:
+                self._seen = newest
+                return [_dt(earliest)]
+            left = end - time.monotonic()
+            if left <= 0:
+                return []
+            time.sleep(min(POLL_SECONDS, left))
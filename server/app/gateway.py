@@ -1,35 +1,39 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
-import hashlib
+import io
 import os
-import secrets
 import shlex
 import sys
-import traceback
-from dataclasses import dataclass
-from datetime import timedelta
+import time
 from pathlib import Path
-from typing import Iterable
-
-from app import logutil
-from app.db import get_file_by_token, insert_file, utcnow
+from typing import TYPE_CHECKING, BinaryIO, NamedTuple
+
+from app import (
+    admission,
+    allocate,
+    bloom,
+    compress,
+    logutil,
+    metrics,
+    phases,
+    quota,
+    segments,
+    shaping,
+    store,
+    zerocopy,
+)
+from app.db import INSERT_BATCH_SIZE, FileRecord, get_file_by_token, session as db_session, utcnow
+from app.store import Config
+
+# upload (hashlib, threading, queue) and bundle are imported where a C or D
+# record needs them, so neither delays the first ACK.
+if TYPE_CHECKING:
+    from app import bundle
 
 ACK_OK = b"\x00"
-MAX_CHUNK_SIZE = 1024 * 1024
-
-
-@dataclass(frozen=True)
-class Config:
-    data_dir: Path
-    ttl_days: int
-
-    @classmethod
-    def from_env(cls) -> "Config":
-        data_dir = Path(os.environ.get("DATA_DIR", "/data")).resolve()
-        ttl_days = int(os.environ.get("TTL_DAYS", "7"))
-        data_dir.mkdir(parents=True, exist_ok=True)
-        return cls(data_dir=data_dir, ttl_days=ttl_days)
+# scp error reply: the client reports the message and skips the file.
+ACK_ERROR = b"\x01"
 
 
 def _stderr(msg: str) -> None:
@@ -37,21 +41,30 @@ def _stderr(msg: str) -> None:
     sys.stderr.flush()
 
 
+def _format_exc() -> str:
+    # traceback is only needed on failure; keep it off the startup path.
+    import traceback
+
+    return traceback.format_exc()
+
+
 def _read_exact(n: int) -> bytes:
     # Read exactly n bytes from stdin (scp protocol).
     buf = bytearray()
     r = sys.stdin.buffer
-    while len(buf) < n:
-        chunk = r.read(n - len(buf))
-        if not chunk:
-            raise EOFError("unexpected EOF")
-        buf.extend(chunk)
+    with phases.span("client"):
+        while len(buf) < n:
+            chunk = r.read(n - len(buf))
+            if not chunk:
+                raise EOFError("unexpected EOF")
+            buf.extend(chunk)
     return bytes(buf)
 
 
 def _read_line() -> bytes:
     # scp control records are line-delimited.
-    line = sys.stdin.buffer.readline()
+    with phases.span("client"):
+        line = sys.stdin.buffer.readline()
     if not line:
         raise EOFError("unexpected EOF")
     return line
@@ -63,6 +76,11 @@ def _send_ok() -> None:
     sys.stdout.buffer.flush()
 
 
+def _send_error(msg: str) -> None:
+    sys.stdout.buffer.write(ACK_ERROR + msg.replace("\n", " ").encode("utf-8") + b"\n")
+    sys.stdout.buffer.flush()
+
+
 def _expect_client_ok() -> None:
     b = _read_exact(1)
     # scp uses \0 for ok; others for errors; treat non-ok as failure
@@ -70,16 +88,17 @@ def _expect_client_ok() -> None:
         raise RuntimeError(f"client did not ACK OK: {b!r}")
 
 
-def _token() -> str:
-    # URL-safe token, high entropy (used as stored filename).
-    return secrets.token_urlsafe(32)
-
-
 def _parse_original_command() -> str:
     # sshd places the original command here for ForcedCommand.
     return os.environ.get("SSH_ORIGINAL_COMMAND", "").strip()
 
 
+def _is_sftp(cmd: str) -> bool:
+    # With ForceCommand, a subsystem request shows up as the subsystem's command.
+    prog = cmd.split(" ", 1)[0]
+    return prog == "internal-sftp" or prog.endswith("/sftp-server")
+
+
 def _scp_flags(cmd: str) -> set[str]:
     """
     Extract short option flags from an scp command string.
@@ -102,7 +121,7 @@ def _scp_flags(cmd: str) -> set[str]:
 
 
 def _parse_c_record(line: bytes) -> tuple[str, int, str]:
-    # C<mode> <size> <filename>
+    # C<mode> <size> <filename>, or D<mode> 0 <dirname>
     try:
         parts = line.decode("utf-8", errors="replace").strip().split(" ", 2)
         mode = parts[0][1:]
@@ -110,129 +129,393 @@ def _parse_c_record(line: bytes) -> tuple[str, int, str]:
         filename = parts[2]
         return mode, size, filename
     except Exception as exc:
-        raise RuntimeError(f"bad C record: {line!r} ({exc})") from exc
-
-
-def _iter_file_chunks(size: int) -> Iterable[bytes]:
-    # Stream the file payload in bounded chunks.
-    remaining = size
-    while remaining > 0:
-        chunk = sys.stdin.buffer.read(min(MAX_CHUNK_SIZE, remaining))
-        if not chunk:
-            raise EOFError("unexpected EOF while reading file data")
-        remaining -= len(chunk)
-        yield chunk
+        raise RuntimeError(f"bad {chr(line[0])} record: {line!r} ({exc})") from exc
 
 
 def scp_receive_one(conf: Config) -> list[dict[str, str | int]]:
     """
     Minimal scp -t receiver.
-    Supports multiple files (C records) in one session.
+    Supports multiple files (C records) in one session; each top-level
+    directory (D ... E, from scp -r) is stored as one bundle token.
+    Receipts are written over one DB connection in groups of INSERT_BATCH_SIZE.
     Returns receipts for each received file.
     """
     receipts: list[dict[str, str | int]] = []
+    pending: list[FileRecord] = []
+    phases.begin("scp_receive", conf.phase_sample)
+    ok = False
+    try:
+        with db_session():
+            try:
+                _receive_records(conf, receipts, pending)
+            except BaseException:
+                # Files already on disk still get rows, so the cleaner reclaims them.
+                _flush_pending_quietly(conf, pending)
+                raise
+            store.flush_pending(conf, pending)
+        ok = True
+    finally:
+        # Entries that never got rows are dead space the cleaner may take.
+        segments.release()
+        size = sum(int(r["size_bytes"]) for r in receipts)
+        phases.end(ok=ok, files=len(receipts), bytes=size)
+    return receipts
+
+
+def _flush_pending_quietly(conf: Config, pending: list[FileRecord]) -> None:
+    try:
+        store.flush_pending(conf, pending)
+    except Exception as exc:
+        logutil.error(f"scp_receive_one: failed to record {len(pending)} files err={exc!r}")
+
+
+class _Tree(NamedTuple):
+    # A directory upload (scp -r) being written as one bundle.
+    token: str
+    tmp_path: Path
+    final_path: Path
+    alloc: allocate.Allocation
+    writer: bundle.Writer
+
+
+def _queue(
+    conf: Config,
+    record: FileRecord,
+    mode: str,
+    receipts: list[dict[str, str | int]],
+    pending: list[FileRecord],
+) -> None:
+    pending.append(record)
+    if len(pending) >= INSERT_BATCH_SIZE:
+        store.flush_pending(conf, pending)
+    receipts.append(
+        {
+            "token": record.token,
+            "sha512": record.sha512,
+            "expires_at": record.expires_at.isoformat(),
+            "original_name": record.original_name,
+            "size_bytes": record.size_bytes,
+            "mode": mode,
+        }
+    )
+
+
+def _pacer(conf: Config, size: int) -> shaping.Pacer | None:
+    return shaping.pacer(conf.shaping, conf.data_dir, size)
+
+
+def _reject(filename: str, exc: Exception) -> None:
+    logutil.warning(f"scp_receive_one: rejected filename={filename!r}: {exc}")
+    _send_error(f"upload rejected: {exc}")
+
+
+def _receive_small(conf: Config, size: int, filename: str) -> FileRecord | None:
+    # Buffered in memory, then appended to a segment in one write.
+    token = store.new_token()
+    try:
+        allocate.check_space(conf.data_dir, size, conf.reserve_bytes)
+        quota.charge(conf.key, conf.quota, size=size)
+    except (allocate.NoSpace, quota.OverQuota) as exc:
+        _reject(filename, exc)
+        return None
+    _send_ok()  # ack header
+
+    from app import upload
+
+    try:
+        buf = io.BytesIO()
+        encoder = compress.Encoder(buf, conf.codec)
+        digest = upload.receive(sys.stdin.buffer, encoder, size, _pacer(conf, size))
+        encoder.finish()
+        term = _read_exact(1)
+        if term != ACK_OK:
+            raise RuntimeError(f"missing file terminator, got {term!r}")
+        record = store.store_small(
+            conf,
+            token,
+            buf.getvalue(),
+            digest=digest,
+            filename=filename,
+            size=size,
+            codec=encoder.codec,
+        )
+    except BaseException:
+        quota.refund(conf.key, conf.quota, size=size)
+        raise
+    _send_ok()  # ack file received
+
+    logutil.info(
+        f"scp_receive_one: queued receipt token={token} size={size} "
+        f"codec={encoder.codec} segment={record.stored_path} sha512={digest[:16]}..."
+    )
+    return record
+
+
+def _receive_file(conf: Config, size: int, filename: str) -> FileRecord | None:
+    # One C record outside any directory: its own token and file.
+    if conf.use_segment(size):
+        return _receive_small(conf, size, filename)
+    token, tmp_path, final_path = store.new_upload(conf)
+    charged = 0
+    try:
+        # Refuse before the client starts sending, not gigabytes in.
+        allocate.check_space(conf.data_dir, size, conf.reserve_bytes)
+        quota.charge(conf.key, conf.quota, size=size)
+        charged = size
+        alloc = allocate.allocate(tmp_path, size, preallocate=conf.preallocate)
+    except (allocate.NoSpace, quota.OverQuota) as exc:
+        quota.refund(conf.key, conf.quota, size=charged)
+        _reject(filename, exc)
+        return None
+    except BaseException:
+        quota.refund(conf.key, conf.quota, size=charged)
+        raise
+    _send_ok()  # ack header
+    from app import upload
+
+    try:
+        encoder = compress.Encoder(alloc.file, conf.codec)
+        digest = upload.receive(sys.stdin.buffer, encoder, size, _pacer(conf, size))
+        encoder.finish()
+
+        # file terminator
+        term = _read_exact(1)
+        if term != ACK_OK:
+            raise RuntimeError(f"missing file terminator, got {term!r}")
+
+        record = store.store_upload(
+            conf,
+            token,
+            tmp_path,
+            final_path,
+            digest=digest,
+            filename=filename,
+            size=size,
+            codec=encoder.codec,
+            alloc=alloc,
+        )
+    except BaseException:
+        alloc.abort()
+        quota.refund(conf.key, conf.quota, size=size)
+        raise
+    _send_ok()  # ack file received
+
+    logutil.info(
+        f"scp_receive_one: queued receipt token={token} size={size} "
+        f"codec={encoder.codec} sha512={digest[:16]}..."
+    )
+    return record
+
+
+def _open_tree(conf: Config) -> _Tree:
+    from app import bundle
+
+    token, tmp_path, final_path = store.new_upload(conf)
+    alloc = allocate.allocate(tmp_path, 0)
+    return _Tree(token, tmp_path, final_path, alloc, bundle.Writer(alloc.file))
+
+
+def _receive_member(conf: Config, tree: _Tree, mode: str, size: int, filename: str) -> None:
+    # Charged per member; _receive_records refunds the added ones if the tree fails.
+    charged = 0
+    try:
+        allocate.check_space(conf.data_dir, size, conf.reserve_bytes)
+        quota.charge(conf.key, conf.quota, size=size)
+        charged = size
+        if conf.preallocate:
+            tree.alloc.reserve(size)
+    except (allocate.NoSpace, quota.OverQuota) as exc:
+        quota.refund(conf.key, conf.quota, size=charged)
+        _reject(filename, exc)
+        return
+    _send_ok()  # ack header
+    from app import upload
+
+    try:
+        digest = upload.receive(sys.stdin.buffer, tree.writer, size, _pacer(conf, size))
+        term = _read_exact(1)
+        if term != ACK_OK:
+            raise RuntimeError(f"missing file terminator, got {term!r}")
+        tree.writer.add(int(mode, 8), filename, size, digest)
+    except BaseException:
+        quota.refund(conf.key, conf.quota, size=size)
+        raise
+    _send_ok()  # ack file received
+
+
+def _store_tree(conf: Config, tree: _Tree) -> FileRecord:
+    from app import bundle
+
+    digest = tree.writer.finish()
+    record = store.store_upload(
+        conf,
+        tree.token,
+        tree.tmp_path,
+        tree.final_path,
+        digest=digest,
+        filename=tree.writer.name,
+        size=tree.writer.size,
+        alloc=tree.alloc,
+        is_bundle=True,
+    )
+    files = sum(e.kind == bundle.FILE for e in tree.writer.entries)
+    logutil.info(
+        f"scp_receive_one: queued bundle token={tree.token} files={files} "
+        f"size={tree.writer.size}"
+    )
+    return record
+
+
+def _receive_records(
+    conf: Config, receipts: list[dict[str, str | int]], pending: list[FileRecord]
+) -> None:
     logutil.debug("scp_receive_one: sending initial ACK")
     _send_ok()  # initial ack
 
-    while True:
-        try:
-            line = _read_line()
-        except EOFError:
-            break
-
-        if line.startswith(b"T"):
-            # timestamps line: accept, ignore
-            logutil.verbose("scp_receive_one: received T record")
-            _send_ok()
-            continue
-
-        if line.startswith(b"C"):
-            # C<mode> <size> <filename>\n
-            mode, size, filename = _parse_c_record(line)
-
-            logutil.debug(
-                f"scp_receive_one: C record mode={mode} size={size} filename={filename!r}"
-            )
-            _send_ok()  # ack header
-
-            token = _token()
-            tmp_path = conf.data_dir / f".{token}.tmp"
-            final_path = conf.data_dir / token
-
-            h = hashlib.sha512()
-            remaining = size
-            with open(tmp_path, "wb") as f:
-                for chunk in _iter_file_chunks(size):
-                    f.write(chunk)
-                    h.update(chunk)
-                    remaining -= len(chunk)
-                    logutil.verbose(f"scp_receive_one: remaining={remaining}")
-
-            # file terminator
-            term = _read_exact(1)
-            if term != ACK_OK:
-                raise RuntimeError(f"missing file terminator, got {term!r}")
-
-            os.replace(tmp_path, final_path)
-            _send_ok()  # ack file received
-            logutil.debug(f"scp_receive_one: stored token={token} path={final_path}")
-
-            created = utcnow()
-            expires = created + timedelta(days=conf.ttl_days)
-            digest = h.hexdigest()
-
-            logutil.info(
-                f"scp_receive_one: insert_file token={token} size={size} sha512={digest[:16]}..."
-            )
-            insert_file(
-                token=token,
-                sha512=digest,
-                original_name=filename,
-                size_bytes=size,
-                stored_path=str(final_path),
-                created_at=created,
-                expires_at=expires,
-            )
-
-            receipts.append(
-                {
-                    "token": token,
-                    "sha512": digest,
-                    "expires_at": expires.isoformat(),
-                    "original_name": filename,
-                    "size_bytes": size,
-                    "mode": mode,
-                }
-            )
-            continue
-
-        if line.startswith(b"E"):
-            _send_ok()
-            continue
-
-        # Some clients may send blank; stop on EOF only
-        if line.strip() == b"":
-            continue
-
-        raise RuntimeError(f"unsupported scp record: {line!r}")
+    # Set between a top-level D record and its matching E.
+    tree: _Tree | None = None
+    try:
+        while True:
+            try:
+                line = _read_line()
+            except EOFError:
+                if tree is not None:
+                    raise EOFError("unexpected EOF inside a directory upload") from None
+                break
 
-    return receipts
+            if line.startswith(b"T"):
+                # timestamps line: accept, ignore
+                logutil.verbose("scp_receive_one: received T record")
+                _send_ok()
+                continue
+
+            if line.startswith(b"C"):
+                # C<mode> <size> <filename>\n
+                mode, size, filename = _parse_c_record(line)
+
+                logutil.debug(
+                    "scp_receive_one: C record mode=%s size=%s filename=%r", mode, size, filename
+                )
+                if tree is not None:
+                    _receive_member(conf, tree, mode, size, filename)
+                elif (record := _receive_file(conf, size, filename)) is not None:
+                    _queue(conf, record, mode, receipts, pending)
+                continue
+
+            if line.startswith(b"D"):
+                mode, _, dirname = _parse_c_record(line)
+                logutil.debug("scp_receive_one: D record mode=%s dirname=%r", mode, dirname)
+                if tree is None:
+                    tree = _open_tree(conf)
+                tree.writer.enter(int(mode, 8), dirname)
+                _send_ok()
+                continue
+
+            if line.startswith(b"E"):
+                if tree is not None:
+                    tree.writer.leave()
+                    if tree.writer.depth == 0:
+                        mode = f"{tree.writer.entries[0].mode:04o}"
+                        record, tree = _store_tree(conf, tree), None
+                        _queue(conf, record, mode, receipts, pending)
+                _send_ok()
+                continue
+
+            # Some clients may send blank; stop on EOF only
+            if line.strip() == b"":
+                continue
+
+            raise RuntimeError(f"unsupported scp record: {line!r}")
+    except BaseException:
+        if tree is not None:
+            tree.alloc.abort()
+            from app import bundle
+
+            added = sum(e.size for e in tree.writer.entries if e.kind == bundle.FILE)
+            quota.refund(conf.key, conf.quota, size=added)
+        raise
+
+
+def _send_header(header: str) -> None:
+    sys.stdout.buffer.write(header.encode("utf-8"))
+    sys.stdout.buffer.flush()
+    _expect_client_ok()
+
+
+def _send_data(conf: Config, f: BinaryIO, size: int, codec: str, token: str) -> str:
+    # Payload after an ACKed C header, then the terminator; returns the copy mode.
+    pace = _pacer(conf, size)
+    with phases.span("send"):
+        if codec == compress.NONE:
+            sent, mode = zerocopy.send_file(f, sys.stdout.buffer, size, conf.send_mode, pace)
+        else:
+            # The header already promised the original size; decode on the way out.
+            sent = compress.send_decoded(f, sys.stdout.buffer, size, codec, pace)
+            mode = codec
+    if sent != size:
+        logutil.error(f"scp_send_one: short file token={token!r} sent={sent} expected={size}")
+        sys.exit(1)
+    sys.stdout.buffer.write(ACK_OK)
+    sys.stdout.buffer.flush()
+
+    logutil.debug("scp_send_one: waiting for final client ACK")
+    _expect_client_ok()
+    return mode
 
 
-def scp_send_one(conf: Config, token: str) -> None:
+def _send_bundle(conf: Config, f: BinaryIO, token: str) -> int:
+    # Replays the recorded D/C/E stream; returns the number of files sent.
+    from app import bundle
+
+    files = 0
+    for e in bundle.read_index(f):
+        if e.kind == bundle.DIR:
+            _send_header(f"D{e.mode:04o} 0 {e.name}\n")
+        elif e.kind == bundle.END:
+            _send_header("E\n")
+        else:
+            _send_header(f"C{e.mode:04o} {e.size} {e.name}\n")
+            f.seek(e.offset)
+            _send_data(conf, f, e.size, compress.NONE, token)
+            files += 1
+    return files
+
+
+def scp_send_one(conf: Config, token: str, *, recursive: bool = False) -> None:
     """
-    Minimal scp -f sender for a single token.
+    Minimal scp -f sender for a single token. Directory bundles need -r.
     """
-    logutil.debug(f"scp_send_one: lookup token={token!r}")
-    row = get_file_by_token(token)
-    if not row:
+    phases.begin("scp_send", conf.phase_sample)
+    size = None
+    try:
+        size = _send_one(conf, token, recursive)
+    finally:
+        phases.end(ok=size is not None, files=int(size is not None), bytes=size or 0)
+
+
+def _send_one(conf: Config, token: str, recursive: bool) -> int:
+    # Returns the bytes sent; every failure exits.
+    if conf.bloom and not bloom.might_contain(conf.data_dir, token):
+        _stderr("ERROR: token not found\n")
+        logutil.warning(f"scp_send_one: token not found token={token!r} bloom=reject")
+        metrics.inc("gateway_bloom_total", result="reject")
+        sys.exit(2)
+    logutil.debug("scp_send_one: lookup token=%r", token)
+    with phases.span("lookup"):
+        record = get_file_by_token(token)
+    if not record:
         _stderr("ERROR: token not found\n")
-        logutil.warning(f"scp_send_one: token not found token={token!r}")
+        # With the filter on, a miss that gets this far is a false positive.
+        suffix = ""
+        if conf.bloom:
+            suffix = " bloom=false_positive"
+            metrics.inc("gateway_bloom_total", result="false_positive")
+        logutil.warning(f"scp_send_one: token not found token={token!r}{suffix}")
         sys.exit(2)
 
-    _, _, original_name, size_bytes, stored_path, _, expires_at = row
+    stored_path, size_bytes = record.stored_path, record.size_bytes
     now = utcnow()
-    if now >= expires_at:
+    if now >= record.expires_at:
         _stderr("ERROR: token expired\n")
         logutil.info(f"scp_send_one: token expired token={token!r}")
         sys.exit(2)
@@ -243,32 +526,64 @@ def scp_send_one(conf: Config, token: str) -> None:
         logutil.error(f"scp_send_one: file missing token={token!r} path={stored_path}")
         sys.exit(2)
 
-    _stderr(f"Filename: {original_name}\n")
+    if record.bundle and not recursive:
+        _stderr("ERROR: token is a directory, use scp -r\n")
+        logutil.info(f"scp_send_one: directory without -r token={token!r}")
+        sys.exit(2)
+
+    _stderr(f"Filename: {record.original_name}\n")
     logutil.debug("scp_send_one: waiting for initial client ACK")
     _expect_client_ok()
 
-    header = f"C0644 {size_bytes} {token}\n".encode("utf-8")
-    sys.stdout.buffer.write(header)
-    sys.stdout.buffer.flush()
+    if record.bundle:
+        with open(path, "rb") as f:
+            files = _send_bundle(conf, f, token)
+        logutil.info(
+            f"scp_send_one: completed token={token!r} bundle files={files} bytes={size_bytes}"
+        )
+        _count_download(size_bytes)
+        return size_bytes
 
-    logutil.debug("scp_send_one: waiting for client ACK after header")
-    _expect_client_ok()
+    logutil.debug("scp_send_one: sending header")
+    _send_header(f"C0644 {size_bytes} {token}\n")
 
     with open(path, "rb") as f:
-        while True:
-            chunk = f.read(MAX_CHUNK_SIZE)
-            if not chunk:
-                break
-            sys.stdout.buffer.write(chunk)
-    sys.stdout.buffer.write(ACK_OK)
-    sys.stdout.buffer.flush()
+        if record.seg_offset is not None:
+            f.seek(record.seg_offset)
+        mode = _send_data(conf, f, size_bytes, record.codec, token)
+    logutil.info(f"scp_send_one: completed token={token!r} bytes={size_bytes} mode={mode}")
+    _count_download(size_bytes)
+    return size_bytes
 
-    logutil.debug("scp_send_one: waiting for final client ACK")
-    _expect_client_ok()
-    logutil.info(f"scp_send_one: completed token={token!r} bytes={size_bytes}")
+
+def _count_download(size: int) -> None:
+    metrics.inc("gateway_files_total", direction="download")
+    metrics.inc("gateway_bytes_total", size, direction="download")
 
 
 def main() -> None:
+    """
+    Runs one session, then reports its duration and outcome to the collector.
+    """
+    started = time.monotonic()
+    # Sessions always end in sys.exit(); anything else is a crash.
+    status = "error"
+    try:
+        _session()
+    except SystemExit as exc:
+        status = "ok" if exc.code in (0, None) else "error"
+        raise
+    finally:
+        mode = sys.argv[1] if len(sys.argv) == 2 else "invalid"
+        metrics.observe(
+            "gateway_session_seconds", time.monotonic() - started, mode=mode, status=status
+        )
+        metrics.flush()
+        # Pre-forked workers outlive the session; its lines go out now.
+        logutil.flush()
+
+
+def _session() -> None:
     if len(sys.argv) != 2 or sys.argv[1] not in ("put", "get"):
         _stderr("FATAL: usage: gateway.py [put|get]\n")
         sys.exit(2)
@@ -279,7 +594,32 @@ def main() -> None:
     flags = _scp_flags(cmd)
     logutil.info(
         f"mode={mode} cmd={cmd!r} flags={''.join(sorted(flags)) or '-'} data_dir={conf.data_dir}"
+        f" key={conf.key or '-'}"
     )
+    try:
+        with admission.admit(conf.admission, conf.data_dir, mode):
+            _admitted(conf, mode, cmd, flags)
+    except admission.Busy as exc:
+        if _is_sftp(cmd):
+            _stderr(f"ERROR: {exc}\n")
+        else:
+            # In place of the first ACK; the scp client prints it and stops.
+            _send_error(str(exc))
+        sys.exit(1)
+
+
+def _admitted(conf: Config, mode: str, cmd: str, flags: set[str]) -> None:
+    try:
+        quota.charge(conf.key, conf.quota, sessions=1)
+    except quota.OverQuota as exc:
+        _stderr(f"ERROR: {exc}\n")
+        sys.exit(2)
+
+    if _is_sftp(cmd):
+        # Imported here so scp sessions never load the SFTP server.
+        from app import sftp
+
+        sys.exit(sftp.main(mode, conf, sys.stdin.buffer, sys.stdout.buffer))
 
     if mode == "put":
         if "t" not in flags:
@@ -289,18 +629,14 @@ def main() -> None:
             receipts = scp_receive_one(conf)
         except Exception as e:
             logutil.error(f"upload failed: {e!r}")
-            logutil.debug(traceback.format_exc())
+            if logutil.enabled("DEBUG"):
+                logutil.debug(_format_exc())
             _stderr(f"ERROR: upload failed: {e}\n")
             sys.exit(1)
 
-        # Receipt on stderr to avoid corrupting scp stdout protocol
         logutil.info(f"upload complete files={len(receipts)}")
         for r in receipts:
-            _stderr(
-                "RECEIPT\n"
-                f"token={r['token']}\n"
-                f"expires_at={r['expires_at']}\n"
-            )
+            store.write_receipt(str(r["token"]), str(r["expires_at"]))
         sys.exit(0)
 
     if mode == "get":
@@ -317,10 +653,11 @@ def main() -> None:
         token = parts[-1].strip()
 
         try:
-            scp_send_one(conf, token)
+            scp_send_one(conf, token, recursive="r" in flags)
         except Exception as e:
             logutil.error(f"download failed: {e!r}")
-            logutil.debug(traceback.format_exc())
+            if logutil.enabled("DEBUG"):
+                logutil.debug(_format_exc())
             _stderr(f"ERROR: download failed: {e}\n")
             sys.exit(1)
 
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+ForceCommand shim for the gateway daemon.
+
+Hands this SSH session's stdin/stdout/stderr to a warm daemon worker over a
+Unix socket (SCM_RIGHTS) and exits with the status the worker reports. Only
+stdlib modules are imported so the shim starts quickly; if the daemon is not
+reachable, or no worker is free to take the session, it execs the gateway
+module directly.
+"""
+from __future__ import annotations
+
+import json
+import os
+import socket
+import struct
+import sys
+
+STATUS = struct.Struct("!i")
+MAX_REQUEST_BYTES = 64 * 1024
+# Session environment the worker needs from sshd.
+FORWARDED_ENV = ("SSH_ORIGINAL_COMMAND", "SSH_USER_AUTH")
+# A worker sends READY once it has taken the connection. Without it in
+# READY_TIMEOUT_SECONDS every worker is busy, and the session runs on its own
+# rather than waiting in the listen backlog behind long transfers.
+READY = b"R"
+READY_TIMEOUT_SECONDS = 0.1
+
+
+def socket_path(mode: str) -> str:
+    socket_dir = os.environ.get("GATEWAY_SOCKET_DIR", "/run/gateway")
+    return os.path.join(socket_dir, f"{mode}.sock")
+
+
+def _request(mode: str) -> bytes:
+    env = {k: os.environ[k] for k in FORWARDED_ENV if k in os.environ}
+    return json.dumps({"mode": mode, "env": env}).encode("utf-8")
+
+
+def _recv_status(sock: socket.socket) -> int:
+    buf = b""
+    while len(buf) < STATUS.size:
+        chunk = sock.recv(STATUS.size - len(buf))
+        if not chunk:
+            # Worker died mid-session; the transfer did not complete.
+            return 1
+        buf += chunk
+    return STATUS.unpack(buf)[0]
+
+
+def _fallback(argv: list[str]) -> None:
+    os.execv(sys.executable, [sys.executable, "-m", "app.gateway", *argv])
+
+
+def main() -> None:
+    argv = sys.argv[1:]
+    mode = argv[0] if len(argv) == 1 else ""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path(mode))
+        sock.settimeout(READY_TIMEOUT_SECONDS)
+        ready = sock.recv(1) == READY
+    except OSError:
+        # Also socket.timeout: no idle worker.
+        ready = False
+    if not ready:
+        sock.close()
+        _fallback(argv)
+        return
+    sock.settimeout(None)
+    with sock:
+        socket.send_fds(sock, [_request(mode)], [0, 1, 2])
+        status = _recv_status(sock)
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import json
+import os
+import pwd
+import signal
+import socket
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+from app import db, gateway, logutil
+from app.gateway_client import FORWARDED_ENV, MAX_REQUEST_BYTES, READY, STATUS
+
+MODES = ("put", "get")
+LISTEN_BACKLOG = 128
+RESPAWN_DELAY_SECONDS = 1.0
+
+
+@dataclass(frozen=True)
+class DaemonConfig:
+    socket_dir: Path
+    workers: int
+    max_sessions: int
+
+    @classmethod
+    def from_env(cls) -> "DaemonConfig":
+        socket_dir = Path(os.environ.get("GATEWAY_SOCKET_DIR", "/run/gateway"))
+        workers = int(os.environ.get("GATEWAY_WORKERS", "4"))
+        max_sessions = int(os.environ.get("GATEWAY_MAX_SESSIONS", "1000"))
+        return cls(socket_dir=socket_dir, workers=workers, max_sessions=max_sessions)
+
+
+def _listen(path: Path, user: str) -> socket.socket:
+    # One socket per mode, connectable only by the matching system user.
+    path.unlink(missing_ok=True)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(str(path))
+    sock.listen(LISTEN_BACKLOG)
+    os.chmod(path, 0o600)
+    if os.geteuid() == 0:
+        pw = pwd.getpwnam(user)
+        os.chown(path, pw.pw_uid, pw.pw_gid)
+    return sock
+
+
+def _drop_privileges(user: str) -> None:
+    # Workers run as the put/get user, like the per-session gateway.py did.
+    if os.geteuid() != 0:
+        return
+    pw = pwd.getpwnam(user)
+    # Keeps the shared group that DATA_DIR's shared files belong to.
+    os.initgroups(user, pw.pw_gid)
+    os.setgid(pw.pw_gid)
+    os.setuid(pw.pw_uid)
+
+
+def _exit_status(code: object) -> int:
+    # Mirror the interpreter's mapping of SystemExit codes to exit statuses.
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    return 1
+
+
+def run_session(mode: str, fds: list[int], env: dict[str, str]) -> int:
+    """
+    Run gateway.main() against the client's stdio fds and return its exit status.
+    """
+    saved = (sys.stdin, sys.stdout, sys.stderr, sys.argv)
+    saved_env = {k: os.environ.get(k) for k in FORWARDED_ENV}
+    streams = [
+        open(fds[0], "r", closefd=True),
+        open(fds[1], "w", closefd=True),
+        open(fds[2], "w", closefd=True),
+    ]
+    sys.stdin, sys.stdout, sys.stderr = streams
+    sys.argv = ["gateway.py", mode]
+    for key in FORWARDED_ENV:
+        os.environ.pop(key, None)
+    os.environ.update(env)
+    status = 0
+    try:
+        gateway.main()
+    except SystemExit as exc:
+        status = _exit_status(exc.code)
+    except Exception as exc:
+        logutil.error(f"daemon: session crashed mode={mode} err={exc!r}")
+        status = 1
+    finally:
+        for stream in streams:
+            try:
+                stream.close()
+            except OSError:
+                # Client already hung up; nothing left to flush to.
+                pass
+        sys.stdin, sys.stdout, sys.stderr, sys.argv = saved
+        for key, value in saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    return status
+
+
+def handle_connection(mode: str, conn: socket.socket) -> int | None:
+    """
+    Runs the session a client hands over and returns its exit status, or
+    None if the client had already given up on this worker.
+    """
+    msg, fds, _flags, _addr = socket.recv_fds(conn, MAX_REQUEST_BYTES, 3)
+    if not msg and not fds:
+        logutil.debug("daemon: client left before the handoff mode=%s", mode)
+        return None
+    if len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        logutil.warning(f"daemon: rejected request without stdio fds fds={len(fds)}")
+        return 1
+    try:
+        request = json.loads(msg)
+        env = {k: str(v) for k, v in request["env"].items() if k in FORWARDED_ENV}
+    except Exception as exc:
+        for fd in fds:
+            os.close(fd)
+        logutil.warning(f"daemon: rejected malformed request err={exc!r}")
+        return 1
+    logutil.debug("daemon: session start mode=%s pid=%s", mode, os.getpid())
+    return run_session(mode, fds, env)
+
+
+def _worker(mode: str, listener: socket.socket, conf: DaemonConfig) -> None:
+    _drop_privileges(mode)
+    try:
+        db.hold_connection()
+    except Exception as exc:
+        # Sessions still work; conn() connects on demand.
+        logutil.warning(f"daemon: {mode} worker could not pre-connect to db err={exc!r}")
+    logutil.debug("daemon: %s worker ready pid=%s", mode, os.getpid())
+    for _ in range(conf.max_sessions):
+        conn, _addr = listener.accept()
+        with conn:
+            try:
+                conn.sendall(READY)
+            except OSError:
+                # Timed out waiting for us and ran the session itself.
+                logutil.debug("daemon: client left before the handoff mode=%s", mode)
+                continue
+            status = handle_connection(mode, conn)
+            if status is None:
+                continue
+            try:
+                conn.sendall(STATUS.pack(status))
+            except OSError as exc:
+                logutil.warning(f"daemon: could not report status mode={mode} err={exc!r}")
+    logutil.debug("daemon: %s worker recycling after %s sessions", mode, conf.max_sessions)
+
+
+def _spawn(mode: str, listener: socket.socket, conf: DaemonConfig) -> int:
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    status = 0
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        _worker(mode, listener, conf)
+    except BaseException as exc:
+        logutil.error(f"daemon: {mode} worker failed err={exc!r}")
+        status = 1
+    finally:
+        # os._exit skips atexit.
+        logutil.flush()
+        os._exit(status)
+
+
+def serve(
+    conf: DaemonConfig, *, sleep: Callable[[float], None] = time.sleep
+) -> None:
+    conf.socket_dir.mkdir(parents=True, exist_ok=True)
+    listeners = {mode: _listen(conf.socket_dir / f"{mode}.sock", mode) for mode in MODES}
+    children: dict[int, str] = {}
+    for mode in MODES:
+        for _ in range(conf.workers):
+            children[_spawn(mode, listeners[mode], conf)] = mode
+
+    def stop(signum: int, _frame: object) -> None:
+        logutil.info(f"daemon: stopping signal={signum} workers={len(children)}")
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logutil.info(f"daemon: started workers={len(children)}")
+
+    while True:
+        pid, wait_status = os.wait()
+        mode = children.pop(pid, None)
+        if mode is None:
+            continue
+        code = os.waitstatus_to_exitcode(wait_status)
+        if code != 0:
+            # Avoid a fork storm when workers die at startup (e.g. bad config).
+            logutil.warning(f"daemon: {mode} worker exited pid={pid} code={code}")
+            sleep(RESPAWN_DELAY_SECONDS)
+        children[_spawn(mode, listeners[mode], conf)] = mode
+
+
+def main() -> None:
+    conf = DaemonConfig.from_env()
+    logutil.info(
+        f"daemon: starting socket_dir={conf.socket_dir} workers={conf.workers} max_sessions={conf.max_sessions}"
+    )
+    serve(conf)
+
+
+if __name__ == "__main__":
+    main()
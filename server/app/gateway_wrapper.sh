@@ -51,4 +51,12 @@ export PYTHONPATH="/srv:${PYTHONPATH:-}"
 # Send Python logs to docker logs, not the SSH client.
 export LOG_SINK
 
-exec /usr/local/bin/python /srv/app/gateway.py "$@"
+# Hand the session to a warm daemon worker when one is listening.
+if [ "${GATEWAY_DAEMON:-0}" = "1" ] && [ -S "${GATEWAY_SOCKET_DIR:-/run/gateway}/${1:-}.sock" ]; then
+  log_debug "handing session to gateway daemon"
+  exec /usr/local/bin/python -S /srv/app/gateway_client.py "$@"
+fi
+
+# Run as a module so the precompiled bytecode is used for gateway.py too
+# (a script passed by path is always recompiled from source).
+exec /usr/local/bin/python -m app.gateway "$@"
@@ -1,8 +1,22 @@
+"""
+Leveled log lines to LOG_SINK (a file) or stderr.
+
+Messages take %-style arguments, formatted only once the level is known to
+be enabled: logutil.debug("lookup token=%r", token) costs one comparison at
+INFO. LOG_LEVEL and LOG_SINK are read once per process. Lines for a file
+sink are buffered and written with one write() per flush, so whole lines
+reach the O_APPEND file and never interleave with other processes'.
+WARNING and ERROR lines flush at once, the rest after FLUSH_SECONDS or
+BUFFER_BYTES, and at exit, fork and session end (see flush). The buffer is
+shared by every thread of the process under one lock.
+"""
 from __future__ import annotations
 
+import atexit
 import os
 import sys
-from datetime import datetime, timezone
+import threading
+import time
 from typing import Final
 
 _LEVELS: Final[dict[str, int]] = {
@@ -17,10 +31,30 @@ _ALIASES: Final[dict[str, str]] = {
     "ERR": "ERROR",
     "TRACE": "VERBOSE",
 }
+_ERROR, _WARNING, _INFO, _DEBUG, _VERBOSE = range(5)
 _DEFAULT_LEVEL: Final[str] = "INFO"
 _CURRENT_LEVEL: int | None = None
 _LEVEL_SOURCE: str | None = None
 
+# Buffered lines are written once they are this old or this large.
+FLUSH_SECONDS: Final[float] = 1.0
+BUFFER_BYTES: Final[int] = 64 * 1024
+# Lines at or below this level are written immediately.
+_FLUSH_LEVEL: Final[int] = _WARNING
+
+# Sink file descriptor (None = stderr) and the lines not yet written to it.
+_SINK_FD: int | None = None
+_buffer: list[bytes] = []
+_buffered = 0
+_buffered_since = 0.0
+# Guards the buffer and the first load of the level and sink: the cleaner's
+# remover pool and upload threads log too. Reentrant, as loading flushes.
+_lock = threading.RLock()
+
+# Timestamp text for the second it was formatted in.
+_ts_second = -1
+_ts_text = ""
+
 
 def _sink_path() -> str | None:
     raw = os.environ.get("LOG_SINK")
@@ -42,13 +76,31 @@ def _resolve_level_name(raw: str | None) -> str:
     return _DEFAULT_LEVEL
 
 
+def _open_sink() -> None:
+    global _SINK_FD
+    flush()
+    if _SINK_FD is not None:
+        os.close(_SINK_FD)
+        _SINK_FD = None
+    path = _sink_path()
+    if path:
+        try:
+            _SINK_FD = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        except OSError:
+            # Fall back to stderr, as a failed open() per line used to.
+            pass
+
+
 def _load_level() -> None:
     global _CURRENT_LEVEL, _LEVEL_SOURCE
     raw = os.environ.get("LOG_LEVEL")
     source = "LOG_LEVEL"
     name = _resolve_level_name(raw)
-    _CURRENT_LEVEL = _LEVELS[name]
+    # The sink is resolved alongside the level; resetting one reloads both.
+    # Opened first: another thread logs as soon as the level is set.
+    _open_sink()
     _LEVEL_SOURCE = source
+    _CURRENT_LEVEL = _LEVELS[name]
     if raw is not None:
         raw_name = raw.strip().upper()
         if raw_name not in _LEVELS and raw_name not in _ALIASES:
@@ -60,49 +112,111 @@ def _load_level() -> None:
 
 def _level() -> int:
     if _CURRENT_LEVEL is None:
-        _load_level()
+        with _lock:
+            if _CURRENT_LEVEL is None:
+                _load_level()
     return _CURRENT_LEVEL
 
 
 def _ts() -> str:
-    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    global _ts_second, _ts_text
+    second = int(time.time())
+    if second != _ts_second:
+        _ts_text = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(second))
+        _ts_second = second
+    return _ts_text
+
+
+def flush() -> None:
+    """
+    Writes buffered lines to the sink. Cheap when nothing is buffered.
+    """
+    global _buffered
+    if not _buffer:
+        return
+    # Held while writing too, so lines reach the sink in the order logged.
+    with _lock:
+        data = b"".join(_buffer)
+        _buffer.clear()
+        _buffered = 0
+        view = memoryview(data)
+        try:
+            while view:
+                view = view[os.write(_SINK_FD, view) :]
+        except OSError:
+            sys.stderr.write(view.tobytes().decode("utf-8", "replace"))
+            sys.stderr.flush()
 
 
 def _emit(level: str, msg: str) -> None:
+    global _buffered, _buffered_since
     line = f"{level} {_ts()} {msg}\n"
-    sink = _sink_path()
-    if sink:
-        try:
-            with open(sink, "a", encoding="utf-8") as f:
-                f.write(line)
-            return
-        except Exception:
-            pass
-    sys.stderr.write(line)
-    sys.stderr.flush()
-
-
-def log(level: str, msg: str) -> None:
+    if _SINK_FD is None:
+        sys.stderr.write(line)
+        sys.stderr.flush()
+        return
+    data = line.encode("utf-8")
+    with _lock:
+        if not _buffer:
+            _buffered_since = time.monotonic()
+        _buffer.append(data)
+        _buffered += len(data)
+        due = (
+            _LEVELS[level] <= _FLUSH_LEVEL
+            or _buffered >= BUFFER_BYTES
+            or time.monotonic() - _buffered_since >= FLUSH_SECONDS
+        )
+    if due:
+        flush()
+
+
+def enabled(level: str) -> bool:
+    """
+    True if lines at `level` are written; guards costly message building.
+    """
+    number = _LEVELS.get(level)
+    if number is None:
+        number = _LEVELS[_resolve_level_name(level)]
+    return number <= _level()
+
+
+def log(level: str, msg: str, *args: object) -> None:
     level_name = _resolve_level_name(level)
     if _LEVELS[level_name] <= _level():
-        _emit(level_name, msg)
+        _emit(level_name, msg % args if args else msg)
+
+
+def error(msg: str, *args: object) -> None:
+    if _level() >= _ERROR:
+        _emit("ERROR", msg % args if args else msg)
+
+
+def warning(msg: str, *args: object) -> None:
+    if _level() >= _WARNING:
+        _emit("WARNING", msg % args if args else msg)
 
 
-def error(msg: str) -> None:
-    log("ERROR", msg)
+def info(msg: str, *args: object) -> None:
+    if _level() >= _INFO:
+        _emit("INFO", msg % args if args else msg)
 
 
-def warning(msg: str) -> None:
-    log("WARNING", msg)
+def debug(msg: str, *args: object) -> None:
+    if _level() >= _DEBUG:
+        _emit("DEBUG", msg % args if args else msg)
 
 
-def info(msg: str) -> None:
-    log("INFO", msg)
+def verbose(msg: str, *args: object) -> None:
+    if _level() >= _VERBOSE:
+        _emit("VERBOSE", msg % args if args else msg)
 
 
-def debug(msg: str) -> None:
-    log("DEBUG", msg)
+def _reset_lock() -> None:  # pragma: no cover
+    global _lock
+    # Another thread may have held it when the process forked.
+    _lock = threading.RLock()
 
 
-def verbose(msg: str) -> None:
-    log("VERBOSE", msg)
+atexit.register(flush)
+# A child would otherwise write the parent's buffered lines a second time.
+os.register_at_fork(before=flush, after_in_child=_reset_lock)
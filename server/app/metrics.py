@@ -0,0 +1,282 @@
+"""
+Counters, gauges and histograms, exported in the Prometheus text format.
+
+Gateway sessions are short-lived processes, so each records into its own
+registry and sends it as one datagram to METRICS_SOCKET when the session
+ends (see flush). The cleaner collects those datagrams, merges them into
+its registry next to its own metrics, and serves the total on
+http://METRICS_ADDR/metrics. With nothing listening the snapshot is
+dropped; metrics never fail a session.
+"""
+from __future__ import annotations
+
+import os
+import threading
+from bisect import bisect_left
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from app import logutil
+
+if TYPE_CHECKING:
+    import socket
+
+SOCKET_NAME = "metrics.sock"
+DEFAULT_ADDR = "127.0.0.1:9108"
+# One session's snapshot is a few KB; anything past this is dropped.
+MAX_DATAGRAM = 64 * 1024
+
+# Upper bounds (le) of histogram buckets, in seconds.
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, 120.0, 600.0)
+LAG_BUCKETS = (1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0, 14400.0, 86400.0)
+BUCKETS = {"cleanup_lag_seconds": LAG_BUCKETS}
+
+_Key = tuple[str, tuple[tuple[str, str], ...]]
+
+_COUNTER = "c"
+_GAUGE = "g"
+_HISTOGRAM = "h"
+
+
+def _key(name: str, labels: dict[str, str]) -> _Key:
+    return name, tuple(sorted(labels.items()))
+
+
+def _label_text(labels: tuple[tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: dict[_Key, float] = {}
+        self._gauges: dict[_Key, float] = {}
+        # Per-bucket counts (the last one is +Inf), then the sum.
+        self._histograms: dict[_Key, list[float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        bounds = BUCKETS.get(name, SECONDS_BUCKETS)
+        key = _key(name, labels)
+        with self._lock:
+            slots = self._histograms.get(key)
+            if slots is None:
+                slots = self._histograms[key] = [0.0] * (len(bounds) + 2)
+            slots[bisect_left(bounds, value)] += 1
+            slots[-1] += value
+
+    def __bool__(self) -> bool:
+        return bool(self._counters or self._gauges or self._histograms)
+
+    def dump(self) -> str:
+        """
+        Serializes the registry for merge(): one tab-separated line per series.
+        """
+        lines = []
+        with self._lock:
+            for kind, series in (
+                (_COUNTER, self._counters),
+                (_GAUGE, self._gauges),
+                (_HISTOGRAM, self._histograms),
+            ):
+                for (name, labels), value in series.items():
+                    text = ",".join(f"{k}={v}" for k, v in labels)
+                    if kind == _HISTOGRAM:
+                        value = ",".join(_number(v) for v in value)
+                    else:
+                        value = _number(value)
+                    lines.append(f"{kind}\t{name}\t{text}\t{value}\n")
+        return "".join(lines)
+
+    def merge(self, text: str) -> None:
+        """
+        Adds counters and histograms from a dump(); gauges take its value.
+        """
+        for line in text.splitlines():
+            kind, name, label_text, value = line.split("\t")
+            labels = dict(p.split("=", 1) for p in label_text.split(",") if p)
+            if kind == _COUNTER:
+                self.inc(name, float(value), **labels)
+            elif kind == _GAUGE:
+                self.set(name, float(value), **labels)
+            elif kind == _HISTOGRAM:
+                slots = [float(v) for v in value.split(",")]
+                key = _key(name, labels)
+                with self._lock:
+                    mine = self._histograms.setdefault(key, [0.0] * len(slots))
+                    if len(mine) != len(slots):
+                        raise ValueError(f"bucket mismatch for {name}")
+                    for i, v in enumerate(slots):
+                        mine[i] += v
+            else:
+                raise ValueError(f"unknown series kind {kind!r}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def render(self) -> str:
+        """
+        Returns the Prometheus text exposition of every series.
+        """
+        out = []
+        with self._lock:
+            for kind, series in (("counter", self._counters), ("gauge", self._gauges)):
+                typed = set()
+                for (name, labels), value in sorted(series.items()):
+                    if name not in typed:
+                        out.append(f"# TYPE {name} {kind}\n")
+                        typed.add(name)
+                    out.append(f"{name}{_label_text(labels)} {_number(value)}\n")
+            typed = set()
+            for (name, labels), slots in sorted(self._histograms.items()):
+                if name not in typed:
+                    out.append(f"# TYPE {name} histogram\n")
+                    typed.add(name)
+                bounds = BUCKETS.get(name, SECONDS_BUCKETS)
+                total = 0.0
+                for le, count in zip((*map(_number, bounds), "+Inf"), slots):
+                    total += count
+                    le_label = _label_text(labels, f'le="{le}"')
+                    out.append(f"{name}_bucket{le_label} {_number(total)}\n")
+                out.append(f"{name}_sum{_label_text(labels)} {_number(slots[-1])}\n")
+                out.append(f"{name}_count{_label_text(labels)} {_number(total)}\n")
+        return "".join(out)
+
+
+REGISTRY = Registry()
+
+
+def inc(name: str, value: float = 1, **labels: str) -> None:
+    REGISTRY.inc(name, value, **labels)
+
+
+def set_gauge(name: str, value: float, **labels: str) -> None:
+    REGISTRY.set(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels: str) -> None:
+    REGISTRY.observe(name, value, **labels)
+
+
+def socket_path() -> Path:
+    raw = os.environ.get("METRICS_SOCKET")
+    if raw:
+        return Path(raw)
+    return Path(os.environ.get("DATA_DIR", "/data")) / SOCKET_NAME
+
+
+def flush() -> None:
+    """
+    Sends this process's metrics to the collector and starts over.
+    """
+    if not REGISTRY:
+        return
+    payload = REGISTRY.dump().encode()
+    REGISTRY.clear()
+    # socket (with selectors) is a large share of session start-up; sent once, at the end.
+    import socket
+
+    path = socket_path()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.setblocking(False)
+            s.sendto(payload, str(path))
+    except OSError as exc:
+        # No collector, or its queue is full: losing a sample beats waiting.
+        logutil.debug("metrics: dropped snapshot bytes=%s err=%r", len(payload), exc)
+
+
+def collect(sock: socket.socket, registry: Registry = REGISTRY) -> None:
+    """
+    Merges datagrams from `sock` into `registry` until the socket is closed.
+    """
+    while True:
+        try:
+            data = sock.recv(MAX_DATAGRAM)
+        except OSError:
+            return
+        try:
+            registry.merge(data.decode())
+        except ValueError as exc:
+            logutil.warning(f"metrics: ignored malformed snapshot err={exc!r}")
+
+
+def bind_collector(path: Path) -> socket.socket:
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+    sock.bind(str(path))
+    # Gateway sessions run as the put and get users, in the group of DATA_DIR
+    # (setgid), where the socket lives by default.
+    os.chmod(path, 0o660)
+    return sock
+
+
+def start_http(addr: str, registry: Registry = REGISTRY):
+    """
+    Serves registry.render() at /metrics from a daemon thread; returns the server.
+    """
+    # Only the cleaner serves; keep http.server off the gateway's import path.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:
+            logutil.verbose("metrics: http " + format, *args)
+
+    host, _, port = addr.rpartition(":")
+    server = ThreadingHTTPServer((host, int(port)), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def serve_from_env() -> None:
+    """
+    Starts the collector and the /metrics endpoint; METRICS_ADDR="" turns both off.
+    """
+    addr = os.environ.get("METRICS_ADDR", DEFAULT_ADDR)
+    if not addr:
+        logutil.info("metrics: disabled")
+        return
+    path = socket_path()
+    try:
+        sock = bind_collector(path)
+        server = start_http(addr)
+    except OSError as exc:
+        # Cleanup matters more than its metrics; run without them.
+        logutil.error(f"metrics: could not serve addr={addr} socket={path} err={exc!r}")
+        return
+    threading.Thread(target=collect, args=(sock,), name="metrics-collect", daemon=True).start()
+    logutil.info(f"metrics: serving addr={addr} port={server.server_port} socket={path}")
@@ -0,0 +1,104 @@
+"""
+Online migration of stored files to the DATA_SHARD_DEPTH layout.
+
+    python -m app.migrate_layout [--depth N] [--batch-size N] [--dry-run]
+
+Rows are scanned in token order. Each file is hard-linked at its new path,
+the batch's files.stored_path values are switched in one UPDATE (only where
+they still point at the old path), and then the name the DB no longer
+references is unlinked. Both names stay valid until the UPDATE commits, so
+the gateway and cleaner can keep running; rerunning after an interruption is
+safe.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+from pathlib import Path
+from typing import Sequence
+
+from app import logutil, storage
+from app.db import list_stored_paths, session, update_stored_paths
+
+BATCH_SIZE = 1000
+
+
+def _link(old: Path, new: Path) -> bool:
+    # False when the old file is gone (expired meanwhile) or the target is foreign.
+    storage.ensure_parent(new)
+    try:
+        os.link(old, new)
+    except FileExistsError:
+        # Left behind by an interrupted run: fine if it is the same inode.
+        try:
+            return os.path.samefile(old, new)
+        except OSError:
+            return False
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def migrate_batch(
+    rows: Sequence[tuple[str, str]], data_dir: Path, depth: int, *, dry_run: bool = False
+) -> int:
+    moves: list[tuple[str, str, str]] = []
+    for token, stored_path in rows:
+        new = storage.token_path(data_dir, token, depth)
+        if str(new) == stored_path:
+            continue
+        if dry_run or _link(Path(stored_path), new):
+            moves.append((token, stored_path, str(new)))
+        else:
+            logutil.warning(f"migrate: skipped token={token} path={stored_path}")
+    if dry_run:
+        return len(moves)
+
+    updated = update_stored_paths(moves)
+    for token, old, new in moves:
+        # Drop whichever name the DB does not reference.
+        stale = old if token in updated else new
+        try:
+            os.unlink(stale)
+        except FileNotFoundError:
+            pass
+    return len(updated)
+
+
+def migrate(
+    data_dir: Path, depth: int, *, batch_size: int = BATCH_SIZE, dry_run: bool = False
+) -> int:
+    moved = 0
+    after = ""
+    with session():
+        while True:
+            rows = list_stored_paths(after, batch_size)
+            if not rows:
+                break
+            moved += migrate_batch(rows, data_dir, depth, dry_run=dry_run)
+            after = rows[-1][0]
+            logutil.info(f"migrate: progress moved={moved} last_token={after}")
+    return moved
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m app.migrate_layout",
+        description="Move stored files to the sharded layout and rewrite files.stored_path.",
+    )
+    parser.add_argument("--depth", type=int, default=storage.shard_depth_from_env())
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+
+    data_dir = Path(os.environ.get("DATA_DIR", "/data")).resolve()
+    logutil.info(
+        f"migrate: starting data_dir={data_dir} depth={args.depth} "
+        f"batch_size={args.batch_size} dry_run={args.dry_run}"
+    )
+    moved = migrate(data_dir, args.depth, batch_size=args.batch_size, dry_run=args.dry_run)
+    logutil.info(f"migrate: done {'would move' if args.dry_run else 'moved'}={moved}")
+
+
+if __name__ == "__main__":
+    main()
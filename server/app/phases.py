@@ -0,0 +1,146 @@
+"""
+Per-session phase timings for the gateway.
+
+A sampled session starts a Timer with begin(); code on its path wraps each
+phase in `with phases.span("name")`, and end() logs one JSON summary line:
+bytes, wall seconds, MB/s and the seconds spent in each phase. Spans nest,
+and a phase's time excludes the spans inside it (db_connect is not counted
+again in insert). Phases timed on the upload worker thread are added with
+add(); they overlap client reads, so phases can sum to more than the wall
+time. Unsampled sessions get a timer whose methods do nothing.
+"""
+from __future__ import annotations
+
+import os
+import time
+
+from app import logutil
+
+# Fraction of sessions timed when GATEWAY_PHASE_SAMPLE is unset.
+DEFAULT_SAMPLE = 1.0
+
+
+def sample_from_env() -> float:
+    return float(os.environ.get("GATEWAY_PHASE_SAMPLE", str(DEFAULT_SAMPLE)))
+
+
+class _Span:
+    __slots__ = ("_timer", "_name", "_outer", "_started")
+
+    def __init__(self, timer: "Timer", name: str) -> None:
+        self._timer = timer
+        self._name = name
+
+    def __enter__(self) -> None:
+        timer = self._timer
+        self._outer, timer._nested = timer._nested, 0.0
+        self._started = time.perf_counter()
+
+    def __exit__(self, *exc: object) -> None:
+        elapsed = time.perf_counter() - self._started
+        timer = self._timer
+        timer.add(self._name, elapsed - timer._nested)
+        timer._nested = self._outer + elapsed
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exc: object) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Timer:
+    active = True
+
+    def __init__(self, kind: str) -> None:
+        self.kind = kind
+        self.phases: dict[str, float] = {}
+        self._started = time.perf_counter()
+        # Time spent in spans nested inside the innermost open one.
+        self._nested = 0.0
+
+    def span(self, name: str) -> _Span:
+        return _Span(self, name)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def summary(self, **fields: object) -> dict[str, object]:
+        seconds = time.perf_counter() - self._started
+        size = int(fields.get("bytes", 0))
+        return {
+            "kind": self.kind,
+            **fields,
+            "seconds": round(seconds, 6),
+            "mb_per_s": round(size / seconds / 1e6, 3) if seconds > 0 else 0.0,
+            "phases": {k: round(v, 6) for k, v in sorted(self.phases.items())},
+        }
+
+
+class _Off(Timer):
+    active = False
+
+    def __init__(self) -> None:
+        pass
+
+    def span(self, name: str) -> _NoSpan:
+        return _NO_SPAN
+
+    def add(self, name: str, seconds: float) -> None:
+        pass
+
+
+OFF = _Off()
+_current: Timer = OFF
+
+
+def _sampled(rate: float) -> bool:
+    if rate >= 1:
+        return True
+    if rate <= 0:
+        return False
+    # Two random bytes are plenty; the random module costs more to import.
+    return int.from_bytes(os.urandom(2), "little") < rate * 65536
+
+
+def begin(kind: str, rate: float) -> Timer:
+    """
+    Starts timing a session of `kind` with probability `rate`.
+    """
+    global _current
+    _current = Timer(kind) if _sampled(rate) else OFF
+    return _current
+
+
+def current() -> Timer:
+    return _current
+
+
+def span(name: str) -> _Span | _NoSpan:
+    return _current.span(name)
+
+
+def add(name: str, seconds: float) -> None:
+    _current.add(name, seconds)
+
+
+def end(**fields: object) -> None:
+    """
+    Logs the current session's summary with `fields` (e.g. ok, files, bytes).
+    """
+    global _current
+    timer, _current = _current, OFF
+    if not timer.active:
+        return
+    # Only sampled sessions pay for the json import.
+    import json
+
+    summary = timer.summary(**fields)
+    logutil.info(f"phases {json.dumps(summary, separators=(',', ':'))}")
@@ -0,0 +1,137 @@
+"""
+Per-key session and upload budgets.
+
+With ExposeAuthInfo, sshd writes the methods a session authenticated with to
+the file named by SSH_USER_AUTH; the SHA256 fingerprint of its public key
+(as ssh-keygen -l prints it) is what budgets are kept against. Each key may
+start KEY_QUOTA_SESSIONS sessions and upload KEY_QUOTA_MB per
+KEY_QUOTA_WINDOW_SECONDS, kept as two token buckets in one key_buckets row
+per key (see db.charge_key) and charged as sessions start and C records
+arrive, so no check ever sums over files. A bucket holds at most one budget
+and refills at one budget per window: a key that used it all waits for it to
+refill, rather than getting a fresh budget when a fixed window turns over.
+Uploads that fail after being charged are refunded. 0 turns a budget off.
+"""
+from __future__ import annotations
+
+import base64
+import os
+from typing import NamedTuple
+
+from app import db, logutil
+
+DEFAULT_WINDOW_SECONDS = 86400
+# Stands in for "no limit" in the budget comparison; far above any real total.
+_UNLIMITED = 1 << 62
+
+
+class OverQuota(Exception):
+    pass
+
+
+class Limits(NamedTuple):
+    bytes: int = 0
+    sessions: int = 0
+    window_seconds: int = DEFAULT_WINDOW_SECONDS
+
+    @property
+    def enabled(self) -> bool:
+        return self.bytes > 0 or self.sessions > 0
+
+    def describe(self) -> str:
+        parts = []
+        if self.bytes:
+            parts.append(f"{self.bytes // (1024 * 1024)} MB")
+        if self.sessions:
+            parts.append(f"{self.sessions} sessions")
+        return f"{' and '.join(parts)} per {self.window_seconds}s"
+
+
+def limits_from_env() -> Limits:
+    return Limits(
+        bytes=int(os.environ.get("KEY_QUOTA_MB", "0")) * 1024 * 1024,
+        sessions=int(os.environ.get("KEY_QUOTA_SESSIONS", "0")),
+        window_seconds=int(
+            os.environ.get("KEY_QUOTA_WINDOW_SECONDS", str(DEFAULT_WINDOW_SECONDS))
+        ),
+    )
+
+
+def fingerprint(auth_info: str) -> str:
+    """
+    Returns the fingerprint of the first public key in an SSH_USER_AUTH
+    file's text, or "" when it holds none.
+    """
+    # hashlib loads OpenSSL, a few ms of session start; only needed with a key.
+    import hashlib
+
+    for line in auth_info.splitlines():
+        parts = line.split()
+        if len(parts) >= 3 and parts[0] == "publickey":
+            try:
+                blob = base64.b64decode(parts[2], validate=True)
+            except ValueError:
+                continue
+            digest = base64.b64encode(hashlib.sha256(blob).digest()).rstrip(b"=")
+            return "SHA256:" + digest.decode("ascii")
+    return ""
+
+
+def key_from_env() -> str:
+    path = os.environ.get("SSH_USER_AUTH")
+    if not path:
+        return ""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return fingerprint(f.read())
+    except OSError as exc:
+        logutil.warning(f"quota: cannot read SSH_USER_AUTH path={path} err={exc!r}")
+        return ""
+
+
+def charge(key: str, limits: Limits, *, sessions: int = 0, size: int = 0) -> None:
+    """
+    Counts sessions and bytes against `key`; raises OverQuota, counting
+    nothing, if that would exceed either budget. A no-op without budgets.
+    """
+    if not limits.enabled:
+        return
+    if not key:
+        # Without ExposeAuthInfo there is nothing to keep budgets against.
+        logutil.debug("quota: no key fingerprint, budgets not applied")
+        return
+    max_sessions = limits.sessions or _UNLIMITED
+    max_bytes = limits.bytes or _UNLIMITED
+    now = db.utcnow()
+    fits = (
+        sessions <= max_sessions
+        and size <= max_bytes
+        and db.charge_key(
+            key,
+            sessions,
+            size,
+            max_sessions=max_sessions,
+            max_bytes=max_bytes,
+            now=now,
+            window_seconds=limits.window_seconds,
+        )
+    )
+    if not fits:
+        logutil.warning(f"quota: over budget key={key} sessions={sessions} bytes={size}")
+        raise OverQuota(f"quota exceeded ({limits.describe()})")
+    logutil.debug("quota: charged key=%s sessions=%s bytes=%s", key, sessions, size)
+
+
+def refund(key: str, limits: Limits, *, sessions: int = 0, size: int = 0) -> None:
+    """
+    Gives back what charge() counted for work that then failed. Best effort:
+    the failure itself is what the caller reports.
+    """
+    if not limits.enabled or not key or not (sessions or size):
+        return
+    try:
+        db.refund_key(key, sessions, size)
+    except Exception as exc:
+        logutil.warning(f"quota: refund failed key={key} bytes={size} err={exc!r}")
+        return
+    logutil.debug("quota: refunded key=%s sessions=%s bytes=%s", key, sessions, size)
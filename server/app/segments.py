@@ -0,0 +1,156 @@
+"""
+Log-structured store for small uploads. Payloads up to DATA_SEGMENT_MAX_KB
+are appended to shared segment files, data_dir/segments/<bucket>-<n>, and
+their rows record (stored_path, seg_offset, seg_length) instead of owning a
+file. Appends from concurrent sessions are serialized with flock.
+
+Segments are named after the hour their entries were written in. Once that
+hour (plus GRACE_SECONDS) is over, nothing is appended to them again, so the
+cleaner can delete a segment whose entries have all expired, or copy the few
+live entries out of a sparse one.
+
+Rows are written in batches, some time after an entry was appended and
+ACKed. Until they are, the appending process holds a shared flock on the
+segment's lease file (<segment>.lease, see release), and the cleaner leaves
+a segment alone while it cannot lock that file exclusively (see lock_idle).
+"""
+from __future__ import annotations
+
+import fcntl
+import os
+import time
+from pathlib import Path
+
+from app import logutil, storage
+
+SEGMENT_DIR = "segments"
+# A segment is closed for appends once it reaches this size.
+SEGMENT_BYTES = 64 * 1024 * 1024
+BUCKET_SECONDS = 3600
+GRACE_SECONDS = 600
+# Closed segments with less than this fraction of live bytes get compacted.
+DEFAULT_MIN_LIVE = 0.25
+
+LEASE_SUFFIX = ".lease"
+
+# (bucket, n) of the last segment this process appended to.
+_last = (0, 0)
+# Lease fds this process holds, by segment: entries whose rows are not written.
+_leases: dict[Path, int] = {}
+
+
+def max_item_from_env() -> int:
+    # Largest payload, in bytes, stored in a segment; 0 disables segments.
+    return int(os.environ.get("DATA_SEGMENT_MAX_KB", "0")) * 1024
+
+
+def bucket_of(ts: float) -> int:
+    return int(ts // BUCKET_SECONDS) * BUCKET_SECONDS
+
+
+def _parse(name: str) -> tuple[int, int] | None:
+    bucket, sep, n = name.partition("-")
+    if not sep or not bucket.isdigit() or not n.isdigit():
+        return None
+    return int(bucket), int(n)
+
+
+def lease_path(path: Path) -> Path:
+    return path.with_name(path.name + LEASE_SUFFIX)
+
+
+def _lease(path: Path) -> None:
+    if path in _leases:
+        return
+    fd = os.open(lease_path(path), os.O_RDONLY | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    _leases[path] = fd
+
+
+def release() -> None:
+    """
+    Drops this process's leases. Call once the rows of every entry it has
+    appended are committed (or will never be).
+    """
+    while _leases:
+        os.close(_leases.popitem()[1])
+
+
+def lock_idle(path: Path) -> int | None:
+    """
+    Locks a closed segment's lease exclusively and returns the fd to close
+    once the segment is gone, or None while a session still holds a lease.
+    """
+    fd = os.open(lease_path(path), os.O_RDONLY | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def append(data_dir: Path, data: bytes, *, now: float | None = None) -> tuple[Path, int]:
+    """
+    Appends data to the current segment; returns (segment path, offset).
+    The segment stays leased until release().
+    """
+    global _last
+    bucket = bucket_of(time.time() if now is None else now)
+    n = _last[1] if _last[0] == bucket else 0
+    directory = data_dir / SEGMENT_DIR
+    storage.ensure_parent(directory / "-")
+    while True:
+        path = directory / f"{bucket}-{n}"
+        # Before the data goes in, so the cleaner never sees it unleased.
+        _lease(path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            offset = os.fstat(fd).st_size
+            if offset and offset + len(data) > SEGMENT_BYTES:
+                n += 1
+                continue
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view) :]
+        finally:
+            # Closing drops the flock.
+            os.close(fd)
+        _last = (bucket, n)
+        return path, offset
+
+
+def closed_segments(data_dir: Path, now: float) -> list[Path]:
+    """
+    Segments nothing will be appended to any more, oldest first.
+    """
+    directory = data_dir / SEGMENT_DIR
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    closed = []
+    for name in names:
+        parsed = _parse(name)
+        if parsed is not None and parsed[0] + BUCKET_SECONDS + GRACE_SECONDS <= now:
+            closed.append((parsed, directory / name))
+    return [path for _, path in sorted(closed)]
+
+
+def compact(
+    data_dir: Path, path: Path, entries: list[tuple[str, int, int]]
+) -> list[tuple[str, str, int]]:
+    """
+    Copies live (token, offset, length) entries out of `path` into the
+    current segment; returns (token, new_path, new_offset) moves to record.
+    The old segment is reclaimed once no row points at it any more.
+    """
+    moves = []
+    with open(path, "rb") as src:
+        for token, offset, length in entries:
+            data = os.pread(src.fileno(), length, offset)
+            new_path, new_offset = append(data_dir, data)
+            moves.append((token, str(new_path), new_offset))
+    logutil.debug("segments: compacted path=%s entries=%s", path, len(moves))
+    return moves
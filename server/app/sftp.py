@@ -0,0 +1,580 @@
+"""
+SFTP (protocol version 3) subset for the store. It is used when the client
+requests the sftp subsystem, which OpenSSH scp does by default since 9.0.
+
+The namespace is virtual: "/" is an empty directory that cannot be listed.
+For put, opening any path for writing starts a new upload named after the
+last path component, and CLOSE stores it like an scp upload and prints its
+receipt on stderr. For get, the last path component is a token.
+
+Requests are handled as they arrive. Replies are only flushed before
+blocking for more input, so a client can keep many READ/WRITE requests in
+flight. Offsets may come in any order.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import stat
+import struct
+from pathlib import Path
+from typing import BinaryIO, Callable
+
+from app import allocate, bloom, compress, logutil, metrics, quota, segments, shaping, store
+from app.db import FileRecord, get_file_by_token, session as db_session, utcnow
+
+VERSION = 3
+
+FXP_INIT = 1
+FXP_VERSION = 2
+FXP_OPEN = 3
+FXP_CLOSE = 4
+FXP_READ = 5
+FXP_WRITE = 6
+FXP_LSTAT = 7
+FXP_FSTAT = 8
+FXP_SETSTAT = 9
+FXP_FSETSTAT = 10
+FXP_OPENDIR = 11
+FXP_READDIR = 12
+FXP_REALPATH = 16
+FXP_STAT = 17
+FXP_EXTENDED = 200
+FXP_EXTENDED_REPLY = 201
+FXP_STATUS = 101
+FXP_HANDLE = 102
+FXP_DATA = 103
+FXP_NAME = 104
+FXP_ATTRS = 105
+
+FX_OK = 0
+FX_EOF = 1
+FX_NO_SUCH_FILE = 2
+FX_PERMISSION_DENIED = 3
+FX_FAILURE = 4
+FX_BAD_MESSAGE = 5
+FX_OP_UNSUPPORTED = 8
+
+FXF_READ = 0x1
+FXF_WRITE = 0x2
+
+ATTR_SIZE = 0x1
+ATTR_PERMISSIONS = 0x4
+ATTR_ACMODTIME = 0x8
+
+# Advertised through limits@openssh.com; OpenSSH clients then size their
+# requests to MAX_READ/MAX_WRITE instead of 32 KiB, so each round trip
+# carries about 8x more data.
+LIMITS_EXTENSION = b"limits@openssh.com"
+MAX_PACKET = 256 * 1024
+MAX_READ = MAX_PACKET - 1024
+MAX_WRITE = MAX_PACKET - 1024
+MAX_HANDLES = 64
+# Largest offset pwrite takes (off_t); uploads cannot grow past it.
+MAX_FILE_SIZE = (1 << 63) - 1
+INPUT_CHUNK = 256 * 1024
+REHASH_CHUNK = 1024 * 1024
+
+_U32 = struct.Struct(">I")
+_U64 = struct.Struct(">Q")
+_DIR_ATTRS = _U32.pack(ATTR_PERMISSIONS) + _U32.pack(stat.S_IFDIR | 0o755)
+
+
+class SftpError(Exception):
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+
+
+class _Msg:
+    """Cursor over one request body."""
+
+    def __init__(self, data: bytes, pos: int) -> None:
+        self.data = data
+        self.pos = pos
+
+    def u32(self) -> int:
+        value = _U32.unpack_from(self.data, self.pos)[0]
+        self.pos += 4
+        return value
+
+    def u64(self) -> int:
+        value = _U64.unpack_from(self.data, self.pos)[0]
+        self.pos += 8
+        return value
+
+    def string(self) -> bytes:
+        n = self.u32()
+        value = self.data[self.pos : self.pos + n]
+        if len(value) != n:
+            raise struct.error("truncated string")
+        self.pos += n
+        return value
+
+    def path(self) -> str:
+        return self.string().decode("utf-8", errors="replace")
+
+
+def _string(value: bytes | str) -> bytes:
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return _U32.pack(len(value)) + value
+
+
+def _normalize(path: str) -> str:
+    parts: list[str] = []
+    for part in path.split("/"):
+        if part in ("", "."):
+            continue
+        if part == "..":
+            if parts:
+                parts.pop()
+            continue
+        parts.append(part)
+    return "/" + "/".join(parts)
+
+
+def _file_attrs(size: int, mtime: int) -> bytes:
+    return b"".join(
+        (
+            _U32.pack(ATTR_SIZE | ATTR_PERMISSIONS | ATTR_ACMODTIME),
+            _U64.pack(size),
+            _U32.pack(stat.S_IFREG | 0o644),
+            _U32.pack(mtime),
+            _U32.pack(mtime),
+        )
+    )
+
+
+class _Upload:
+    """
+    An upload opened for writing. SHA-512 follows the writes while they are
+    contiguous; anything else (gaps, rewrites) is hashed from disk on close.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        tmp_path: Path,
+        final_path: Path,
+        filename: str,
+        pace: shaping.Pacer | None = None,
+    ) -> None:
+        self.token = token
+        self.tmp_path = tmp_path
+        self.final_path = final_path
+        self.filename = filename
+        self.fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        self.size = 0
+        # Bytes charged against the key's budget so far (see SftpServer._grow).
+        self.charged = 0
+        self._hash = hashlib.sha512()
+        self._hashed = 0
+        self._in_order = True
+        self._pace = pace
+
+    def write(self, offset: int, data: bytes) -> None:
+        if self._pace is not None:
+            self._pace(len(data))
+        view = memoryview(data)
+        pos = offset
+        while view:
+            n = os.pwrite(self.fd, view, pos)
+            view = view[n:]
+            pos += n
+        if self._in_order and offset == self._hashed:
+            self._hash.update(data)
+            self._hashed += len(data)
+        else:
+            self._in_order = False
+        self.size = max(self.size, offset + len(data))
+
+    def digest(self) -> str:
+        if self._in_order and self._hashed == self.size:
+            return self._hash.hexdigest()
+        h = hashlib.sha512()
+        with open(self.tmp_path, "rb") as f:
+            while chunk := f.read(REHASH_CHUNK):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def abort(self) -> None:
+        self.close()
+        try:
+            os.unlink(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class _Download:
+    def __init__(self, record: FileRecord, pace: shaping.Pacer | None = None) -> None:
+        self.token = record.token
+        self.size = record.size_bytes
+        # Where the payload starts in stored_path; non-zero inside a segment.
+        self._start = record.seg_offset or 0
+        self._sent = 0
+        self._pace = pace
+        self._decoded: compress.DecodedReader | None = None
+        self._fd = -1
+        if record.codec == compress.NONE:
+            self._fd = os.open(record.stored_path, os.O_RDONLY)
+        else:
+            self._decoded = compress.DecodedReader(
+                record.stored_path, record.codec, self._start
+            )
+
+    def pread(self, length: int, offset: int) -> bytes:
+        if self._decoded is not None:
+            data = self._decoded.pread(length, offset)
+        else:
+            # A segment holds other payloads past this one.
+            length = max(0, min(length, self.size - offset))
+            data = os.pread(self._fd, length, self._start + offset)
+        self._sent += len(data)
+        if self._pace is not None:
+            self._pace(len(data))
+        return data
+
+    def close(self) -> None:
+        if self._sent >= self.size:
+            metrics.inc("gateway_files_total", direction="download")
+        metrics.inc("gateway_bytes_total", self._sent, direction="download")
+        if self._decoded is not None:
+            self._decoded.close()
+        else:
+            os.close(self._fd)
+
+    abort = close
+
+
+class _Listing:
+    def close(self) -> None:
+        pass
+
+    abort = close
+
+
+class SftpServer:
+    def __init__(
+        self, conf: store.Config, mode: str, rfile: BinaryIO, wfile: BinaryIO
+    ) -> None:
+        self.conf = conf
+        self.mode = mode
+        self.rfile = rfile
+        self.wfile = wfile
+        self.receipts: list[FileRecord] = []
+        self._handles: dict[bytes, _Upload | _Download | _Listing] = {}
+        self._next_handle = 0
+        self._inbuf = bytearray()
+        self._handlers: dict[int, Callable[[int, _Msg], None]] = {
+            FXP_OPEN: self._open,
+            FXP_CLOSE: self._close,
+            FXP_READ: self._read,
+            FXP_WRITE: self._write,
+            FXP_LSTAT: self._stat,
+            FXP_STAT: self._stat,
+            FXP_FSTAT: self._fstat,
+            FXP_SETSTAT: self._ignore_attrs,
+            FXP_FSETSTAT: self._ignore_attrs,
+            FXP_OPENDIR: self._opendir,
+            FXP_READDIR: self._readdir,
+            FXP_REALPATH: self._realpath,
+            FXP_EXTENDED: self._extended,
+        }
+
+    def _packet(self) -> bytes | None:
+        buf = self._inbuf
+        while True:
+            if len(buf) >= 4:
+                n = _U32.unpack_from(buf)[0]
+                if n > MAX_PACKET or n == 0:
+                    raise RuntimeError(f"bad sftp packet length {n}")
+                if len(buf) >= 4 + n:
+                    packet = bytes(buf[4 : 4 + n])
+                    del buf[: 4 + n]
+                    return packet
+            # About to wait on the client: send everything answered so far.
+            self.wfile.flush()
+            chunk = self.rfile.read1(INPUT_CHUNK)
+            if not chunk:
+                if buf:
+                    raise EOFError("truncated sftp packet")
+                return None
+            buf += chunk
+
+    def _send(self, kind: int, *parts: bytes) -> None:
+        body = b"".join(parts)
+        self.wfile.write(_U32.pack(len(body) + 1) + bytes((kind,)) + body)
+
+    def _status(self, req_id: int, code: int, message: str = "") -> None:
+        self._send(FXP_STATUS, _U32.pack(req_id), _U32.pack(code), _string(message), _string(""))
+
+    def _check_handles(self) -> None:
+        # Advertised in limits@openssh.com; each open upload holds an fd.
+        if len(self._handles) >= MAX_HANDLES:
+            raise SftpError(FX_FAILURE, "too many open handles")
+
+    def _add_handle(self, obj: _Upload | _Download | _Listing) -> bytes:
+        self._next_handle += 1
+        handle = str(self._next_handle).encode("ascii")
+        self._handles[handle] = obj
+        return handle
+
+    def _handle(self, msg: _Msg) -> _Upload | _Download | _Listing:
+        obj = self._handles.get(msg.string())
+        if obj is None:
+            raise SftpError(FX_FAILURE, "invalid handle")
+        return obj
+
+    def serve(self) -> list[FileRecord]:
+        """
+        Answers requests until the client closes its end. Uploads never
+        closed by the client are discarded. Returns the stored uploads.
+        """
+        with db_session():
+            try:
+                while (packet := self._packet()) is not None:
+                    self._dispatch(packet)
+            finally:
+                for obj in self._handles.values():
+                    obj.abort()
+                    if isinstance(obj, _Upload):
+                        self._refund(obj)
+                self._handles.clear()
+            self.wfile.flush()
+        return self.receipts
+
+    def _dispatch(self, packet: bytes) -> None:
+        kind = packet[0]
+        if kind == FXP_INIT:
+            self._send(FXP_VERSION, _U32.pack(VERSION), _string(LIMITS_EXTENSION), _string("1"))
+            return
+        msg = _Msg(packet, 1)
+        try:
+            req_id = msg.u32()
+        except struct.error:
+            raise RuntimeError(f"sftp request type={kind} without id") from None
+        handler = self._handlers.get(kind)
+        if handler is None:
+            logutil.debug("sftp: unsupported request type=%s", kind)
+            self._status(req_id, FX_OP_UNSUPPORTED, "operation not supported")
+            return
+        try:
+            handler(req_id, msg)
+        except SftpError as exc:
+            self._status(req_id, exc.code, str(exc))
+        except struct.error:
+            self._status(req_id, FX_BAD_MESSAGE, "malformed request")
+        except OSError as exc:
+            logutil.error(f"sftp: request type={kind} failed err={exc!r}")
+            self._status(req_id, FX_FAILURE, exc.strerror or "I/O error")
+
+    def _extended(self, req_id: int, msg: _Msg) -> None:
+        name = msg.string()
+        if name != LIMITS_EXTENSION:
+            raise SftpError(FX_OP_UNSUPPORTED, "extension not supported")
+        limits = (MAX_PACKET, MAX_READ, MAX_WRITE, MAX_HANDLES)
+        self._send(FXP_EXTENDED_REPLY, _U32.pack(req_id), *(_U64.pack(v) for v in limits))
+
+    def _realpath(self, req_id: int, msg: _Msg) -> None:
+        path = _normalize(msg.path())
+        self._send(FXP_NAME, _U32.pack(req_id), _U32.pack(1), _string(path), _string(path), _U32.pack(0))
+
+    def _lookup(self, path: str) -> FileRecord:
+        token = path.rsplit("/", 1)[-1]
+        record = None
+        if self.mode == "get" and token:
+            if not self.conf.bloom or bloom.might_contain(self.conf.data_dir, token):
+                record = get_file_by_token(token)
+        if not record:
+            raise SftpError(FX_NO_SUCH_FILE, "no such token")
+        if utcnow() >= record.expires_at:
+            logutil.info(f"sftp: token expired token={token!r}")
+            raise SftpError(FX_NO_SUCH_FILE, "token expired")
+        if record.bundle:
+            raise SftpError(FX_OP_UNSUPPORTED, "directory tokens need legacy scp (-O -r)")
+        return record
+
+    def _stat(self, req_id: int, msg: _Msg) -> None:
+        path = _normalize(msg.path())
+        if path == "/":
+            self._send(FXP_ATTRS, _U32.pack(req_id), _DIR_ATTRS)
+            return
+        record = self._lookup(path)
+        attrs = _file_attrs(record.size_bytes, int(record.created_at.timestamp()))
+        self._send(FXP_ATTRS, _U32.pack(req_id), attrs)
+
+    def _fstat(self, req_id: int, msg: _Msg) -> None:
+        obj = self._handle(msg)
+        if isinstance(obj, _Listing):
+            self._send(FXP_ATTRS, _U32.pack(req_id), _DIR_ATTRS)
+            return
+        self._send(FXP_ATTRS, _U32.pack(req_id), _file_attrs(obj.size, int(utcnow().timestamp())))
+
+    def _ignore_attrs(self, req_id: int, msg: _Msg) -> None:
+        # Times and modes from scp -p have nowhere to go; accept them.
+        self._status(req_id, FX_OK)
+
+    def _opendir(self, req_id: int, msg: _Msg) -> None:
+        self._check_handles()
+        if _normalize(msg.path()) != "/":
+            raise SftpError(FX_NO_SUCH_FILE, "no such directory")
+        self._send(FXP_HANDLE, _U32.pack(req_id), _string(self._add_handle(_Listing())))
+
+    def _readdir(self, req_id: int, msg: _Msg) -> None:
+        # Tokens are capabilities: never enumerate them.
+        self._handle(msg)
+        self._status(req_id, FX_EOF)
+
+    def _open(self, req_id: int, msg: _Msg) -> None:
+        self._check_handles()
+        path = _normalize(msg.path())
+        pflags = msg.u32()
+        name = path.rsplit("/", 1)[-1]
+        if self.mode == "put":
+            if pflags & FXF_READ or not pflags & FXF_WRITE:
+                raise SftpError(FX_PERMISSION_DENIED, "uploads are write-only")
+            if not name:
+                raise SftpError(FX_FAILURE, "missing file name")
+            token, tmp_path, final_path = store.new_upload(self.conf)
+            # SFTP does not say how big an upload will be: shaped as bulk.
+            pace = shaping.pacer(self.conf.shaping, self.conf.data_dir, -1)
+            obj: _Upload | _Download = _Upload(token, tmp_path, final_path, name, pace)
+            logutil.debug("sftp: upload open token=%s filename=%r", token, name)
+        else:
+            if pflags & FXF_WRITE:
+                raise SftpError(FX_PERMISSION_DENIED, "downloads are read-only")
+            record = self._lookup(path)
+            token = record.token
+            pace = shaping.pacer(self.conf.shaping, self.conf.data_dir, record.size_bytes)
+            try:
+                obj = _Download(record, pace)
+            except FileNotFoundError:
+                logutil.error(f"sftp: file missing token={token!r} path={record.stored_path}")
+                raise SftpError(FX_NO_SUCH_FILE, "file missing on disk") from None
+            logutil.debug("sftp: download open token=%r", token)
+        self._send(FXP_HANDLE, _U32.pack(req_id), _string(self._add_handle(obj)))
+
+    def _read(self, req_id: int, msg: _Msg) -> None:
+        obj = self._handle(msg)
+        offset = msg.u64()
+        length = msg.u32()
+        if not isinstance(obj, _Download):
+            raise SftpError(FX_PERMISSION_DENIED, "not open for reading")
+        data = obj.pread(min(length, MAX_READ), offset)
+        if not data:
+            self._status(req_id, FX_EOF)
+            return
+        self._send(FXP_DATA, _U32.pack(req_id), _string(data))
+
+    def _write(self, req_id: int, msg: _Msg) -> None:
+        handle = msg.string()
+        offset = msg.u64()
+        data = msg.string()
+        obj = self._handles.get(handle)
+        if obj is None:
+            raise SftpError(FX_FAILURE, "invalid handle")
+        if not isinstance(obj, _Upload):
+            raise SftpError(FX_PERMISSION_DENIED, "not open for writing")
+        try:
+            self._grow(obj, offset + len(data))
+        except SftpError:
+            # A refused write leaves a hole: discard the upload rather than store it short.
+            del self._handles[handle]
+            obj.abort()
+            self._refund(obj)
+            raise
+        obj.write(offset, data)
+        self._status(req_id, FX_OK)
+
+    def _grow(self, obj: _Upload, end: int) -> None:
+        if end > MAX_FILE_SIZE:
+            raise SftpError(FX_FAILURE, "write past the largest file size")
+        if end <= obj.size:
+            return
+        # SFTP gives no size up front: space and quota follow the high-water mark.
+        growth = end - obj.size
+        try:
+            allocate.check_space(self.conf.data_dir, growth, self.conf.reserve_bytes)
+            quota.charge(self.conf.key, self.conf.quota, size=growth)
+        except (allocate.NoSpace, quota.OverQuota) as exc:
+            raise SftpError(FX_FAILURE, str(exc)) from None
+        obj.charged += growth
+
+    def _refund(self, obj: _Upload) -> None:
+        # The upload is not kept: give back what its writes were charged.
+        quota.refund(self.conf.key, self.conf.quota, size=obj.charged)
+
+    def _close(self, req_id: int, msg: _Msg) -> None:
+        handle = msg.string()
+        obj = self._handles.pop(handle, None)
+        if obj is None:
+            raise SftpError(FX_FAILURE, "invalid handle")
+        if not isinstance(obj, _Upload):
+            obj.close()
+            self._status(req_id, FX_OK)
+            return
+        try:
+            obj.close()
+            digest = obj.digest()
+            # Writes may have come out of order, so compress the finished file.
+            codec = compress.encode_path(obj.tmp_path, self.conf.codec)
+            if self.conf.use_segment(obj.size):
+                data = obj.tmp_path.read_bytes()
+                record = store.store_small(
+                    self.conf,
+                    obj.token,
+                    data,
+                    digest=digest,
+                    filename=obj.filename,
+                    size=obj.size,
+                    codec=codec,
+                )
+                os.unlink(obj.tmp_path)
+            else:
+                record = store.store_upload(
+                    self.conf,
+                    obj.token,
+                    obj.tmp_path,
+                    obj.final_path,
+                    digest=digest,
+                    filename=obj.filename,
+                    size=obj.size,
+                    codec=codec,
+                )
+        except BaseException:
+            try:
+                os.unlink(obj.tmp_path)
+            except FileNotFoundError:
+                pass
+            self._refund(obj)
+            raise
+        try:
+            store.flush_pending(self.conf, [record])
+        except Exception as exc:
+            # Without a row nothing would ever reclaim the file.
+            logutil.error(f"sftp: failed to record token={record.token} err={exc!r}")
+            # An unrecorded segment entry is dead space the cleaner compacts away.
+            if record.seg_offset is None:
+                os.unlink(record.stored_path)
+            else:
+                segments.release()
+            self._refund(obj)
+            raise SftpError(FX_FAILURE, "could not record upload") from None
+        self.receipts.append(record)
+        logutil.info(f"sftp: stored token={record.token} size={record.size_bytes}")
+        store.write_receipt(record.token, record.expires_at.isoformat())
+        self._status(req_id, FX_OK)
+
+
+def main(mode: str, conf: store.Config, rfile: BinaryIO, wfile: BinaryIO) -> int:
+    try:
+        receipts = SftpServer(conf, mode, rfile, wfile).serve()
+    except Exception as e:
+        logutil.error(f"sftp session failed: {e!r}")
+        return 1
+    logutil.info(f"sftp session complete mode={mode} uploads={len(receipts)}")
+    return 0
@@ -0,0 +1,174 @@
+"""
+Bandwidth shaping for transfers.
+
+Each session may move at most SHAPE_SESSION_MBPS, and all gateway processes
+together at most SHAPE_TOTAL_MBPS. The total is a token bucket shared through
+a small mmap'd file in DATA_DIR (BUCKET_NAME), updated under flock. Transfers
+of at most SHAPE_SMALL_MB are small: they may spend the bucket down to empty,
+while bulk transfers stop at RESERVE of its capacity, so bulk uses what small
+ones leave and never makes them wait. Copy loops call the pacer() they are
+handed with each chunk they move; it sleeps until the chunk fits. 0 = off.
+"""
+from __future__ import annotations
+
+import fcntl
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+BUCKET_NAME = "bandwidth.bucket"
+# Seconds of rate a full bucket holds: the longest burst after an idle spell.
+BURST_SECONDS = 1.0
+# Fraction of the shared bucket only small transfers may spend.
+RESERVE = 0.25
+DEFAULT_SMALL_MB = 8
+# Bucket level in bytes, and the time.monotonic() it was last brought up to.
+_STATE = struct.Struct("<dd")
+
+Pacer = Callable[[int], None]
+
+
+class Limits(NamedTuple):
+    session_bytes_per_s: int = 0
+    total_bytes_per_s: int = 0
+    small_bytes: int = DEFAULT_SMALL_MB * 1024 * 1024
+
+    @property
+    def enabled(self) -> bool:
+        return self.session_bytes_per_s > 0 or self.total_bytes_per_s > 0
+
+
+def limits_from_env() -> Limits:
+    mb = 1024 * 1024
+    return Limits(
+        session_bytes_per_s=int(float(os.environ.get("SHAPE_SESSION_MBPS", "0")) * mb),
+        total_bytes_per_s=int(float(os.environ.get("SHAPE_TOTAL_MBPS", "0")) * mb),
+        small_bytes=int(float(os.environ.get("SHAPE_SMALL_MB", str(DEFAULT_SMALL_MB))) * mb),
+    )
+
+
+class _LocalBucket:
+    # A process serves one session at a time, so this is the session's budget.
+    # A chunk may overdraw it and then waits off the debt.
+    def __init__(self, rate: int) -> None:
+        self.rate = rate
+        self.level = rate * BURST_SECONDS
+        self.stamp = time.monotonic()
+
+    def delay(self, n: int) -> float:
+        now = time.monotonic()
+        self.level = min(self.rate * BURST_SECONDS, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.level -= n
+        return -self.level / self.rate if self.level < 0 else 0.0
+
+
+class _SharedBucket:
+    def __init__(self, path: Path, rate: int) -> None:
+        self.rate = rate
+        self.capacity = rate * BURST_SECONDS
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o660)
+            # Put and get sessions run as different users in DATA_DIR's group;
+            # umask would drop the group write bit.
+            os.fchmod(fd, 0o660)
+        except FileExistsError:
+            fd = os.open(path, os.O_RDWR)
+        self._fd = fd
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < _STATE.size:
+                # A zero stamp reads as a long idle spell: the bucket starts full.
+                os.ftruncate(fd, _STATE.size)
+            self._map = mmap.mmap(fd, _STATE.size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def delay(self, n: int, floor: float) -> float:
+        """
+        Spends n bytes if that leaves at least `floor`; otherwise spends
+        nothing and returns how long to wait before asking again.
+        """
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            level, stamp = _STATE.unpack_from(self._map)
+            now = time.monotonic()
+            # A stamp ahead of now is from before a reboot.
+            level = min(self.capacity, level + max(0.0, now - stamp) * self.rate)
+            wait = 0.0
+            if level - n >= floor:
+                level -= n
+            else:
+                wait = (floor + n - level) / self.rate
+            _STATE.pack_into(self._map, 0, level, now)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return wait
+
+    def close(self) -> None:
+        self._map.close()
+        os.close(self._fd)
+
+
+# Per process: a forked worker must not share the lock's file description.
+_local: _LocalBucket | None = None
+_shared: _SharedBucket | None = None
+_pid = 0
+
+
+def _buckets(
+    limits: Limits, data_dir: Path
+) -> tuple[_LocalBucket | None, _SharedBucket | None]:
+    global _local, _shared, _pid
+    if _pid != os.getpid():
+        _local = _shared = None
+        _pid = os.getpid()
+    rate = limits.session_bytes_per_s
+    if rate and (_local is None or _local.rate != rate):
+        _local = _LocalBucket(rate)
+    rate = limits.total_bytes_per_s
+    if rate and (_shared is None or _shared.rate != rate):
+        if _shared is not None:
+            _shared.close()
+        _shared = _SharedBucket(data_dir / BUCKET_NAME, rate)
+    return (
+        _local if limits.session_bytes_per_s else None,
+        _shared if limits.total_bytes_per_s else None,
+    )
+
+
+def pacer(limits: Limits, data_dir: Path, size: int) -> Pacer | None:
+    """
+    Returns the pacing function for a transfer of `size` bytes (-1 when not
+    known up front), or None when nothing is shaped.
+    """
+    if not limits.enabled:
+        return None
+    local, shared = _buckets(limits, data_dir)
+    small = 0 <= size <= limits.small_bytes
+    floor = 0.0
+    piece = 0
+    if shared is not None:
+        floor = 0.0 if small else shared.capacity * RESERVE
+        # A bulk chunk larger than the unreserved part would never fit whole.
+        piece = max(1, int(shared.capacity - floor))
+
+    def pace(n: int) -> None:
+        if local is not None:
+            wait = local.delay(n)
+            if wait:
+                time.sleep(wait)
+        if shared is None:
+            return
+        while n > 0:
+            part = min(n, piece)
+            wait = shared.delay(part, floor)
+            if wait:
+                time.sleep(wait)
+            else:
+                n -= part
+
+    return pace
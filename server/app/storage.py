@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+# Hex characters per fan-out directory level ("ab" -> 256 entries per level).
+SHARD_WIDTH = 2
+# Flat, as existing deployments are laid out; see app.migrate_layout.
+DEFAULT_SHARD_DEPTH = 0
+# Deduplicated payloads live under data_dir/BLOB_DIR, apart from token files.
+BLOB_DIR = "blobs"
+
+# Shard directories this process already created; skips repeat mkdir calls.
+_MADE_DIRS: set[Path] = set()
+
+
+def shard_depth_from_env() -> int:
+    return int(os.environ.get("DATA_SHARD_DEPTH", str(DEFAULT_SHARD_DEPTH)))
+
+
+def token_path(data_dir: Path, token: str, depth: int) -> Path:
+    """
+    Where `token` is stored. depth=0 is the flat layout (data_dir/<token>);
+    depth=2 gives data_dir/ab/cd/<token>, with ab/cd taken from a hash of the
+    token so entries spread evenly however tokens are generated.
+    """
+    if depth <= 0:
+        return data_dir / token
+    # Not at module level: hashlib loads OpenSSL, which a session start need not wait for.
+    import hashlib
+
+    digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).hexdigest()
+    shards = [digest[i * SHARD_WIDTH : (i + 1) * SHARD_WIDTH] for i in range(depth)]
+    return data_dir.joinpath(*shards, token)
+
+
+def blob_path(data_dir: Path, sha512: str, token: str, depth: int) -> Path:
+    """
+    Where a deduplicated payload is stored: data_dir/blobs/ab/cd/<sha512>.<token>,
+    sharded by the digest itself. The creating upload's token keeps each
+    generation distinct, so a blob the cleaner is freeing never shares a name
+    with a fresh upload of the same content.
+    """
+    shards = [sha512[i * SHARD_WIDTH : (i + 1) * SHARD_WIDTH] for i in range(max(depth, 0))]
+    return data_dir.joinpath(BLOB_DIR, *shards, f"{sha512}.{token}")
+
+
+def dedup_from_env() -> bool:
+    return os.environ.get("DATA_DEDUP", "0") == "1"
+
+
+def ensure_parent(path: Path) -> None:
+    parent = path.parent
+    if parent in _MADE_DIRS:
+        return
+    parent.mkdir(parents=True, exist_ok=True)
+    _MADE_DIRS.add(parent)
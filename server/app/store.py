@@ -0,0 +1,236 @@
+"""
+Where uploads go once received, for both scp and sftp sessions: the session
+Config, the token and paths a new upload gets, moving it (or appending it to
+a segment) into place, and recording its receipt row.
+"""
+from __future__ import annotations
+
+import base64
+import os
+import sys
+from datetime import timedelta
+from pathlib import Path
+from typing import NamedTuple
+
+from app import (
+    admission,
+    allocate,
+    bloom,
+    compress,
+    logutil,
+    metrics,
+    phases,
+    quota,
+    segments,
+    shaping,
+    storage,
+    zerocopy,
+)
+from app.db import FileRecord, insert_files, utcnow
+
+
+# NamedTuple rather than a dataclass: importing dataclasses pulls in inspect,
+# which costs more at session start than the rest of the gateway together.
+class Config(NamedTuple):
+    data_dir: Path
+    ttl_days: int
+    # Fan-out levels under data_dir (see storage.token_path); 0 = flat.
+    shard_depth: int = 0
+    # Download copy path, one of zerocopy.MODES.
+    send_mode: str = zerocopy.AUTO
+    # Store each distinct payload once, shared by every token that uploads it.
+    dedup: bool = False
+    # Codec new uploads are stored with (compress.CODECS), when they compress.
+    codec: str = compress.NONE
+    # Bytes an upload must leave free on data_dir (see allocate.check_space).
+    reserve_bytes: int = 0
+    # Reserve each scp upload's full size with posix_fallocate up front.
+    preallocate: bool = True
+    # Uploads up to this many bytes are appended to a shared segment
+    # (see app.segments) instead of getting a file each; 0 = off.
+    segment_max: int = 0
+    # Keep data_dir/tokens.bloom (see app.bloom) current and refuse tokens
+    # it has never seen without asking the DB.
+    bloom: bool = False
+    # Fraction of scp sessions that log a phase timing summary (app.phases).
+    phase_sample: float = 0.0
+    # Fingerprint of the session's SSH key and its budgets (app.quota).
+    key: str = ""
+    quota: quota.Limits = quota.Limits()
+    # Bandwidth caps per session and across all sessions (app.shaping).
+    shaping: shaping.Limits = shaping.Limits()
+    # Concurrent put/get sessions allowed, and the queue in front (app.admission).
+    admission: admission.Limits = admission.Limits()
+
+    @classmethod
+    def from_env(cls) -> "Config":
+        data_dir = Path(os.environ.get("DATA_DIR", "/data")).resolve()
+        ttl_days = int(os.environ.get("TTL_DAYS", "7"))
+        data_dir.mkdir(parents=True, exist_ok=True)
+        return cls(
+            data_dir=data_dir,
+            ttl_days=ttl_days,
+            shard_depth=storage.shard_depth_from_env(),
+            send_mode=os.environ.get("GATEWAY_SEND_MODE", zerocopy.AUTO),
+            dedup=storage.dedup_from_env(),
+            codec=compress.codec_from_env(),
+            reserve_bytes=allocate.reserve_from_env(),
+            preallocate=allocate.preallocate_from_env(),
+            segment_max=segments.max_item_from_env(),
+            bloom=bloom.capacity_from_env() > 0,
+            phase_sample=phases.sample_from_env(),
+            key=quota.key_from_env(),
+            quota=quota.limits_from_env(),
+            shaping=shaping.limits_from_env(),
+            admission=admission.limits_from_env(),
+        )
+
+    def use_segment(self, size: int) -> bool:
+        # Dedup keys stored files by digest, so it keeps one file per payload.
+        return not self.dedup and 0 < size <= self.segment_max
+
+
+def new_token() -> str:
+    """
+    A fresh URL-safe, high-entropy token; also the stored filename.
+    """
+    # Same encoding as secrets.token_urlsafe(32) without importing secrets.
+    return base64.urlsafe_b64encode(os.urandom(32)).rstrip(b"=").decode("ascii")
+
+
+def flush_pending(conf: Config, pending: list[FileRecord]) -> None:
+    """
+    Writes queued receipt rows, then removes payloads the DB already had.
+    Tokens go into the filter once committed, before any receipt is sent.
+    """
+    if pending:
+        with phases.span("insert"):
+            duplicates = insert_files(pending)
+        # Every segment entry appended so far now has its row.
+        segments.release()
+        tokens = [r.token for r in pending]
+        metrics.inc("gateway_files_total", len(pending), direction="upload")
+        metrics.inc("gateway_bytes_total", sum(r.size_bytes for r in pending), direction="upload")
+        pending.clear()
+        if conf.bloom:
+            with phases.span("bloom"):
+                bloom.add(conf.data_dir, tokens)
+        for path in duplicates:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def new_upload(conf: Config) -> tuple[str, Path, Path]:
+    """
+    Picks a token for an incoming file; returns (token, tmp_path, final_path).
+    """
+    token = new_token()
+    final_path = storage.token_path(conf.data_dir, token, conf.shard_depth)
+    # Same directory as the final name so os.replace stays atomic.
+    tmp_path = final_path.parent / f".{token}.tmp"
+    storage.ensure_parent(final_path)
+    return token, tmp_path, final_path
+
+
+def store_upload(
+    conf: Config,
+    token: str,
+    tmp_path: Path,
+    final_path: Path,
+    *,
+    digest: str,
+    filename: str,
+    size: int,
+    codec: str = compress.NONE,
+    alloc: allocate.Allocation | None = None,
+    is_bundle: bool = False,
+) -> FileRecord:
+    """
+    Moves a fully received upload (tmp_path, or `alloc` if given) into place
+    and returns its receipt row.
+    """
+    stored_path = final_path
+    if conf.dedup:
+        stored_path = storage.blob_path(conf.data_dir, digest, token, conf.shard_depth)
+        storage.ensure_parent(stored_path)
+    with phases.span("store"):
+        if alloc is not None:
+            # A bundle holds a whole tree, so its one fsync covers many files.
+            alloc.commit(stored_path, durable=is_bundle)
+        else:
+            os.replace(tmp_path, stored_path)
+    logutil.debug("stored token=%s path=%s", token, stored_path)
+    return _record(
+        conf,
+        token,
+        stored_path,
+        digest=digest,
+        filename=filename,
+        size=size,
+        blob=conf.dedup,
+        codec=codec,
+        bundle=is_bundle,
+    )
+
+
+def store_small(
+    conf: Config,
+    token: str,
+    data: bytes,
+    *,
+    digest: str,
+    filename: str,
+    size: int,
+    codec: str = compress.NONE,
+) -> FileRecord:
+    """
+    Appends a fully received small upload (as stored, i.e. after encoding)
+    to the current segment and returns its receipt row.
+    """
+    with phases.span("store"):
+        stored_path, offset = segments.append(conf.data_dir, data)
+    logutil.debug(
+        "stored token=%s path=%s offset=%s length=%s", token, stored_path, offset, len(data)
+    )
+    return _record(
+        conf,
+        token,
+        stored_path,
+        digest=digest,
+        filename=filename,
+        size=size,
+        codec=codec,
+        seg_offset=offset,
+        seg_length=len(data),
+    )
+
+
+def _record(
+    conf: Config,
+    token: str,
+    stored_path: Path,
+    *,
+    digest: str,
+    filename: str,
+    size: int,
+    **fields: object,
+) -> FileRecord:
+    created = utcnow()
+    return FileRecord(
+        token=token,
+        sha512=digest,
+        original_name=filename,
+        size_bytes=size,
+        stored_path=str(stored_path),
+        created_at=created,
+        expires_at=created + timedelta(days=conf.ttl_days),
+        **fields,
+    )
+
+
+def write_receipt(token: str, expires_at: str) -> None:
+    # Receipt on stderr to avoid corrupting the stdout protocol stream.
+    sys.stderr.write("RECEIPT\n" f"token={token}\n" f"expires_at={expires_at}\n")
+    sys.stderr.flush()
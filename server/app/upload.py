@@ -0,0 +1,118 @@
+"""
+Upload engine for scp payloads. Data is read with readinto() into a small ring
+of reused buffers; a worker thread hashes and writes each filled buffer while
+the next one is being received. readinto, SHA-512 over large buffers and file
+writes all release the GIL, so the three overlap.
+"""
+from __future__ import annotations
+
+import hashlib
+import queue
+import threading
+import time
+from typing import BinaryIO, Callable
+
+from app import phases
+
+Pacer = Callable[[int], None]
+
+CHUNK_SIZE = 1024 * 1024
+# Buffers in flight: one being filled, the rest queued for or held by the worker.
+BUFFERS = 4
+
+# Allocated on first upload and reused for every file in the process.
+_pool: list[memoryview] = []
+
+
+def _buffers() -> list[memoryview]:
+    if not _pool:
+        _pool.extend(memoryview(bytearray(CHUNK_SIZE)) for _ in range(BUFFERS))
+    return _pool
+
+
+def _fill(src: BinaryIO, view: memoryview, pace: Pacer | None) -> int:
+    with phases.span("client"):
+        n = src.readinto(view)
+    if not n:
+        raise EOFError("unexpected EOF while reading file data")
+    if pace is not None:
+        # Holding off the next read pushes back on the client.
+        with phases.span("shape"):
+            pace(n)
+    return n
+
+
+def _serial(
+    src: BinaryIO, dst: BinaryIO, h: "hashlib._Hash", size: int, pace: Pacer | None
+) -> None:
+    view = _buffers()[0]
+    remaining = size
+    while remaining:
+        n = _fill(src, view[: min(remaining, CHUNK_SIZE)], pace)
+        with phases.span("hash"):
+            h.update(view[:n])
+        with phases.span("write"):
+            dst.write(view[:n])
+        remaining -= n
+
+
+def _pipelined(
+    src: BinaryIO, dst: BinaryIO, h: "hashlib._Hash", size: int, pace: Pacer | None
+) -> None:
+    free: queue.SimpleQueue = queue.SimpleQueue()
+    full: queue.SimpleQueue = queue.SimpleQueue()
+    for view in _buffers():
+        free.put(view)
+    failure: list[BaseException] = []
+    timer = phases.current()
+
+    def drain() -> None:
+        while True:
+            item = full.get()
+            if item is None:
+                return
+            view, n = item
+            # After a failure keep recycling buffers so the reader never blocks.
+            if not failure:
+                try:
+                    # Spans track nesting on the session thread; add() directly.
+                    started = time.perf_counter() if timer.active else 0.0
+                    h.update(view[:n])
+                    hashed = time.perf_counter() if timer.active else 0.0
+                    dst.write(view[:n])
+                    if timer.active:
+                        timer.add("hash", hashed - started)
+                        timer.add("write", time.perf_counter() - hashed)
+                except BaseException as exc:
+                    failure.append(exc)
+            free.put(view)
+
+    worker = threading.Thread(target=drain, name="upload", daemon=True)
+    worker.start()
+    try:
+        remaining = size
+        while remaining and not failure:
+            view = free.get()
+            n = _fill(src, view[: min(remaining, CHUNK_SIZE)], pace)
+            full.put((view, n))
+            remaining -= n
+    finally:
+        full.put(None)
+        worker.join()
+    if failure:
+        raise failure[0]
+
+
+def receive(src: BinaryIO, dst: BinaryIO, size: int, pace: Pacer | None = None) -> str:
+    """
+    Copies exactly `size` bytes from src to dst and returns their SHA-512 hex
+    digest. Raises EOFError if src ends first. Payloads that fit in one buffer
+    skip the worker thread. `pace` is called with each chunk read (see
+    app.shaping).
+    """
+    h = hashlib.sha512()
+    if size <= CHUNK_SIZE:
+        _serial(src, dst, h, size, pace)
+    else:
+        _pipelined(src, dst, h, size, pace)
+    return h.hexdigest()
@@ -0,0 +1,132 @@
+"""
+File -> stdout copies for downloads that stay in the kernel where possible:
+splice() when stdout is a pipe, sendfile() otherwise (sockets, files), and a
+single reused readinto() buffer when neither works for the fd pair.
+"""
+from __future__ import annotations
+
+import errno
+import io
+import os
+import stat
+from typing import BinaryIO, Callable
+
+AUTO = "auto"
+SENDFILE = "sendfile"
+SPLICE = "splice"
+COPY = "copy"
+MODES = (AUTO, SENDFILE, SPLICE, COPY)
+
+COPY_CHUNK_SIZE = 1024 * 1024
+# Bytes requested per sendfile/splice call; the kernel caps a call near 2 GiB.
+KERNEL_CHUNK_SIZE = 1 << 30
+# Per call when paced, so the pacer sees the transfer in small steps.
+PACED_CHUNK_SIZE = 1024 * 1024
+
+# Errors meaning "not supported for these fds" rather than a failed transfer.
+_UNSUPPORTED = frozenset({errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP})
+
+# Allocated on first use and kept for the life of the process.
+_buffer: bytearray | None = None
+
+
+def _fileno(out: BinaryIO) -> int | None:
+    try:
+        return out.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+
+
+def _pick(mode: str, out_fd: int) -> str:
+    if mode != AUTO:
+        return mode
+    if hasattr(os, "splice") and stat.S_ISFIFO(os.fstat(out_fd).st_mode):
+        return SPLICE
+    if hasattr(os, "sendfile"):
+        return SENDFILE
+    return COPY
+
+
+def _wait_writable(fd: int) -> None:
+    # Only reached when sshd hands us a non-blocking stdout.
+    import select
+
+    select.select([], [fd], [])
+
+
+def _kernel_copy(
+    mode: str,
+    src_fd: int,
+    out_fd: int,
+    offset: int,
+    count: int,
+    pace: Callable[[int], None] | None = None,
+) -> int | None:
+    # None when the very first call reports the fd pair as unsupported.
+    sent = 0
+    chunk = KERNEL_CHUNK_SIZE if pace is None else PACED_CHUNK_SIZE
+    while sent < count:
+        n = min(count - sent, chunk)
+        try:
+            if mode == SPLICE:
+                done = os.splice(src_fd, out_fd, n, offset_src=offset + sent)
+            else:
+                done = os.sendfile(out_fd, src_fd, offset + sent, n)
+        except BlockingIOError:
+            _wait_writable(out_fd)
+            continue
+        except OSError as exc:
+            if sent or exc.errno not in _UNSUPPORTED:
+                raise
+            return None
+        if not done:
+            break
+        sent += done
+        if pace is not None:
+            pace(done)
+    return sent
+
+
+def _copy(
+    src: BinaryIO, out: BinaryIO, count: int, pace: Callable[[int], None] | None = None
+) -> int:
+    global _buffer
+    if _buffer is None:
+        _buffer = bytearray(COPY_CHUNK_SIZE)
+    view = memoryview(_buffer)
+    sent = 0
+    while sent < count:
+        n = src.readinto(view[: min(COPY_CHUNK_SIZE, count - sent)])
+        if not n:
+            break
+        out.write(view[:n])
+        sent += n
+        if pace is not None:
+            pace(n)
+    return sent
+
+
+def send_file(
+    src: BinaryIO,
+    out: BinaryIO,
+    count: int,
+    mode: str = AUTO,
+    pace: Callable[[int], None] | None = None,
+) -> tuple[int, str]:
+    """
+    Writes up to `count` bytes of `src`, from its current position, to `out`.
+    Returns (bytes sent, mode used); fewer than `count` means src hit EOF.
+    `pace` is called with each chunk sent (see app.shaping).
+    """
+    if mode not in MODES:
+        raise ValueError(f"unknown send mode {mode!r}")
+    # Anything already buffered in `out` must reach the fd first.
+    out.flush()
+    out_fd = _fileno(out) if mode != COPY else None
+    if out_fd is not None:
+        picked = _pick(mode, out_fd)
+        if picked != COPY:
+            sent = _kernel_copy(picked, src.fileno(), out_fd, src.tell(), count, pace)
+            if sent is not None:
+                return sent, picked
+    return _copy(src, out, count, pace), COPY
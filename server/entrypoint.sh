@@ -35,13 +35,37 @@ log_debug() { log DEBUG "$*"; }
 log_verbose() { log VERBOSE "$*"; }
 
 : "${DATA_DIR:=/data}"
+: "${DATA_SHARD_DEPTH:=0}"
+: "${DATA_DEDUP:=0}"
+: "${DATA_CODEC:=none}"
+: "${DATA_RESERVE_MB:=1024}"
+: "${DATA_PREALLOCATE:=1}"
+: "${DATA_SEGMENT_MAX_KB:=0}"
+: "${DATA_BLOOM_CAPACITY:=0}"
+: "${METRICS_SOCKET:=${DATA_DIR}/metrics.sock}"
 : "${KEYS_DIR:=/keys}"
+: "${DB_BACKEND:=postgres}"
+: "${DB_PATH:=${DATA_DIR}/meta/files.db}"
 : "${DB_HOST:=db}"
 : "${DB_PORT:=5432}"
 : "${DB_NAME:=app}"
 : "${DB_USER:=app}"
 : "${DB_PASSWORD:=app}"
 : "${SSHD_LOG_LEVEL:=INFO}"
+: "${GATEWAY_DAEMON:=1}"
+: "${GATEWAY_SOCKET_DIR:=/run/gateway}"
+: "${GATEWAY_SEND_MODE:=auto}"
+: "${GATEWAY_PHASE_SAMPLE:=1}"
+: "${KEY_QUOTA_SESSIONS:=0}"
+: "${KEY_QUOTA_MB:=0}"
+: "${KEY_QUOTA_WINDOW_SECONDS:=86400}"
+: "${SHAPE_SESSION_MBPS:=0}"
+: "${SHAPE_TOTAL_MBPS:=0}"
+: "${SHAPE_SMALL_MB:=8}"
+: "${GATEWAY_MAX_PUT:=0}"
+: "${GATEWAY_MAX_GET:=0}"
+: "${GATEWAY_QUEUE:=64}"
+: "${GATEWAY_QUEUE_SECONDS:=30}"
 
 log_info "entrypoint starting LOG_LEVEL=${LOG_LEVEL}"
 log_debug "env DATA_DIR=${DATA_DIR} KEYS_DIR=${KEYS_DIR} DB_HOST=${DB_HOST} DB_PORT=${DB_PORT} DB_NAME=${DB_NAME} DB_USER=${DB_USER}"
@@ -52,7 +76,15 @@ chmod 666 "${LOG_SINK}"
 tail -n+1 -F "${LOG_SINK}" >&2 &
 
 mkdir -p "${DATA_DIR}"
-chmod 755 "${DATA_DIR}"
+# setgid: files created in DATA_DIR, by any user, belong to the transfer group
+# that put and get share, so shared files can be 0660 rather than 0666.
+chgrp transfer "${DATA_DIR}"
+chmod 2755 "${DATA_DIR}"
+# Shared by put and get sessions: admission slots and the bandwidth bucket.
+mkdir -p "${DATA_DIR}/admission"
+chmod 2770 "${DATA_DIR}/admission"
+touch "${DATA_DIR}/bandwidth.bucket"
+chmod 660 "${DATA_DIR}/bandwidth.bucket"
 
 # Host keys (generate if absent)
 if [ ! -f /etc/ssh/ssh_host_ed25519_key ]; then
@@ -83,23 +115,63 @@ else
 fi
 
 # Initialize DB schema (idempotent)
-export DB_HOST DB_PORT DB_NAME DB_USER DB_PASSWORD
-log_info "initializing database schema"
+export DB_BACKEND DB_PATH DB_HOST DB_PORT DB_NAME DB_USER DB_PASSWORD
+log_info "initializing database schema backend=${DB_BACKEND}"
 python -c "from app.db import init_db; init_db()"
+if [ "${DB_BACKEND}" = "sqlite" ]; then
+  # put and get workers write the database and create its -wal/-shm files,
+  # which SQLite gives the database's mode; setgid keeps them in the group.
+  chgrp transfer "$(dirname "${DB_PATH}")" "${DB_PATH}"*
+  chmod 2770 "$(dirname "${DB_PATH}")"
+  chmod 660 "${DB_PATH}"*
+fi
 
 cat > /etc/ssh/sshd_env <<EOF
+export DB_BACKEND=${DB_BACKEND}
+export DB_PATH=${DB_PATH}
 export DB_HOST=${DB_HOST}
 export DB_PORT=${DB_PORT}
 export DB_NAME=${DB_NAME}
 export DB_USER=${DB_USER}
 export DB_PASSWORD=${DB_PASSWORD}
 export DATA_DIR=${DATA_DIR}
+export DATA_SHARD_DEPTH=${DATA_SHARD_DEPTH}
+export DATA_DEDUP=${DATA_DEDUP}
+export DATA_CODEC=${DATA_CODEC}
+export DATA_RESERVE_MB=${DATA_RESERVE_MB}
+export DATA_PREALLOCATE=${DATA_PREALLOCATE}
+export DATA_SEGMENT_MAX_KB=${DATA_SEGMENT_MAX_KB}
+export DATA_BLOOM_CAPACITY=${DATA_BLOOM_CAPACITY}
+export METRICS_SOCKET=${METRICS_SOCKET}
 export TTL_DAYS=${TTL_DAYS}
 export LOG_LEVEL=${LOG_LEVEL}
 export LOG_SINK=${LOG_SINK}
+export GATEWAY_DAEMON=${GATEWAY_DAEMON}
+export GATEWAY_SOCKET_DIR=${GATEWAY_SOCKET_DIR}
+export GATEWAY_SEND_MODE=${GATEWAY_SEND_MODE}
+export GATEWAY_PHASE_SAMPLE=${GATEWAY_PHASE_SAMPLE}
+export KEY_QUOTA_SESSIONS=${KEY_QUOTA_SESSIONS}
+export KEY_QUOTA_MB=${KEY_QUOTA_MB}
+export KEY_QUOTA_WINDOW_SECONDS=${KEY_QUOTA_WINDOW_SECONDS}
+export SHAPE_SESSION_MBPS=${SHAPE_SESSION_MBPS}
+export SHAPE_TOTAL_MBPS=${SHAPE_TOTAL_MBPS}
+export SHAPE_SMALL_MB=${SHAPE_SMALL_MB}
+export GATEWAY_MAX_PUT=${GATEWAY_MAX_PUT}
+export GATEWAY_MAX_GET=${GATEWAY_MAX_GET}
+export GATEWAY_QUEUE=${GATEWAY_QUEUE}
+export GATEWAY_QUEUE_SECONDS=${GATEWAY_QUEUE_SECONDS}
 EOF
 
 log_info "sshd environment captured"
+
+# Pre-forked gateway workers; sessions fall back to gateway.py if it is down.
+if [ "${GATEWAY_DAEMON}" = "1" ]; then
+  mkdir -p "${GATEWAY_SOCKET_DIR}"
+  chmod 755 "${GATEWAY_SOCKET_DIR}"
+  export DATA_DIR DATA_SHARD_DEPTH DATA_DEDUP DATA_CODEC DATA_RESERVE_MB DATA_PREALLOCATE DATA_SEGMENT_MAX_KB DATA_BLOOM_CAPACITY METRICS_SOCKET TTL_DAYS LOG_LEVEL LOG_SINK GATEWAY_SOCKET_DIR GATEWAY_SEND_MODE GATEWAY_PHASE_SAMPLE KEY_QUOTA_SESSIONS KEY_QUOTA_MB KEY_QUOTA_WINDOW_SECONDS SHAPE_SESSION_MBPS SHAPE_TOTAL_MBPS SHAPE_SMALL_MB GATEWAY_MAX_PUT GATEWAY_MAX_GET GATEWAY_QUEUE GATEWAY_QUEUE_SECONDS
+  log_info "starting gateway daemon socket_dir=${GATEWAY_SOCKET_DIR}"
+  python -m app.gateway_daemon &
+fi
 log_info "STARTED"
 
 # Start sshd in foreground
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import ast
 import sys
 import threading
 import trace
@@ -54,6 +55,22 @@ def _iter_cov_files(cov_targets: Iterable[str]) -> list[Path]:
     return sorted(files)
 
 
+def _excluded_lines(path: Path) -> set[int]:
+    # Imports under `if TYPE_CHECKING:` only run for type checkers, and code
+    # marked `# pragma: no cover` only in forked children, whose counts are lost.
+    source = path.read_text(encoding="utf-8")
+    marked = {n for n, line in enumerate(source.splitlines(), 1) if "# pragma: no cover" in line}
+    lines: set[int] = set()
+    for node in ast.walk(ast.parse(source)):
+        test = node.test if isinstance(node, ast.If) else None
+        name = test.id if isinstance(test, ast.Name) else getattr(test, "attr", None)
+        if name == "TYPE_CHECKING":
+            lines.update(range(node.body[0].lineno, node.body[-1].end_lineno + 1))
+        elif isinstance(node, ast.stmt) and node.lineno in marked:
+            lines.update(range(node.lineno, node.end_lineno + 1))
+    return lines
+
+
 def pytest_sessionfinish(session: pytest.Session, exitstatus: int) -> None:
     sys.settrace(None)
     threading.settrace(None)
@@ -72,6 +89,7 @@ def pytest_sessionfinish(session: pytest.Session, exitstatus: int) -> None:
 
     for path in files:
         exec_lines = set(trace._find_executable_linenos(str(path)).keys())
+        exec_lines -= _excluded_lines(path)
         if not exec_lines:
             continue
         hit_lines = {
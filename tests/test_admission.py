@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import fcntl
+import os
+import stat
+import threading
+
+import pytest
+
+from app import admission
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+        self.on_sleep = None
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(round(seconds, 6))
+        self.now += seconds
+        if self.on_sleep:
+            self.on_sleep()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(admission.time, "monotonic", c.monotonic)
+    monkeypatch.setattr(admission.time, "sleep", c.sleep)
+    return c
+
+
+def _hold(path):
+    fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o666)
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    return fd
+
+
+def test_limits_from_env(monkeypatch):
+    for name in ("GATEWAY_MAX_PUT", "GATEWAY_MAX_GET", "GATEWAY_QUEUE", "GATEWAY_QUEUE_SECONDS"):
+        monkeypatch.delenv(name, raising=False)
+    assert admission.limits_from_env() == admission.Limits()
+
+    monkeypatch.setenv("GATEWAY_MAX_PUT", "4")
+    monkeypatch.setenv("GATEWAY_MAX_GET", "8")
+    monkeypatch.setenv("GATEWAY_QUEUE", "2")
+    monkeypatch.setenv("GATEWAY_QUEUE_SECONDS", "1.5")
+    limits = admission.limits_from_env()
+    assert limits == admission.Limits(put=4, get=8, queue=2, queue_seconds=1.5)
+    assert (limits.slots("put"), limits.slots("get")) == (4, 8)
+
+
+def test_admit_is_a_no_op_without_a_limit(tmp_path):
+    with admission.admit(admission.Limits(), tmp_path, "put"):
+        pass
+    assert not (tmp_path / admission.DIR_NAME).exists()
+
+
+def test_admit_holds_a_slot_for_the_block(tmp_path):
+    limits = admission.Limits(put=1)
+    with admission.admit(limits, tmp_path, "put"):
+        directory = tmp_path / admission.DIR_NAME
+        assert stat.S_IMODE(directory.stat().st_mode) == 0o2770
+        assert stat.S_IMODE((directory / "put.0").stat().st_mode) == 0o660
+        with pytest.raises(BlockingIOError):
+            _hold(directory / "put.0")
+    os.close(_hold(directory / "put.0"))
+    # Get sessions have their own slots, and an existing directory is reused.
+    with admission.admit(admission.Limits(get=1), tmp_path, "get"):
+        assert (directory / "get.0").exists()
+
+
+def test_admit_queues_until_a_slot_frees(tmp_path, clock, monkeypatch):
+    monkeypatch.setenv("LOG_LEVEL", "INFO")
+    (tmp_path / admission.DIR_NAME).mkdir()
+    held = _hold(tmp_path / admission.DIR_NAME / "get.0")
+    clock.on_sleep = lambda: len(clock.slept) == 3 and os.close(held)
+
+    with admission.admit(admission.Limits(get=1), tmp_path, "get"):
+        with pytest.raises(BlockingIOError):
+            _hold(tmp_path / admission.DIR_NAME / "get.0")
+
+    # Alone in the queue, so at its head: no back-off.
+    assert clock.slept == [admission.POLL_MIN_SECONDS] * 3
+    # The queue slot was given back once admitted.
+    os.close(_hold(tmp_path / admission.DIR_NAME / "get.queue.0"))
+
+
+def test_admit_gives_up_after_queue_seconds(tmp_path, clock):
+    (tmp_path / admission.DIR_NAME).mkdir()
+    held = _hold(tmp_path / admission.DIR_NAME / "put.0")
+    limits = admission.Limits(put=1, queue_seconds=1.0)
+
+    with pytest.raises(admission.Busy, match="no put slot free in 1s"):
+        with admission.admit(limits, tmp_path, "put"):
+            pytest.fail("admitted")
+
+    assert round(sum(clock.slept), 6) <= 1.0
+    assert set(clock.slept) == {admission.POLL_MIN_SECONDS}
+    os.close(held)
+    os.close(_hold(tmp_path / admission.DIR_NAME / "put.queue.0"))
+
+
+def test_admit_rejects_at_once_with_the_queue_full(tmp_path, clock):
+    directory = tmp_path / admission.DIR_NAME
+    directory.mkdir()
+    held = [_hold(directory / "put.0"), _hold(directory / "put.queue.0")]
+
+    with pytest.raises(admission.Busy, match="put queue is full"):
+        with admission.admit(admission.Limits(put=1, queue=1), tmp_path, "put"):
+            pytest.fail("admitted")
+
+    assert clock.slept == []
+    for fd in held:
+        os.close(fd)
+
+
+def test_waiters_go_before_newcomers_and_in_ticket_order(tmp_path, clock, monkeypatch, capfd):
+    monkeypatch.setenv("LOG_LEVEL", "INFO")
+    directory = tmp_path / admission.DIR_NAME
+    directory.mkdir()
+    # An earlier waiter: queued, holding the oldest ticket.
+    marker = os.open(directory / "put.queued", os.O_RDONLY | os.O_CREAT, 0o666)
+    fcntl.flock(marker, fcntl.LOCK_SH)
+    waiter, ticket = admission._enqueue(directory, "put", admission.Limits(put=1))
+    assert ticket == 0
+
+    def waiter_leaves():
+        if len(clock.slept) == 2:
+            os.close(waiter)
+            os.close(marker)
+
+    clock.on_sleep = waiter_leaves
+    # The run slot is free, yet the newcomer queues behind the waiter.
+    with admission.admit(admission.Limits(put=1), tmp_path, "put"):
+        with pytest.raises(BlockingIOError):
+            _hold(directory / "put.0")
+
+    # Backing off behind the waiter, then at the head once it has gone.
+    assert clock.slept == [0.002, 0.004]
+    assert "put queued position=2 depth=2 slots=1" in capfd.readouterr().err
+    # Nobody is queued any more: the next session goes straight in.
+    assert not admission._queue_waiting(directory, "put")
+    assert admission._queued_tickets(directory, "put", admission.Limits(put=1)) == []
+
+
+def test_queued_tickets_never_see_a_slot_before_its_ticket(tmp_path):
+    directory = tmp_path / admission.DIR_NAME
+    directory.mkdir()
+    limits = admission.Limits(put=1)
+    # A slot left behind by an earlier waiter still holds its old ticket.
+    stale = os.open(directory / "put.queue.0", os.O_RDWR | os.O_CREAT, 0o666)
+    os.pwrite(stale, admission._TICKET.pack(7), 0)
+    os.close(stale)
+    counter = os.open(directory / "put.ticket", os.O_RDWR | os.O_CREAT, 0o666)
+    os.pwrite(counter, admission._TICKET.pack(9), 0)
+
+    # A newcomer mid-_enqueue holds the counter; readers wait for it.
+    fcntl.flock(counter, fcntl.LOCK_EX)
+    seen = []
+    reader = threading.Thread(
+        target=lambda: seen.append(admission._queued_tickets(directory, "put", limits))
+    )
+    reader.start()
+    reader.join(0.1)
+    assert reader.is_alive()
+    os.close(counter)
+    reader.join()
+    assert seen == [[]]
+
+    fd, ticket = admission._enqueue(directory, "put", limits)
+    assert ticket == 9
+    assert admission._queued_tickets(directory, "put", limits) == [9]
+    os.close(fd)
@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import errno
+import os
+import shutil
+from types import SimpleNamespace
+
+import pytest
+
+from app import allocate
+
+
+@pytest.fixture
+def tmpfile_links(monkeypatch):
+    # Sandboxes may refuse linkat through /proc; copying has the same effect.
+    monkeypatch.setattr(allocate, "_TMPFILE_OK", None)
+    monkeypatch.setattr(
+        allocate, "_link_tmpfile", lambda fd, dest: shutil.copyfile(f"/proc/self/fd/{fd}", dest)
+    )
+
+
+@pytest.fixture
+def named_tmp(monkeypatch):
+    monkeypatch.setattr(allocate, "_TMPFILE_OK", False)
+
+
+def test_check_space_keeps_reserve(monkeypatch, tmp_path):
+    monkeypatch.setattr(os, "statvfs", lambda _p: SimpleNamespace(f_bavail=100, f_frsize=10))
+
+    allocate.check_space(tmp_path, 500, 500)
+    with pytest.raises(allocate.NoSpace):
+        allocate.check_space(tmp_path, 501, 500)
+
+
+def test_settings_from_env(monkeypatch):
+    monkeypatch.delenv("DATA_RESERVE_MB", raising=False)
+    monkeypatch.delenv("DATA_PREALLOCATE", raising=False)
+    assert allocate.reserve_from_env() == allocate.DEFAULT_RESERVE_MB * 1024 * 1024
+    assert allocate.preallocate_from_env() is True
+    monkeypatch.setenv("DATA_RESERVE_MB", "2")
+    monkeypatch.setenv("DATA_PREALLOCATE", "0")
+    assert allocate.reserve_from_env() == 2 * 1024 * 1024
+    assert allocate.preallocate_from_env() is False
+
+
+def test_tmpfile_is_anonymous_until_commit(tmp_path, tmpfile_links):
+    alloc = allocate.allocate(tmp_path / ".tok.tmp", 100)
+    assert alloc.tmp_path is None
+    assert os.fstat(alloc.fd).st_size == 100
+    alloc.file.write(b"hello")
+    assert os.listdir(tmp_path) == []
+
+    alloc.commit(tmp_path / "tok")
+
+    assert os.listdir(tmp_path) == ["tok"]
+    assert (tmp_path / "tok").read_bytes() == b"hello"
+
+
+def test_named_fallback_commits_and_aborts(tmp_path, named_tmp):
+    alloc = allocate.allocate(tmp_path / ".a.tmp", 3)
+    alloc.file.write(b"abc")
+    alloc.commit(tmp_path / "a")
+    assert (tmp_path / "a").read_bytes() == b"abc"
+
+    alloc = allocate.allocate(tmp_path / ".b.tmp", 0)
+    alloc.abort()
+    assert sorted(os.listdir(tmp_path)) == ["a"]
+
+
+def test_abort_after_failed_commit(tmp_path, named_tmp):
+    alloc = allocate.allocate(tmp_path / ".a.tmp", 3)
+    with pytest.raises(FileNotFoundError):
+        alloc.commit(tmp_path / "missing" / "a")
+    alloc.abort()
+    alloc.abort()
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_probe_falls_back_when_links_fail(tmp_path, monkeypatch):
+    monkeypatch.setattr(allocate, "_TMPFILE_OK", None)
+
+    def refuse(fd, dest):
+        raise OSError(errno.EXDEV, "cross-device link")
+
+    monkeypatch.setattr(allocate, "_link_tmpfile", refuse)
+    alloc = allocate.allocate(tmp_path / ".a.tmp", 1)
+
+    assert alloc.tmp_path == tmp_path / ".a.tmp"
+    assert allocate._TMPFILE_OK is False
+    alloc.abort()
+    assert os.listdir(tmp_path) == []
+
+
+def test_probe_without_tmpfile_support(tmp_path, monkeypatch):
+    monkeypatch.delattr(os, "O_TMPFILE")
+    assert allocate._probe(tmp_path) is False
+    monkeypatch.undo()
+
+    real_open = os.open
+
+    def no_tmpfile(path, flags, mode=0o777):
+        if flags & os.O_TMPFILE == os.O_TMPFILE:
+            raise OSError(errno.EOPNOTSUPP, "not supported")
+        return real_open(path, flags, mode)
+
+    monkeypatch.setattr(os, "open", no_tmpfile)
+    assert allocate._probe(tmp_path) is False
+
+
+@pytest.mark.parametrize(
+    "err, raised",
+    [(errno.ENOSPC, allocate.NoSpace), (errno.EBADF, OSError), (errno.EOPNOTSUPP, None)],
+)
+def test_fallocate_errors(tmp_path, named_tmp, monkeypatch, err, raised):
+    def fail(fd, offset, length):
+        raise OSError(err, os.strerror(err))
+
+    monkeypatch.setattr(os, "posix_fallocate", fail)
+    if raised is None:
+        allocate.allocate(tmp_path / ".a.tmp", 10).abort()
+    else:
+        with pytest.raises(raised):
+            allocate.allocate(tmp_path / ".a.tmp", 10)
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_preallocate_can_be_disabled(tmp_path, named_tmp, monkeypatch):
+    monkeypatch.setattr(os, "posix_fallocate", lambda *a: pytest.fail("fallocate called"))
+    alloc = allocate.allocate(tmp_path / ".a.tmp", 10, preallocate=False)
+    assert os.fstat(alloc.fd).st_size == 0
+    alloc.abort()
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import pytest
+
+from app import bloom
+
+
+@pytest.fixture(autouse=True)
+def fresh_reader(monkeypatch):
+    monkeypatch.setattr(bloom, "_reader", None)
+
+
+def test_sizing_meets_the_target_rate():
+    bits, hashes = bloom.sizing(1000, 0.01)
+    assert bits == 9600
+    assert hashes == 7
+    assert bloom.sizing(1) == (64, bloom.MAX_HASHES)
+
+
+def test_filter_has_no_false_negatives_and_few_false_positives(tmp_path):
+    f = bloom.Filter.create(tmp_path / "f", 1000)
+    # Writable by DATA_DIR's group (put and get), not by everyone.
+    assert (tmp_path / "f").stat().st_mode & 0o777 == 0o660
+    tokens = [f"tok{i}" for i in range(1000)]
+    f.add(tokens)
+
+    assert all(t in f for t in tokens)
+    false_positives = sum(f"other{i}" in f for i in range(10000))
+    stats = f.stats(len(tokens))
+    f.close()
+    assert false_positives < 300
+    assert 0.4 < stats.fill < 0.6
+    assert stats.fp_rate < 0.02
+
+
+def test_filter_rejects_foreign_files(tmp_path):
+    (tmp_path / "f").write_bytes(b"x" * 64)
+    with pytest.raises(ValueError):
+        bloom.Filter(tmp_path / "f")
+
+
+def test_might_contain_without_a_filter_defers_to_the_db(tmp_path):
+    assert bloom.might_contain(tmp_path, "anything")
+    bloom.add(tmp_path, ["a"])
+    assert bloom.might_contain(tmp_path, "anything")
+
+
+def test_rebuild_swaps_in_live_tokens_and_keeps_concurrent_adds(tmp_path):
+    stats = bloom.rebuild(tmp_path, 100, [["old"]])
+    assert stats.tokens == 1
+    assert bloom.might_contain(tmp_path, "old")
+    assert not bloom.might_contain(tmp_path, "new")
+
+    def batches():
+        yield ["kept"]
+        # An upload committed while the cleaner is scanning.
+        bloom.add(tmp_path, ["new"])
+        yield ["also"]
+
+    stats = bloom.rebuild(tmp_path, 100, batches())
+
+    assert stats.tokens == 2
+    assert not (tmp_path / "tokens.bloom.next").exists()
+    # The reader notices the new file without a restart.
+    assert not bloom.might_contain(tmp_path, "old")
+    for token in ("kept", "also", "new"):
+        assert bloom.might_contain(tmp_path, token)
+
+
+def test_failed_rebuild_keeps_the_old_filter(tmp_path):
+    bloom.rebuild(tmp_path, 100, [["old"]])
+
+    def batches():
+        yield ["x"]
+        raise RuntimeError("db gone")
+
+    with pytest.raises(RuntimeError):
+        bloom.rebuild(tmp_path, 100, batches())
+
+    assert not (tmp_path / "tokens.bloom.next").exists()
+    assert bloom.might_contain(tmp_path, "old")
+
+
+def test_capacity_from_env(monkeypatch):
+    monkeypatch.delenv("DATA_BLOOM_CAPACITY", raising=False)
+    assert bloom.capacity_from_env() == 0
+    monkeypatch.setenv("DATA_BLOOM_CAPACITY", "5000")
+    assert bloom.capacity_from_env() == 5000
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import hashlib
+import io
+
+import pytest
+
+from app import bundle
+
+
+def _build() -> tuple[bytes, str]:
+    out = io.BytesIO()
+    w = bundle.Writer(out)
+    w.enter(0o755, "top")
+    w.write(b"hello")
+    w.add(0o644, "a.txt", 5, hashlib.sha512(b"hello").hexdigest())
+    w.enter(0o700, "sub")
+    w.add(0o600, "empty", 0, hashlib.sha512(b"").hexdigest())
+    w.leave()
+    w.leave()
+    assert w.depth == 0 and w.name == "top" and w.size == 5
+    digest = w.finish()
+    return out.getvalue(), digest
+
+
+def test_index_round_trip():
+    data, digest = _build()
+    entries = bundle.read_index(io.BytesIO(data))
+
+    assert [(e.kind, e.mode, e.name, e.size, e.offset) for e in entries] == [
+        ("D", 0o755, "top", 0, 0),
+        ("C", 0o644, "a.txt", 5, 0),
+        ("D", 0o700, "sub", 0, 0),
+        ("C", 0o600, "empty", 0, 5),
+        ("E", 0, "", 0, 0),
+        ("E", 0, "", 0, 0),
+    ]
+    assert entries[1].sha512 == hashlib.sha512(b"hello").hexdigest()
+    assert entries[0].sha512 == ""
+    assert data[:5] == b"hello"
+
+
+def test_digest_depends_on_contents_not_timing():
+    _, first = _build()
+    _, second = _build()
+    assert first == second
+
+    out = io.BytesIO()
+    w = bundle.Writer(out)
+    w.enter(0o755, "top")
+    assert w.finish() != first
+
+
+@pytest.mark.parametrize("name", ["", ".", "..", "a/b"])
+def test_writer_rejects_path_names(name):
+    w = bundle.Writer(io.BytesIO())
+    with pytest.raises(ValueError):
+        w.enter(0o755, name)
+    with pytest.raises(ValueError):
+        w.add(0o644, name, 0, "")
+
+
+def test_read_index_rejects_plain_files():
+    with pytest.raises(ValueError):
+        bundle.read_index(io.BytesIO(b"x" * 100))
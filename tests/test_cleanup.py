@@ -5,7 +5,7 @@ import sys
 import pytest
 
 from app import cleanup
-from app import cleanup_worker, db
+from app import cleanup_worker, db, metrics
 
 
 class DummyConfig:
@@ -25,6 +25,7 @@ def test_cleanup_main_invokes_loop(monkeypatch):
         raise SystemExit(0)
 
     monkeypatch.setattr(cleanup, "init_db", fake_init_db)
+    monkeypatch.setattr(metrics, "serve_from_env", lambda: None)
     monkeypatch.setattr(cleanup, "CleanupConfig", DummyConfig)
     monkeypatch.setattr(cleanup, "run_cleanup_loop", fake_run)
 
@@ -48,6 +49,7 @@ def test_cleanup_entrypoint_runs_main(monkeypatch):
             return "config"
 
     monkeypatch.setattr(db, "init_db", fake_init_db)
+    monkeypatch.setattr(metrics, "serve_from_env", lambda: None)
     monkeypatch.setattr(cleanup_worker, "run_cleanup_loop", fake_run)
     monkeypatch.setattr(cleanup_worker, "CleanupConfig", DummyConfig)
 
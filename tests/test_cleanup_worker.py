@@ -1,79 +1,384 @@
 from __future__ import annotations
 
-from datetime import datetime, timezone
+import io
 from pathlib import Path
-
+import sys
+from datetime import datetime, timedelta, timezone
 import pytest
 
-from app import cleanup_worker
+from app import bloom, cleanup_worker, gateway, segments, store
 
 
-def test_remove_expired_files_handles_missing_and_error(tmp_path, monkeypatch):
+def test_remove_expired_files_handles_missing_and_error(tmp_path):
     existing = tmp_path / "old.txt"
     existing.write_text("gone", encoding="utf-8")
     missing = tmp_path / "missing.txt"
-
-    original_unlink = Path.unlink
-
-    def unlink_with_error(self):
-        if self.name == "error.txt":
-            raise OSError("boom")
-        return original_unlink(self)
-
+    # unlink() on a directory fails, exercising the error path.
     error_path = tmp_path / "error.txt"
-    error_path.write_text("fail", encoding="utf-8")
-
-    monkeypatch.setattr(Path, "unlink", unlink_with_error)
+    error_path.mkdir()
+    outside_dir = tmp_path / "elsewhere"
+    outside_dir.mkdir()
+    outside = outside_dir / "abs.txt"
+    outside.write_text("x", encoding="utf-8")
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    nested = data_dir / "ab" / "tok"
+    nested.parent.mkdir()
+    nested.write_text("x", encoding="utf-8")
+    config = cleanup_worker.CleanupConfig(data_dir=data_dir, interval_seconds=1, workers=2)
 
-    cleanup_worker.remove_expired_files(
+    counts = cleanup_worker.remove_expired_files(
         [
             ("tok1", str(existing)),
             ("tok2", str(missing)),
             ("tok3", str(error_path)),
-        ]
+            ("tok4", str(outside)),
+            ("tok5", str(nested)),
+        ],
+        config,
     )
 
+    assert counts == {"removed": 3, "missing": 1, "failed": 1}
     assert not existing.exists()
+    assert not outside.exists()
+    assert not nested.exists()
     assert error_path.exists()
 
 
-def test_run_cleanup_loop_deletes_and_sleeps(tmp_path, monkeypatch):
-    data_dir = tmp_path
-    expired_file = data_dir / "expired.bin"
-    expired_file.write_text("bye", encoding="utf-8")
+def test_remove_expired_files_empty_batch_is_quiet(tmp_path):
+    config = cleanup_worker.CleanupConfig(data_dir=tmp_path, interval_seconds=1)
+    assert cleanup_worker.remove_expired_files([], config) == {
+        "removed": 0,
+        "missing": 0,
+        "failed": 0,
+    }
+
+
+def test_pacer_spaces_operations():
+    now = [100.0]
+    slept = []
+
+    def fake_sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+
+    pacer = cleanup_worker.Pacer(4, clock=lambda: now[0], sleep=fake_sleep)
+    for _ in range(3):
+        pacer.wait()
+
+    assert slept == [0.25, 0.25]
 
-    calls = {"count": 0}
+    unlimited = cleanup_worker.Pacer(0, sleep=fake_sleep)
+    unlimited.wait()
+    assert slept == [0.25, 0.25]
+
+
+class Stop(BaseException):
+    pass
+
+
+class FakeListener:
+    def __init__(self, script):
+        self.script = list(script)
+        self.timeouts = []
+        self.connects = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closed = True
+
+    def connect(self):
+        self.connects += 1
+
+    def wait(self, timeout):
+        self.timeouts.append(timeout)
+        step = self.script.pop(0)
+        return step()
+
+
+def test_run_cleanup_loop_sleeps_until_deadlines(tmp_path, monkeypatch):
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    d1, d2, d3 = (base + timedelta(seconds=s) for s in (10, 20, 30))
+    now = [base]
+    expired_file = tmp_path / "expired.bin"
+    expired_file.write_text("bye", encoding="utf-8")
+    deletes = []
 
-    def fake_delete_expired(_now):
-        calls["count"] += 1
-        if calls["count"] == 1:
-            return []
-        return [("tok", str(expired_file))]
+    def fake_delete_expired(at):
+        deletes.append(at)
+        if len(deletes) == 2:
+            yield [("tok", str(expired_file))]
 
+    seeds = [[d1, d2], []]
     monkeypatch.setattr(cleanup_worker, "delete_expired", fake_delete_expired)
+    monkeypatch.setattr(cleanup_worker, "upcoming_expirations", lambda limit: seeds.pop(0))
+    monkeypatch.setattr(cleanup_worker, "utcnow", lambda: now[0])
+
+    def first_wait():
+        now[0] = d1 + timedelta(seconds=1)
+        return [d3]
+
+    def second_wait():
+        now[0] = d3 + timedelta(seconds=1)
+        return []
+
+    def stop():
+        raise Stop()
+
+    listener = FakeListener([first_wait, second_wait, stop])
+    config = cleanup_worker.CleanupConfig(
+        data_dir=tmp_path, interval_seconds=100, window=2, slack_seconds=1
+    )
+
+    with pytest.raises(Stop):
+        cleanup_worker.run_cleanup_loop(config, listener=listener, clock=lambda: 0.0)
+
+    # Startup resync, then one pass per wake-up; no polling in between.
+    assert deletes == [base, d1 + timedelta(seconds=1), d3 + timedelta(seconds=1)]
+    assert not expired_file.exists()
+    # The last sleep is capped by the reclaim interval, not the resync interval.
+    assert listener.timeouts == [11.0, 10.0, 60.0]
+    assert listener.connects == 1
+    assert listener.closed
+    assert seeds == []
+
+
+def test_run_cleanup_loop_resyncs_after_interval_and_retries(tmp_path, monkeypatch):
+    clock = [0.0]
+    deletes = []
+    monkeypatch.setattr(cleanup_worker, "delete_expired", lambda at: deletes.append(at) or iter([]))
+    monkeypatch.setattr(cleanup_worker, "upcoming_expirations", lambda limit: [])
     monkeypatch.setattr(
-        cleanup_worker,
-        "utcnow",
-        lambda: datetime(2024, 1, 1, tzinfo=timezone.utc),
+        cleanup_worker, "utcnow", lambda: datetime(2024, 1, 1, tzinfo=timezone.utc)
     )
 
-    def stop_sleep(_seconds):
-        if calls["count"] >= 2:
-            raise StopIteration
+    def idle():
+        clock[0] += 60
+        return []
 
-    config = cleanup_worker.CleanupConfig(data_dir=data_dir, interval_seconds=1)
+    def broken():
+        raise OSError("connection lost")
 
-    with pytest.raises(StopIteration):
-        cleanup_worker.run_cleanup_loop(config, sleep=stop_sleep)
+    def stop():
+        raise Stop()
 
-    assert not expired_file.exists()
+    listener = FakeListener([idle, broken, stop])
+    slept = []
+    config = cleanup_worker.CleanupConfig(data_dir=tmp_path, interval_seconds=60)
+
+    with pytest.raises(Stop):
+        cleanup_worker.run_cleanup_loop(
+            config, listener=listener, clock=lambda: clock[0], sleep=slept.append
+        )
+
+    assert slept == [cleanup_worker.RETRY_SECONDS]
+    assert listener.connects == 2
+    # Startup, interval resync, and resync after reconnecting.
+    assert len(deletes) == 3
+
+
+def test_run_cleanup_loop_reclaims_between_resyncs(tmp_path, monkeypatch):
+    clock = [0.0]
+    deletes = []
+    reclaims = []
+    seeds = []
+    monkeypatch.setattr(cleanup_worker, "delete_expired", lambda at: deletes.append(at) or iter([]))
+    monkeypatch.setattr(
+        cleanup_worker, "upcoming_expirations", lambda limit: seeds.append(clock[0]) or []
+    )
+    monkeypatch.setattr(
+        cleanup_worker, "reclaim_segments", lambda remover, config: reclaims.append(clock[0])
+    )
+    monkeypatch.setattr(cleanup_worker, "rebuild_filter", lambda config: None)
+    monkeypatch.setattr(
+        cleanup_worker, "utcnow", lambda: datetime(2024, 1, 1, tzinfo=timezone.utc)
+    )
+
+    def idle():
+        clock[0] += 60
+        return []
+
+    def stop():
+        raise Stop()
+
+    listener = FakeListener([idle, idle, stop])
+    config = cleanup_worker.CleanupConfig(
+        data_dir=tmp_path, interval_seconds=3600, reclaim_interval_seconds=60
+    )
+
+    with pytest.raises(Stop):
+        cleanup_worker.run_cleanup_loop(config, listener=listener, clock=lambda: clock[0])
+
+    # One full resync at startup; reclaim and re-seed every 60s after it.
+    assert len(deletes) == 1
+    assert reclaims == [0.0, 60.0, 120.0]
+    assert seeds == [0.0, 60.0, 120.0]
+    assert listener.timeouts == [60.0, 60.0, 60.0]
+
+
+def test_expiry_schedule_window():
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    schedule = cleanup_worker.ExpirySchedule(window=2)
+
+    schedule.seed([])
+    assert schedule.next_deadline() is None
+    assert not schedule.needs_seed()
+
+    schedule.seed([base, base + timedelta(seconds=5)])
+    schedule.push(base + timedelta(seconds=9))
+    schedule.push(base - timedelta(seconds=1))
+    assert schedule.next_deadline() == base - timedelta(seconds=1)
+
+    schedule.expire_through(base)
+    assert not schedule.needs_seed()
+    schedule.expire_through(base + timedelta(seconds=5))
+    # Past the end of a full window: rows beyond it must be re-read.
+    assert schedule.needs_seed()
 
 
 def test_cleanup_config_from_env(monkeypatch, tmp_path):
     monkeypatch.setenv("DATA_DIR", str(tmp_path))
     monkeypatch.setenv("CLEAN_INTERVAL_SECONDS", "5")
+    monkeypatch.setenv("CLEAN_WORKERS", "3")
+    monkeypatch.setenv("CLEAN_OPS_PER_SECOND", "250")
+    monkeypatch.setenv("RECLAIM_INTERVAL_SECONDS", "7")
 
     cfg = cleanup_worker.CleanupConfig.from_env()
 
     assert cfg.data_dir == tmp_path.resolve()
     assert cfg.interval_seconds == 5
+    assert cfg.reclaim_interval_seconds == 7
+    assert cfg.workers == 3
+    assert cfg.ops_per_second == 250.0
+    assert cfg.window == 1000
+    assert cfg.slack_seconds == 1.0
+    assert cfg.segment_min_live == segments.DEFAULT_MIN_LIVE
+    assert cfg.bloom_capacity == 0
+
+
+def test_reclaim_segments_unlinks_dead_and_compacts_sparse(tmp_path, monkeypatch):
+    hour = segments.BUCKET_SECONDS
+    monkeypatch.setattr(segments, "_last", (0, 0))
+    dead, _ = segments.append(tmp_path, b"gone", now=hour)
+    sparse, _ = segments.append(tmp_path, b"x" * 20 + b"LIVE", now=2 * hour)
+    busy, _ = segments.append(tmp_path, b"busy", now=3 * hour)
+    segments.append(tmp_path, b"open", now=9 * hour)
+    # Their rows are written.
+    segments.release()
+    now = datetime.fromtimestamp(9 * hour, timezone.utc)
+    monkeypatch.setattr(cleanup_worker, "utcnow", lambda: now)
+    monkeypatch.setattr(segments.time, "time", now.timestamp)
+
+    usage = {str(sparse): (1, 4), str(busy): (1, 4)}
+    monkeypatch.setattr(cleanup_worker, "segment_usage", lambda paths: usage)
+    monkeypatch.setattr(cleanup_worker, "segment_entries", lambda path: [("tok", 20, 4)])
+    moved = []
+
+    def move_segment_entries(old, moves):
+        moved.append((old, moves))
+        return {token for token, _, _ in moves}
+
+    monkeypatch.setattr(cleanup_worker, "move_segment_entries", move_segment_entries)
+    forgotten = []
+    monkeypatch.setattr(
+        cleanup_worker, "forget_segments", lambda paths: forgotten.extend(paths) or paths[:1]
+    )
+    config = cleanup_worker.CleanupConfig(data_dir=tmp_path, interval_seconds=1)
+
+    with cleanup_worker.FileRemover(config) as remover:
+        assert cleanup_worker.reclaim_segments(remover, config) == 1
+
+    current = tmp_path / "segments" / f"{9 * hour}-0"
+    assert moved == [(str(sparse), [("tok", str(current), 4)])]
+    assert current.read_bytes() == b"openLIVE"
+    # The compacted segment is only let go on a later pass.
+    assert forgotten == [str(dead), str(busy)]
+    assert not dead.exists() and sparse.exists() and busy.exists()
+
+
+class _Stdin(io.BytesIO):
+    # Runs on_line() before handing out the record at line number `at`.
+    def __init__(self, data, at, on_line):
+        super().__init__(data)
+        self.lines, self.at, self.on_line = 0, at, on_line
+
+    def readline(self, *args):
+        self.lines += 1
+        if self.lines == self.at:
+            self.on_line()
+        return super().readline(*args)
+
+
+def test_segments_of_a_session_outlive_a_bucket_rollover(tmp_path, monkeypatch):
+    hour = segments.BUCKET_SECONDS
+    clock = [hour + 5.0]
+    monkeypatch.setattr(segments.time, "time", lambda: clock[0])
+    monkeypatch.setattr(
+        cleanup_worker, "utcnow", lambda: datetime.fromtimestamp(clock[0], timezone.utc)
+    )
+    monkeypatch.setattr(segments, "_last", (0, 0))
+    rows = []
+    monkeypatch.setattr(store, "insert_files", lambda recs: rows.extend(recs) or [])
+    usage = {}
+    monkeypatch.setattr(cleanup_worker, "segment_usage", lambda paths: usage)
+    # As forget_segments does: a segment without rows counts as dead.
+    monkeypatch.setattr(
+        cleanup_worker,
+        "forget_segments",
+        lambda paths: [p for p in paths if usage.get(p, (0, 0))[0] <= 0],
+    )
+    config = cleanup_worker.CleanupConfig(data_dir=tmp_path, interval_seconds=1)
+    reclaimed = []
+
+    def later_reclaim():
+        # The first file's bucket has closed, its row is not written yet.
+        clock[0] = 3 * hour
+        with cleanup_worker.FileRemover(config) as remover:
+            reclaimed.append(cleanup_worker.reclaim_segments(remover, config))
+
+    stdin = _Stdin(b"C0644 2 a\nhi\x00C0644 2 b\nyo\x00", 2, later_reclaim)
+    monkeypatch.setattr(sys, "stdin", type("In", (), {"buffer": stdin})())
+    monkeypatch.setattr(sys, "stdout", type("Out", (), {"buffer": io.BytesIO()})())
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, segment_max=1024)
+
+    gateway.scp_receive_one(conf)
+
+    assert reclaimed == [0]
+    first, second = rows
+    assert Path(first.stored_path).name == f"{hour}-0"
+    assert Path(second.stored_path).name == f"{3 * hour}-0"
+    assert Path(first.stored_path).read_bytes() == b"hi"
+
+    # Once rows exist the counts decide; with none live it goes.
+    clock[0] = 5 * hour
+    usage[first.stored_path] = (1, 2)
+    with cleanup_worker.FileRemover(config) as remover:
+        assert cleanup_worker.reclaim_segments(remover, config) == 1
+    assert Path(first.stored_path).exists() and not Path(second.stored_path).exists()
+    assert not segments.lease_path(Path(second.stored_path)).exists()
+
+
+def test_rebuild_filter_scans_every_token(tmp_path, monkeypatch):
+    rows = ["a", "b", "c"]
+    scans = []
+
+    def list_tokens(after, limit):
+        scans.append(after)
+        return [t for t in rows if t > after][:limit]
+
+    monkeypatch.setattr(cleanup_worker, "list_tokens", list_tokens)
+    monkeypatch.setattr(bloom, "_reader", None)
+    config = cleanup_worker.CleanupConfig(data_dir=tmp_path, interval_seconds=1)
+    assert cleanup_worker.rebuild_filter(config) is None
+
+    config = cleanup_worker.CleanupConfig(
+        data_dir=tmp_path, interval_seconds=1, bloom_capacity=2, scan_batch=2
+    )
+    stats = cleanup_worker.rebuild_filter(config)
+
+    assert stats.tokens == 3
+    assert scans == ["", "b", "c"]
+    assert all(bloom.might_contain(tmp_path, t) for t in rows)
@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import io
+import os
+import zlib
+
+import pytest
+
+from app import compress
+
+TEXT = b"the quick brown fox jumps over the lazy dog\n" * 4000
+
+
+@pytest.mark.parametrize("codec", [compress.ZLIB, compress.LZMA])
+def test_encoder_round_trips_compressible_data(codec):
+    out = io.BytesIO()
+    encoder = compress.Encoder(out, codec)
+    for i in range(0, len(TEXT), 10000):
+        encoder.write(memoryview(TEXT)[i : i + 10000])
+    encoder.finish()
+
+    assert encoder.codec == codec
+    assert len(out.getvalue()) < len(TEXT) // 10
+    decoded = io.BytesIO()
+    assert compress.send_decoded(io.BytesIO(out.getvalue()), decoded, len(TEXT), codec) == len(TEXT)
+    assert decoded.getvalue() == TEXT
+
+
+def test_encoder_stores_incompressible_data_as_is():
+    payload = os.urandom(100000)
+    out = io.BytesIO()
+    encoder = compress.Encoder(out, compress.ZLIB)
+    encoder.write(payload[:70000])
+    encoder.write(payload[70000:])
+    encoder.finish()
+
+    assert encoder.codec == compress.NONE
+    assert out.getvalue() == payload
+
+
+@pytest.mark.parametrize("codec", [compress.NONE, compress.ZLIB])
+def test_encoder_empty_payload_is_uncompressed(codec):
+    out = io.BytesIO()
+    encoder = compress.Encoder(out, codec)
+    encoder.finish()
+
+    assert encoder.codec == compress.NONE
+    assert out.getvalue() == b""
+
+
+def test_send_decoded_stops_at_count():
+    out = io.BytesIO()
+    paced = []
+    src = io.BytesIO(zlib.compress(TEXT))
+    sent = compress.send_decoded(src, out, 100, compress.ZLIB, paced.append)
+
+    assert sent == 100
+    assert out.getvalue() == TEXT[:100]
+    assert paced == [100]
+
+    # A truncated stream sends what it decodes to, the caller sees it short.
+    out = io.BytesIO()
+    src = io.BytesIO(zlib.compress(TEXT)[:300])
+    assert 0 < compress.send_decoded(src, out, len(TEXT), compress.ZLIB) < len(TEXT)
+    assert TEXT.startswith(out.getvalue())
+
+
+def test_encode_path_compresses_in_place(tmp_path):
+    path = tmp_path / "f"
+    path.write_bytes(TEXT)
+
+    assert compress.encode_path(path, compress.ZLIB) == compress.ZLIB
+    assert zlib.decompress(path.read_bytes()) == TEXT
+    assert os.listdir(tmp_path) == ["f"]
+
+
+def test_encode_path_leaves_incompressible_or_disabled(tmp_path):
+    path = tmp_path / "f"
+    payload = os.urandom(1000)
+    path.write_bytes(payload)
+
+    assert compress.encode_path(path, compress.ZLIB) == compress.NONE
+    assert compress.encode_path(path, compress.NONE) == compress.NONE
+    assert path.read_bytes() == payload
+
+
+def test_encode_path_failure_removes_partial_output(tmp_path, monkeypatch):
+    path = tmp_path / "f"
+    path.write_bytes(TEXT)
+
+    def broken(codec):
+        raise OSError("no space")
+
+    monkeypatch.setattr(compress, "_compressor", broken)
+    with pytest.raises(OSError):
+        compress.encode_path(path, compress.LZMA)
+
+    assert os.listdir(tmp_path) == ["f"]
+    assert path.read_bytes() == TEXT
+
+
+def test_decoded_reader_moves_forward_and_restarts(tmp_path, monkeypatch):
+    monkeypatch.setattr(compress, "READ_CHUNK", 1000)
+    path = tmp_path / "f"
+    path.write_bytes(zlib.compress(TEXT))
+    reader = compress.DecodedReader(str(path), compress.ZLIB)
+
+    assert reader.pread(10, 5) == TEXT[5:15]
+    assert reader.pread(50000, 20000) == TEXT[20000:70000]
+    assert reader.pread(10, 3) == TEXT[3:13]
+    assert reader.pread(100, len(TEXT) - 40) == TEXT[-40:]
+    assert reader.pread(100, len(TEXT) + 10) == b""
+    reader.close()
+    reader.close()
+
+
+@pytest.mark.parametrize("codec", [compress.ZLIB, compress.LZMA])
+def test_decoding_holds_at_most_a_chunk_of_a_highly_compressible_blob(
+    codec, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(compress, "READ_CHUNK", 4096)
+    size = 8 * 1024 * 1024
+    out = io.BytesIO()
+    encoder = compress.Encoder(out, codec)
+    encoder.write(bytes(size))
+    encoder.finish()
+    blob = out.getvalue() + b"next entry"
+    assert len(blob) < 4096 * 4
+
+    class Sink:
+        sent = 0
+        largest = 0
+
+        def write(self, data):
+            self.sent += len(data)
+            self.largest = max(self.largest, len(data))
+
+    sink = Sink()
+    assert compress.send_decoded(io.BytesIO(blob), sink, size + 1, codec) == size
+    assert (sink.sent, sink.largest) == (size, 4096)
+
+    path = tmp_path / "blob"
+    path.write_bytes(blob)
+    reader = compress.DecodedReader(str(path), codec)
+    assert reader.pread(10, size - 5) == bytes(5)
+    assert len(reader._buf) <= 4096
+    assert reader.pread(10, size) == b""
+    reader.close()
+
+
+def test_decompressor_rejects_unknown_codec():
+    with pytest.raises(ValueError):
+        compress._decompressor("brotli")
+
+
+def test_codec_from_env(monkeypatch):
+    monkeypatch.delenv("DATA_CODEC", raising=False)
+    assert compress.codec_from_env() == compress.NONE
+    monkeypatch.setenv("DATA_CODEC", "lzma")
+    assert compress.codec_from_env() == compress.LZMA
+    monkeypatch.setenv("DATA_CODEC", "gzip")
+    with pytest.raises(ValueError):
+        compress.codec_from_env()
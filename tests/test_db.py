@@ -2,7 +2,9 @@ from __future__ import annotations
 
 from datetime import datetime, timezone
 
-from app import db
+import pytest
+
+from app import db, db_postgres
 
 
 class DummyConn:
@@ -10,11 +12,18 @@ class DummyConn:
         self.fetchone_result = fetchone_result
         self.fetchall_result = fetchall_result
         self.queries: list[tuple[str, tuple | None]] = []
+        self.many: list[tuple[str, list]] = []
 
     def execute(self, query: str, params: tuple | None = None):
         self.queries.append((query, params))
         return self
 
+    def executemany(self, query: str, params_seq):
+        self.many.append((query, list(params_seq)))
+
+    def cursor(self):
+        return self
+
     def fetchone(self):
         return self.fetchone_result
 
@@ -35,7 +44,7 @@ def test_dsn_from_env(monkeypatch):
     monkeypatch.setenv("DB_USER", "user")
     monkeypatch.setenv("DB_PASSWORD", "pw")
 
-    dsn = db._dsn()
+    dsn = db_postgres._dsn()
 
     assert "host=db" in dsn
     assert "port=5439" in dsn
@@ -46,22 +55,29 @@ def test_dsn_from_env(monkeypatch):
 
 def test_init_db_executes_schema(monkeypatch):
     dummy = DummyConn()
-    monkeypatch.setattr(db.psycopg, "connect", lambda _dsn: dummy)
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
     monkeypatch.setenv("DB_HOST", "db")
     monkeypatch.setenv("DB_NAME", "app")
     monkeypatch.setenv("DB_USER", "user")
     monkeypatch.setenv("DB_PASSWORD", "pw")
 
-    db.init_db()
+    db_postgres.init_db()
 
-    assert len(dummy.queries) == 2
+    assert len(dummy.queries) == 12
     assert "CREATE TABLE" in dummy.queries[0][0]
     assert "CREATE INDEX" in dummy.queries[1][0]
+    assert "ADD COLUMN IF NOT EXISTS blob" in dummy.queries[2][0]
+    assert "CREATE TABLE IF NOT EXISTS blobs" in dummy.queries[3][0]
+    assert "ALTER TABLE files ADD COLUMN IF NOT EXISTS codec" in dummy.queries[4][0]
+    assert "ALTER TABLE blobs ADD COLUMN IF NOT EXISTS codec" in dummy.queries[5][0]
+    assert "ADD COLUMN IF NOT EXISTS bundle" in dummy.queries[6][0]
+    assert "DROP TABLE IF EXISTS key_usage" in dummy.queries[10][0]
+    assert "CREATE TABLE IF NOT EXISTS key_buckets" in dummy.queries[11][0]
 
 
 def test_insert_file_executes(monkeypatch):
     dummy = DummyConn()
-    monkeypatch.setattr(db.psycopg, "connect", lambda _dsn: dummy)
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
     monkeypatch.setenv("DB_HOST", "db")
     monkeypatch.setenv("DB_NAME", "app")
     monkeypatch.setenv("DB_USER", "user")
@@ -78,44 +94,457 @@ def test_insert_file_executes(monkeypatch):
         expires_at=now,
     )
 
-    assert len(dummy.queries) == 1
-    assert "INSERT INTO files" in dummy.queries[0][0]
+    assert dummy.queries == [
+        ("SELECT pg_notify(%s, %s)", (db_postgres.EXPIRY_CHANNEL, now.isoformat()))
+    ]
+    assert len(dummy.many) == 1
+    assert "INSERT INTO files" in dummy.many[0][0]
+    assert dummy.many[0][1] == [
+        db.FileRecord("tok", "sha", "file.txt", 1, "/tmp/file", now, now)
+    ]
 
 
 def test_get_file_by_token(monkeypatch):
-    row = ("tok", "sha", "name", 1, "/tmp/file", datetime.now(timezone.utc), datetime.now(timezone.utc))
+    now = datetime.now(timezone.utc)
+    row = ("tok", "sha", "name", 1, "/tmp/file", now, now, False, "none", False, None, None)
     dummy = DummyConn(fetchone_result=row)
-    monkeypatch.setattr(db.psycopg, "connect", lambda _dsn: dummy)
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
     monkeypatch.setenv("DB_HOST", "db")
     monkeypatch.setenv("DB_NAME", "app")
     monkeypatch.setenv("DB_USER", "user")
     monkeypatch.setenv("DB_PASSWORD", "pw")
 
-    result = db.get_file_by_token("tok")
+    result = db_postgres.get_file_by_token("tok")
 
-    assert result == row
+    assert result == db.FileRecord(*row)
     assert len(dummy.queries) == 1
     assert "SELECT token" in dummy.queries[0][0]
 
 
-def test_delete_expired(monkeypatch):
-    rows = [("tok1", "/tmp/1"), ("tok2", "/tmp/2")]
-    dummy = DummyConn(fetchall_result=rows)
-    monkeypatch.setattr(db.psycopg, "connect", lambda _dsn: dummy)
+def test_utcnow_timezone():
+    now = db.utcnow()
+    assert now.tzinfo is timezone.utc
+
+
+class HeldConn(DummyConn):
+    def __init__(self):
+        super().__init__()
+        self.closed = False
+        self.broken = False
+        self.transactions = 0
+
+    def transaction(self):
+        self.transactions += 1
+        return self
+
+    def close(self):
+        self.closed = True
+
+
+def test_hold_connection_reuses_one_connection(monkeypatch):
+    opened: list[HeldConn] = []
+
+    def fake_connect(_dsn, **kwargs):
+        assert kwargs == {"autocommit": True}
+        opened.append(HeldConn())
+        return opened[-1]
+
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", fake_connect)
     monkeypatch.setenv("DB_HOST", "db")
     monkeypatch.setenv("DB_NAME", "app")
     monkeypatch.setenv("DB_USER", "user")
     monkeypatch.setenv("DB_PASSWORD", "pw")
 
+    db_postgres.hold_connection()
+    try:
+        db_postgres.get_file_by_token("a")
+        db_postgres.get_file_by_token("b")
+        assert len(opened) == 1
+        assert opened[0].transactions == 2
+
+        # A lost connection is replaced transparently.
+        opened[0].broken = True
+        db_postgres.get_file_by_token("c")
+        assert len(opened) == 2
+        assert opened[1].transactions == 1
+    finally:
+        db_postgres.release_connection()
+
+    assert opened[1].closed
+    assert db_postgres._HELD is None
+    db_postgres.release_connection()
+
+
+def _record(token: str) -> db.FileRecord:
     now = datetime.now(timezone.utc)
-    result = db.delete_expired(now)
+    return db.FileRecord(token, "sha", "f", 1, f"/tmp/{token}", now, now)
+
+
+def test_insert_files_empty_is_noop(monkeypatch):
+    def fail(_dsn, **_kwargs):
+        raise AssertionError("should not connect")
+
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", fail)
 
-    assert result == rows
+    db_postgres.insert_files([])
+
+
+def test_session_reuses_one_connection(monkeypatch):
+    opened: list[HeldConn] = []
+
+    def fake_connect(_dsn, **kwargs):
+        opened.append(HeldConn())
+        return opened[-1]
+
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", fake_connect)
+    monkeypatch.setenv("DB_HOST", "db")
+    monkeypatch.setenv("DB_NAME", "app")
+    monkeypatch.setenv("DB_USER", "user")
+    monkeypatch.setenv("DB_PASSWORD", "pw")
+
+    with db_postgres.session():
+        # Nothing connects until the first query.
+        assert opened == []
+        db_postgres.insert_files([_record("a"), _record("b")])
+        with db_postgres.session():
+            db_postgres.insert_files([_record("c")])
+
+    assert len(opened) == 1
+    assert opened[0].closed
+    assert [len(params) for _q, params in opened[0].many] == [2, 1]
+    assert db_postgres._HELD is None
+    assert db_postgres._KEEP is False
+
+
+def _db_env(monkeypatch):
+    monkeypatch.setenv("DB_HOST", "db")
+    monkeypatch.setenv("DB_NAME", "app")
+    monkeypatch.setenv("DB_USER", "user")
+    monkeypatch.setenv("DB_PASSWORD", "pw")
+
+
+class BatchConn(HeldConn):
+    def __init__(self, batches):
+        super().__init__()
+        self.batches = list(batches)
+
+    def fetchall(self):
+        return self.batches.pop(0)
+
+
+def test_delete_expired_streams_batches(monkeypatch):
+    dummy = BatchConn(
+        [
+            [("tok1", "/tmp/1", "s1", False, None), ("tok2", "/tmp/2", "s2", False, None)],
+            [("tok3", "/tmp/3", "s3", False, None)],
+        ]
+    )
+    connects = []
+
+    def fake_connect(_dsn, **_kwargs):
+        connects.append(1)
+        return dummy
+
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", fake_connect)
+    _db_env(monkeypatch)
+
+    now = datetime.now(timezone.utc)
+    batches = db_postgres.delete_expired(now, batch_size=2)
+
+    # Nothing runs until the cleaner asks for the first batch.
+    assert dummy.queries == []
+    assert list(batches) == [[("tok1", "/tmp/1"), ("tok2", "/tmp/2")], [("tok3", "/tmp/3")]]
+    assert len(connects) == 1
     assert len(dummy.queries) == 2
-    assert "SELECT token" in dummy.queries[0][0]
-    assert "DELETE FROM files" in dummy.queries[1][0]
+    query, params = dummy.queries[0]
+    assert "DELETE FROM files" in query
+    assert "RETURNING token, stored_path, sha512, blob" in query
+    assert "SKIP LOCKED" in query
+    assert params == (now, 2)
 
 
-def test_utcnow_timezone():
-    now = db.utcnow()
-    assert now.tzinfo is timezone.utc
+def test_delete_expired_releases_blob_references(monkeypatch):
+    dummy = BatchConn(
+        [
+            [
+                ("tok1", "/data/blobs/s1.tok1", "s1", True, None),
+                ("tok2", "/data/blobs/s1.tok1", "s1", True, None),
+                ("tok3", "/data/blobs/s2.tok3", "s2", True, None),
+                ("tok4", "/data/tok4", "s4", False, None),
+            ],
+            # Only s1 lost its last reference.
+            [("s1", "/data/blobs/s1.tok1")],
+        ]
+    )
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn, **_kw: dummy)
+    _db_env(monkeypatch)
+
+    batches = list(db_postgres.delete_expired(datetime.now(timezone.utc), batch_size=10))
+
+    assert batches == [[("tok4", "/data/tok4"), ("s1", "/data/blobs/s1.tok1")]]
+    lock, update, delete = dummy.queries[1:]
+    assert "ORDER BY sha512 FOR UPDATE" in lock[0] and lock[1] == (["s1", "s2"],)
+    assert "refcount = b.refcount - d.n" in update[0]
+    assert update[1] == (["s1", "s2"], [2, 1])
+    assert "refcount <= 0" in delete[0]
+
+
+def test_delete_expired_skips_batches_with_nothing_to_unlink(monkeypatch):
+    dummy = BatchConn([[("tok1", "/data/blobs/s1.tok1", "s1", True, None)], []])
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn, **_kw: dummy)
+    _db_env(monkeypatch)
+
+    assert list(db_postgres.delete_expired(datetime.now(timezone.utc), batch_size=10)) == []
+
+
+def test_insert_files_adopts_existing_blobs(monkeypatch):
+    now = datetime.now(timezone.utc)
+    dummy = DummyConn(
+        fetchall_result=[("s1", "/data/blobs/s1.old", "zlib"), ("s2", "/data/blobs/s2.b", "none")]
+    )
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
+    _db_env(monkeypatch)
+
+    records = [
+        db.FileRecord("a", "s2", "f", 1, "/data/blobs/s2.a", now, now, blob=True),
+        db.FileRecord("b", "s1", "f", 1, "/data/blobs/s1.b", now, now, blob=True, codec="lzma"),
+        db.FileRecord("c", "s2", "f", 1, "/data/blobs/s2.c", now, now, blob=True),
+        db.FileRecord("d", "s3", "f", 1, "/data/d", now, now),
+    ]
+    spare = db_postgres.insert_files(records)
+
+    upsert, params = dummy.queries[0]
+    assert "ON CONFLICT (sha512) DO UPDATE" in upsert
+    assert params == (
+        ["s1", "s2"],
+        ["/data/blobs/s1.b", "/data/blobs/s2.a"],
+        [1, 2],
+        ["lzma", "none"],
+    )
+    assert [r.stored_path for r in dummy.many[0][1]] == [
+        "/data/blobs/s2.b",
+        "/data/blobs/s1.old",
+        "/data/blobs/s2.b",
+        "/data/d",
+    ]
+    assert [r.codec for r in dummy.many[0][1]] == ["none", "zlib", "none", "none"]
+    assert sorted(spare) == ["/data/blobs/s1.b", "/data/blobs/s2.a", "/data/blobs/s2.c"]
+
+
+def test_insert_files_counts_segment_entries(monkeypatch):
+    now = datetime.now(timezone.utc)
+    dummy = DummyConn()
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
+    _db_env(monkeypatch)
+
+    def record(token, path, **seg):
+        return db.FileRecord(token, "s", "f", 9, path, now, now, **seg)
+
+    db_postgres.insert_files(
+        [
+            record("a", "/data/segments/7-1", seg_offset=0, seg_length=4),
+            record("b", "/data/segments/7-0", seg_offset=0, seg_length=5),
+            record("c", "/data/segments/7-1", seg_offset=4, seg_length=6),
+            record("d", "/data/d"),
+        ]
+    )
+
+    upsert, params = dummy.queries[0]
+    assert "INSERT INTO segments" in upsert
+    assert params == (["/data/segments/7-0", "/data/segments/7-1"], [1, 2], [5, 10])
+
+
+def test_delete_expired_releases_segment_entries(monkeypatch):
+    dummy = BatchConn(
+        [
+            [
+                ("tok1", "/data/segments/7-0", "s1", False, 4),
+                ("tok2", "/data/tok2", "s2", False, None),
+            ]
+        ]
+    )
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn, **_kw: dummy)
+    _db_env(monkeypatch)
+
+    batches = list(db_postgres.delete_expired(datetime.now(timezone.utc), batch_size=10))
+
+    # The segment itself stays until the cleaner reclaims it as a whole.
+    assert batches == [[("tok2", "/data/tok2")]]
+    upsert, params = dummy.queries[1]
+    assert "INSERT INTO segments" in upsert
+    assert params == (["/data/segments/7-0"], [-1], [-4])
+
+
+def test_segment_usage_and_entries(monkeypatch):
+    dummy = DummyConn(fetchall_result=[("/s/1", 2, 10)])
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
+    _db_env(monkeypatch)
+
+    assert db_postgres.segment_usage(["/s/1", "/s/2"]) == {"/s/1": (2, 10)}
+    assert dummy.queries[0][1] == (["/s/1", "/s/2"],)
+
+    dummy.fetchall_result = [("a", 0, 4), ("b", 4, 6)]
+    assert db_postgres.segment_entries("/s/1") == [("a", 0, 4), ("b", 4, 6)]
+    assert "ORDER BY seg_offset" in dummy.queries[1][0]
+
+
+def test_forget_segments_returns_unreferenced_paths(monkeypatch):
+    dummy = DummyConn(fetchall_result=[("/s/1", 0), ("/s/2", 3)])
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
+    _db_env(monkeypatch)
+
+    # /s/3 has no row: its only upload never got recorded.
+    assert db_postgres.forget_segments(["/s/1", "/s/2", "/s/3"]) == ["/s/1", "/s/3"]
+    lock, delete = dummy.queries
+    assert "FOR UPDATE" in lock[0]
+    assert "live <= 0" in delete[0]
+
+
+def test_move_segment_entries_moves_counts(monkeypatch):
+    dummy = DummyConn(fetchall_result=[("a", "/s/new", 4)])
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
+    _db_env(monkeypatch)
+
+    assert db_postgres.move_segment_entries("/s/old", []) == set()
+    moved = db_postgres.move_segment_entries("/s/old", [("a", "/s/new", 0), ("b", "/s/new", 4)])
+
+    assert moved == {"a"}
+    update, release, add = dummy.queries
+    assert update[1] == (["a", "b"], ["/s/new", "/s/new"], [0, 4], "/s/old")
+    assert release[1] == (["/s/old"], [-1], [-4])
+    assert add[1] == (["/s/new"], [1], [4])
+
+
+def test_delete_expired_empty_backlog(monkeypatch):
+    dummy = BatchConn([[]])
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn, **_kw: dummy)
+    _db_env(monkeypatch)
+
+    assert list(db_postgres.delete_expired(datetime.now(timezone.utc))) == []
+
+
+def test_insert_files_announces_earliest_deadline(monkeypatch):
+    dummy = DummyConn()
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
+    _db_env(monkeypatch)
+    early = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    late = datetime(2024, 1, 2, tzinfo=timezone.utc)
+
+    db_postgres.insert_files(
+        [
+            db.FileRecord("a", "sha", "f", 1, "/tmp/a", early, late),
+            db.FileRecord("b", "sha", "f", 1, "/tmp/b", early, early),
+        ]
+    )
+
+    assert dummy.queries == [
+        ("SELECT pg_notify(%s, %s)", (db_postgres.EXPIRY_CHANNEL, early.isoformat()))
+    ]
+
+
+def test_list_stored_paths_is_keyset_paginated(monkeypatch):
+    dummy = DummyConn(fetchall_result=[("a", "/data/a"), ("b", "/data/b")])
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
+    _db_env(monkeypatch)
+
+    assert db_postgres.list_stored_paths("", 2) == [("a", "/data/a"), ("b", "/data/b")]
+    assert "WHERE token > %s AND NOT blob" in dummy.queries[0][0]
+    assert "AND seg_offset IS NULL ORDER BY token LIMIT %s" in dummy.queries[0][0]
+    assert dummy.queries[0][1] == ("", 2)
+
+
+def test_list_tokens_is_keyset_paginated(monkeypatch):
+    dummy = DummyConn(fetchall_result=[("b",), ("c",)])
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
+    _db_env(monkeypatch)
+
+    assert db_postgres.list_tokens("a", 2) == ["b", "c"]
+    assert dummy.queries[0][1] == ("a", 2)
+
+
+def test_charge_key_reports_whether_the_upsert_applied(monkeypatch):
+    dummy = DummyConn(fetchone_result=(1,))
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
+    _db_env(monkeypatch)
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    limits = dict(max_sessions=2, max_bytes=10, now=now, window_seconds=60)
+
+    assert db_postgres.charge_key("SHA256:k", 1, 0, **limits)
+    dummy.fetchone_result = None
+    assert not db_postgres.charge_key("SHA256:k", 0, 5, **limits)
+    query, params = dummy.queries[1]
+    assert "ON CONFLICT (fingerprint)" in query
+    assert params["bytes"] == 5 and params["max_bytes"] == 10
+
+    db_postgres.refund_key("SHA256:k", 0, 5)
+    query, params = dummy.queries[-1]
+    assert query.strip().startswith("UPDATE key_buckets")
+    assert params == {"key": "SHA256:k", "sessions": 0, "bytes": 5}
+
+
+def test_update_stored_paths_returns_updated_tokens(monkeypatch):
+    dummy = DummyConn(fetchall_result=[("a",)])
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
+    _db_env(monkeypatch)
+
+    updated = db_postgres.update_stored_paths(
+        [("a", "/data/a", "/data/x/y/a"), ("b", "/data/b", "/data/z/w/b")]
+    )
+
+    assert updated == {"a"}
+    query, params = dummy.queries[0]
+    assert "f.stored_path = m.old_path" in query
+    assert params == (["a", "b"], ["/data/a", "/data/b"], ["/data/x/y/a", "/data/z/w/b"])
+
+
+def test_update_stored_paths_empty_is_noop(monkeypatch):
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: pytest.fail("connected"))
+
+    assert db_postgres.update_stored_paths([]) == set()
+
+
+def test_upcoming_expirations(monkeypatch):
+    when = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    dummy = DummyConn(fetchall_result=[(when,)])
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", lambda _dsn: dummy)
+    _db_env(monkeypatch)
+
+    assert db_postgres.upcoming_expirations(5) == [when]
+    assert "ORDER BY expires_at LIMIT" in dummy.queries[0][0]
+    assert dummy.queries[0][1] == (5,)
+
+
+class ListenConn(HeldConn):
+    def __init__(self, payloads):
+        super().__init__()
+        self.payloads = payloads
+        self.waits = []
+
+    def notifies(self, *, timeout, stop_after):
+        self.waits.append((timeout, stop_after))
+        return [type("Notify", (), {"payload": p}) for p in self.payloads]
+
+
+def test_expiry_listener(monkeypatch):
+    when = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    opened = []
+
+    def fake_connect(_dsn, **kwargs):
+        assert kwargs == {"autocommit": True}
+        opened.append(ListenConn([when.isoformat()]))
+        return opened[-1]
+
+    monkeypatch.setattr(db_postgres._psycopg(), "connect", fake_connect)
+    _db_env(monkeypatch)
+
+    listener = db_postgres.ExpiryListener()
+    with pytest.raises(RuntimeError, match="not connected"):
+        listener.wait(1.0)
+    with listener:
+        listener.connect()
+        assert listener.wait(2.5) == [when]
+        listener.connect()
+
+    assert opened[0].queries == [(f"LISTEN {db_postgres.EXPIRY_CHANNEL}", None)]
+    assert opened[0].waits == [(2.5, 1)]
+    assert opened[0].closed and opened[1].closed
@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app import db, db_postgres, db_sqlite
+
+NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture(params=[db.SQLITE, db.POSTGRES])
+def backend(request, tmp_path, monkeypatch):
+    """
+    The same contract against each backend, through app.db as callers use it.
+    Postgres needs a real server and driver; point DB_TEST_POSTGRES=1 and
+    DB_HOST etc. at a scratch database.
+    """
+    monkeypatch.setenv("DB_BACKEND", request.param)
+    if request.param == db.SQLITE:
+        monkeypatch.setenv("DB_PATH", str(tmp_path / "meta" / "files.db"))
+        db.release_connection()
+        db.init_db()
+        yield db
+        db.release_connection()
+        return
+    if os.environ.get("DB_TEST_POSTGRES") != "1":
+        pytest.skip("set DB_TEST_POSTGRES=1 to run against a Postgres server")
+    db.init_db()
+    with db_postgres.conn() as c:
+        c.execute("TRUNCATE files, blobs, segments, key_buckets")
+    yield db
+
+
+def _record(token, *, expires=NOW, **fields):
+    defaults = dict(sha512="sha-" + token, original_name="f", size_bytes=1)
+    defaults.update(fields)
+    return db.FileRecord(
+        token,
+        defaults.pop("sha512"),
+        defaults.pop("original_name"),
+        defaults.pop("size_bytes"),
+        defaults.pop("stored_path", f"/data/{token}"),
+        NOW,
+        expires,
+        **defaults,
+    )
+
+
+def test_insert_and_lookup_round_trip(backend):
+    record = _record("a", codec="zlib", bundle=True, expires=NOW + timedelta(days=1))
+    backend.insert_files([record])
+
+    assert backend.get_file_by_token("a") == record
+    assert backend.get_file_by_token("missing") is None
+    assert backend.insert_files([]) == []
+    assert backend.upcoming_expirations(10) == [NOW + timedelta(days=1)]
+
+
+def test_delete_expired_in_batches(backend):
+    backend.insert_files(
+        [_record(t, expires=NOW + timedelta(seconds=i)) for i, t in enumerate("abcde")]
+    )
+
+    batches = list(backend.delete_expired(NOW + timedelta(seconds=2), batch_size=2))
+
+    assert sorted(row for batch in batches for row in batch) == [
+        ("a", "/data/a"),
+        ("b", "/data/b"),
+        ("c", "/data/c"),
+    ]
+    assert backend.get_file_by_token("d") is not None
+    assert list(backend.delete_expired(NOW)) == []
+
+
+def test_blobs_are_shared_until_the_last_reference(backend):
+    first = _record("a", sha512="s", stored_path="/data/blobs/s.a", blob=True, codec="lzma")
+    second = _record("b", sha512="s", stored_path="/data/blobs/s.b", blob=True)
+    spare = backend.insert_files([first, second, _record("x", expires=NOW + timedelta(2))])
+    later = _record(
+        "c", sha512="s", stored_path="/data/blobs/s.c", blob=True, expires=NOW + timedelta(1)
+    )
+    spare += backend.insert_files([later])
+
+    assert sorted(spare) == ["/data/blobs/s.b", "/data/blobs/s.c"]
+    assert backend.get_file_by_token("c").stored_path == "/data/blobs/s.a"
+    assert backend.get_file_by_token("c").codec == "lzma"
+    assert list(backend.delete_expired(NOW)) == []
+    assert list(backend.delete_expired(NOW + timedelta(1))) == [[("s", "/data/blobs/s.a")]]
+
+
+def test_segment_counts_follow_rows(backend):
+    seg = "/data/segments/0-0"
+    backend.insert_files(
+        [
+            _record("a", stored_path=seg, seg_offset=0, seg_length=4),
+            _record("b", stored_path=seg, seg_offset=4, seg_length=6, expires=NOW + timedelta(1)),
+        ]
+    )
+    assert backend.segment_usage([seg, "/other"]) == {seg: (2, 10)}
+    assert backend.list_stored_paths("", 10) == []
+
+    assert list(backend.delete_expired(NOW)) == []
+    assert backend.segment_usage([seg]) == {seg: (1, 6)}
+    assert backend.segment_entries(seg) == [("b", 4, 6)]
+
+    assert backend.move_segment_entries(seg, []) == set()
+    moved = backend.move_segment_entries(seg, [("b", "/data/segments/1-0", 0), ("a", "/x", 0)])
+    assert moved == {"b"}
+    assert backend.segment_usage([seg, "/data/segments/1-0"]) == {
+        seg: (0, 0),
+        "/data/segments/1-0": (1, 6),
+    }
+    assert backend.forget_segments([seg, "/data/segments/1-0", "/never"]) == [seg, "/never"]
+    assert backend.segment_usage([seg]) == {}
+
+
+def test_stored_path_moves(backend):
+    backend.insert_files([_record("a"), _record("b")])
+
+    assert backend.list_stored_paths("", 1) == [("a", "/data/a")]
+    assert backend.list_stored_paths("a", 10) == [("b", "/data/b")]
+    assert backend.list_tokens("", 10) == ["a", "b"]
+    assert backend.list_tokens("a", 1) == ["b"]
+    assert backend.update_stored_paths([]) == set()
+    updated = backend.update_stored_paths([("a", "/data/a", "/new/a"), ("b", "/stale", "/new/b")])
+    assert updated == {"a"}
+    assert backend.get_file_by_token("a").stored_path == "/new/a"
+
+
+def test_failed_transaction_rolls_back(backend):
+    backend.insert_files([_record("a")])
+    with pytest.raises(Exception):
+        backend.insert_files([_record("b"), _record("a")])
+    assert backend.get_file_by_token("b") is None
+
+
+def test_charge_key_keeps_token_buckets(backend):
+    def charge(sessions, size, at):
+        return backend.charge_key(
+            "SHA256:k",
+            sessions,
+            size,
+            max_sessions=2,
+            max_bytes=100,
+            now=at,
+            window_seconds=3600,
+        )
+
+    assert charge(1, 60, NOW)
+    assert charge(1, 40, NOW)
+    # Either bucket running out refuses the charge and leaves both alone.
+    assert not charge(0, 1, NOW)
+    assert not charge(1, 0, NOW)
+    # Buckets refill steadily, not all at once when a window ends: a quarter
+    # hour gives back a quarter of each budget.
+    assert not charge(0, 26, NOW + timedelta(minutes=15))
+    assert charge(0, 24, NOW + timedelta(minutes=15))
+    assert not charge(1, 0, NOW + timedelta(minutes=15))
+    # Never more than one budget at once, however long a key stays idle.
+    assert not charge(0, 101, NOW + timedelta(days=1))
+    assert charge(2, 100, NOW + timedelta(days=1))
+
+    # A refund makes room again at once, and never below empty.
+    backend.refund_key("SHA256:k", 1, 30)
+    assert charge(1, 30, NOW + timedelta(days=1))
+    assert not charge(0, 1, NOW + timedelta(days=1))
+    backend.refund_key("SHA256:k", 5, 500)
+    assert not charge(0, 101, NOW + timedelta(days=1))
+    assert charge(2, 100, NOW + timedelta(days=1))
+    backend.refund_key("SHA256:missing", 1, 1)
+
+
+def test_sqlite_listener_polls_for_new_rows(tmp_path, monkeypatch):
+    monkeypatch.setenv("DB_PATH", str(tmp_path / "files.db"))
+    db_sqlite.hold_connection()
+    db_sqlite.init_db()
+    clock = [0.0]
+    monkeypatch.setattr(db_sqlite.time, "monotonic", lambda: clock[0])
+    inserted = []
+
+    def sleep(seconds):
+        clock[0] += seconds
+        if not inserted:
+            db_sqlite.insert_files([_record("a", expires=NOW + timedelta(1))])
+            inserted.append(1)
+
+    monkeypatch.setattr(db_sqlite.time, "sleep", sleep)
+
+    with db_sqlite.ExpiryListener() as listener:
+        with pytest.raises(RuntimeError):
+            listener.wait(1)
+        listener.connect()
+        assert listener.wait(60) == [NOW + timedelta(1)]
+        assert clock[0] == db_sqlite.POLL_SECONDS
+        assert listener.wait(12) == []
+        assert clock[0] == db_sqlite.POLL_SECONDS + 12
+    with db_sqlite.session():
+        db_sqlite.release_connection()
+    db_sqlite.release_connection()
+
+
+def test_sqlite_listener_sees_rows_inserted_after_the_newest_were_deleted(tmp_path, monkeypatch):
+    monkeypatch.setenv("DB_PATH", str(tmp_path / "files.db"))
+    db_sqlite.release_connection()
+    db_sqlite.init_db()
+    db_sqlite.insert_files([_record("a"), _record("b")])
+    with db_sqlite.ExpiryListener() as listener:
+        listener.connect()
+        # The cleaner empties the table; a plain rowid would now start over.
+        assert sum(len(batch) for batch in db_sqlite.delete_expired(NOW)) == 2
+        db_sqlite.insert_files([_record("c", expires=NOW + timedelta(1))])
+        assert listener.wait(0) == [NOW + timedelta(1)]
+    db_sqlite.release_connection()
+
+
+def test_sqlite_init_db_rebuilds_files_without_an_autoincrement_id(tmp_path, monkeypatch):
+    import sqlite3
+
+    path = tmp_path / "files.db"
+    old = sqlite3.connect(path)
+    old.execute(
+        "CREATE TABLE files (token TEXT PRIMARY KEY, sha512 TEXT NOT NULL, "
+        "original_name TEXT NOT NULL, size_bytes INTEGER NOT NULL, stored_path TEXT NOT NULL, "
+        "created_at TEXT NOT NULL, expires_at TEXT NOT NULL, blob INTEGER NOT NULL DEFAULT 0, "
+        "codec TEXT NOT NULL DEFAULT 'none', bundle INTEGER NOT NULL DEFAULT 0, "
+        "seg_offset INTEGER, seg_length INTEGER)"
+    )
+    old.execute(
+        "INSERT INTO files (token, sha512, original_name, size_bytes, stored_path, created_at, "
+        "expires_at) VALUES ('a', 'sha-a', 'f', 1, '/tmp/a', ?, ?)",
+        (db_sqlite._ts(NOW), db_sqlite._ts(NOW)),
+    )
+    old.commit()
+    old.close()
+    monkeypatch.setenv("DB_PATH", str(path))
+    db_sqlite.release_connection()
+
+    db_sqlite.init_db()
+    db_sqlite.init_db()
+
+    assert db_sqlite.get_file_by_token("a").stored_path == "/tmp/a"
+    names = {r[0] for r in db_sqlite._connection().execute("SELECT name FROM sqlite_master")}
+    assert "files_old" not in names and "idx_files_expires_at" in names
+    db_sqlite.release_connection()
+
+
+def test_backend_from_env_selects_sqlite(monkeypatch):
+    monkeypatch.delenv("DB_BACKEND", raising=False)
+    assert db.backend_from_env() == db.POSTGRES
+    monkeypatch.setenv("DB_BACKEND", "mysql")
+    with pytest.raises(ValueError):
+        db.backend_from_env()
+
+    monkeypatch.setenv("DB_BACKEND", db.POSTGRES)
+    assert db.backend() is db_postgres
+    monkeypatch.setenv("DB_BACKEND", db.SQLITE)
+    assert db.backend() is db_sqlite
+
+
+def test_names_imported_from_db_follow_the_backend(tmp_path, monkeypatch):
+    # Bound before DB_BACKEND changes, as `from app.db import ...` callers are.
+    from app.db import get_file_by_token, init_db
+
+    monkeypatch.setenv("DB_BACKEND", db.SQLITE)
+    monkeypatch.setenv("DB_PATH", str(tmp_path / "files.db"))
+    db_sqlite.release_connection()
+    init_db()
+    assert (tmp_path / "files.db").exists()
+    assert get_file_by_token("missing") is None
+    with db.expiry_listener() as listener:
+        assert isinstance(listener, db_sqlite.ExpiryListener)
+    with db.session():
+        db.hold_connection()
+    db_sqlite.release_connection()
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import json
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+from app import gateway_client
+
+
+def test_socket_path_uses_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("GATEWAY_SOCKET_DIR", str(tmp_path))
+    assert gateway_client.socket_path("put") == str(tmp_path / "put.sock")
+
+
+def test_request_forwards_only_known_env(monkeypatch):
+    monkeypatch.setenv("SSH_ORIGINAL_COMMAND", "scp -t /")
+    monkeypatch.setenv("SSH_USER_AUTH", "/tmp/sshauth.x")
+    monkeypatch.setenv("DB_PASSWORD", "secret")
+
+    request = json.loads(gateway_client._request("put"))
+
+    env = {"SSH_ORIGINAL_COMMAND": "scp -t /", "SSH_USER_AUTH": "/tmp/sshauth.x"}
+    assert request == {"mode": "put", "env": env}
+
+
+def test_recv_status_short_read_is_failure():
+    a, b = socket.socketpair()
+    with a, b:
+        b.sendall(b"\x00\x00")
+        b.close()
+        assert gateway_client._recv_status(a) == 1
+
+
+def test_main_falls_back_to_gateway_when_daemon_down(monkeypatch, tmp_path):
+    monkeypatch.setenv("GATEWAY_SOCKET_DIR", str(tmp_path))
+    monkeypatch.setattr(sys, "argv", ["gateway_client.py", "put"])
+    calls = []
+    monkeypatch.setattr(os, "execv", lambda path, args: calls.append((path, args)))
+
+    gateway_client.main()
+
+    assert calls == [
+        (sys.executable, [sys.executable, "-m", "app.gateway", "put"])
+    ]
+
+
+def test_main_hands_fds_to_daemon_and_exits_with_status(monkeypatch, tmp_path):
+    monkeypatch.setenv("GATEWAY_SOCKET_DIR", str(tmp_path))
+    monkeypatch.setenv("SSH_ORIGINAL_COMMAND", "scp -f tok")
+    monkeypatch.setattr(sys, "argv", ["gateway_client.py", "get"])
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(tmp_path / "get.sock"))
+    listener.listen(1)
+    seen = {}
+
+    def daemon():
+        conn, _ = listener.accept()
+        with conn:
+            conn.sendall(gateway_client.READY)
+            msg, fds, _flags, _addr = socket.recv_fds(conn, 4096, 3)
+            seen["request"] = json.loads(msg)
+            seen["fds"] = len(fds)
+            for fd in fds:
+                os.close(fd)
+            conn.sendall(gateway_client.STATUS.pack(3))
+
+    t = threading.Thread(target=daemon)
+    t.start()
+    with listener, pytest.raises(SystemExit) as exc:
+        gateway_client.main()
+    t.join()
+
+    assert exc.value.code == 3
+    assert seen == {
+        "request": {"mode": "get", "env": {"SSH_ORIGINAL_COMMAND": "scp -f tok"}},
+        "fds": 3,
+    }
+
+
+def test_gateway_client_entrypoint_runs_main(monkeypatch, tmp_path):
+    monkeypatch.setenv("GATEWAY_SOCKET_DIR", str(tmp_path))
+    monkeypatch.setattr(sys, "argv", ["gateway_client.py"])
+    calls = []
+    monkeypatch.setattr(os, "execv", lambda path, args: calls.append(args))
+
+    sys.modules.pop("app.gateway_client", None)
+    __import__("runpy").run_module("app.gateway_client", run_name="__main__")
+
+    assert calls and calls[0][-2:] == ["-m", "app.gateway"]
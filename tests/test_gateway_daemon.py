@@ -0,0 +1,386 @@
+from __future__ import annotations
+
+import io
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import types
+
+import pytest
+
+from app import gateway_client, gateway_daemon
+
+
+class Stop(Exception):
+    pass
+
+
+def _pipe_fds():
+    # Returns (client ends, worker fds) for stdin/stdout/stderr.
+    stdin_r, stdin_w = os.pipe()
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    return (stdin_w, stdout_r, stderr_r), [stdin_r, stdout_w, stderr_w]
+
+
+def _fake_pw(monkeypatch, euid=0):
+    monkeypatch.setattr(os, "geteuid", lambda: euid)
+    monkeypatch.setattr(
+        gateway_daemon.pwd,
+        "getpwnam",
+        lambda name: types.SimpleNamespace(pw_uid=1000, pw_gid=1001),
+    )
+
+
+def test_daemon_config_from_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("GATEWAY_SOCKET_DIR", str(tmp_path))
+    monkeypatch.setenv("GATEWAY_WORKERS", "2")
+    monkeypatch.setenv("GATEWAY_MAX_SESSIONS", "10")
+
+    conf = gateway_daemon.DaemonConfig.from_env()
+
+    assert conf == gateway_daemon.DaemonConfig(
+        socket_dir=tmp_path, workers=2, max_sessions=10
+    )
+
+
+def test_listen_restricts_socket_to_user(monkeypatch, tmp_path):
+    _fake_pw(monkeypatch)
+    chowned = []
+    monkeypatch.setattr(os, "chown", lambda path, uid, gid: chowned.append((uid, gid)))
+    path = tmp_path / "put.sock"
+    path.write_text("stale", encoding="utf-8")
+
+    sock = gateway_daemon._listen(path, "put")
+    sock.close()
+
+    assert oct(path.stat().st_mode & 0o777) == "0o600"
+    assert chowned == [(1000, 1001)]
+
+
+def test_drop_privileges(monkeypatch):
+    _fake_pw(monkeypatch)
+    calls = []
+    monkeypatch.setattr(os, "initgroups", lambda user, gid: calls.append(("groups", user, gid)))
+    monkeypatch.setattr(os, "setgid", lambda gid: calls.append(("gid", gid)))
+    monkeypatch.setattr(os, "setuid", lambda uid: calls.append(("uid", uid)))
+
+    gateway_daemon._drop_privileges("get")
+    assert calls == [("groups", "get", 1001), ("gid", 1001), ("uid", 1000)]
+
+    calls.clear()
+    monkeypatch.setattr(os, "geteuid", lambda: 1000)
+    gateway_daemon._drop_privileges("get")
+    assert calls == []
+
+
+def test_exit_status_mapping():
+    assert gateway_daemon._exit_status(None) == 0
+    assert gateway_daemon._exit_status(2) == 2
+    assert gateway_daemon._exit_status("fatal") == 1
+
+
+def test_run_session_swaps_stdio_and_env(monkeypatch):
+    client, fds = _pipe_fds()
+    monkeypatch.setenv("SSH_ORIGINAL_COMMAND", "daemon-own")
+    seen = {}
+
+    def fake_main():
+        seen["argv"] = list(sys.argv)
+        seen["cmd"] = os.environ["SSH_ORIGINAL_COMMAND"]
+        seen["stdin"] = sys.stdin.buffer.read()
+        sys.stdout.buffer.write(b"\x00")
+        sys.stderr.write("RECEIPT\n")
+        sys.exit(0)
+
+    monkeypatch.setattr(gateway_daemon.gateway, "main", fake_main)
+    os.write(client[0], b"payload")
+    os.close(client[0])
+    saved_stdout = sys.stdout
+
+    status = gateway_daemon.run_session("put", fds, {"SSH_ORIGINAL_COMMAND": "scp -t /"})
+
+    assert status == 0
+    assert seen == {"argv": ["gateway.py", "put"], "cmd": "scp -t /", "stdin": b"payload"}
+    assert os.read(client[1], 10) == b"\x00"
+    assert os.read(client[2], 100) == b"RECEIPT\n"
+    assert sys.stdout is saved_stdout
+    assert os.environ["SSH_ORIGINAL_COMMAND"] == "daemon-own"
+    os.close(client[1])
+    os.close(client[2])
+
+
+def test_run_session_crash_and_unset_env(monkeypatch):
+    client, fds = _pipe_fds()
+    monkeypatch.delenv("SSH_ORIGINAL_COMMAND", raising=False)
+    # Client hung up on stdout: closing it must not break the worker.
+    os.close(client[1])
+
+    def fake_main():
+        sys.stdout.write("unflushed")
+        raise ValueError("boom")
+
+    monkeypatch.setattr(gateway_daemon.gateway, "main", fake_main)
+
+    status = gateway_daemon.run_session("get", fds, {"SSH_ORIGINAL_COMMAND": "scp -f x"})
+
+    assert status == 1
+    assert "SSH_ORIGINAL_COMMAND" not in os.environ
+    for fd in (client[0], client[2]):
+        os.close(fd)
+
+
+def test_run_session_returns_zero_when_main_returns(monkeypatch):
+    client, fds = _pipe_fds()
+    monkeypatch.setattr(gateway_daemon.gateway, "main", lambda: None)
+
+    assert gateway_daemon.run_session("get", fds, {}) == 0
+    for fd in client:
+        os.close(fd)
+
+
+def _send_request(payload: bytes, fds: list[int]):
+    a, b = socket.socketpair()
+    socket.send_fds(a, [payload], fds)
+    return a, b
+
+
+def test_handle_connection_runs_session(monkeypatch):
+    client, fds = _pipe_fds()
+    payload = json.dumps(
+        {"mode": "put", "env": {"SSH_ORIGINAL_COMMAND": "scp -t /", "EVIL": "1"}}
+    ).encode()
+    a, b = _send_request(payload, fds)
+    for fd in fds:
+        os.close(fd)
+    seen = {}
+
+    def fake_run(mode, got_fds, env):
+        seen["mode"] = mode
+        seen["env"] = env
+        for fd in got_fds:
+            os.close(fd)
+        return 4
+
+    monkeypatch.setattr(gateway_daemon, "run_session", fake_run)
+
+    with a, b:
+        assert gateway_daemon.handle_connection("put", b) == 4
+
+    assert seen == {"mode": "put", "env": {"SSH_ORIGINAL_COMMAND": "scp -t /"}}
+    for fd in client:
+        os.close(fd)
+
+
+def test_handle_connection_rejects_bad_requests():
+    r, w = os.pipe()
+    a, b = _send_request(b"{}", [r])
+    with a, b:
+        assert gateway_daemon.handle_connection("put", b) == 1
+    os.close(r)
+    os.close(w)
+
+    client, fds = _pipe_fds()
+    a, b = _send_request(b"not json", fds)
+    with a, b:
+        assert gateway_daemon.handle_connection("put", b) == 1
+    for fd in [*client, *fds]:
+        os.close(fd)
+
+    # The client gave up waiting and hung up.
+    a, b = socket.socketpair()
+    a.close()
+    with b:
+        assert gateway_daemon.handle_connection("put", b) is None
+
+
+class FakeListener:
+    def __init__(self, conns):
+        self.conns = list(conns)
+
+    def accept(self):
+        return self.conns.pop(0), None
+
+
+class FakeConn:
+    def __init__(self, fail_after=None):
+        self.sent = []
+        self.fail_after = fail_after
+
+    def sendall(self, data):
+        if len(self.sent) == self.fail_after:
+            raise BrokenPipeError("gone")
+        self.sent.append(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def test_worker_serves_sessions_then_recycles(monkeypatch):
+    dropped = []
+    monkeypatch.setattr(gateway_daemon, "_drop_privileges", dropped.append)
+
+    def no_db():
+        raise OSError("db down")
+
+    monkeypatch.setattr(gateway_daemon.db, "hold_connection", no_db)
+    statuses = iter([0, 0, None])
+    monkeypatch.setattr(gateway_daemon, "handle_connection", lambda mode, conn: next(statuses))
+    ok, gone, left, late = FakeConn(), FakeConn(fail_after=1), FakeConn(), FakeConn(fail_after=0)
+    conf = gateway_daemon.DaemonConfig(socket_dir=None, workers=1, max_sessions=4)
+
+    gateway_daemon._worker("put", FakeListener([ok, gone, left, late]), conf)
+
+    assert dropped == ["put"]
+    assert ok.sent == [gateway_client.READY, gateway_daemon.STATUS.pack(0)]
+    assert gone.sent == left.sent == [gateway_client.READY]
+    assert late.sent == []
+
+
+def test_sessions_beyond_the_workers_run_on_their_own(monkeypatch, tmp_path):
+    monkeypatch.setenv("GATEWAY_SOCKET_DIR", str(tmp_path))
+    monkeypatch.setattr(sys, "argv", ["gateway_client.py", "put"])
+    monkeypatch.setattr(gateway_daemon, "_drop_privileges", lambda mode: None)
+    monkeypatch.setattr(gateway_daemon.db, "hold_connection", lambda: None)
+    busy, done = threading.Event(), threading.Event()
+
+    def long_transfer(mode, fds, env):
+        for fd in fds:
+            os.close(fd)
+        busy.set()
+        done.wait(10)
+        return 0
+
+    monkeypatch.setattr(gateway_daemon, "run_session", long_transfer)
+    fallbacks = []
+    monkeypatch.setattr(os, "execv", lambda path, args: fallbacks.append(args[-1]))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(tmp_path / "put.sock"))
+    listener.listen(8)
+    # One worker, three concurrent sessions.
+    conf = gateway_daemon.DaemonConfig(socket_dir=tmp_path, workers=1, max_sessions=3)
+    worker = threading.Thread(target=gateway_daemon._worker, args=("put", listener, conf))
+    worker.start()
+    statuses = []
+
+    def first():
+        try:
+            gateway_client.main()
+        except SystemExit as exc:
+            statuses.append(exc.code)
+
+    client = threading.Thread(target=first)
+    client.start()
+    assert busy.wait(10)
+
+    gateway_client.main()
+    gateway_client.main()
+
+    assert fallbacks == ["put", "put"]
+    done.set()
+    client.join()
+    worker.join()
+    listener.close()
+    assert statuses == [0]
+
+
+def test_spawn_parent_returns_pid(monkeypatch):
+    monkeypatch.setattr(os, "fork", lambda: 1234)
+    assert gateway_daemon._spawn("put", None, None) == 1234
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_spawn_child_runs_worker_and_exits(monkeypatch, fail):
+    monkeypatch.setattr(os, "fork", lambda: 0)
+    monkeypatch.setattr(signal, "signal", lambda *_args: None)
+
+    def fake_worker(mode, listener, conf):
+        if fail:
+            raise RuntimeError("boom")
+
+    def fake_exit(code):
+        raise Stop(code)
+
+    monkeypatch.setattr(gateway_daemon, "_worker", fake_worker)
+    monkeypatch.setattr(os, "_exit", fake_exit)
+
+    with pytest.raises(Stop) as exc:
+        gateway_daemon._spawn("put", None, None)
+
+    assert exc.value.args == (1 if fail else 0,)
+
+
+def test_serve_spawns_pools_and_respawns(monkeypatch, tmp_path):
+    conf = gateway_daemon.DaemonConfig(socket_dir=tmp_path / "run", workers=1, max_sessions=1)
+    monkeypatch.setattr(gateway_daemon, "_listen", lambda path, user: f"listener-{user}")
+    pids = iter([10, 20, 30, 40])
+    spawned = []
+
+    def fake_spawn(mode, listener, _conf):
+        spawned.append((mode, listener))
+        return next(pids)
+
+    handlers = {}
+    monkeypatch.setattr(gateway_daemon, "_spawn", fake_spawn)
+    monkeypatch.setattr(signal, "signal", lambda sig, handler: handlers.update({sig: handler}))
+    waits = iter([(99, 0), (10, 0), (20, 256)])
+
+    def fake_wait():
+        try:
+            return next(waits)
+        except StopIteration:
+            raise Stop()
+
+    monkeypatch.setattr(os, "wait", fake_wait)
+    slept = []
+
+    with pytest.raises(Stop):
+        gateway_daemon.serve(conf, sleep=slept.append)
+
+    assert spawned == [
+        ("put", "listener-put"),
+        ("get", "listener-get"),
+        ("put", "listener-put"),
+        ("get", "listener-get"),
+    ]
+    assert slept == [gateway_daemon.RESPAWN_DELAY_SECONDS]
+    assert set(handlers) == {signal.SIGTERM, signal.SIGINT}
+
+    killed = []
+
+    def fake_kill(pid, sig):
+        killed.append(pid)
+        if pid == 30:
+            raise ProcessLookupError()
+
+    monkeypatch.setattr(os, "kill", fake_kill)
+    with pytest.raises(SystemExit) as exc:
+        handlers[signal.SIGTERM](signal.SIGTERM, None)
+
+    assert exc.value.code == 0
+    assert sorted(killed) == [30, 40]
+
+
+def test_main_and_entrypoint(monkeypatch, tmp_path):
+    monkeypatch.setenv("GATEWAY_SOCKET_DIR", str(tmp_path))
+    served = []
+    monkeypatch.setattr(gateway_daemon, "serve", served.append)
+
+    gateway_daemon.main()
+    assert served[0].socket_dir == tmp_path
+
+    def fake_fork():
+        raise Stop()
+
+    monkeypatch.setattr(os, "fork", fake_fork)
+    monkeypatch.setattr(os, "geteuid", lambda: 1000)
+    monkeypatch.setattr(sys, "stderr", io.StringIO())
+    sys.modules.pop("app.gateway_daemon", None)
+    with pytest.raises(Stop):
+        __import__("runpy").run_module("app.gateway_daemon", run_name="__main__")
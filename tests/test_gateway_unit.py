@@ -2,12 +2,18 @@ from __future__ import annotations
 
 import hashlib
 import io
+import json
+import os
 import sys
 from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import fcntl
 
 import pytest
 
-from app import gateway
+from app import admission, bloom, bundle, gateway, phases, quota, storage, store
 
 
 class DummyStdin:
@@ -39,17 +45,13 @@ def test_scp_receive_one_put_flow(tmp_path, monkeypatch):
         + b"\n"
     )
     stdout = _set_io(monkeypatch, data)
-    monkeypatch.setattr(gateway, "_token", lambda: "tok123")
+    monkeypatch.setattr(store, "new_token", lambda: "tok123")
 
     created = datetime(2024, 1, 1, tzinfo=timezone.utc)
-    monkeypatch.setattr(gateway, "utcnow", lambda: created)
+    monkeypatch.setattr(store, "utcnow", lambda: created)
 
     inserted = []
-
-    def fake_insert_file(**kwargs):
-        inserted.append(kwargs)
-
-    monkeypatch.setattr(gateway, "insert_file", fake_insert_file)
+    monkeypatch.setattr(store, "insert_files", lambda recs: inserted.extend(recs) or [])
 
     conf = gateway.Config(data_dir=tmp_path, ttl_days=1)
     receipts = gateway.scp_receive_one(conf)
@@ -64,11 +66,362 @@ def test_scp_receive_one_put_flow(tmp_path, monkeypatch):
             "mode": "0644",
         }
     ]
-    assert inserted[0]["stored_path"] == str(tmp_path / "tok123")
+    assert inserted[0].stored_path == str(tmp_path / "tok123")
     assert (tmp_path / "tok123").read_bytes() == payload
     assert stdout.buffer.getvalue() == gateway.ACK_OK * 5
 
 
+def test_scp_receive_one_logs_phase_summary(tmp_path, monkeypatch):
+    _set_io(monkeypatch, b"C0644 2 a.txt\nhi\x00")
+    monkeypatch.setattr(store, "insert_files", lambda recs: [])
+    logged = []
+    monkeypatch.setattr(phases.logutil, "info", logged.append)
+
+    gateway.scp_receive_one(gateway.Config(data_dir=tmp_path, ttl_days=1, phase_sample=1.0))
+
+    summary = json.loads(logged[-1].split(" ", 1)[1])
+    assert summary["kind"] == "scp_receive"
+    assert (summary["ok"], summary["files"], summary["bytes"]) == (True, 1, 2)
+    assert {"client", "hash", "write", "store", "insert"} <= set(summary["phases"])
+
+
+def test_scp_send_one_logs_failed_sessions(tmp_path, monkeypatch):
+    monkeypatch.setattr(gateway, "get_file_by_token", lambda _token: None)
+    monkeypatch.setattr(sys, "stderr", io.StringIO())
+    logged = []
+    monkeypatch.setattr(phases.logutil, "info", logged.append)
+
+    with pytest.raises(SystemExit):
+        gateway.scp_send_one(
+            gateway.Config(data_dir=tmp_path, ttl_days=1, phase_sample=1.0), "missing"
+        )
+
+    summary = json.loads(logged[-1].split(" ", 1)[1])
+    assert (summary["kind"], summary["ok"], summary["bytes"]) == ("scp_send", False, 0)
+    assert set(summary["phases"]) == {"lookup"}
+
+
+def test_scp_receive_one_stores_under_shard_dirs(tmp_path, monkeypatch):
+    _set_io(monkeypatch, b"C0644 2 a.txt\nhi\x00")
+    monkeypatch.setattr(store, "new_token", lambda: "tok123")
+    inserted = []
+    monkeypatch.setattr(store, "insert_files", lambda recs: inserted.extend(recs) or [])
+
+    gateway.scp_receive_one(gateway.Config(data_dir=tmp_path, ttl_days=1, shard_depth=2))
+
+    target = storage.token_path(tmp_path, "tok123", 2)
+    assert inserted[0].stored_path == str(target)
+    assert target.read_bytes() == b"hi"
+    assert not list(target.parent.glob(".*.tmp"))
+
+
+def test_scp_receive_one_dedup_drops_unadopted_candidates(tmp_path, monkeypatch):
+    _set_io(monkeypatch, b"C0644 2 a.txt\nhi\x00C0644 2 b.txt\nhi\x00")
+    tokens = iter(["t0", "t1"])
+    monkeypatch.setattr(store, "new_token", lambda: next(tokens))
+    inserted = []
+
+    def insert_files(records):
+        inserted.extend(records)
+        # The DB adopts the first candidate for the digest; the rest are spare.
+        return [r.stored_path for r in records[1:]] + [str(tmp_path / "vanished")]
+
+    monkeypatch.setattr(store, "insert_files", insert_files)
+
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, shard_depth=2, dedup=True)
+    receipts = gateway.scp_receive_one(conf)
+
+    digest = hashlib.sha512(b"hi").hexdigest()
+    assert [r["sha512"] for r in receipts] == [digest, digest]
+    assert all(r.blob for r in inserted)
+    kept, spare = (Path(r.stored_path) for r in inserted)
+    assert kept == storage.blob_path(tmp_path, digest, "t0", 2)
+    assert kept.read_bytes() == b"hi"
+    assert not spare.exists()
+
+
+def test_scp_receive_one_compresses_and_send_decodes(tmp_path, monkeypatch):
+    payload = b"abc" * 1000
+    _set_io(monkeypatch, b"C0644 3000 a.txt\n" + payload + b"\x00")
+    monkeypatch.setattr(store, "new_token", lambda: "tok123")
+    inserted = []
+    monkeypatch.setattr(store, "insert_files", lambda recs: inserted.extend(recs) or [])
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, codec="zlib")
+
+    receipts = gateway.scp_receive_one(conf)
+
+    (record,) = inserted
+    assert record.codec == "zlib"
+    assert receipts[0]["sha512"] == hashlib.sha512(payload).hexdigest()
+    assert (tmp_path / "tok123").stat().st_size < len(payload)
+
+    monkeypatch.setattr(gateway, "get_file_by_token", lambda _token: record)
+    monkeypatch.setattr(gateway, "utcnow", lambda: record.created_at)
+    stdout = _set_io(monkeypatch, gateway.ACK_OK * 3)
+    monkeypatch.setattr(sys, "stderr", io.StringIO())
+
+    gateway.scp_send_one(conf, "tok123")
+
+    assert stdout.buffer.getvalue() == b"C0644 3000 tok123\n" + payload + gateway.ACK_OK
+
+
+def test_small_uploads_share_a_segment(tmp_path, monkeypatch):
+    small, tiny, big = b"abc" * 1000, b"xy", os.urandom(5000)
+    records = [b"C0644 3000 a\n", small, b"\x00C0644 2 b\n", tiny, b"\x00C0644 5000 c\n", big]
+    _set_io(monkeypatch, b"".join(records) + b"\x00")
+    monkeypatch.setattr(store, "new_token", iter(["t0", "t1", "t2"]).__next__)
+    monkeypatch.setattr(gateway.segments, "_last", (0, 0))
+    inserted = []
+    monkeypatch.setattr(store, "insert_files", lambda recs: inserted.extend(recs) or [])
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, codec="zlib", segment_max=4096)
+
+    gateway.scp_receive_one(conf)
+
+    first, second, third = inserted
+    assert first.stored_path == second.stored_path
+    assert Path(first.stored_path).parent == tmp_path / "segments"
+    assert (first.codec, second.codec) == ("zlib", "none")
+    assert second.seg_offset == first.seg_length and second.seg_length == 2
+    assert third.seg_offset is None and third.stored_path == str(tmp_path / "t2")
+    assert not list(tmp_path.glob(".*.tmp"))
+
+    for record, payload in ((first, small), (second, tiny)):
+        monkeypatch.setattr(gateway, "get_file_by_token", lambda _token: record)
+        monkeypatch.setattr(gateway, "utcnow", lambda: record.created_at)
+        stdout = _set_io(monkeypatch, gateway.ACK_OK * 3)
+        monkeypatch.setattr(sys, "stderr", io.StringIO())
+
+        gateway.scp_send_one(conf, record.token)
+
+        header = f"C0644 {len(payload)} {record.token}\n".encode()
+        assert stdout.buffer.getvalue() == header + payload + gateway.ACK_OK
+
+
+def test_small_upload_rejects_and_checks_terminator(tmp_path, monkeypatch):
+    stdout = _set_io(monkeypatch, b"C0644 9001 big.bin\nC0644 2 a.txt\nhiX")
+    monkeypatch.setattr(os, "statvfs", lambda _p: SimpleNamespace(f_bavail=10, f_frsize=1000))
+    monkeypatch.setattr(store, "insert_files", lambda recs: pytest.fail("nothing to record"))
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, reserve_bytes=1000, segment_max=10000)
+
+    with pytest.raises(RuntimeError, match="terminator"):
+        gateway.scp_receive_one(conf)
+
+    assert stdout.buffer.getvalue().startswith(gateway.ACK_OK + gateway.ACK_ERROR)
+    assert not (tmp_path / "segments").exists()
+
+
+def test_scp_receive_one_rejects_files_that_do_not_fit(tmp_path, monkeypatch):
+    stdout = _set_io(monkeypatch, b"C0644 9001 big.bin\nC0644 2 a.txt\nhi\x00")
+    monkeypatch.setattr(store, "new_token", iter(["t0", "t1"]).__next__)
+    monkeypatch.setattr(os, "statvfs", lambda _p: SimpleNamespace(f_bavail=10, f_frsize=1000))
+    inserted = []
+    monkeypatch.setattr(store, "insert_files", lambda recs: inserted.extend(recs) or [])
+
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, reserve_bytes=1000)
+    receipts = gateway.scp_receive_one(conf)
+
+    assert [r["token"] for r in receipts] == ["t1"]
+    out = stdout.buffer.getvalue()
+    assert out.startswith(gateway.ACK_OK + gateway.ACK_ERROR + b"upload rejected: not enough space")
+    assert out.endswith(b"\n" + gateway.ACK_OK * 2)
+    assert sorted(os.listdir(tmp_path)) == ["t1"]
+
+
+def test_scp_receive_one_rejects_over_quota_files_at_the_header(tmp_path, monkeypatch):
+    stdout = _set_io(monkeypatch, b"C0644 50 big.bin\nC0644 2 a.txt\nhi\x00")
+    monkeypatch.setattr(store, "new_token", iter(["t0", "t1", "t2"]).__next__)
+    monkeypatch.setattr(store, "insert_files", lambda recs: [])
+    charged = []
+
+    def charge_key(key, sessions, size, **_kw):
+        charged.append((key, size))
+        return size <= 10
+
+    monkeypatch.setattr(quota.db, "charge_key", charge_key)
+    limits = quota.Limits(bytes=1024)
+
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, key="SHA256:k", quota=limits)
+    receipts = gateway.scp_receive_one(conf)
+
+    assert [r["token"] for r in receipts] == ["t1"]
+    assert charged == [("SHA256:k", 50), ("SHA256:k", 2)]
+    out = stdout.buffer.getvalue()
+    assert out.startswith(gateway.ACK_OK + gateway.ACK_ERROR + b"upload rejected: quota exceeded")
+    assert sorted(os.listdir(tmp_path)) == ["t1"]
+
+
+
+@pytest.mark.parametrize(
+    "data, segment_max, refunded",
+    [
+        (b"C0644 50 big.bin\nhi", 0, [50]),
+        (b"C0644 5 small.bin\nhi", 4096, [5]),
+        # The member cut short refunds itself; the tree refunds those added.
+        (b"D0755 0 top\nC0644 5 a.txt\nhello\x00C0644 9 b.txt\nhi", 0, [9, 5]),
+    ],
+)
+def test_scp_receive_one_refunds_uploads_that_fail(
+    tmp_path, monkeypatch, data, segment_max, refunded
+):
+    _set_io(monkeypatch, data)
+    monkeypatch.setattr(store, "insert_files", lambda recs: [])
+    monkeypatch.setattr(quota.db, "charge_key", lambda *a, **kw: True)
+    refunds = []
+    monkeypatch.setattr(quota.db, "refund_key", lambda key, sessions, size: refunds.append(size))
+    conf = gateway.Config(
+        data_dir=tmp_path,
+        ttl_days=1,
+        key="SHA256:k",
+        quota=quota.Limits(bytes=1024),
+        segment_max=segment_max,
+    )
+
+    with pytest.raises(EOFError):
+        gateway.scp_receive_one(conf)
+
+    assert refunds == refunded
+
+
+def test_scp_receive_one_refunds_when_the_upload_cannot_be_allocated(tmp_path, monkeypatch):
+    _set_io(monkeypatch, b"C0644 50 big.bin\n")
+    monkeypatch.setattr(quota.db, "charge_key", lambda *a, **kw: True)
+    refunds = []
+    monkeypatch.setattr(quota.db, "refund_key", lambda key, sessions, size: refunds.append(size))
+
+    def allocate_file(path, size, **_kw):
+        raise OSError("read-only file system")
+
+    monkeypatch.setattr(gateway.allocate, "allocate", allocate_file)
+    limits = quota.Limits(bytes=1024)
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, key="SHA256:k", quota=limits)
+
+    with pytest.raises(OSError):
+        gateway.scp_receive_one(conf)
+
+    assert refunds == [50]
+
+
+TREE = (
+    b"D0755 0 top\n"
+    b"C0644 5 a.txt\nhello\x00"
+    b"T0 0 0 0\n"
+    b"D0700 0 sub\n"
+    b"C0600 0 e\n\x00"
+    b"E\n"
+    b"E\n"
+)
+
+
+def test_scp_receive_one_bundles_directory_and_sends_it_back(tmp_path, monkeypatch):
+    stdout = _set_io(monkeypatch, TREE + b"C0644 2 b.txt\nhi\x00")
+    monkeypatch.setattr(store, "new_token", iter(["tree", "file"]).__next__)
+    inserted = []
+    monkeypatch.setattr(store, "insert_files", lambda recs: inserted.extend(recs) or [])
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1)
+
+    receipts = gateway.scp_receive_one(conf)
+
+    assert stdout.buffer.getvalue() == gateway.ACK_OK * 12
+    assert [(r["token"], r["original_name"], r["size_bytes"], r["mode"]) for r in receipts] == [
+        ("tree", "top", 5, "0755"),
+        ("file", "b.txt", 2, "0644"),
+    ]
+    assert [r.bundle for r in inserted] == [True, False]
+    assert sorted(os.listdir(tmp_path)) == ["file", "tree"]
+
+    row = inserted[0]
+    monkeypatch.setattr(gateway, "get_file_by_token", lambda _token: row)
+    monkeypatch.setattr(gateway, "utcnow", lambda: inserted[0].created_at)
+    stdout = _set_io(monkeypatch, gateway.ACK_OK * 9)
+    monkeypatch.setattr(sys, "stderr", io.StringIO())
+
+    gateway.scp_send_one(conf, "tree", recursive=True)
+
+    assert stdout.buffer.getvalue() == (
+        b"D0755 0 top\nC0644 5 a.txt\nhello\x00D0700 0 sub\nC0600 0 e\n\x00E\nE\n"
+    )
+
+    monkeypatch.setattr(sys, "stderr", io.StringIO())
+    with pytest.raises(SystemExit) as exc:
+        gateway.scp_send_one(conf, "tree")
+    assert exc.value.code == 2
+    assert "use scp -r" in sys.stderr.getvalue()
+
+
+def test_scp_receive_one_rejects_directory_members_that_do_not_fit(tmp_path, monkeypatch):
+    stdout = _set_io(monkeypatch, b"D0755 0 top\nC0644 9001 big\nC0644 1 a\nx\x00E\n")
+    monkeypatch.setattr(os, "statvfs", lambda _p: SimpleNamespace(f_bavail=10, f_frsize=1000))
+    inserted = []
+    monkeypatch.setattr(store, "insert_files", lambda recs: inserted.extend(recs) or [])
+
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, reserve_bytes=1000)
+    receipts = gateway.scp_receive_one(conf)
+
+    assert gateway.ACK_ERROR + b"upload rejected: not enough space" in stdout.buffer.getvalue()
+    assert receipts[0]["size_bytes"] == 1
+    with open(inserted[0].stored_path, "rb") as f:
+        assert [e.name for e in bundle.read_index(f)] == ["top", "a", ""]
+
+
+@pytest.mark.parametrize(
+    "tail, error",
+    [(b"", EOFError), (b"C0644 3 a\nx", EOFError), (b"C0644 1 a\nx\x01", RuntimeError)],
+)
+def test_scp_receive_one_broken_directory_leaves_nothing(tmp_path, monkeypatch, tail, error):
+    _set_io(monkeypatch, b"D0755 0 top\n" + tail)
+    monkeypatch.setattr(store, "insert_files", lambda recs: pytest.fail("recorded"))
+
+    with pytest.raises(error):
+        gateway.scp_receive_one(gateway.Config(data_dir=tmp_path, ttl_days=1))
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_scp_receive_one_flushes_receipts_in_batches(tmp_path, monkeypatch):
+    data = b"".join(
+        b"C0644 1 f%d.txt\n" % i + b"x" + b"\x00" for i in range(3)
+    )
+    _set_io(monkeypatch, data)
+    tokens = iter(["t0", "t1", "t2"])
+    monkeypatch.setattr(store, "new_token", lambda: next(tokens))
+    monkeypatch.setattr(gateway, "INSERT_BATCH_SIZE", 2)
+    flushes = []
+    monkeypatch.setattr(
+        store, "insert_files", lambda records: flushes.append([r.token for r in records]) or []
+    )
+
+    receipts = gateway.scp_receive_one(gateway.Config(data_dir=tmp_path, ttl_days=1))
+
+    assert [r["token"] for r in receipts] == ["t0", "t1", "t2"]
+    assert flushes == [["t0", "t1"], ["t2"]]
+
+
+def test_scp_receive_one_records_stored_files_on_failure(tmp_path, monkeypatch):
+    data = b"C0644 1 a.txt\nx\x00" + b"X\n"
+    _set_io(monkeypatch, data)
+    monkeypatch.setattr(store, "new_token", lambda: "tok")
+    inserted = []
+    monkeypatch.setattr(store, "insert_files", lambda recs: inserted.extend(recs) or [])
+
+    with pytest.raises(RuntimeError, match="unsupported"):
+        gateway.scp_receive_one(gateway.Config(data_dir=tmp_path, ttl_days=1))
+
+    assert [r.token for r in inserted] == ["tok"]
+
+
+def test_scp_receive_one_failed_flush_keeps_original_error(tmp_path, monkeypatch):
+    data = b"C0644 1 a.txt\nx\x00" + b"X\n"
+    _set_io(monkeypatch, data)
+
+    def db_down(_records):
+        raise OSError("db down")
+
+    monkeypatch.setattr(store, "insert_files", db_down)
+
+    with pytest.raises(RuntimeError, match="unsupported"):
+        gateway.scp_receive_one(gateway.Config(data_dir=tmp_path, ttl_days=1))
+
+
 def test_scp_receive_one_unsupported_record(monkeypatch, tmp_path):
     _set_io(monkeypatch, b"X\n")
     conf = gateway.Config(data_dir=tmp_path, ttl_days=1)
@@ -135,7 +488,7 @@ def test_scp_send_one_success(tmp_path, monkeypatch):
 
     created = datetime(2024, 1, 1, tzinfo=timezone.utc)
     expires = created + timedelta(days=1)
-    row = ("tok", "sha", "orig.txt", len(payload), str(path), created, expires)
+    row = gateway.FileRecord("tok", "sha", "orig.txt", len(payload), str(path), created, expires)
 
     monkeypatch.setattr(gateway, "get_file_by_token", lambda _token: row)
     monkeypatch.setattr(gateway, "utcnow", lambda: created)
@@ -153,6 +506,24 @@ def test_scp_send_one_success(tmp_path, monkeypatch):
     assert "Filename: orig.txt" in stderr.getvalue()
 
 
+def test_scp_send_one_short_file_fails(tmp_path, monkeypatch):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"da")
+    created = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    expires = created + timedelta(days=1)
+    row = gateway.FileRecord("tok", "sha", "orig.txt", 4, str(path), created, expires)
+    monkeypatch.setattr(gateway, "get_file_by_token", lambda _token: row)
+    monkeypatch.setattr(gateway, "utcnow", lambda: created)
+    stdout = _set_io(monkeypatch, gateway.ACK_OK * 3)
+    monkeypatch.setattr(sys, "stderr", io.StringIO())
+
+    with pytest.raises(SystemExit) as exc:
+        gateway.scp_send_one(gateway.Config(data_dir=tmp_path, ttl_days=1), "tok")
+
+    assert exc.value.code == 1
+    assert not stdout.buffer.getvalue().endswith(b"da" + gateway.ACK_OK)
+
+
 def test_scp_send_one_token_not_found(monkeypatch, tmp_path):
     monkeypatch.setattr(gateway, "get_file_by_token", lambda _token: None)
     stderr = io.StringIO()
@@ -165,10 +536,41 @@ def test_scp_send_one_token_not_found(monkeypatch, tmp_path):
     assert "token not found" in stderr.getvalue()
 
 
+def test_scp_send_one_filter_rejects_unknown_tokens_without_the_db(monkeypatch, tmp_path):
+    monkeypatch.setattr(bloom, "_reader", None)
+    bloom.rebuild(tmp_path, 100, [["known"]])
+    lookups = []
+    monkeypatch.setattr(gateway, "get_file_by_token", lambda token: lookups.append(token))
+    monkeypatch.setattr(sys, "stderr", io.StringIO())
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, bloom=True)
+
+    for token in ("missing", "known"):
+        with pytest.raises(SystemExit) as exc:
+            gateway.scp_send_one(conf, token)
+        assert exc.value.code == 2
+
+    # Only the token the filter has seen reaches the DB.
+    assert lookups == ["known"]
+
+
+def test_flush_pending_adds_committed_tokens_to_the_filter(monkeypatch, tmp_path):
+    monkeypatch.setattr(bloom, "_reader", None)
+    bloom.rebuild(tmp_path, 100, [])
+    monkeypatch.setattr(store, "insert_files", lambda recs: [])
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    pending = [gateway.FileRecord("tok", "sha", "f", 1, str(tmp_path / "tok"), now, now)]
+
+    store.flush_pending(gateway.Config(data_dir=tmp_path, ttl_days=1, bloom=True), pending)
+
+    assert pending == []
+    assert bloom.might_contain(tmp_path, "tok")
+    assert not bloom.might_contain(tmp_path, "other")
+
+
 def test_scp_send_one_expired(monkeypatch, tmp_path):
     now = datetime(2024, 1, 2, tzinfo=timezone.utc)
     expired = now - timedelta(seconds=1)
-    row = ("tok", "sha", "orig.txt", 1, str(tmp_path / "x"), now, expired)
+    row = gateway.FileRecord("tok", "sha", "orig.txt", 1, str(tmp_path / "x"), now, expired)
 
     monkeypatch.setattr(gateway, "get_file_by_token", lambda _token: row)
     monkeypatch.setattr(gateway, "utcnow", lambda: now)
@@ -185,7 +587,7 @@ def test_scp_send_one_expired(monkeypatch, tmp_path):
 def test_scp_send_one_missing_file(monkeypatch, tmp_path):
     now = datetime(2024, 1, 2, tzinfo=timezone.utc)
     expires = now + timedelta(days=1)
-    row = ("tok", "sha", "orig.txt", 1, str(tmp_path / "missing"), now, expires)
+    row = gateway.FileRecord("tok", "sha", "orig.txt", 1, str(tmp_path / "missing"), now, expires)
 
     monkeypatch.setattr(gateway, "get_file_by_token", lambda _token: row)
     monkeypatch.setattr(gateway, "utcnow", lambda: now)
@@ -204,7 +606,7 @@ def test_scp_send_one_bad_ack(monkeypatch, tmp_path):
     path.write_bytes(b"x")
     now = datetime(2024, 1, 1, tzinfo=timezone.utc)
     expires = now + timedelta(days=1)
-    row = ("tok", "sha", "orig.txt", 1, str(path), now, expires)
+    row = gateway.FileRecord("tok", "sha", "orig.txt", 1, str(path), now, expires)
 
     monkeypatch.setattr(gateway, "get_file_by_token", lambda _token: row)
     monkeypatch.setattr(gateway, "utcnow", lambda: now)
@@ -262,6 +664,7 @@ def test_main_put_error(monkeypatch, tmp_path):
     monkeypatch.setattr(sys, "argv", ["gateway.py", "put"])
     monkeypatch.setattr(sys, "stderr", io.StringIO())
     monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setenv("LOG_LEVEL", "DEBUG")
     monkeypatch.setattr(gateway, "_parse_original_command", lambda: "scp -t /")
 
     def boom(_conf):
@@ -273,6 +676,60 @@ def test_main_put_error(monkeypatch, tmp_path):
         gateway.main()
 
     assert exc.value.code == 1
+    assert "Traceback" in sys.stderr.getvalue()
+
+
+def test_main_refuses_sessions_over_the_key_budget(monkeypatch, tmp_path):
+    auth = tmp_path / "auth"
+    auth.write_text("publickey ssh-ed25519 AAAAC3NzaC1lZDI1NTE5\n")
+    monkeypatch.setattr(sys, "argv", ["gateway.py", "get"])
+    monkeypatch.setattr(sys, "stderr", io.StringIO())
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setenv("SSH_USER_AUTH", str(auth))
+    monkeypatch.setenv("KEY_QUOTA_SESSIONS", "5")
+    monkeypatch.setattr(gateway, "_parse_original_command", lambda: "scp -f token")
+    monkeypatch.setattr(quota.db, "charge_key", lambda key, sessions, size, **_kw: False)
+    monkeypatch.setattr(gateway, "scp_send_one", lambda *a, **kw: pytest.fail("served"))
+
+    with pytest.raises(SystemExit) as exc:
+        gateway.main()
+
+    assert exc.value.code == 2
+    assert "ERROR: quota exceeded (5 sessions per 86400s)" in sys.stderr.getvalue()
+
+
+BUSY = "server busy: get queue is full, try again later\n"
+
+
+@pytest.mark.parametrize(
+    "cmd, out, err",
+    [
+        ("scp -f token", gateway.ACK_ERROR + BUSY.encode(), ""),
+        ("internal-sftp", b"", "ERROR: " + BUSY),
+    ],
+)
+def test_main_turns_sessions_away_when_busy(monkeypatch, tmp_path, cmd, out, err):
+    monkeypatch.setattr(sys, "argv", ["gateway.py", "get"])
+    monkeypatch.setattr(sys, "stderr", io.StringIO())
+    stdout = _set_io(monkeypatch, b"")
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setenv("GATEWAY_MAX_GET", "1")
+    monkeypatch.setenv("GATEWAY_QUEUE", "0")
+    monkeypatch.setattr(gateway, "_parse_original_command", lambda: cmd)
+    monkeypatch.setattr(gateway, "scp_send_one", lambda *a, **kw: pytest.fail("served"))
+    (tmp_path / admission.DIR_NAME).mkdir()
+    held = os.open(tmp_path / admission.DIR_NAME / "get.0", os.O_RDONLY | os.O_CREAT)
+    fcntl.flock(held, fcntl.LOCK_EX)
+
+    try:
+        with pytest.raises(SystemExit) as exc:
+            gateway.main()
+    finally:
+        os.close(held)
+
+    assert exc.value.code == 1
+    assert stdout.buffer.getvalue() == out
+    assert sys.stderr.getvalue().endswith(err)
 
 
 def test_main_get_missing_flag(monkeypatch, tmp_path):
@@ -307,7 +764,8 @@ def test_main_get_success(monkeypatch, tmp_path):
 
     called = {"count": 0}
 
-    def fake_send(_conf, _token):
+    def fake_send(_conf, _token, *, recursive):
+        assert not recursive
         called["count"] += 1
 
     monkeypatch.setattr(gateway, "scp_send_one", fake_send)
@@ -323,9 +781,10 @@ def test_main_get_error(monkeypatch, tmp_path):
     monkeypatch.setattr(sys, "argv", ["gateway.py", "get"])
     monkeypatch.setattr(sys, "stderr", io.StringIO())
     monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setenv("LOG_LEVEL", "DEBUG")
     monkeypatch.setattr(gateway, "_parse_original_command", lambda: "scp -f token")
 
-    def boom(_conf, _token):
+    def boom(_conf, _token, **_kwargs):
         raise RuntimeError("nope")
 
     monkeypatch.setattr(gateway, "scp_send_one", boom)
@@ -334,6 +793,7 @@ def test_main_get_error(monkeypatch, tmp_path):
         gateway.main()
 
     assert exc.value.code == 1
+    assert "Traceback" in sys.stderr.getvalue()
 
 
 def test_parse_original_command(monkeypatch):
@@ -350,3 +810,35 @@ def test_gateway_entrypoint_runs_main(monkeypatch):
         __import__("runpy").run_module("app.gateway", run_name="__main__")
 
     assert exc.value.code == 2
+
+
+def test_gateway_import_defers_heavy_modules():
+    # Kept off the path to the first ACK (bench/bench_startup.py): psycopg until
+    # the first db_postgres.conn(), socket until metrics.flush(), hashlib, upload and
+    # bundle until a record needs them.
+    import subprocess
+    from pathlib import Path
+
+    deferred = ["psycopg", "dataclasses", "socket", "hashlib", "queue", "app.upload", "app.bundle"]
+    server = Path(__file__).resolve().parents[1] / "server"
+    out = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, app.gateway; print([m for m in {deferred!r} if m in sys.modules])",
+        ],
+        env={"PYTHONPATH": str(server)},
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+    assert out.strip() == "[]"
+
+
+def test_token_is_urlsafe():
+    token = store.new_token()
+    assert len(token) == 43
+    assert set(token) <= set(
+        "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+    )
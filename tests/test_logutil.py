@@ -1,6 +1,9 @@
 from __future__ import annotations
 
 import io
+import os
+import signal
+import threading
 
 from app import logutil
 
@@ -23,6 +26,7 @@ def test_logutil_writes_to_file_sink(tmp_path, monkeypatch):
     monkeypatch.setenv("LOG_LEVEL", "DEBUG")
 
     logutil.debug("file sink")
+    logutil.flush()
 
     data = sink.read_text(encoding="utf-8")
     assert "DEBUG" in data
@@ -92,3 +96,128 @@ def test_logutil_wrappers(monkeypatch):
     assert "ERROR" in output
     assert "WARNING" in output
     assert "VERBOSE" in output
+
+
+def test_logutil_formats_args_only_when_enabled(monkeypatch):
+    buffer = io.StringIO()
+    monkeypatch.setattr(logutil, "sys", type("Sys", (), {"stderr": buffer}))
+    monkeypatch.setenv("LOG_LEVEL", "INFO")
+
+    class Costly:
+        def __repr__(self):
+            raise AssertionError("formatted a disabled line")
+
+    logutil.debug("token=%r", Costly())
+    logutil.info("token=%r size=%d", "abc", 3)
+    logutil.log("INFO", "plain %s")
+
+    assert not logutil.enabled("DEBUG")
+    assert logutil.enabled("warn")
+    output = buffer.getvalue()
+    assert "token='abc' size=3" in output
+    assert "plain %s" in output
+
+
+def test_logutil_buffers_file_sink_until_flush(tmp_path, monkeypatch):
+    sink = tmp_path / "log.txt"
+    monkeypatch.setenv("LOG_SINK", str(sink))
+    monkeypatch.setenv("LOG_LEVEL", "DEBUG")
+
+    logutil.info("first")
+    assert sink.read_text(encoding="utf-8") == ""
+    # Warnings go out at once, together with what was buffered before them.
+    logutil.warning("second")
+    assert sink.read_text(encoding="utf-8").count("\n") == 2
+
+    logutil.debug("third")
+    monkeypatch.setattr(logutil, "BUFFER_BYTES", 1)
+    logutil.debug("fourth")
+    assert "fourth" in sink.read_text(encoding="utf-8")
+
+    monkeypatch.setattr(logutil, "BUFFER_BYTES", 1 << 20)
+    monkeypatch.setattr(logutil, "FLUSH_SECONDS", 0.0)
+    logutil.debug("fifth")
+    assert "fifth" in sink.read_text(encoding="utf-8")
+
+
+def test_logutil_keeps_every_line_logged_from_threads(tmp_path, monkeypatch):
+    sink = tmp_path / "log.txt"
+    monkeypatch.setenv("LOG_SINK", str(sink))
+    monkeypatch.setenv("LOG_LEVEL", "DEBUG")
+    monkeypatch.setattr(logutil, "BUFFER_BYTES", 4096)
+    # All threads make the first call together, racing to load the level and sink.
+    start = threading.Barrier(8)
+
+    def run(n):
+        start.wait()
+        for i in range(2000):
+            logutil.debug("thread=%d line=%d", n, i)
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    logutil.flush()
+
+    lines = sink.read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 8 * 2000
+    assert all(line.startswith("DEBUG ") for line in lines)
+    for n in range(8):
+        mine = [line for line in lines if f" thread={n} " in line]
+        assert [int(line.rsplit("=", 1)[1]) for line in mine] == list(range(2000))
+
+
+def test_logutil_forked_child_gets_a_free_lock(tmp_path, monkeypatch):
+    sink = tmp_path / "log.txt"
+    monkeypatch.setenv("LOG_SINK", str(sink))
+    monkeypatch.setenv("LOG_LEVEL", "INFO")
+    monkeypatch.setattr(logutil, "_lock", logutil._lock)
+    logutil.flush()
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with logutil._lock:
+            held.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    held.wait()
+    pid = os.fork()
+    if pid == 0:
+        # Would hang on the inherited lock; the alarm turns that into a failure.
+        signal.alarm(5)
+        logutil.warning("child")
+        os._exit(0)
+    try:
+        assert os.waitpid(pid, 0)[1] == 0
+        # Written by the child while this process still holds the lock.
+        assert not logutil._lock.acquire(blocking=False)
+        assert sink.read_text(encoding="utf-8").splitlines()[-1].endswith(" child")
+    finally:
+        release.set()
+        holder.join()
+
+
+def test_logutil_failed_flush_falls_back_to_stderr(tmp_path, monkeypatch):
+    buffer = io.StringIO()
+    monkeypatch.setattr(logutil, "sys", type("Sys", (), {"stderr": buffer}))
+    monkeypatch.setenv("LOG_SINK", str(tmp_path / "log.txt"))
+    monkeypatch.setenv("LOG_LEVEL", "INFO")
+    logutil.info("buffered")
+
+    def broken(fd, data):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(logutil.os, "write", broken)
+    logutil.flush()
+
+    assert "buffered" in buffer.getvalue()
+
+
+def test_logutil_reuses_the_timestamp_within_a_second(monkeypatch):
+    monkeypatch.setattr(logutil.time, "time", lambda: 1_700_000_000.25)
+    first = logutil._ts()
+    monkeypatch.setattr(logutil.time, "strftime", lambda *a: "unused")
+    assert logutil._ts() == first == "2023-11-14T22:13:20Z"
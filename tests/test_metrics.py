@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from app import metrics
+
+
+def test_registry_renders_prometheus_text():
+    reg = metrics.Registry()
+    reg.inc("gateway_files_total", direction="upload")
+    reg.inc("gateway_files_total", 2, direction="upload")
+    reg.set("bloom_fp_rate", 0.25)
+    reg.observe("db_transaction_seconds", 0.003, backend="sqlite")
+    reg.observe("db_transaction_seconds", 1000.0, backend="sqlite")
+
+    text = reg.render()
+
+    assert "# TYPE gateway_files_total counter\n" in text
+    assert 'gateway_files_total{direction="upload"} 3\n' in text
+    assert "bloom_fp_rate 0.25\n" in text
+    assert "# TYPE db_transaction_seconds histogram\n" in text
+    assert 'db_transaction_seconds_bucket{backend="sqlite",le="0.001"} 0\n' in text
+    assert 'db_transaction_seconds_bucket{backend="sqlite",le="0.005"} 1\n' in text
+    assert 'db_transaction_seconds_bucket{backend="sqlite",le="+Inf"} 2\n' in text
+    assert 'db_transaction_seconds_sum{backend="sqlite"} 1000.003\n' in text
+    assert 'db_transaction_seconds_count{backend="sqlite"} 2\n' in text
+
+
+def test_dump_merges_into_another_registry():
+    gateway_side = metrics.Registry()
+    gateway_side.inc("gateway_bytes_total", 10, direction="download")
+    gateway_side.set("g", 1)
+    gateway_side.observe("cleanup_lag_seconds", 30)
+    collector = metrics.Registry()
+    collector.inc("gateway_bytes_total", 5, direction="download")
+
+    collector.merge(gateway_side.dump())
+    collector.merge(gateway_side.dump())
+
+    text = collector.render()
+    assert 'gateway_bytes_total{direction="download"} 25\n' in text
+    assert 'cleanup_lag_seconds_bucket{le="60"} 2\n' in text
+    assert "g 1\n" in text
+
+    for bad in ("x\tname\t\t1", "c\tname\t\tnan?", "h\tcleanup_lag_seconds\t\t1,2"):
+        with pytest.raises(ValueError):
+            collector.merge(bad)
+    collector.clear()
+    assert not collector
+    assert collector.render() == ""
+
+
+def test_flush_sends_one_snapshot_to_the_collector(tmp_path, monkeypatch):
+    path = tmp_path / "m.sock"
+    monkeypatch.setenv("METRICS_SOCKET", str(path))
+    monkeypatch.setattr(metrics, "REGISTRY", metrics.Registry())
+    metrics.flush()  # nothing recorded, nothing sent
+
+    # No collector yet: the snapshot is dropped quietly.
+    metrics.inc("lost")
+    metrics.flush()
+    assert not metrics.REGISTRY
+
+    sock = metrics.bind_collector(path)
+    assert path.stat().st_mode & 0o777 == 0o660
+    received = metrics.Registry()
+    metrics.inc("gateway_files_total", direction="upload")
+    metrics.observe("gateway_session_seconds", 0.2, mode="put", status="ok")
+    metrics.set_gauge("up", 1)
+    metrics.flush()
+    sock.sendto(b"bogus", str(path))
+    # Stands in for the socket closing: collect() returns on the timeout.
+    sock.settimeout(0.2)
+    metrics.collect(sock, received)
+    sock.close()
+
+    text = received.render()
+    assert 'gateway_files_total{direction="upload"} 1\n' in text
+    assert "lost" not in text
+    assert not metrics.REGISTRY
+
+
+def test_socket_path_defaults_to_data_dir(monkeypatch, tmp_path):
+    monkeypatch.delenv("METRICS_SOCKET", raising=False)
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    assert metrics.socket_path() == tmp_path / metrics.SOCKET_NAME
+
+
+def test_http_endpoint_serves_metrics(monkeypatch):
+    reg = metrics.Registry()
+    reg.inc("cleanup_files_total", result="removed")
+    server = metrics.start_http("127.0.0.1:0", reg)
+    base = f"http://127.0.0.1:{server.server_port}"
+    try:
+        with urllib.request.urlopen(f"{base}/metrics") as resp:
+            body = resp.read().decode()
+        with pytest.raises(urllib.error.HTTPError) as exc:
+            urllib.request.urlopen(f"{base}/other")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'cleanup_files_total{result="removed"} 1\n' in body
+    assert exc.value.code == 404
+
+
+def test_serve_from_env(monkeypatch, tmp_path):
+    monkeypatch.setenv("METRICS_ADDR", "")
+    metrics.serve_from_env()
+
+    started = []
+    monkeypatch.setattr(threading.Thread, "start", lambda self: started.append(self.name))
+    monkeypatch.setenv("METRICS_ADDR", "127.0.0.1:0")
+    monkeypatch.setenv("METRICS_SOCKET", str(tmp_path / "missing" / "m.sock"))
+    metrics.serve_from_env()
+    assert started == []
+
+    monkeypatch.setenv("METRICS_SOCKET", str(tmp_path / "m.sock"))
+    metrics.serve_from_env()
+    assert started == ["metrics-http", "metrics-collect"]
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import os
+import sys
+
+import pytest
+
+from app import migrate_layout, storage
+
+
+class FakeFiles:
+    """In-memory files table for list_stored_paths/update_stored_paths."""
+
+    def __init__(self, rows):
+        self.rows = dict(rows)
+        self.sessions = 0
+
+    def list_stored_paths(self, after, limit):
+        tokens = sorted(t for t in self.rows if t > after)[:limit]
+        return [(t, self.rows[t]) for t in tokens]
+
+    def update_stored_paths(self, moves):
+        updated = set()
+        for token, old, new in moves:
+            if self.rows.get(token) == old:
+                self.rows[token] = new
+                updated.add(token)
+        return updated
+
+    def install(self, monkeypatch):
+        monkeypatch.setattr(migrate_layout, "list_stored_paths", self.list_stored_paths)
+        monkeypatch.setattr(migrate_layout, "update_stored_paths", self.update_stored_paths)
+
+        class Session:
+            def __enter__(s):
+                self.sessions += 1
+
+            def __exit__(s, *exc):
+                return False
+
+        monkeypatch.setattr(migrate_layout, "session", Session)
+
+
+def _flat(tmp_path, *tokens):
+    for token in tokens:
+        (tmp_path / token).write_bytes(token.encode())
+    return FakeFiles((t, str(tmp_path / t)) for t in tokens)
+
+
+def test_migrate_moves_files_and_rows(tmp_path, monkeypatch):
+    files = _flat(tmp_path, "a", "b", "c")
+    files.install(monkeypatch)
+
+    moved = migrate_layout.migrate(tmp_path, 2, batch_size=2)
+
+    assert moved == 3
+    assert files.sessions == 1
+    for token in "abc":
+        target = storage.token_path(tmp_path, token, 2)
+        assert files.rows[token] == str(target)
+        assert target.read_bytes() == token.encode()
+        assert not (tmp_path / token).exists()
+    # Already in place: a second run is a no-op.
+    assert migrate_layout.migrate(tmp_path, 2) == 0
+
+
+def test_migrate_dry_run_touches_nothing(tmp_path, monkeypatch):
+    files = _flat(tmp_path, "a")
+    files.install(monkeypatch)
+
+    assert migrate_layout.migrate(tmp_path, 2, dry_run=True) == 1
+    assert files.rows["a"] == str(tmp_path / "a")
+    assert (tmp_path / "a").exists()
+
+
+def test_migrate_batch_skips_missing_and_drops_stale_link(tmp_path, monkeypatch):
+    files = _flat(tmp_path, "keep", "raced")
+    files.install(monkeypatch)
+    # Expired between scan and link.
+    files.rows["gone"] = str(tmp_path / "gone")
+    rows = files.list_stored_paths("", 10)
+    # Row rewritten by someone else after the scan: the UPDATE must not match.
+    files.rows["raced"] = "/elsewhere/raced"
+
+    moved = migrate_layout.migrate_batch(rows, tmp_path, 1)
+
+    assert moved == 1
+    assert storage.token_path(tmp_path, "keep", 1).exists()
+    assert not storage.token_path(tmp_path, "raced", 1).exists()
+    assert (tmp_path / "raced").exists()
+    assert files.rows["gone"] == str(tmp_path / "gone")
+
+
+def test_link_resumes_after_interrupted_run(tmp_path):
+    old = tmp_path / "tok"
+    old.write_bytes(b"x")
+    new = storage.token_path(tmp_path, "tok", 2)
+    storage.ensure_parent(new)
+    os.link(old, new)
+
+    assert migrate_layout._link(old, new) is True
+
+    other = tmp_path / "other"
+    other.write_bytes(b"y")
+    assert migrate_layout._link(other, new) is False
+    old.unlink()
+    assert migrate_layout._link(old, new) is False
+
+
+def test_link_old_removed_between_link_and_samefile(tmp_path, monkeypatch):
+    def link(src, dst):
+        raise FileExistsError(dst)
+
+    monkeypatch.setattr(os, "link", link)
+
+    assert migrate_layout._link(tmp_path / "gone", tmp_path / "ab" / "gone") is False
+
+
+def test_migrate_unlink_tolerates_vanished_file(tmp_path, monkeypatch):
+    files = _flat(tmp_path, "a")
+    files.install(monkeypatch)
+
+    def update(moves):
+        # Cleaner removed the old name concurrently.
+        os.unlink(moves[0][1])
+        return files.update_stored_paths(moves)
+
+    monkeypatch.setattr(migrate_layout, "update_stored_paths", update)
+
+    assert migrate_layout.migrate(tmp_path, 2) == 1
+
+
+def test_main_uses_env_defaults(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setenv("DATA_SHARD_DEPTH", "1")
+    calls = []
+    monkeypatch.setattr(
+        migrate_layout, "migrate", lambda *a, **kw: calls.append((a, kw)) or 0
+    )
+
+    migrate_layout.main(["--dry-run"])
+
+    assert calls == [
+        ((tmp_path.resolve(), 1), {"batch_size": migrate_layout.BATCH_SIZE, "dry_run": True})
+    ]
+
+
+def test_migrate_layout_entrypoint(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setattr("sys.argv", ["migrate_layout", "--depth", "x"])
+
+    sys.modules.pop("app.migrate_layout", None)
+    with pytest.raises(SystemExit):
+        __import__("runpy").run_module("app.migrate_layout", run_name="__main__")
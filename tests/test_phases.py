@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import json
+
+import pytest
+
+from app import phases
+
+
+@pytest.fixture(autouse=True)
+def no_session(monkeypatch):
+    monkeypatch.setattr(phases, "_current", phases.OFF)
+
+
+def _clock(monkeypatch, *ticks):
+    values = iter(ticks)
+    monkeypatch.setattr(phases.time, "perf_counter", lambda: next(values))
+
+
+def test_nested_spans_report_exclusive_time(monkeypatch):
+    # begin, insert enter, db_connect enter/exit, insert exit, client enter/exit, end
+    _clock(monkeypatch, 0.0, 1.0, 1.5, 3.5, 4.0, 4.0, 5.0, 10.0)
+    logged = []
+    monkeypatch.setattr(phases.logutil, "info", logged.append)
+
+    phases.begin("scp_receive", 1.0)
+    with phases.span("insert"):
+        with phases.span("db_connect"):
+            pass
+    with phases.span("client"):
+        pass
+    phases.end(ok=True, files=1, bytes=20_000_000)
+
+    line = logged[0]
+    assert line.startswith("phases {")
+    assert json.loads(line.split(" ", 1)[1]) == {
+        "kind": "scp_receive",
+        "ok": True,
+        "files": 1,
+        "bytes": 20_000_000,
+        "seconds": 10.0,
+        "mb_per_s": 2.0,
+        "phases": {"client": 1.0, "db_connect": 2.0, "insert": 1.0},
+    }
+    assert phases.current() is phases.OFF
+
+
+def test_unsampled_sessions_record_nothing(monkeypatch):
+    logged = []
+    monkeypatch.setattr(phases.logutil, "info", logged.append)
+
+    assert phases.begin("scp_send", 0.0) is phases.OFF
+    with phases.span("lookup"):
+        phases.add("hash", 1.0)
+    phases.end(ok=True)
+
+    assert logged == []
+
+
+def test_sampling_rate(monkeypatch):
+    monkeypatch.setattr(phases.os, "urandom", lambda n: b"\x00\x80")  # 0.5
+    assert not phases._sampled(0.5)
+    assert phases._sampled(0.6)
+    assert phases._sampled(1.0)
+    assert not phases._sampled(0)
+
+
+def test_summary_of_an_instant_session(monkeypatch):
+    _clock(monkeypatch, 3.0, 3.0)
+    assert phases.Timer("x").summary()["mb_per_s"] == 0.0
+
+
+def test_sample_from_env(monkeypatch):
+    monkeypatch.delenv("GATEWAY_PHASE_SAMPLE", raising=False)
+    assert phases.sample_from_env() == phases.DEFAULT_SAMPLE
+    monkeypatch.setenv("GATEWAY_PHASE_SAMPLE", "0.05")
+    assert phases.sample_from_env() == 0.05
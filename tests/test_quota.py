@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+
+import pytest
+
+from app import quota
+
+BLOB = b"\x00\x00\x00\x0bssh-ed25519" + b"k" * 36
+B64 = base64.b64encode(BLOB).decode()
+FP = "SHA256:" + base64.b64encode(hashlib.sha256(BLOB).digest()).decode().rstrip("=")
+
+
+def test_fingerprint_matches_ssh_keygen_format():
+    text = f"password\npublickey ssh-ed25519 !!!\npublickey ssh-ed25519 {B64}\n"
+    assert quota.fingerprint(text) == FP
+    assert len(FP) == len("SHA256:") + 43
+    assert quota.fingerprint("password\n") == ""
+
+
+def test_key_from_env(monkeypatch, tmp_path):
+    monkeypatch.delenv("SSH_USER_AUTH", raising=False)
+    assert quota.key_from_env() == ""
+
+    auth = tmp_path / "auth"
+    monkeypatch.setenv("SSH_USER_AUTH", str(auth))
+    assert quota.key_from_env() == ""
+    auth.write_text(f"publickey ssh-ed25519 {B64}\n")
+    assert quota.key_from_env() == FP
+
+
+def test_limits_from_env(monkeypatch):
+    for name in ("KEY_QUOTA_MB", "KEY_QUOTA_SESSIONS", "KEY_QUOTA_WINDOW_SECONDS"):
+        monkeypatch.delenv(name, raising=False)
+    assert not quota.limits_from_env().enabled
+
+    monkeypatch.setenv("KEY_QUOTA_MB", "5")
+    monkeypatch.setenv("KEY_QUOTA_SESSIONS", "10")
+    monkeypatch.setenv("KEY_QUOTA_WINDOW_SECONDS", "60")
+    limits = quota.limits_from_env()
+    assert limits == quota.Limits(bytes=5 * 1024 * 1024, sessions=10, window_seconds=60)
+    assert limits.describe() == "5 MB and 10 sessions per 60s"
+
+
+def test_charge_applies_only_budgets_that_are_set(monkeypatch):
+    calls = []
+
+    def charge_key(key, sessions, size, **kw):
+        calls.append((key, sessions, size, kw["max_sessions"], kw["max_bytes"]))
+        return size < 100
+
+    monkeypatch.setattr(quota.db, "charge_key", charge_key)
+    limits = quota.Limits(sessions=3)
+
+    quota.charge(FP, quota.Limits(), sessions=1)
+    quota.charge("", limits, sessions=1)
+    assert calls == []
+
+    quota.charge(FP, limits, sessions=1)
+    assert calls == [(FP, 1, 0, 3, quota._UNLIMITED)]
+    with pytest.raises(quota.OverQuota, match="3 sessions per 86400s"):
+        quota.charge(FP, limits, size=500)
+
+
+def test_charge_refuses_what_could_never_fit_without_the_db(monkeypatch):
+    monkeypatch.setattr(quota.db, "charge_key", lambda *a, **kw: pytest.fail("asked the db"))
+    with pytest.raises(quota.OverQuota):
+        quota.charge(FP, quota.Limits(bytes=1024), size=2048)
+
+
+def test_refund_gives_back_charges_best_effort(monkeypatch, capsys):
+    calls = []
+
+    def refund_key(key, sessions, size):
+        if size > 100:
+            raise RuntimeError("db down")
+        calls.append((key, sessions, size))
+
+    monkeypatch.setattr(quota.db, "refund_key", refund_key)
+    limits = quota.Limits(bytes=1024)
+
+    quota.refund(FP, quota.Limits(), size=10)
+    quota.refund("", limits, size=10)
+    quota.refund(FP, limits)
+    assert calls == []
+
+    quota.refund(FP, limits, size=10)
+    assert calls == [(FP, 0, 10)]
+    quota.refund(FP, limits, size=500)
+    assert "quota: refund failed" in capsys.readouterr().err
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from app import segments
+
+HOUR = segments.BUCKET_SECONDS
+
+
+@pytest.fixture(autouse=True)
+def fresh(monkeypatch):
+    monkeypatch.setattr(segments, "_last", (0, 0))
+    yield
+    segments.release()
+
+
+def test_max_item_from_env(monkeypatch):
+    monkeypatch.delenv("DATA_SEGMENT_MAX_KB", raising=False)
+    assert segments.max_item_from_env() == 0
+    monkeypatch.setenv("DATA_SEGMENT_MAX_KB", "64")
+    assert segments.max_item_from_env() == 64 * 1024
+
+
+def test_append_packs_payloads_back_to_back(tmp_path):
+    first = segments.append(tmp_path, b"hello", now=10 * HOUR + 5)
+    second = segments.append(tmp_path, b"world!", now=10 * HOUR + 9)
+
+    path = tmp_path / "segments" / f"{10 * HOUR}-0"
+    assert first == (path, 0)
+    assert second == (path, 5)
+    assert path.read_bytes() == b"helloworld!"
+
+
+def test_append_rotates_full_segments_and_buckets(tmp_path, monkeypatch):
+    monkeypatch.setattr(segments, "SEGMENT_BYTES", 8)
+    segments.append(tmp_path, b"12345", now=HOUR)
+    path, offset = segments.append(tmp_path, b"6789", now=HOUR)
+    assert (path.name, offset) == (f"{HOUR}-1", 0)
+    # The next append starts at the segment this process rotated to.
+    assert segments.append(tmp_path, b"ab", now=HOUR)[0].name == f"{HOUR}-1"
+    # Oversized payloads still get stored, alone in an empty segment.
+    path, offset = segments.append(tmp_path, b"x" * 20, now=HOUR)
+    assert (path.name, offset) == (f"{HOUR}-2", 0)
+    assert segments.append(tmp_path, b"new", now=2 * HOUR)[0].name == f"{2 * HOUR}-0"
+
+
+def test_closed_segments_wait_for_grace(tmp_path):
+    assert segments.closed_segments(tmp_path, 0) == []
+    for now in (HOUR, 3 * HOUR):
+        segments.append(tmp_path, b"x", now=now)
+    (tmp_path / "segments" / "stray").write_bytes(b"")
+
+    now = 4 * HOUR + segments.GRACE_SECONDS
+    closed = segments.closed_segments(tmp_path, now)
+    assert [p.name for p in closed] == [f"{HOUR}-0", f"{3 * HOUR}-0"]
+    assert [p.name for p in segments.closed_segments(tmp_path, now - 1)] == [f"{HOUR}-0"]
+
+
+def test_appended_segments_stay_leased_until_released(tmp_path):
+    path, _ = segments.append(tmp_path, b"unrecorded", now=HOUR)
+    assert segments.append(tmp_path, b"more", now=HOUR)[0] == path
+    assert segments.lease_path(path).name == f"{HOUR}-0.lease"
+    assert segments.lock_idle(path) is None
+
+    segments.release()
+
+    fd = segments.lock_idle(path)
+    assert fd is not None
+    # Held exclusively until the cleaner is done with the segment.
+    assert segments.lock_idle(path) is None
+    os.close(fd)
+
+
+def test_compact_copies_live_entries(tmp_path, monkeypatch):
+    old, _ = segments.append(tmp_path, b"deadLIVEdeadMORE", now=HOUR)
+    monkeypatch.setattr(segments.time, "time", lambda: 5 * HOUR)
+
+    moves = segments.compact(tmp_path, old, [("a", 4, 4), ("b", 12, 4)])
+
+    new = tmp_path / "segments" / f"{5 * HOUR}-0"
+    assert moves == [("a", str(new), 0), ("b", str(new), 4)]
+    assert new.read_bytes() == b"LIVEMORE"
+    assert os.path.exists(old)
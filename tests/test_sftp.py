@@ -0,0 +1,649 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+import shutil
+import struct
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app import bloom, gateway, quota, sftp, shaping, store
+
+NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def _str(value: bytes | str) -> bytes:
+    if isinstance(value, str):
+        value = value.encode()
+    return struct.pack(">I", len(value)) + value
+
+
+def _pkt(kind: int, req_id: int | None, *parts: bytes) -> bytes:
+    body = bytes((kind,)) + (b"" if req_id is None else struct.pack(">I", req_id)) + b"".join(parts)
+    return struct.pack(">I", len(body)) + body
+
+
+def _u32(v: int) -> bytes:
+    return struct.pack(">I", v)
+
+
+def _u64(v: int) -> bytes:
+    return struct.pack(">Q", v)
+
+
+def _replies(data: bytes) -> dict[int, tuple[int, bytes]]:
+    # req_id -> (type, rest); VERSION is keyed as -1.
+    out = {}
+    pos = 0
+    while pos < len(data):
+        n = struct.unpack_from(">I", data, pos)[0]
+        body = data[pos + 4 : pos + 4 + n]
+        pos += 4 + n
+        if body[0] == sftp.FXP_VERSION:
+            out[-1] = (body[0], body[1:])
+        else:
+            out[struct.unpack_from(">I", body, 1)[0]] = (body[0], body[5:])
+    return out
+
+
+def _status(reply: tuple[int, bytes]) -> int:
+    assert reply[0] == sftp.FXP_STATUS
+    return struct.unpack_from(">I", reply[1])[0]
+
+
+def _handle(reply: tuple[int, bytes]) -> bytes:
+    assert reply[0] == sftp.FXP_HANDLE
+    return reply[1][4:]
+
+
+def _serve(monkeypatch, tmp_path, mode, *requests, conf=None):
+    conf = conf or gateway.Config(data_dir=tmp_path, ttl_days=1)
+    stderr = io.StringIO()
+    monkeypatch.setattr(sys, "stderr", stderr)
+    wfile = io.BytesIO()
+    server = sftp.SftpServer(conf, mode, io.BytesIO(b"".join(requests)), wfile)
+    server.serve()
+    return server, _replies(wfile.getvalue()), stderr.getvalue()
+
+
+@pytest.fixture
+def db_fakes(monkeypatch):
+    inserted = []
+    monkeypatch.setattr(store, "insert_files", lambda recs: inserted.extend(recs) or [])
+    monkeypatch.setattr(store, "utcnow", lambda: NOW)
+    monkeypatch.setattr(sftp, "utcnow", lambda: NOW)
+    return inserted
+
+
+def test_put_flow_accepts_out_of_order_writes(monkeypatch, tmp_path, db_fakes):
+    monkeypatch.setattr(store, "new_token", lambda: "tok1")
+    open_req = _pkt(sftp.FXP_OPEN, 4, _str("/dir/../a.txt"), _u32(0x1A), _u32(0))
+    handle = b"1"
+    server, replies, stderr = _serve(
+        monkeypatch,
+        tmp_path,
+        "put",
+        _pkt(sftp.FXP_INIT, None, _u32(3)),
+        _pkt(sftp.FXP_REALPATH, 1, _str(".")),
+        _pkt(sftp.FXP_STAT, 2, _str("/")),
+        _pkt(sftp.FXP_STAT, 3, _str("/a.txt")),
+        open_req,
+        _pkt(sftp.FXP_WRITE, 5, _str(handle), _u64(5), _str(b"world")),
+        _pkt(sftp.FXP_WRITE, 6, _str(handle), _u64(0), _str(b"hello")),
+        _pkt(sftp.FXP_FSTAT, 7, _str(handle)),
+        _pkt(sftp.FXP_FSETSTAT, 8, _str(handle), _u32(0)),
+        _pkt(sftp.FXP_CLOSE, 9, _str(handle)),
+    )
+
+    assert replies[-1] == (sftp.FXP_VERSION, _u32(3) + _str("limits@openssh.com") + _str("1"))
+    assert replies[1] == (sftp.FXP_NAME, _u32(1) + _str("/") + _str("/") + _u32(0))
+    assert replies[2] == (sftp.FXP_ATTRS, sftp._DIR_ATTRS)
+    assert _status(replies[3]) == sftp.FX_NO_SUCH_FILE
+    assert _handle(replies[4]) == handle
+    assert _status(replies[5]) == _status(replies[6]) == sftp.FX_OK
+    assert replies[7][0] == sftp.FXP_ATTRS
+    assert struct.unpack_from(">Q", replies[7][1], 4)[0] == 10
+    assert _status(replies[8]) == _status(replies[9]) == sftp.FX_OK
+
+    (record,) = db_fakes
+    assert server.receipts == [record]
+    assert record.token == "tok1" and record.original_name == "a.txt"
+    assert record.sha512 == hashlib.sha512(b"helloworld").hexdigest()
+    assert (tmp_path / "tok1").read_bytes() == b"helloworld"
+    assert "token=tok1" in stderr
+
+
+def test_put_sequential_writes_hash_while_streaming(monkeypatch, tmp_path, db_fakes):
+    monkeypatch.setattr(store, "new_token", lambda: "tok1")
+    monkeypatch.setattr(sftp, "open", lambda *a: pytest.fail("re-read upload"), raising=False)
+    _serve(
+        monkeypatch,
+        tmp_path,
+        "put",
+        _pkt(sftp.FXP_OPEN, 1, _str("a"), _u32(0x1A), _u32(0)),
+        _pkt(sftp.FXP_WRITE, 2, _str(b"1"), _u64(0), _str(b"ab")),
+        _pkt(sftp.FXP_WRITE, 3, _str(b"1"), _u64(2), _str(b"cd")),
+        _pkt(sftp.FXP_CLOSE, 4, _str(b"1")),
+    )
+
+    assert db_fakes[0].sha512 == hashlib.sha512(b"abcd").hexdigest()
+
+
+def test_put_charges_writes_against_the_key_budget(monkeypatch, tmp_path, db_fakes):
+    monkeypatch.setattr(store, "new_token", iter(["t1", "t2"]).__next__)
+    charged = []
+
+    def charge_key(key, sessions, size, **_kw):
+        charged.append(size)
+        return sum(charged) <= 6
+
+    monkeypatch.setattr(quota.db, "charge_key", charge_key)
+    refunded = []
+    monkeypatch.setattr(quota.db, "refund_key", lambda key, sessions, size: refunded.append(size))
+    conf = gateway.Config(
+        data_dir=tmp_path, ttl_days=1, key="SHA256:k", quota=quota.Limits(bytes=1024)
+    )
+    _, replies, _ = _serve(
+        monkeypatch,
+        tmp_path,
+        "put",
+        _pkt(sftp.FXP_OPEN, 1, _str("a"), _u32(0x1A), _u32(0)),
+        _pkt(sftp.FXP_WRITE, 2, _str(b"1"), _u64(0), _str(b"abcd")),
+        # Rewriting what is already charged costs nothing.
+        _pkt(sftp.FXP_WRITE, 3, _str(b"1"), _u64(0), _str(b"ab")),
+        _pkt(sftp.FXP_CLOSE, 4, _str(b"1")),
+        _pkt(sftp.FXP_OPEN, 5, _str("b"), _u32(0x1A), _u32(0)),
+        _pkt(sftp.FXP_WRITE, 6, _str(b"2"), _u64(0), _str(b"ab")),
+        _pkt(sftp.FXP_WRITE, 7, _str(b"2"), _u64(2), _str(b"cd")),
+        _pkt(sftp.FXP_CLOSE, 8, _str(b"2")),
+        conf=conf,
+    )
+
+    assert [_status(replies[i]) for i in range(2, 5)] == [sftp.FX_OK] * 3
+    assert _status(replies[6]) == sftp.FX_OK
+    assert _status(replies[7]) == sftp.FX_FAILURE
+    assert b"quota exceeded" in replies[7][1]
+    # The refused upload is dropped, not stored short.
+    assert _status(replies[8]) == sftp.FX_FAILURE
+    assert charged == [4, 2, 2]
+    # The dropped upload gives back the 2 bytes its first write was charged.
+    assert refunded == [2]
+    assert [r.token for r in db_fakes] == ["t1"]
+    assert sorted(os.listdir(tmp_path)) == ["t1"]
+
+
+def _budget(monkeypatch):
+    # One key's bytes in use, as charge_key and refund_key keep them.
+    used = [0]
+
+    def charge_key(key, sessions, size, *, max_bytes, **_kw):
+        if used[0] + size > max_bytes:
+            return False
+        used[0] += size
+        return True
+
+    def refund_key(key, sessions, size):
+        used[0] -= size
+
+    monkeypatch.setattr(quota.db, "charge_key", charge_key)
+    monkeypatch.setattr(quota.db, "refund_key", refund_key)
+    return used
+
+
+def test_put_refunds_uploads_that_are_not_stored(monkeypatch, tmp_path, db_fakes):
+    used = _budget(monkeypatch)
+    conf = gateway.Config(
+        data_dir=tmp_path, ttl_days=1, key="SHA256:k", quota=quota.Limits(bytes=1024)
+    )
+    open_a = _pkt(sftp.FXP_OPEN, 1, _str("a"), _u32(0x1A), _u32(0))
+    write = _pkt(sftp.FXP_WRITE, 2, _str(b"1"), _u64(0), _str(b"abcd"))
+
+    # The client disconnects mid-upload, without closing it.
+    _serve(monkeypatch, tmp_path, "put", open_a, write, conf=conf)
+    assert used == [0]
+
+    def db_down(_records):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(store, "insert_files", db_down)
+    _, replies, _ = _serve(
+        monkeypatch, tmp_path, "put", open_a, write, _pkt(sftp.FXP_CLOSE, 3, _str(b"1")), conf=conf
+    )
+    assert _status(replies[3]) == sftp.FX_FAILURE
+    assert used == [0]
+
+    def no_space(*_a, **_kw):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(store, "store_upload", no_space)
+    _, replies, _ = _serve(
+        monkeypatch, tmp_path, "put", open_a, write, _pkt(sftp.FXP_CLOSE, 3, _str(b"1")), conf=conf
+    )
+    assert _status(replies[3]) == sftp.FX_FAILURE
+    assert used == [0]
+    assert [p for p in tmp_path.rglob("*") if p.is_file()] == []
+
+
+def test_put_write_checks_space_and_offset(monkeypatch, tmp_path, db_fakes):
+    monkeypatch.setattr(store, "new_token", iter(["t1", "t2"]).__next__)
+    checked = []
+
+    def check_space(data_dir, size, reserve):
+        checked.append(size)
+        if size > 100:
+            raise sftp.allocate.NoSpace("not enough space")
+
+    monkeypatch.setattr(sftp.allocate, "check_space", check_space)
+    _, replies, _ = _serve(
+        monkeypatch,
+        tmp_path,
+        "put",
+        _pkt(sftp.FXP_OPEN, 1, _str("a"), _u32(0x1A), _u32(0)),
+        _pkt(sftp.FXP_WRITE, 2, _str(b"1"), _u64(0), _str(b"ab")),
+        # A sparse write is charged for the hole it leaves too.
+        _pkt(sftp.FXP_WRITE, 3, _str(b"1"), _u64(1 << 20), _str(b"cd")),
+        _pkt(sftp.FXP_OPEN, 4, _str("b"), _u32(0x1A), _u32(0)),
+        _pkt(sftp.FXP_WRITE, 5, _str(b"2"), _u64(sftp.MAX_FILE_SIZE), _str(b"x")),
+        _pkt(sftp.FXP_WRITE, 6, _str(b"2"), _u64(0), _str(b"x")),
+    )
+
+    assert _status(replies[2]) == sftp.FX_OK
+    assert _status(replies[3]) == sftp.FX_FAILURE
+    assert b"not enough space" in replies[3][1]
+    assert _status(replies[5]) == sftp.FX_FAILURE
+    assert b"largest file size" in replies[5][1]
+    assert replies[6][1].startswith(_u32(sftp.FX_FAILURE) + _str("invalid handle"))
+    assert checked == [2, 1 << 20]
+    assert db_fakes == []
+    assert os.listdir(tmp_path) == []
+
+
+def test_open_refuses_handles_past_the_limit(monkeypatch, tmp_path, db_fakes):
+    monkeypatch.setattr(sftp, "MAX_HANDLES", 2)
+    _, replies, _ = _serve(
+        monkeypatch,
+        tmp_path,
+        "put",
+        _pkt(sftp.FXP_OPEN, 1, _str("a"), _u32(0x1A), _u32(0)),
+        _pkt(sftp.FXP_OPENDIR, 2, _str("/")),
+        _pkt(sftp.FXP_OPEN, 3, _str("b"), _u32(0x1A), _u32(0)),
+        _pkt(sftp.FXP_OPENDIR, 4, _str("/")),
+        _pkt(sftp.FXP_CLOSE, 5, _str(b"2")),
+        _pkt(sftp.FXP_OPEN, 6, _str("c"), _u32(0x1A), _u32(0)),
+    )
+
+    assert _handle(replies[1]) == b"1" and _handle(replies[2]) == b"2"
+    assert _status(replies[3]) == _status(replies[4]) == sftp.FX_FAILURE
+    assert b"too many open handles" in replies[3][1]
+    assert _handle(replies[6]) == b"3"
+    # Never closed, so never stored.
+    assert db_fakes == []
+    assert [p for p in tmp_path.rglob("*") if p.is_file()] == []
+
+
+def test_limits_extension_reports_request_sizes(monkeypatch, tmp_path):
+    _, replies, _ = _serve(
+        monkeypatch,
+        tmp_path,
+        "get",
+        _pkt(sftp.FXP_EXTENDED, 1, _str("limits@openssh.com")),
+        _pkt(sftp.FXP_EXTENDED, 2, _str("posix-rename@openssh.com"), _str("/a"), _str("/b")),
+    )
+
+    kind, body = replies[1]
+    assert kind == sftp.FXP_EXTENDED_REPLY
+    assert struct.unpack(">QQQQ", body) == (
+        sftp.MAX_PACKET,
+        sftp.MAX_READ,
+        sftp.MAX_WRITE,
+        sftp.MAX_HANDLES,
+    )
+    assert _status(replies[2]) == sftp.FX_OP_UNSUPPORTED
+
+
+def test_put_rejects_reads_and_bad_requests(monkeypatch, tmp_path, db_fakes):
+    server, replies, _ = _serve(
+        monkeypatch,
+        tmp_path,
+        "put",
+        _pkt(sftp.FXP_OPEN, 1, _str("/a"), _u32(sftp.FXF_READ), _u32(0)),
+        _pkt(sftp.FXP_OPEN, 2, _str("/"), _u32(sftp.FXF_WRITE), _u32(0)),
+        _pkt(sftp.FXP_OPEN, 3, _str("/a"), _u32(sftp.FXF_WRITE), _u32(0)),
+        _pkt(sftp.FXP_READ, 4, _str(b"1"), _u64(0), _u32(10)),
+        _pkt(sftp.FXP_READ, 5, _str(b"nope"), _u64(0), _u32(10)),
+        _pkt(sftp.FXP_CLOSE, 6, _str(b"nope")),
+        _pkt(13, 7, _str("/a")),
+        _pkt(sftp.FXP_STAT, 8, _u32(99)),
+        _pkt(sftp.FXP_OPENDIR, 9, _str("/")),
+        _pkt(sftp.FXP_READDIR, 10, _str(b"2")),
+        _pkt(sftp.FXP_FSTAT, 11, _str(b"2")),
+        _pkt(sftp.FXP_CLOSE, 12, _str(b"2")),
+        _pkt(sftp.FXP_OPENDIR, 13, _str("/x")),
+        _pkt(sftp.FXP_SETSTAT, 14, _str("/a"), _u32(0)),
+    )
+
+    assert _status(replies[1]) == sftp.FX_PERMISSION_DENIED
+    assert _status(replies[2]) == sftp.FX_FAILURE
+    assert _status(replies[4]) == sftp.FX_PERMISSION_DENIED
+    assert _status(replies[5]) == sftp.FX_FAILURE
+    assert _status(replies[6]) == sftp.FX_FAILURE
+    assert _status(replies[7]) == sftp.FX_OP_UNSUPPORTED
+    assert _status(replies[8]) == sftp.FX_BAD_MESSAGE
+    assert _status(replies[10]) == sftp.FX_EOF
+    assert replies[11] == (sftp.FXP_ATTRS, sftp._DIR_ATTRS)
+    assert _status(replies[12]) == sftp.FX_OK
+    assert _status(replies[13]) == sftp.FX_NO_SUCH_FILE
+    assert _status(replies[14]) == sftp.FX_OK
+    # The upload opened by request 3 was never closed: discarded, no row.
+    assert db_fakes == [] and server.receipts == []
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_put_close_failures_leave_no_files(monkeypatch, tmp_path, db_fakes):
+    def db_down(_records):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(store, "insert_files", db_down)
+    _, replies, _ = _serve(
+        monkeypatch,
+        tmp_path,
+        "put",
+        _pkt(sftp.FXP_OPEN, 1, _str("a"), _u32(sftp.FXF_WRITE), _u32(0)),
+        _pkt(sftp.FXP_CLOSE, 2, _str(b"1")),
+    )
+    assert _status(replies[2]) == sftp.FX_FAILURE
+    # A segment entry without a row is given up to the cleaner.
+    _, replies, _ = _serve(
+        monkeypatch,
+        tmp_path,
+        "put",
+        _pkt(sftp.FXP_OPEN, 1, _str("a"), _u32(sftp.FXF_WRITE), _u32(0)),
+        _pkt(sftp.FXP_WRITE, 2, _str(b"1"), _u64(0), _str(b"hey")),
+        _pkt(sftp.FXP_CLOSE, 3, _str(b"1")),
+        conf=gateway.Config(data_dir=tmp_path, ttl_days=1, segment_max=8000),
+    )
+    assert _status(replies[3]) == sftp.FX_FAILURE
+    assert gateway.segments._leases == {}
+    shutil.rmtree(tmp_path / "segments")
+
+    def no_space(*_a, **_kw):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(store, "store_upload", no_space)
+    _, replies, _ = _serve(
+        monkeypatch,
+        tmp_path,
+        "put",
+        _pkt(sftp.FXP_OPEN, 1, _str("a"), _u32(sftp.FXF_WRITE), _u32(0)),
+        _pkt(sftp.FXP_CLOSE, 2, _str(b"1")),
+    )
+    assert _status(replies[2]) == sftp.FX_FAILURE
+    assert [p for p in tmp_path.rglob("*") if p.is_file()] == []
+
+
+def test_close_keeps_original_error_when_tmp_is_gone(monkeypatch, tmp_path, db_fakes):
+    def lost(conf, token, tmp_path, *_a, **_kw):
+        os.unlink(tmp_path)
+        raise OSError(5, "I/O error")
+
+    monkeypatch.setattr(store, "store_upload", lost)
+    _, replies, _ = _serve(
+        monkeypatch,
+        tmp_path,
+        "put",
+        _pkt(sftp.FXP_OPEN, 1, _str("a"), _u32(sftp.FXF_WRITE), _u32(0)),
+        _pkt(sftp.FXP_CLOSE, 2, _str(b"1")),
+    )
+
+    assert _status(replies[2]) == sftp.FX_FAILURE
+
+
+def _get_row(monkeypatch, path, *, expires=NOW + timedelta(days=1)):
+    row = gateway.FileRecord("tok", "sha", "orig.txt", 5, str(path), NOW, expires)
+    monkeypatch.setattr(sftp, "get_file_by_token", lambda token: row if token == "tok" else None)
+
+
+def test_get_flow_serves_pipelined_reads(monkeypatch, tmp_path, db_fakes):
+    path = tmp_path / "stored"
+    path.write_bytes(b"hello")
+    _get_row(monkeypatch, path)
+
+    _, replies, _ = _serve(
+        monkeypatch,
+        tmp_path,
+        "get",
+        _pkt(sftp.FXP_LSTAT, 1, _str("/tok")),
+        _pkt(sftp.FXP_OPEN, 2, _str("/tok"), _u32(sftp.FXF_READ), _u32(0)),
+        _pkt(sftp.FXP_READ, 3, _str(b"1"), _u64(3), _u32(100)),
+        _pkt(sftp.FXP_READ, 4, _str(b"1"), _u64(0), _u32(3)),
+        _pkt(sftp.FXP_READ, 5, _str(b"1"), _u64(5), _u32(3)),
+        _pkt(sftp.FXP_WRITE, 6, _str(b"1"), _u64(0), _str(b"x")),
+        _pkt(sftp.FXP_FSTAT, 7, _str(b"1")),
+        _pkt(sftp.FXP_CLOSE, 8, _str(b"1")),
+        _pkt(sftp.FXP_STAT, 9, _str("/other")),
+        _pkt(sftp.FXP_OPEN, 10, _str("/tok"), _u32(sftp.FXF_WRITE), _u32(0)),
+    )
+
+    assert replies[1] == (sftp.FXP_ATTRS, sftp._file_attrs(5, int(NOW.timestamp())))
+    assert replies[3] == (sftp.FXP_DATA, _str(b"lo"))
+    assert replies[4] == (sftp.FXP_DATA, _str(b"hel"))
+    assert _status(replies[5]) == sftp.FX_EOF
+    assert _status(replies[6]) == sftp.FX_PERMISSION_DENIED
+    assert struct.unpack_from(">Q", replies[7][1], 4)[0] == 5
+    assert _status(replies[8]) == sftp.FX_OK
+    assert _status(replies[9]) == sftp.FX_NO_SUCH_FILE
+    assert _status(replies[10]) == sftp.FX_PERMISSION_DENIED
+
+
+def test_shaped_transfers_pace_every_read_and_write(monkeypatch, tmp_path, db_fakes):
+    path = tmp_path / "stored"
+    path.write_bytes(b"hello")
+    _get_row(monkeypatch, path)
+    monkeypatch.setattr(store, "new_token", lambda: "up")
+    paced = []
+
+    def pacer(limits, data_dir, size):
+        return lambda n: paced.append((size, n))
+
+    monkeypatch.setattr(shaping, "pacer", pacer)
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, shaping=shaping.Limits(1, 1))
+    for mode, *requests in (
+        ("get", _pkt(sftp.FXP_OPEN, 1, _str("/tok"), _u32(sftp.FXF_READ), _u32(0))),
+        ("put", _pkt(sftp.FXP_OPEN, 1, _str("a"), _u32(sftp.FXF_WRITE), _u32(0))),
+    ):
+        data = _pkt(sftp.FXP_READ, 2, _str(b"1"), _u64(0), _u32(4))
+        if mode == "put":
+            data = _pkt(sftp.FXP_WRITE, 2, _str(b"1"), _u64(0), _str(b"abc"))
+        _serve(monkeypatch, tmp_path, mode, *requests, data, conf=conf)
+
+    # Downloads are sized up front; SFTP uploads are not, so they count as bulk.
+    assert paced == [(5, 4), (-1, 3)]
+
+
+def test_put_compresses_and_get_decodes(monkeypatch, tmp_path, db_fakes):
+    monkeypatch.setattr(store, "new_token", lambda: "tok")
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, codec="lzma")
+    half = b"ab" * 2000
+    _serve(
+        monkeypatch,
+        tmp_path,
+        "put",
+        _pkt(sftp.FXP_OPEN, 1, _str("a"), _u32(sftp.FXF_WRITE), _u32(0)),
+        _pkt(sftp.FXP_WRITE, 2, _str(b"1"), _u64(len(half)), _str(half)),
+        _pkt(sftp.FXP_WRITE, 3, _str(b"1"), _u64(0), _str(half)),
+        _pkt(sftp.FXP_CLOSE, 4, _str(b"1")),
+        conf=conf,
+    )
+
+    (record,) = db_fakes
+    assert record.codec == "lzma" and record.size_bytes == 8000
+    assert record.sha512 == hashlib.sha512(half * 2).hexdigest()
+    assert (tmp_path / "tok").stat().st_size < 8000
+
+    monkeypatch.setattr(sftp, "get_file_by_token", lambda token: record)
+    _, replies, _ = _serve(
+        monkeypatch,
+        tmp_path,
+        "get",
+        _pkt(sftp.FXP_OPEN, 1, _str("tok"), _u32(sftp.FXF_READ), _u32(0)),
+        _pkt(sftp.FXP_READ, 2, _str(b"1"), _u64(0), _u32(5000)),
+        _pkt(sftp.FXP_READ, 3, _str(b"1"), _u64(5000), _u32(5000)),
+        _pkt(sftp.FXP_READ, 4, _str(b"1"), _u64(8000), _u32(5000)),
+        _pkt(sftp.FXP_CLOSE, 5, _str(b"1")),
+        conf=conf,
+    )
+
+    assert replies[2] == (sftp.FXP_DATA, _str((half * 2)[:5000]))
+    assert replies[3] == (sftp.FXP_DATA, _str((half * 2)[5000:]))
+    assert _status(replies[4]) == sftp.FX_EOF
+    assert _status(replies[5]) == sftp.FX_OK
+
+
+def test_small_uploads_go_to_a_segment(monkeypatch, tmp_path, db_fakes):
+    monkeypatch.setattr(store, "new_token", iter(["t1", "t2"]).__next__)
+    monkeypatch.setattr(gateway.segments, "_last", (0, 0))
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, codec="lzma", segment_max=8000)
+    text = b"ab" * 3000
+    _serve(
+        monkeypatch,
+        tmp_path,
+        "put",
+        _pkt(sftp.FXP_OPEN, 1, _str("a"), _u32(sftp.FXF_WRITE), _u32(0)),
+        _pkt(sftp.FXP_WRITE, 2, _str(b"1"), _u64(0), _str(b"hey")),
+        _pkt(sftp.FXP_CLOSE, 3, _str(b"1")),
+        _pkt(sftp.FXP_OPEN, 4, _str("b"), _u32(sftp.FXF_WRITE), _u32(0)),
+        _pkt(sftp.FXP_WRITE, 5, _str(b"2"), _u64(0), _str(text)),
+        _pkt(sftp.FXP_CLOSE, 6, _str(b"2")),
+        conf=conf,
+    )
+
+    plain, packed = db_fakes
+    assert plain.stored_path == packed.stored_path
+    assert (plain.seg_offset, plain.seg_length, plain.codec) == (0, 3, "none")
+    assert (packed.seg_offset, packed.codec) == (3, "lzma")
+    assert [p.name for p in tmp_path.iterdir()] == ["segments"]
+
+    records = {r.token: r for r in db_fakes}
+    monkeypatch.setattr(sftp, "get_file_by_token", records.get)
+    _, replies, _ = _serve(
+        monkeypatch,
+        tmp_path,
+        "get",
+        _pkt(sftp.FXP_OPEN, 1, _str("t1"), _u32(sftp.FXF_READ), _u32(0)),
+        _pkt(sftp.FXP_READ, 2, _str(b"1"), _u64(1), _u32(100)),
+        _pkt(sftp.FXP_READ, 3, _str(b"1"), _u64(3), _u32(100)),
+        _pkt(sftp.FXP_OPEN, 4, _str("t2"), _u32(sftp.FXF_READ), _u32(0)),
+        _pkt(sftp.FXP_READ, 5, _str(b"2"), _u64(0), _u32(10000)),
+        _pkt(sftp.FXP_READ, 6, _str(b"2"), _u64(6000), _u32(100)),
+        conf=conf,
+    )
+
+    assert replies[2] == (sftp.FXP_DATA, _str(b"ey"))
+    assert _status(replies[3]) == sftp.FX_EOF
+    assert replies[5] == (sftp.FXP_DATA, _str(text))
+    assert _status(replies[6]) == sftp.FX_EOF
+
+
+def test_get_expired_or_missing_file(monkeypatch, tmp_path, db_fakes):
+    _get_row(monkeypatch, tmp_path / "missing")
+    _, replies, _ = _serve(
+        monkeypatch, tmp_path, "get", _pkt(sftp.FXP_OPEN, 1, _str("tok"), _u32(1), _u32(0))
+    )
+    assert _status(replies[1]) == sftp.FX_NO_SUCH_FILE
+
+    _get_row(monkeypatch, tmp_path / "missing", expires=NOW)
+    _, replies, _ = _serve(monkeypatch, tmp_path, "get", _pkt(sftp.FXP_STAT, 1, _str("tok")))
+    assert _status(replies[1]) == sftp.FX_NO_SUCH_FILE
+
+
+def test_get_filter_answers_unknown_tokens(monkeypatch, tmp_path, db_fakes):
+    path = tmp_path / "stored"
+    path.write_bytes(b"hello")
+    monkeypatch.setattr(bloom, "_reader", None)
+    bloom.rebuild(tmp_path, 100, [["tok"]])
+    lookups = []
+    row = gateway.FileRecord("tok", "sha", "orig.txt", 5, str(path), NOW, NOW + timedelta(1))
+    monkeypatch.setattr(sftp, "get_file_by_token", lambda token: lookups.append(token) or row)
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1, bloom=True)
+
+    _, replies, _ = _serve(
+        monkeypatch,
+        tmp_path,
+        "get",
+        _pkt(sftp.FXP_STAT, 1, _str("/nope")),
+        _pkt(sftp.FXP_STAT, 2, _str("/tok")),
+        conf=conf,
+    )
+
+    assert _status(replies[1]) == sftp.FX_NO_SUCH_FILE
+    assert replies[2][0] == sftp.FXP_ATTRS
+    assert lookups == ["tok"]
+
+
+def test_get_rejects_directory_bundles(monkeypatch, tmp_path, db_fakes):
+    expires = NOW + timedelta(days=1)
+    row = gateway.FileRecord("tok", "sha", "top", 5, str(tmp_path), NOW, expires, bundle=True)
+    monkeypatch.setattr(sftp, "get_file_by_token", lambda token: row)
+
+    _, replies, _ = _serve(monkeypatch, tmp_path, "get", _pkt(sftp.FXP_STAT, 1, _str("tok")))
+
+    assert _status(replies[1]) == sftp.FX_OP_UNSUPPORTED
+
+
+def test_get_session_end_closes_open_downloads(monkeypatch, tmp_path, db_fakes):
+    path = tmp_path / "stored"
+    path.write_bytes(b"hello")
+    _get_row(monkeypatch, path)
+    closed = []
+    real_close = os.close
+    monkeypatch.setattr(os, "close", lambda fd: closed.append(fd) or real_close(fd))
+
+    _serve(monkeypatch, tmp_path, "get", _pkt(sftp.FXP_OPEN, 1, _str("tok"), _u32(1), _u32(0)))
+
+    assert len(closed) == 1
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        struct.pack(">I", sftp.MAX_PACKET + 1),
+        struct.pack(">I", 10) + b"\x03",
+        struct.pack(">I", 2) + bytes((sftp.FXP_OPEN, 0)),
+    ],
+)
+def test_main_fails_on_broken_framing(data, tmp_path):
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1)
+
+    assert sftp.main("put", conf, io.BytesIO(data), io.BytesIO()) == 1
+
+
+def test_main_returns_zero_on_clean_eof(tmp_path):
+    conf = gateway.Config(data_dir=tmp_path, ttl_days=1)
+
+    assert sftp.main("get", conf, io.BytesIO(b""), io.BytesIO()) == 0
+
+
+def test_gateway_dispatches_sftp_subsystem(monkeypatch, tmp_path):
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    monkeypatch.setenv("SSH_ORIGINAL_COMMAND", "/usr/lib/openssh/sftp-server -l INFO")
+    monkeypatch.setattr(sys, "argv", ["gateway.py", "get"])
+    calls = []
+    monkeypatch.setattr(sftp, "main", lambda mode, conf, r, w: calls.append(mode) or 0)
+
+    with pytest.raises(SystemExit) as exc:
+        gateway.main()
+
+    assert exc.value.code == 0
+    assert calls == ["get"]
+    assert gateway._is_sftp("internal-sftp")
+    assert not gateway._is_sftp("scp -t /")
+
+
+def test_upload_abort_tolerates_missing_tmp(tmp_path):
+    upload = sftp._Upload("tok", tmp_path / ".tok.tmp", tmp_path / "tok", "a")
+    os.unlink(tmp_path / ".tok.tmp")
+
+    upload.abort()
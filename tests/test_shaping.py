@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from app import shaping
+
+MB = 1024 * 1024
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(round(seconds, 6))
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(shaping.time, "monotonic", c.monotonic)
+    monkeypatch.setattr(shaping.time, "sleep", c.sleep)
+    monkeypatch.setattr(shaping, "_pid", 0)
+    return c
+
+
+def test_limits_from_env(monkeypatch):
+    for name in ("SHAPE_SESSION_MBPS", "SHAPE_TOTAL_MBPS", "SHAPE_SMALL_MB"):
+        monkeypatch.delenv(name, raising=False)
+    assert shaping.limits_from_env() == shaping.Limits()
+    assert not shaping.Limits().enabled
+
+    monkeypatch.setenv("SHAPE_SESSION_MBPS", "2.5")
+    monkeypatch.setenv("SHAPE_TOTAL_MBPS", "100")
+    monkeypatch.setenv("SHAPE_SMALL_MB", "1")
+    assert shaping.limits_from_env() == shaping.Limits(int(2.5 * MB), 100 * MB, MB)
+
+
+def test_unshaped_transfers_get_no_pacer(tmp_path):
+    assert shaping.pacer(shaping.Limits(), tmp_path, 10) is None
+    assert not (tmp_path / shaping.BUCKET_NAME).exists()
+
+
+def test_session_rate_holds_after_the_first_burst(tmp_path, clock):
+    pace = shaping.pacer(shaping.Limits(session_bytes_per_s=MB), tmp_path, -1)
+
+    for _ in range(3):
+        pace(MB)
+
+    # The first second's worth goes out at once, then one second per MB.
+    assert clock.slept == [1.0, 1.0]
+    assert not (tmp_path / shaping.BUCKET_NAME).exists()
+
+
+def test_bulk_transfers_leave_the_reserve_to_small_ones(tmp_path, clock):
+    limits = shaping.Limits(total_bytes_per_s=4 * MB, small_bytes=MB)
+    bulk = shaping.pacer(limits, tmp_path, 100 * MB)
+    small = shaping.pacer(limits, tmp_path, 1000)
+
+    bulk(3 * MB)
+    assert clock.slept == []
+    # Only the reserved quarter is left: bulk waits, small goes at once.
+    bulk(MB)
+    assert clock.slept == [0.25]
+    small(MB)
+    assert clock.slept == [0.25]
+
+    path = tmp_path / shaping.BUCKET_NAME
+    assert path.stat().st_mode & 0o777 == 0o660
+    # Another gateway process maps the same bucket and sees it drained.
+    other = shaping._SharedBucket(path, 4 * MB)
+    assert other.delay(MB, 0.0) == pytest.approx(0.25)
+    other.close()
+
+
+def test_bulk_chunks_larger_than_the_bucket_go_in_parts(tmp_path, clock):
+    pace = shaping.pacer(shaping.Limits(total_bytes_per_s=MB), tmp_path, -1)
+
+    pace(3 * MB)
+
+    # Bulk gets 3/4 MB of the full bucket at once, the rest at 1 MB/s.
+    assert sum(clock.slept) == pytest.approx(2.25)
+
+
+def test_buckets_are_per_process_and_follow_the_limits(tmp_path, clock, monkeypatch):
+    shaping.pacer(shaping.Limits(1, 1), tmp_path, 0)
+    local, shared = shaping._local, shaping._shared
+    shaping.pacer(shaping.Limits(1, 1), tmp_path, 0)
+    assert (shaping._local, shaping._shared) == (local, shared)
+
+    shaping.pacer(shaping.Limits(2, 2), tmp_path, 0)
+    assert shaping._local is not local and shaping._shared is not shared
+
+    monkeypatch.setattr(os, "getpid", lambda: -1)
+    shaping.pacer(shaping.Limits(2, 2), tmp_path, 0)
+    assert shaping._local.rate == 2 and shaping._pid == -1
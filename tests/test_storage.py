@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+from app import storage
+
+
+def test_token_path_flat_when_depth_zero(tmp_path):
+    assert storage.token_path(tmp_path, "tok", 0) == tmp_path / "tok"
+
+
+def test_token_path_shards_by_hash_prefix(tmp_path):
+    path = storage.token_path(tmp_path, "tok", 2)
+
+    rel = path.relative_to(tmp_path).parts
+    assert len(rel) == 3 and rel[-1] == "tok"
+    assert all(len(part) == storage.SHARD_WIDTH for part in rel[:2])
+    # Stable for a given token, so readers can recompute it.
+    assert storage.token_path(tmp_path, "tok", 2) == path
+    assert storage.token_path(tmp_path, "tok", 1) == tmp_path / rel[0] / "tok"
+
+
+def test_shard_depth_from_env(monkeypatch):
+    monkeypatch.delenv("DATA_SHARD_DEPTH", raising=False)
+    assert storage.shard_depth_from_env() == storage.DEFAULT_SHARD_DEPTH
+    assert storage.DEFAULT_SHARD_DEPTH == 0
+    monkeypatch.setenv("DATA_SHARD_DEPTH", "2")
+    assert storage.shard_depth_from_env() == 2
+
+
+def test_ensure_parent_creates_once(tmp_path, monkeypatch):
+    calls = []
+    real_mkdir = Path.mkdir
+
+    def mkdir(self, *args, **kwargs):
+        calls.append(self)
+        return real_mkdir(self, *args, **kwargs)
+
+    monkeypatch.setattr(Path, "mkdir", mkdir)
+    path = tmp_path / "ab" / "cd" / "tok"
+
+    storage.ensure_parent(path)
+    made = len(calls)
+    storage.ensure_parent(path.parent / "other")
+
+    assert path.parent.is_dir()
+    assert calls[0] == path.parent
+    assert len(calls) == made
+
+
+def test_blob_path_shards_by_digest_and_keeps_generations_apart(tmp_path):
+    digest = "abcdef" + "0" * 122
+
+    first = storage.blob_path(tmp_path, digest, "t1", 2)
+
+    assert first == tmp_path / "blobs" / "ab" / "cd" / f"{digest}.t1"
+    assert storage.blob_path(tmp_path, digest, "t2", 2) != first
+    assert storage.blob_path(tmp_path, digest, "t1", 0) == tmp_path / "blobs" / f"{digest}.t1"
+
+
+def test_dedup_from_env(monkeypatch):
+    monkeypatch.delenv("DATA_DEDUP", raising=False)
+    assert storage.dedup_from_env() is False
+    monkeypatch.setenv("DATA_DEDUP", "1")
+    assert storage.dedup_from_env() is True
@@ -6,7 +6,7 @@ from datetime import datetime, timedelta, timezone
 
 import pytest
 
-from app import cleanup_worker, gateway
+from app import cleanup_worker, gateway, store
 
 
 class DummyStdin:
@@ -20,41 +20,36 @@ class DummyStdout:
 
 
 def test_put_get_and_expire_flow(tmp_path, monkeypatch):
-    store: dict[str, dict] = {}
+    rows: dict[str, dict] = {}
 
-    def insert_file(**kwargs):
-        store[kwargs["token"]] = kwargs
+    def insert_files(records):
+        for rec in records:
+            rows[rec.token] = rec._asdict()
+        return []
 
     def get_file_by_token(token: str):
-        rec = store.get(token)
+        rec = rows.get(token)
         if not rec:
             return None
-        return (
-            rec["token"],
-            rec["sha512"],
-            rec["original_name"],
-            rec["size_bytes"],
-            rec["stored_path"],
-            rec["created_at"],
-            rec["expires_at"],
-        )
+        return gateway.FileRecord(**rec)
 
     def delete_expired(now: datetime):
         expired = []
-        for token, rec in list(store.items()):
+        for token, rec in list(rows.items()):
             if rec["expires_at"] <= now:
                 expired.append((token, rec["stored_path"]))
-                store.pop(token)
-        return expired
+                rows.pop(token)
+        yield expired
 
-    monkeypatch.setattr(gateway, "insert_file", insert_file)
+    monkeypatch.setattr(store, "insert_files", insert_files)
     monkeypatch.setattr(gateway, "get_file_by_token", get_file_by_token)
     monkeypatch.setattr(cleanup_worker, "delete_expired", delete_expired)
 
     created = datetime(2024, 1, 1, tzinfo=timezone.utc)
     monkeypatch.setattr(gateway, "utcnow", lambda: created)
+    monkeypatch.setattr(store, "utcnow", lambda: created)
     monkeypatch.setattr(cleanup_worker, "utcnow", lambda: created + timedelta(days=2))
-    monkeypatch.setattr(gateway, "_token", lambda: "tok")
+    monkeypatch.setattr(store, "new_token", lambda: "tok")
 
     # PUT (scp -t)
     payload = b"hello"
@@ -81,11 +76,13 @@ def test_put_get_and_expire_flow(tmp_path, monkeypatch):
     assert payload in out
 
     # Expire + cleanup
-    expired = cleanup_worker.delete_expired(cleanup_worker.utcnow())
-    cleanup_worker.remove_expired_files(expired)
+    for batch in cleanup_worker.delete_expired(cleanup_worker.utcnow()):
+        cleanup_worker.remove_expired_files(
+            batch, cleanup_worker.CleanupConfig(data_dir=tmp_path, interval_seconds=1)
+        )
 
     assert not (tmp_path / "tok").exists()
-    assert store == {}
+    assert rows == {}
 
 
 def test_get_wrong_token(monkeypatch, tmp_path):
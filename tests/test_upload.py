@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import hashlib
+import io
+
+import pytest
+
+from app import phases, upload
+
+
+class TrickleReader(io.RawIOBase):
+    """Returns at most `step` bytes per readinto, like a slow socket."""
+
+    def __init__(self, data: bytes, step: int):
+        self.data = io.BytesIO(data)
+        self.step = step
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        chunk = self.data.read(min(len(b), self.step))
+        b[: len(chunk)] = chunk
+        return len(chunk)
+
+
+class FailingWriter(io.BytesIO):
+    def write(self, b):
+        raise OSError("disk full")
+
+
+def test_receive_small_payload_leaves_trailing_bytes():
+    src = io.BytesIO(b"hello\x00next")
+    dst = io.BytesIO()
+
+    digest = upload.receive(src, dst, 5)
+
+    assert digest == hashlib.sha512(b"hello").hexdigest()
+    assert dst.getvalue() == b"hello"
+    assert src.read() == b"\x00next"
+
+
+def test_receive_large_payload_is_pipelined():
+    payload = bytes(range(256)) * (upload.CHUNK_SIZE * 3 // 256 + 7)
+    src = io.BufferedReader(TrickleReader(payload + b"\x00", 300_000))
+    dst = io.BytesIO()
+    paced = []
+
+    digest = upload.receive(src, dst, len(payload), paced.append)
+
+    assert digest == hashlib.sha512(payload).hexdigest()
+    assert dst.getvalue() == payload
+    assert src.read() == b"\x00"
+    assert sum(paced) == len(payload)
+
+
+@pytest.mark.parametrize("size", [10, upload.CHUNK_SIZE * 2])
+def test_receive_times_phases_when_sampled(size, monkeypatch):
+    monkeypatch.setattr(phases, "_current", phases.OFF)
+    timer = phases.begin("test", 1.0)
+
+    upload.receive(io.BytesIO(b"x" * size), io.BytesIO(), size)
+    phases.end()
+
+    assert set(timer.phases) == {"client", "hash", "write"}
+
+
+@pytest.mark.parametrize("size", [10, upload.CHUNK_SIZE * 2])
+def test_receive_short_source_raises(size):
+    with pytest.raises(EOFError):
+        upload.receive(io.BytesIO(b"x" * (size - 1)), io.BytesIO(), size)
+
+
+def test_receive_write_failure_propagates_and_frees_buffers():
+    size = upload.CHUNK_SIZE * (upload.BUFFERS + 2)
+
+    with pytest.raises(OSError, match="disk full"):
+        upload.receive(io.BytesIO(b"x" * size), FailingWriter(), size)
+
+    # All buffers were returned: the next upload does not block.
+    dst = io.BytesIO()
+    upload.receive(io.BytesIO(b"y" * size), dst, size)
+    assert dst.getvalue() == b"y" * size
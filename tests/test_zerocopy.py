@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import errno
+import io
+import os
+
+import pytest
+
+from app import zerocopy
+
+
+@pytest.fixture
+def src(tmp_path):
+    path = tmp_path / "src.bin"
+    path.write_bytes(b"0123456789" * 1000)
+    with open(path, "rb") as f:
+        yield f
+
+
+def test_send_file_to_regular_file_uses_sendfile(src, tmp_path):
+    with open(tmp_path / "out.bin", "wb") as out:
+        out.write(b"hdr")
+        assert zerocopy.send_file(src, out, 10000) == (10000, zerocopy.SENDFILE)
+        out.write(b"end")
+
+    assert (tmp_path / "out.bin").read_bytes() == b"hdr" + b"0123456789" * 1000 + b"end"
+
+
+def test_send_file_to_pipe_uses_splice(src):
+    r, w = os.pipe()
+    with os.fdopen(r, "rb") as reader, os.fdopen(w, "wb") as out:
+        src.seek(5)
+        assert zerocopy.send_file(src, out, 20) == (20, zerocopy.SPLICE)
+        assert reader.read(20) == b"56789012345678901234"
+
+
+def test_send_file_without_fileno_copies(src):
+    out = io.BytesIO()
+
+    assert zerocopy.send_file(src, out, 15) == (15, zerocopy.COPY)
+    assert out.getvalue() == b"012345678901234"
+
+
+def test_paced_send_file_reports_each_chunk(src, tmp_path, monkeypatch):
+    monkeypatch.setattr(zerocopy, "PACED_CHUNK_SIZE", 4096)
+    monkeypatch.setattr(zerocopy, "COPY_CHUNK_SIZE", 4096)
+    monkeypatch.setattr(zerocopy, "_buffer", None)
+    paced = []
+    with open(tmp_path / "out.bin", "wb") as out:
+        assert zerocopy.send_file(src, out, 10000, pace=paced.append)[0] == 10000
+    src.seek(0)
+    zerocopy.send_file(src, io.BytesIO(), 5000, pace=paced.append)
+
+    assert paced == [4096, 4096, 1808, 4096, 904]
+
+
+def test_send_file_short_source_stops_at_eof(src, tmp_path):
+    with open(tmp_path / "out.bin", "wb") as out:
+        assert zerocopy.send_file(src, out, 20000)[0] == 10000
+    assert zerocopy.send_file(src, io.BytesIO(), 20000) == (10000, zerocopy.COPY)
+
+
+def test_send_file_falls_back_when_unsupported(src, tmp_path, monkeypatch):
+    def sendfile(*_args):
+        raise OSError(errno.EINVAL, "unsupported")
+
+    monkeypatch.setattr(os, "sendfile", sendfile)
+    with open(tmp_path / "out.bin", "wb") as out:
+        assert zerocopy.send_file(src, out, 10000) == (10000, zerocopy.COPY)
+
+    assert (tmp_path / "out.bin").read_bytes() == b"0123456789" * 1000
+
+
+def test_send_file_copy_mode_and_no_sendfile(src, tmp_path, monkeypatch):
+    with open(tmp_path / "out.bin", "wb") as out:
+        assert zerocopy.send_file(src, out, 3, zerocopy.COPY) == (3, zerocopy.COPY)
+        monkeypatch.delattr(os, "sendfile")
+        assert zerocopy.send_file(src, out, 3) == (3, zerocopy.COPY)
+
+    assert (tmp_path / "out.bin").read_bytes() == b"012345"
+
+
+def test_send_file_errors_after_progress_propagate(src, tmp_path, monkeypatch):
+    calls = []
+
+    def sendfile(_out, _in, offset, count):
+        calls.append(offset)
+        if len(calls) == 1:
+            return 4
+        raise OSError(errno.EINVAL, "changed mid-transfer")
+
+    monkeypatch.setattr(os, "sendfile", sendfile)
+    with open(tmp_path / "out.bin", "wb") as out, pytest.raises(OSError):
+        zerocopy.send_file(src, out, 10, zerocopy.SENDFILE)
+
+    assert calls == [0, 4]
+
+
+def test_send_file_waits_on_nonblocking_stdout(src, tmp_path, monkeypatch):
+    real = os.sendfile
+    calls = []
+
+    def sendfile(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise BlockingIOError(errno.EAGAIN, "full")
+        return real(*args)
+
+    monkeypatch.setattr(os, "sendfile", sendfile)
+    with open(tmp_path / "out.bin", "wb") as out:
+        assert zerocopy.send_file(src, out, 10) == (10, zerocopy.SENDFILE)
+
+    assert len(calls) == 2
+
+
+def test_send_file_rejects_unknown_mode(src):
+    with pytest.raises(ValueError):
+        zerocopy.send_file(src, io.BytesIO(), 1, "mmap")